@@ -0,0 +1,439 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+benchmarks.py
+
+Benchmark suite for the hot paths of the model: network response, likelihood, sampling,
+EM fits, bootstrap, marginal inverse Fisher Information, dataset generation and DataPBS loading.
+
+Sizes and seeds are fixed, so that runs can be compared. Results are written as JSON,
+and can be compared to a saved baseline. Everything runs offline, no data files needed:
+
+    python benchmarks.py                                  # run everything, print the timings
+    python benchmarks.py --save_baseline                  # run and save as the new baseline
+    python benchmarks.py --only em_fit --repeats 5        # run the benchmarks whose name contain em_fit
+    python benchmarks.py --output results.json --baseline Data/benchmarks/baseline.json
+
+Created by Loic Matthey on 2015-08-10.
+Copyright (c) 2015 Gatsby Unit. All rights reserved.
+"""
+
+import os
+import sys
+import time
+import json
+import shutil
+import tempfile
+import argparse
+import platform
+import subprocess
+import collections
+
+import numpy as np
+import scipy
+
+import utils
+import em_circularmixture
+import em_circularmixture_allitems
+import em_circularmixture_allitems_uniquekappa
+import em_circularmixture_allitems_kappafi
+import em_circularmixture_parametrickappa
+import em_circularmixture_parametrickappa_doublepowerlaw
+
+from highdimensionnetwork import HighDimensionNetwork
+from datageneratorrfn import DataGeneratorRFN
+from statisticsmeasurer import StatisticsMeasurer
+from gibbs_sampler_continuous_fullcollapsed_randomfactorialnetwork import Sampler
+from datapbs import DataPBS
+
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Data', 'benchmarks', 'baseline.json')
+
+# Relative change of the best time above which a benchmark is reported as slower/faster than the baseline
+DEFAULT_TOLERANCE = 0.2
+
+SEED = 42
+
+# Benchmarks by name, in running order. Filled by the @benchmark decorator.
+BENCHMARKS = collections.OrderedDict()
+
+
+def benchmark(fct):
+    '''
+        Register a benchmark.
+
+        fct() does the setup and returns the function to time. It is called with the random seed fixed.
+    '''
+    BENCHMARKS[fct.__name__] = fct
+    return fct
+
+
+######
+
+def build_network(M=100):
+    return HighDimensionNetwork.create_full_conjunctive(M, R=2, rcscale=2.5)
+
+
+def build_data_gen(random_network, N=100, T=3, sigmax=0.2):
+    time_weights_parameters = dict(weighting_alpha=1.0, weighting_beta=1.0, specific_weighting=0.1, weight_prior='uniform')
+
+    return DataGeneratorRFN(N, T, random_network, sigma_x=sigmax, sigma_y=0.001, sigma_baseline=0.0001, time_weights_parameters=time_weights_parameters, cued_feature_time=T-1)
+
+
+def build_sampler(N=100, T=3, M=100, sigmax=0.2, sigma_output=0.1):
+    random_network = build_network(M)
+    data_gen = build_data_gen(random_network, N=N, T=T, sigmax=sigmax)
+    data_gen_noise = build_data_gen(random_network, N=500, T=T, sigmax=sigmax)
+    stat_meas = StatisticsMeasurer(data_gen_noise)
+
+    return Sampler(data_gen, n_parameters=stat_meas.model_parameters, tc=T-1, sigma_output=sigma_output)
+
+
+def build_mixture_responses(N=500, T=3):
+    '''
+        Responses sampled from a mixture model with T-1 nontargets
+
+        Returns (responses, targets, nontargets)
+    '''
+
+    em_fit_target = dict(kappa=5.0, mixt_target=0.75, mixt_nontargets=0.15, mixt_random=0.1)
+
+    targets = utils.sample_angle(N)
+    nontargets = utils.sample_angle((N, T-1))
+    responses = em_circularmixture.sample_from_fit(em_fit_target, targets, nontargets)
+
+    return (utils.wrap_angles(responses), targets, nontargets)
+
+
+def build_mixture_responses_allT(N=200, Tmax=4):
+    '''
+        Responses for all set sizes, as used by the parametric kappa EM.
+
+        Returns (T_space, responses, targets, nontargets), of shapes Tmax x N (x Tmax-1)
+    '''
+
+    T_space = np.arange(1, Tmax+1)
+
+    responses = np.zeros((Tmax, N))
+    targets = np.zeros((Tmax, N))
+    nontargets = np.nan*np.ones((Tmax, N, Tmax-1))
+
+    for T_i, T in enumerate(T_space):
+        (responses[T_i], targets[T_i], nontargets[T_i, :, :(T-1)]) = build_mixture_responses(N=N, T=T)
+
+    return (T_space, responses, targets, nontargets)
+
+
+######
+
+@benchmark
+def network_response():
+    random_network = build_network()
+    stimuli = utils.sample_angle((2000, 2))
+
+    def run():
+        for stimulus in stimuli:
+            random_network.get_network_response(stimulus)
+
+    return run
+
+
+@benchmark
+def sampler_loglikelihood():
+    sampler = build_sampler()
+
+    return lambda: sampler.compute_loglikelihood_N(precision=200)
+
+
+@benchmark
+def sampler_sample_theta():
+    sampler = build_sampler(N=30)
+
+    return lambda: sampler.sample_theta(debug=False)
+
+
+@benchmark
+def sampler_set_theta_max_likelihood():
+    sampler = build_sampler()
+
+    return lambda: sampler.set_theta_max_likelihood(num_points=100, post_optimise=True)
+
+
+@benchmark
+def em_fit_circularmixture():
+    (responses, targets, nontargets) = build_mixture_responses()
+
+    return lambda: em_circularmixture.fit(responses, targets, nontargets)
+
+
+@benchmark
+def em_fit_allitems():
+    (responses, targets, nontargets) = build_mixture_responses()
+
+    return lambda: em_circularmixture_allitems.fit(responses, targets, nontargets)
+
+
+@benchmark
+def em_fit_allitems_uniquekappa():
+    (responses, targets, nontargets) = build_mixture_responses()
+
+    return lambda: em_circularmixture_allitems_uniquekappa.fit(responses, targets, nontargets)
+
+
+@benchmark
+def em_fit_allitems_kappafi():
+    (responses, targets, nontargets) = build_mixture_responses()
+
+    return lambda: em_circularmixture_allitems_kappafi.fit(responses, targets, nontargets, kappa=5.0)
+
+
+@benchmark
+def em_fit_parametrickappa():
+    (T_space, responses, targets, nontargets) = build_mixture_responses_allT()
+
+    return lambda: em_circularmixture_parametrickappa.fit(T_space, responses, targets, nontargets)
+
+
+@benchmark
+def em_fit_parametrickappa_doublepowerlaw():
+    (T_space, responses, targets, nontargets) = build_mixture_responses_allT()
+
+    # Indexed by (T, trecall), a single recall time per set size here
+    Tmax = T_space.size
+    responses_trecall = np.nan*np.ones((Tmax, Tmax, responses.shape[1]))
+    targets_trecall = np.nan*np.ones((Tmax, Tmax, responses.shape[1]))
+    nontargets_trecall = np.nan*np.ones((Tmax, Tmax) + nontargets.shape[1:])
+    for T_i in xrange(Tmax):
+        responses_trecall[T_i, 0] = responses[T_i]
+        targets_trecall[T_i, 0] = targets[T_i]
+        nontargets_trecall[T_i, 0] = nontargets[T_i]
+
+    return lambda: em_circularmixture_parametrickappa_doublepowerlaw.fit(T_space, responses_trecall, targets_trecall, nontargets_trecall)
+
+
+@benchmark
+def em_bootstrap_nontargets():
+    (responses, targets, nontargets) = build_mixture_responses(N=200, T=2)
+
+    return lambda: em_circularmixture_allitems_uniquekappa.bootstrap_nontarget_stat(responses, targets, nontargets, nb_bootstrap_samples=20)
+
+
+@benchmark
+def marginal_inverse_fi():
+    sampler = build_sampler()
+
+    return lambda: sampler.random_network.compute_marginal_inverse_FI(sampler.T, sampler.inv_covariance_fixed_contrib, max_n_samples=2000, min_distance=0.1, convergence_epsilon=0.0, debug=False)
+
+
+@benchmark
+def datagenerator_build_dataset():
+    random_network = build_network()
+    data_gen = build_data_gen(random_network, N=200, T=3)
+
+    return lambda: data_gen.build_dataset(cued_feature_time=2)
+
+
+@benchmark
+def datapbs_loading():
+    '''
+        Loads 100 small result files, with 2 parameters, written in a temporary directory
+    '''
+
+    directory = tempfile.mkdtemp(prefix='benchmarks_datapbs_')
+
+    for (i, (rc_scale, sigmax)) in enumerate([(rc_scale, sigmax) for rc_scale in np.linspace(1., 10., 10) for sigmax in np.linspace(0.1, 1., 10)]):
+        dataset = dict(args=dict(rc_scale=rc_scale, sigmax=sigmax, num_repetitions=5), result_em_fits=np.random.rand(6, 5), result_all_precisions=np.random.rand(5))
+        np.save(os.path.join(directory, 'benchmark_datapbs-%d.npy' % i), dataset)
+
+    dataset_infos = dict(label='Benchmark DataPBS loading',
+                         files=os.path.join(directory, 'benchmark_datapbs-*.npy'),
+                         loading_type='args',
+                         parameters=('rc_scale', 'sigmax'),
+                         variables_to_load=('result_em_fits', 'result_all_precisions'),
+                         )
+
+    def run():
+        return DataPBS(dataset_infos=dataset_infos, debug=False)
+
+    run.cleanup = lambda: shutil.rmtree(directory, ignore_errors=True)
+
+    return run
+
+
+######
+
+def time_benchmark(name, repeats=3):
+    '''
+        Setup and time one benchmark. Seeds are fixed, for the setup and before each repeat.
+
+        Returns dict(times, best, median, setup_time)
+    '''
+
+    np.random.seed(SEED)
+    time_start = time.time()
+    run = BENCHMARKS[name]()
+    setup_time = time.time() - time_start
+
+    times = []
+    try:
+        for repeat_i in xrange(repeats):
+            np.random.seed(SEED + 1)
+
+            time_start = time.time()
+            run()
+            times.append(time.time() - time_start)
+    finally:
+        if hasattr(run, 'cleanup'):
+            run.cleanup()
+
+    return dict(times=times, best=np.min(times), median=float(np.median(times)), setup_time=setup_time)
+
+
+def get_environment():
+    '''
+        Where/what the benchmarks ran on
+    '''
+
+    try:
+        with open(os.devnull, 'w') as devnull:
+            commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)), stderr=devnull).strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return dict(date=time.strftime('%Y-%m-%d %H:%M:%S'), host=platform.node(), platform=platform.platform(), python=platform.python_version(), numpy=np.__version__, scipy=scipy.__version__, commit=commit)
+
+
+def run_benchmarks(names=None, repeats=3, debug=True):
+    '''
+        Run benchmarks (all of them by default)
+
+        Returns dict(environment, repeats, benchmarks: name -> timings)
+    '''
+
+    if names is None:
+        names = BENCHMARKS.keys()
+
+    results = dict(environment=get_environment(), repeats=repeats, benchmarks=collections.OrderedDict())
+
+    for name in names:
+        if debug:
+            print "%s..." % name,
+            sys.stdout.flush()
+
+        results['benchmarks'][name] = time_benchmark(name, repeats=repeats)
+
+        if debug:
+            print "%.4fs (median %.4fs)" % (results['benchmarks'][name]['best'], results['benchmarks'][name]['median'])
+
+    return results
+
+
+def compare_to_baseline(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    '''
+        Compare the best times to the baseline ones.
+
+        Returns dict name -> dict(best, baseline_best, ratio, status), status in 'slower', 'faster', 'same', 'new'
+    '''
+
+    comparison = collections.OrderedDict()
+
+    for (name, timings) in results['benchmarks'].iteritems():
+        if name not in baseline['benchmarks']:
+            comparison[name] = dict(best=timings['best'], baseline_best=None, ratio=None, status='new')
+            continue
+
+        baseline_best = baseline['benchmarks'][name]['best']
+        ratio = timings['best']/baseline_best
+
+        if ratio > 1. + tolerance:
+            status = 'slower'
+        elif ratio < 1. - tolerance:
+            status = 'faster'
+        else:
+            status = 'same'
+
+        comparison[name] = dict(best=timings['best'], baseline_best=baseline_best, ratio=ratio, status=status)
+
+    return comparison
+
+
+def print_comparison(comparison):
+    print "\n%-45s %12s %12s %8s" % ('benchmark', 'best (s)', 'baseline (s)', 'ratio')
+    for (name, compared) in comparison.iteritems():
+        if compared['status'] == 'new':
+            print "%-45s %12.4f %12s %8s  new" % (name, compared['best'], '-', '-')
+        else:
+            print "%-45s %12.4f %12.4f %8.2f  %s" % (name, compared['best'], compared['baseline_best'], compared['ratio'], compared['status'])
+
+
+def save_json(results, filename):
+    directory = os.path.dirname(filename)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+
+    with open(filename, 'w') as json_file:
+        json.dump(results, json_file, indent=2)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks of the model hot paths, with fixed sizes and seeds.')
+    parser.add_argument('--only', default=[], action='append', help='Only run benchmarks whose name contains this. Can be repeated.')
+    parser.add_argument('--repeats', type=int, default=3, help='Timed runs per benchmark, the best one is compared.')
+    parser.add_argument('--output', help='JSON file to write the results to.')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help='Baseline JSON file to compare to.')
+    parser.add_argument('--save_baseline', action='store_true', help='Save the results as the new baseline.')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE, help='Relative change reported as slower/faster.')
+    parser.add_argument('--fail_on_slower', action='store_true', help='Exit with an error if a benchmark is slower than the baseline.')
+    parser.add_argument('--list', action='store_true', help='List the benchmarks and exit.')
+    args = parser.parse_args(argv)
+
+    if args.list:
+        print '\n'.join(BENCHMARKS.keys())
+        return 0
+
+    names = [name for name in BENCHMARKS if not args.only or any([only in name for only in args.only])]
+    if not names:
+        print "No benchmark matching %s" % args.only
+        return 1
+
+    results = run_benchmarks(names, repeats=args.repeats)
+
+    if args.output:
+        save_json(results, args.output)
+
+    slower = []
+    if not args.save_baseline and os.path.exists(args.baseline):
+        with open(args.baseline, 'r') as baseline_file:
+            baseline = json.load(baseline_file)
+
+        comparison = compare_to_baseline(results, baseline, tolerance=args.tolerance)
+        print_comparison(comparison)
+
+        results['baseline_comparison'] = comparison
+        if args.output:
+            save_json(results, args.output)
+
+        slower = [name for (name, compared) in comparison.iteritems() if compared['status'] == 'slower']
+    elif not args.save_baseline:
+        print "\nNo baseline found (%s), save one with --save_baseline" % args.baseline
+
+    if args.save_baseline:
+        # Only replace the benchmarks that were run
+        if os.path.exists(args.baseline):
+            with open(args.baseline, 'r') as baseline_file:
+                baseline = json.load(baseline_file, object_pairs_hook=collections.OrderedDict)
+            baseline['benchmarks'].update(results['benchmarks'])
+            results['benchmarks'] = baseline['benchmarks']
+
+        save_json(results, args.baseline)
+        print "\nBaseline saved to %s" % args.baseline
+
+    if slower and args.fail_on_slower:
+        print "Slower than baseline: %s" % ', '.join(slower)
+        return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
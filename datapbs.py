@@ -115,7 +115,7 @@ class DataPBS:
 
 
             # Load the data
-            curr_dataset = np.load(curr_file).item()
+            curr_dataset = np.load(curr_file, allow_pickle=True).item()
             datasets_list.append(curr_dataset)
 
             # Save the arguments of each dataset
@@ -194,7 +194,7 @@ class DataPBS:
 
             # Load the data
             try:
-                curr_dataset = np.load(curr_file).item()
+                curr_dataset = np.load(curr_file, allow_pickle=True).item()
             except IOError:
                 # Failed to load, possibly as file is incomplete, skip.
                 continue
@@ -7,16 +7,22 @@ Created by Loic Matthey on 2013-11-21.
 Copyright (c) 2013 Gatsby Unit. All rights reserved.
 """
 
+import sys
+
 import numpy as np
 import scipy.special as spsp
 import scipy.stats as spst
-from sklearn.cross_validation import KFold
 import statsmodels.distributions as stmodsdist
 
 import utils
+import utils_instrumentation
+import utils_vonmises
+import em_circularmixture_crossvalidation
+from utils_vonmises import wrap, vonmisespdf
 
 import progress
 
+@utils_instrumentation.timed('em_circularmixture_allitems.fit')
 def fit(responses, target_angle, nontarget_angles=np.array([[]]), initialisation_method='mixed', nb_initialisations=5, debug=False, force_random_less_than=None):
     '''
         Return maximum likelihood values for a different mixture model, with:
@@ -47,6 +53,15 @@ def fit(responses, target_angle, nontarget_angles=np.array([[]]), initialisation
     initial_i = 0
     best_kappas, best_mixt_target, best_mixt_random, best_mixt_nontargets = (np.nan, np.nan, np.nan, np.nan)
 
+    # Precompute some matrices
+    error_to_target = wrap(target_angle - responses)
+    error_to_nontargets = wrap(nontarget_angles - responses[:, np.newaxis])
+    cos_errors_all = np.cos(np.c_[error_to_target, error_to_nontargets])
+
+    # Buffers reused by all EM iterations
+    W = np.empty(responses.size)
+    rw = np.empty(cos_errors_all.shape)
+
     for (kappas, mixt_target, mixt_random, mixt_nontargets, resp_ik) in initial_parameters_list:
 
         if debug:
@@ -57,22 +72,19 @@ def fit(responses, target_angle, nontarget_angles=np.array([[]]), initialisation
         i = 0
         converged = False
 
-        # Precompute some matrices
-        error_to_target = wrap(target_angle - responses)
-        error_to_nontargets = wrap(nontarget_angles - responses[:, np.newaxis])
-
         # EM loop
         while i < max_iter and not converged:
 
             # E-step
             if debug:
                 print "E", i, LL, kappas, mixt_target, mixt_nontargets, mixt_random
-            resp_ik[:, 0] = mixt_target * vonmisespdf(error_to_target, 0.0, kappas[0])
+            utils_vonmises.vonmisespdf_cos(cos_errors_all, kappas, out=resp_ik)
+            resp_ik[:, 0] *= mixt_target
             resp_r = mixt_random/(2.*np.pi)
             if K > 0:
-                for k in xrange(int(K)):
-                    resp_ik[:, k+1] = mixt_nontargets[k] * vonmisespdf(error_to_nontargets[..., k], 0.0, kappas[k+1])
-            W = np.sum(resp_ik, axis=1) + resp_r
+                resp_ik[:, 1:] *= mixt_nontargets
+            np.sum(resp_ik, axis=1, out=W)
+            W += resp_r
 
 
             # Compute likelihood
@@ -85,17 +97,16 @@ def fit(responses, target_angle, nontarget_angles=np.array([[]]), initialisation
                 break
 
             # M-step
-            mixt_target = np.nansum(resp_ik[:, 0]/W)/N
-            mixt_nontargets = np.nansum(resp_ik[:, 1:]/W[:, np.newaxis], axis=0)/N
-            mixt_random = np.nansum(resp_r/W)/N
+            np.divide(resp_ik, W[:, np.newaxis], out=rw)
+            mixt_target = np.nansum(rw[:, 0])/N
+            mixt_nontargets = np.nansum(rw[:, 1:], axis=0)/N
+            mixt_random = resp_r*np.nansum(1./W)/N
 
             if force_random_less_than is not None:
                 # Hacky, force mixt_random to be below this value
                 mixt_random = np.min((mixt_random, force_random_less_than))
 
             # Update kappa
-            rw = resp_ik/W[:, np.newaxis]
-
             if np.abs(np.nansum(rw)) < 1e-10 or np.all(np.isnan(rw)):
                 if debug:
                     print "Kappas diverged:", kappas, np.nansum(rw)
@@ -178,7 +189,7 @@ def compute_responsibilities(responses, target_angle, nontarget_angles, paramete
 
     resp_target = mixt_target * vonmisespdf(error_to_target, 0.0, kappas[0])
     resp_random = mixt_random/(2.*np.pi)
-    resp_nontargets = np.empty((responses.size, K))
+    resp_nontargets = np.empty((responses.size, int(K)))
     if K > 0.:
         for k in xrange(int(K)):
             resp_nontargets[:, k] = mixt_nontargets[k] * vonmisespdf(error_to_nontargets[..., k], 0.0, kappas[k+1])
@@ -192,52 +203,18 @@ def compute_responsibilities(responses, target_angle, nontarget_angles, paramete
     return dict(target=resp_target, nontargets=resp_nontargets, random=resp_random, W=W)
 
 
-def cross_validation_kfold(responses, target_angle, nontarget_angles, K=2, shuffle=False, initialisation_method='fixed', nb_initialisations=5, debug=False, force_random_less_than=None):
+def cross_validation_kfold(responses, target_angle, nontarget_angles, K=2, shuffle=False, initialisation_method='fixed', nb_initialisations=5, debug=False, force_random_less_than=None, nb_processes=None):
     '''
         Perform a k-fold cross validation fit.
 
-        Report the loglikelihood on holdout data as validation metric
+        Report the loglikelihood on holdout data as validation metric.
+        Folds are fitted in parallel worker processes (nb_processes, None for all CPUs),
+        see em_circularmixture_crossvalidation.cross_validation_kfold().
     '''
 
-    # Build the kfold iterator. Sklearn is too cool.
-    kf = KFold(responses.size, n_folds=K, shuffle=shuffle)
-
-    if debug:
-        print "%d-fold cross validation. %d in training, %d in testing. ..." % (K, (K-1.)/K*responses.size, responses.size/float(K))
-
-    # Store test loglikelihoods
-    test_LL = np.zeros(K)
-    k_i = 0
-    fits_all = []
-
-
-    best_fit = None
-
-    for train, test in kf:
-        # Fit the model to the training subset
-        curr_fit = fit(responses[train], target_angle[train], nontarget_angles[train], initialisation_method, nb_initialisations, debug=debug, force_random_less_than=force_random_less_than)
-
-        # Compute the testing loglikelihood
-        test_LL[k_i] = compute_loglikelihood(responses[test], target_angle[test], nontarget_angles[test], curr_fit)
-
-        # Store all parameter fits
-        fits_all.append(curr_fit)
-
-        k_i += 1
-
-    # Store best parameters. Choose the median of train/test LL
-    median_index = np.argmin(np.abs(test_LL - np.median(test_LL)))
-    best_test_LL = test_LL[median_index]
-    best_fit = fits_all[median_index]
-
-    # Do some unzipping
-    fitted_params_names = curr_fit.keys()
-    for param_name in fitted_params_names:
-        exec(param_name + "_all = [fit['" + param_name + "'] for fit in fits_all]")
-
-    return dict(test_LL=test_LL, train_LL=np.array(train_LL_all), fits_all=fits_all, best_fit=best_fit, best_test_LL=best_test_LL, kappa_all=np.array(kappa_all), mixt_target_all=np.array(mixt_target_all), mixt_nontargets_all=np.array(mixt_nontargets_all), mixt_random_all=np.array(mixt_random_all))
-
+    cv_outputs = em_circularmixture_crossvalidation.cross_validation_kfold(responses, target_angle, nontarget_angles, em_module=sys.modules[__name__], K=K, shuffle=shuffle, nb_processes=nb_processes, fit_kwargs=dict(initialisation_method=initialisation_method, nb_initialisations=nb_initialisations, debug=debug, force_random_less_than=force_random_less_than), debug=debug)
 
+    return em_circularmixture_crossvalidation.outputs_single_repetition(cv_outputs, ['kappa', 'mixt_target', 'mixt_nontargets', 'mixt_random'])
 
 
 def initialise_parameters(N, K, method='fixed', nb_initialisations=10):
@@ -270,6 +247,9 @@ def initialise_parameters_random(N, K, nb_initialisations=10):
         Provides nb_initialisations possible values
     '''
 
+    # K can be given as a float
+    K = int(K)
+
     all_params = []
     resp_ik = np.empty((N, K+1))
 
@@ -301,6 +281,9 @@ def initialise_parameters_fixed(N, K):
         Do like Paul and try multiple initial conditions
     '''
 
+    # K can be given as a float
+    K = int(K)
+
     kappas = (np.array([1., 10, 100, 300, 4000, 20, 0.3])*np.ones(K+1)[:, np.newaxis]).T
     mixt_nontargets = ([0.1, 0.1, 0.4, 0.01, 0.01, 0.05, 0.1]*np.ones(K)[:, np.newaxis]).T/K
     mixt_random = [0.01, 0.1, 0.4, 0.1, 0.01, 0.05, 0.1]
@@ -312,28 +295,6 @@ def initialise_parameters_fixed(N, K):
     return zip(kappas, mixt_target, mixt_random, mixt_nontargets, resp_ik)
 
 
-def wrap(angles):
-    '''
-        Wrap angles in a -max_angle:max_angle space
-    '''
-
-    max_angle = np.pi
-
-    angles = np.mod(angles + max_angle, 2*max_angle) - max_angle
-
-    return angles
-
-
-def vonmisespdf(x, mu, K):
-    '''
-        Von Mises PDF (switch to Normal if high kappa)
-    '''
-    if K > 700.:
-        return np.sqrt(K)/(np.sqrt(2*np.pi))*np.exp(-0.5*(x -mu)**2.*K)
-    else:
-        return np.exp(K*np.cos(x-mu)) / (2.*np.pi * spsp.i0(K))
-
-
 def A1inv(R):
     '''
         Invert A1() function
@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+em_circularmixture_crossvalidation.py
+
+Shared k-fold cross-validation runner for the circular mixture models.
+
+Works with any of the em_circularmixture* modules providing fit() and compute_loglikelihood().
+The wrapped errors to targets/nontargets are computed once, folds (and repeated random splits)
+are then fitted in parallel worker processes.
+
+Created by Loic Matthey on 2015-07-22.
+Copyright (c) 2015 Gatsby Unit. All rights reserved.
+"""
+
+import multiprocessing
+
+import numpy as np
+import scipy.stats as spst
+from sklearn.cross_validation import KFold
+
+import utils
+
+
+# Data shared with the worker processes. Set before the Pool is created, so that forked workers
+# inherit it and only the fold indices need to be pickled.
+_cv_shared = dict()
+
+
+def precompute_errors(responses, target_angle, nontarget_angles=np.array([[]]), datapoints_axis=0):
+    '''
+        Compute the wrapped errors to the target and to all nontargets, once.
+
+        Returns errors in a centred representation: responses are set to 0.0 (NaN kept where responses were NaN)
+        and targets/nontargets are replaced by their wrapped errors.
+        As the EM fits only depend on wrap(target - response), fitting the centred dataset is equivalent to fitting the original one.
+
+        Inputs:
+            - responses: N (or TxN if datapoints_axis=1)
+            - target_angle: same shape as responses
+            - nontarget_angles: NxK (or TxNxK)
+    '''
+
+    error_to_target = utils.wrap_angles(target_angle - responses)
+    error_to_nontargets = utils.wrap_angles(nontarget_angles - responses[..., np.newaxis])
+
+    if datapoints_axis == 0 and error_to_nontargets.size > 0:
+        # Remove nontargets columns that are never defined
+        error_to_nontargets = error_to_nontargets[:, ~np.all(np.isnan(error_to_nontargets), axis=0)]
+
+    responses_centred = np.zeros(responses.shape)
+    responses_centred[np.isnan(responses)] = np.nan
+
+    return dict(responses=responses_centred, target=error_to_target, nontargets=error_to_nontargets, datapoints_axis=datapoints_axis)
+
+
+def _evaluate_fold(task):
+    '''
+        Fit one fold on the training subset and compute the loglikelihood of the holdout subset.
+
+        Runs in a worker process, uses the errors stored in _cv_shared.
+        task: (task_i, train indices, test indices, seed)
+    '''
+
+    (task_i, train, test, seed) = task
+
+    # Seed per task, results do not depend on the number of workers
+    np.random.seed(seed)
+
+    em_module = _cv_shared['em_module']
+    errors = _cv_shared['errors']
+    fit_kwargs = _cv_shared['fit_kwargs']
+
+    if errors['datapoints_axis'] == 0:
+        curr_fit = em_module.fit(errors['responses'][train], errors['target'][train], errors['nontargets'][train], **fit_kwargs)
+
+        test_LL = em_module.compute_loglikelihood(errors['responses'][test], errors['target'][test], errors['nontargets'][test], curr_fit)
+    else:
+        # T x N x ... datasets, datapoints are along the second axis
+        curr_fit = em_module.fit(_cv_shared['T_space'], errors['responses'][:, train], errors['target'][:, train], errors['nontargets'][:, train], **fit_kwargs)
+
+        test_LL = em_module.compute_loglikelihood(errors['responses'][:, test], errors['target'][:, test], errors['nontargets'][:, test], curr_fit)
+
+    return (task_i, curr_fit, test_LL)
+
+
+def cross_validation_kfold(responses, target_angle, nontarget_angles=np.array([[]]), em_module=None, K=2, nb_repetitions=1, shuffle=False, T_space=None, nb_processes=None, random_seed=None, fit_kwargs=None, debug=False):
+    '''
+        Perform a (repeated) k-fold cross validation fit, folds are evaluated in parallel.
+
+        Report the loglikelihood on holdout data as validation metric.
+
+        Inputs:
+            - responses, target_angle, nontarget_angles: as for em_module.fit()
+            - em_module: any em_circularmixture* module (default: em_circularmixture)
+            - K: number of folds
+            - nb_repetitions: number of random splits into K folds. Repetitions > 1 are always shuffled.
+            - T_space: for em_circularmixture_parametrickappa, datasets are then TxN and folds are taken along N.
+            - nb_processes: number of worker processes. None uses all CPUs, 1 runs everything in this process.
+            - random_seed: base seed for the splits and the fits' random initialisations.
+            - fit_kwargs: dictionary of extra arguments for em_module.fit()
+
+        Returns a dictionary, with test_LL: nb_repetitions x K array of holdout loglikelihoods.
+    '''
+
+    if em_module is None:
+        # Imported here, the em_circularmixture* modules use this one for their own cross_validation_kfold()
+        import em_circularmixture
+        em_module = em_circularmixture
+    if fit_kwargs is None:
+        fit_kwargs = dict()
+    if random_seed is None:
+        random_seed = np.random.randint(2**30)
+
+    datapoints_axis = 0
+    if T_space is not None:
+        datapoints_axis = 1
+    N = responses.shape[datapoints_axis]
+
+    # Wrapped errors are computed once for all folds
+    errors = precompute_errors(responses, target_angle, nontarget_angles, datapoints_axis=datapoints_axis)
+
+    # Build all folds, for all repetitions
+    tasks = []
+    for repet_i in xrange(nb_repetitions):
+        kf = KFold(N, n_folds=K, shuffle=(shuffle or nb_repetitions > 1), random_state=random_seed + repet_i)
+        for k_i, (train, test) in enumerate(kf):
+            task_i = repet_i*K + k_i
+            tasks.append((task_i, train, test, random_seed + nb_repetitions + task_i))
+
+    if debug:
+        print "%d-fold cross validation, %d repetitions. %d in training, %d in testing. ..." % (K, nb_repetitions, (K-1.)/K*N, N/float(K))
+
+    _cv_shared.update(em_module=em_module, errors=errors, fit_kwargs=fit_kwargs, T_space=T_space)
+
+    try:
+        if nb_processes is None:
+            nb_processes = multiprocessing.cpu_count()
+        nb_processes = min(nb_processes, len(tasks))
+
+        if nb_processes > 1:
+            pool = multiprocessing.Pool(processes=nb_processes)
+            try:
+                results = pool.map(_evaluate_fold, tasks, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = map(_evaluate_fold, tasks)
+    finally:
+        _cv_shared.clear()
+
+    # Merge the results, in task order
+    results = sorted(results, key=lambda res: res[0])
+
+    test_LL = np.array([res[2] for res in results]).reshape((nb_repetitions, K))
+    train_LL = np.array([res[1]['train_LL'] for res in results]).reshape((nb_repetitions, K))
+    fits_all = [[results[repet_i*K + k_i][1] for k_i in xrange(K)] for repet_i in xrange(nb_repetitions)]
+
+    # Store best parameters. Choose the median of test LL
+    median_index = np.argmin(np.abs(test_LL - np.median(test_LL)))
+    best_test_LL = test_LL.flat[median_index]
+    best_fit = results[median_index][1]
+
+    return dict(test_LL=test_LL, train_LL=train_LL, fits_all=fits_all, best_fit=best_fit, best_test_LL=best_test_LL, random_seed=random_seed)
+
+
+def outputs_single_repetition(cv_outputs, fitted_params_names=()):
+    '''
+        Outputs of a cross_validation_kfold() with one repetition, in the format of the original per-module cross_validation_kfold():
+            test_LL, train_LL: K arrays, fits_all: list of K fits, best_fit, best_test_LL,
+            and <param>_all: K arrays of each fitted parameter in fitted_params_names.
+    '''
+
+    outputs = dict(test_LL=cv_outputs['test_LL'][0], train_LL=cv_outputs['train_LL'][0], fits_all=cv_outputs['fits_all'][0], best_fit=cv_outputs['best_fit'], best_test_LL=cv_outputs['best_test_LL'])
+
+    for param_name in fitted_params_names:
+        outputs[param_name + '_all'] = np.array([fit[param_name] for fit in outputs['fits_all']])
+
+    return outputs
+
+
+def test():
+    '''
+        Check that the parallel cross-validation gives the same results as the serial one
+    '''
+
+    N = 300
+    K = 5
+    kappa = 5.0
+
+    target = np.zeros(N)
+    nontargets = np.ones((N, 1))*2.0
+
+    responses = spst.vonmises.rvs(kappa, size=(N))
+    responses[np.random.randint(N, size=N/5)] = utils.sample_angle(N/5)
+
+    cv_serial = cross_validation_kfold(responses, target, nontargets, K=K, nb_repetitions=2, nb_processes=1, random_seed=10, fit_kwargs=dict(initialisation_method='mixed'))
+    cv_parallel = cross_validation_kfold(responses, target, nontargets, K=K, nb_repetitions=2, nb_processes=3, random_seed=10, fit_kwargs=dict(initialisation_method='mixed'))
+
+    assert cv_serial['test_LL'].shape == (2, K)
+    assert np.allclose(cv_serial['test_LL'], cv_parallel['test_LL'])
+    assert np.allclose(cv_serial['best_fit']['kappa'], cv_parallel['best_fit']['kappa'])
+
+
+
+if __name__ == '__main__':
+    test()
@@ -7,18 +7,24 @@ Created by Loic Matthey on 2013-11-21.
 Copyright (c) 2013 Gatsby Unit. All rights reserved.
 """
 
+import sys
+
 import numpy as np
 import scipy.special as spsp
 import scipy.optimize as spopt
 import scipy.stats as spst
-from sklearn.cross_validation import KFold
 import statsmodels.distributions as stmodsdist
 
 import utils
+import utils_instrumentation
+import utils_vonmises
+import em_circularmixture_crossvalidation
+from utils_vonmises import wrap, vonmisespdf
 
 import progress
 
 
+@utils_instrumentation.timed('em_circularmixture_parametrickappa.fit')
 def fit(T_space, responses, targets_angle, nontargets_angles=np.array([[]]), initialisation_method='random', nb_initialisations=5, debug=False, force_random_less_than=None):
     '''
         Modified mixture model where we fit a parametric power law to kappa as a function of number of items.
@@ -60,6 +66,11 @@ def fit(T_space, responses, targets_angle, nontargets_angles=np.array([[]]), ini
     initial_i = 0
     best_alpha, best_beta, best_mixt_target, best_mixt_random, best_mixt_nontargets = (np.nan, np.nan, np.nan, np.nan, np.nan)
 
+    # Precompute some matrices
+    error_to_target = wrap(targets_angle - responses)
+    error_to_nontargets = wrap(nontargets_angles - responses[:, :, np.newaxis])
+    cos_errors_all = np.cos(np.c_[error_to_target[:, :, np.newaxis], error_to_nontargets])
+
     for (alpha, beta, mixt_target, mixt_random, mixt_nontargets, resp_nik) in initial_parameters_list:
 
         if debug:
@@ -70,12 +81,6 @@ def fit(T_space, responses, targets_angle, nontargets_angles=np.array([[]]), ini
         i = 0
         converged = False
 
-        # Precompute some matrices
-        error_to_target = wrap(targets_angle - responses)
-        error_to_nontargets = wrap(nontargets_angles - responses[:, :, np.newaxis])
-        errors_all = np.c_[error_to_target[:, :, np.newaxis], error_to_nontargets]
-
-
         # EM loop
         while i < max_iter and not converged:
 
@@ -83,9 +88,10 @@ def fit(T_space, responses, targets_angle, nontargets_angles=np.array([[]]), ini
             if debug:
                 print "E", i, LL, dLL, alpha, beta, mixt_target, mixt_nontargets, mixt_random
             for T_i, T in enumerate(T_space):
-                resp_nik[T_i, :, 0] = mixt_target[T_i]*vonmisespdf(error_to_target[T_i], 0.0, compute_kappa(T, alpha, beta))
-
-                resp_nik[T_i, :, 1:T] = mixt_nontargets[T_i]/(T - 1.0)*vonmisespdf(error_to_nontargets[T_i, :, :(T-1)], 0.0, compute_kappa(T, alpha, beta))
+                utils_vonmises.vonmisespdf_cos(cos_errors_all[T_i, :, :T], compute_kappa(T, alpha, beta), out=resp_nik[T_i, :, :T])
+                resp_nik[T_i, :, 0] *= mixt_target[T_i]
+                if T > 1:
+                    resp_nik[T_i, :, 1:T] *= mixt_nontargets[T_i]/(T - 1.0)
             resp_random = mixt_random/(2.*np.pi)
 
             W = np.nansum(resp_nik, axis=-1) + resp_random[:, np.newaxis]
@@ -118,7 +124,7 @@ def fit(T_space, responses, targets_angle, nontargets_angles=np.array([[]]), ini
             else:
                 # Estimate alpha and beta with a numerical M-step, 2D optimisaiton over the loglikelihood.
                 # Combine all samples and times.
-                alpha, beta = numerical_M_step(T_space, resp_nik, errors_all, alpha, beta)
+                alpha, beta = numerical_M_step(T_space, resp_nik, cos_errors_all, alpha, beta)
 
                 # R = utils.angle_population_R(np.r_[error_to_target, error_to_nontargets.reshape(int(N*K))], weights=np.r_[rw[:, 0], rw[:, 1:].reshape(int(N*K))])
                 # kappa = A1inv(R)
@@ -166,7 +172,7 @@ def compute_kappa(t, alpha, beta):
     return alpha*t**beta
 
 
-def numerical_M_step(T_space, resp_nik, errors_all, alpha, beta):
+def numerical_M_step(T_space, resp_nik, cos_errors_all, alpha, beta):
     '''
         Perform a numerical M-step, optimizing the loglikelihood over both alpha and beta.
 
@@ -175,22 +181,21 @@ def numerical_M_step(T_space, resp_nik, errors_all, alpha, beta):
     def loglikelihood_closure(params, args):
         '''
             params: (alpha, beta)
-            args: (T_space, resp_nik, errors_all)
+            args: (T_space, resp_nik, cos_errors_all)
         '''
         LL_tot = 0
         for T_i, T in enumerate(args['T_space']):
             LL_tot += np.nansum(args['resp_nik'][T_i]*compute_kappa(
-                T, params[0], params[1])*np.cos(
-                    args['errors_all'][T_i])) - np.nansum(
-                        args['resp_nik'][T_i])*np.log(
-                            spsp.i0(compute_kappa(T, params[0], params[1])))
+                T, params[0], params[1])*args['cos_errors_all'][T_i]) - np.nansum(
+                    args['resp_nik'][T_i])*utils_vonmises.log_i0(
+                        compute_kappa(T, params[0], params[1]))
 
         if np.isnan(LL_tot):
             LL_tot = np.inf
 
         return -LL_tot
 
-    args = dict(T_space=T_space, resp_nik=resp_nik, errors_all=errors_all)
+    args = dict(T_space=T_space, resp_nik=resp_nik, cos_errors_all=cos_errors_all)
 
     res = spopt.minimize(loglikelihood_closure, (alpha, beta), args=args, bounds=((0, 100), (-1.0, 0.0)), options=dict(disp=False))
     # print res['x']
@@ -230,19 +235,25 @@ def compute_responsibilities(responses, targets_angle, nontargets_angles, parame
 
     (alpha, beta, mixt_target, mixt_nontargets, mixt_random) = (parameters['alpha'], parameters['beta'], parameters['mixt_target'], parameters['mixt_nontargets'], parameters['mixt_random'])
 
-    T = int(responses.shape[0])
+    T_space = parameters.get('T_space', np.arange(1, responses.shape[0] + 1))
+
+    # Mixture proportions are fitted per T
+    mixt_target = mixt_target*np.ones(T_space.size)
+    mixt_nontargets = mixt_nontargets*np.ones(T_space.size)
+    mixt_random = mixt_random*np.ones(T_space.size)
 
     error_to_target = wrap(targets_angle - responses)
     error_to_nontargets = wrap(nontargets_angles - responses[:, :, np.newaxis])
 
     resp_target = np.empty(responses.shape)
-    resp_random = np.ones(responses.shape)*mixt_random/(2.*np.pi)
+    resp_random = np.ones(responses.shape)*mixt_random[:, np.newaxis]/(2.*np.pi)
     resp_nontargets = np.nan*np.empty(nontargets_angles.shape)
 
-    for t in xrange(T):
-        resp_target[t] = mixt_target*vonmisespdf(error_to_target[t], 0.0, compute_kappa(t+1, alpha, beta))
+    for T_i, T in enumerate(T_space):
+        resp_target[T_i] = mixt_target[T_i]*vonmisespdf(error_to_target[T_i], 0.0, compute_kappa(T, alpha, beta))
 
-        resp_nontargets[t, :, :t] = mixt_nontargets*vonmisespdf(error_to_nontargets[t, :, :t], 0.0, compute_kappa(t+1, alpha, beta))
+        if T > 1:
+            resp_nontargets[T_i, :, :(T-1)] = mixt_nontargets[T_i]/(T - 1.0)*vonmisespdf(error_to_nontargets[T_i, :, :(T-1)], 0.0, compute_kappa(T, alpha, beta))
 
     W = resp_target + np.nansum(resp_nontargets, axis=-1) + resp_random
 
@@ -253,52 +264,23 @@ def compute_responsibilities(responses, targets_angle, nontargets_angles, parame
     return dict(target=resp_target, nontargets=resp_nontargets, random=resp_random, W=W)
 
 
-def cross_validation_kfold(responses, targets_angle, nontargets_angles, K=2, shuffle=False, initialisation_method='fixed', nb_initialisations=5, debug=False, force_random_less_than=None):
+def cross_validation_kfold(T_space, responses, targets_angle, nontargets_angles, K=2, shuffle=False, initialisation_method='random', nb_initialisations=5, debug=False, force_random_less_than=None, nb_processes=None):
     '''
         Perform a k-fold cross validation fit.
 
-        Report the loglikelihood on holdout data as validation metric
+        Report the loglikelihood on holdout data as validation metric.
+        Folds are fitted in parallel worker processes (nb_processes, None for all CPUs),
+        see em_circularmixture_crossvalidation.cross_validation_kfold().
     '''
 
-    # Build the kfold iterator. Sklearn is too cool.
-    kf = KFold(responses.size, n_folds=K, shuffle=shuffle)
-
-    if debug:
-        print "%d-fold cross validation. %d in training, %d in testing. ..." % (K, (K-1.)/K*responses.size, responses.size/float(K))
-
-    # Store test loglikelihoods
-    test_LL = np.zeros(K)
-    k_i = 0
-    fits_all = []
-
-    best_fit = None
-
-    for train, test in kf:
-        # Fit the model to the training subset
-        curr_fit = fit(responses[train], targets_angle[train], nontargets_angles[train], initialisation_method, nb_initialisations, debug=debug, force_random_less_than=force_random_less_than)
-
-        # Compute the testing loglikelihood
-        test_LL[k_i] = compute_loglikelihood(responses[test], targets_angle[test], nontargets_angles[test], curr_fit)
-
-        # Store all parameter fits
-        fits_all.append(curr_fit)
+    cv_outputs = em_circularmixture_crossvalidation.cross_validation_kfold(responses, targets_angle, nontargets_angles, em_module=sys.modules[__name__], K=K, shuffle=shuffle, T_space=T_space, nb_processes=nb_processes, fit_kwargs=dict(initialisation_method=initialisation_method, nb_initialisations=nb_initialisations, debug=debug, force_random_less_than=force_random_less_than), debug=debug)
 
-        k_i += 1
+    outputs = em_circularmixture_crossvalidation.outputs_single_repetition(cv_outputs)
 
-    # Store best parameters. Choose the median of train/test LL
-    median_index = np.argmin(np.abs(test_LL - np.median(test_LL)))
-    best_test_LL = test_LL[median_index]
-    best_fit = fits_all[median_index]
-
-    # Do some unzipping
-    fitted_params_names = curr_fit.keys()
-    for param_name in fitted_params_names:
-        exec(param_name + "_all = [fit['" + param_name + "'] for fit in fits_all]")
-
-    return dict(test_LL=test_LL,
-                fits_all=fits_all,
-                best_fit=best_fit,
-                best_test_LL=best_test_LL)
+    return dict(test_LL=outputs['test_LL'],
+                fits_all=outputs['fits_all'],
+                best_fit=outputs['best_fit'],
+                best_test_LL=outputs['best_test_LL'])
 
 
 def initialise_parameters(N, T_space, method='random', nb_initialisations=10):
@@ -381,28 +363,6 @@ def initialise_parameters_fixed(N, K):
     return zip(kappa_fixed, mixt_target_fixed, mixt_random_fixed, mixt_nontargets_fixed, resp_ik_fixed)
 
 
-def wrap(angles):
-    '''
-        Wrap angles in a -max_angle:max_angle space
-    '''
-
-    max_angle = np.pi
-
-    angles = np.mod(angles + max_angle, 2*max_angle) - max_angle
-
-    return angles
-
-
-def vonmisespdf(x, mu, K):
-    '''
-        Von Mises PDF (switch to Normal if high kappa)
-    '''
-    if K > 700.:
-        return np.sqrt(K)/(np.sqrt(2*np.pi))*np.exp(-0.5*(x - mu)**2.*K)
-    else:
-        return np.exp(K*np.cos(x-mu)) / (2.*np.pi * spsp.i0(K))
-
-
 def A1inv(R):
     '''
         Invert A1() function
@@ -17,9 +17,13 @@ import statsmodels.distributions as stmodsdist
 import matplotlib.pyplot as plt
 
 import utils
+import utils_instrumentation
+import utils_vonmises
+from utils_vonmises import wrap, vonmisespdf
 
 import progress
 
+@utils_instrumentation.timed('em_circularmixture_parametrickappa_doublepowerlaw.fit')
 def fit(T_space, responses, targets_angle, nontargets_angles=np.array([[]]), initialisation_method='random', nb_initialisations=10, debug=False, force_random_less_than=None):
     '''
         Modified mixture model where we fit a parametric power law to kappa as a function of number of items.
@@ -68,6 +72,11 @@ def fit(T_space, responses, targets_angle, nontargets_angles=np.array([[]]), ini
     initial_i = 0
     best_kappa_theta, best_mixt_target, best_mixt_random_tr, best_mixt_nontargets_tr = (np.nan, np.nan, np.nan, np.nan)
 
+    # Precompute some matrices
+    error_to_target_trn = wrap(targets_angle - responses)
+    error_to_nontargets_trnk = wrap(nontargets_angles - responses[:, :, :, np.newaxis])
+    cos_errors_all_trnk = np.cos(np.c_[error_to_target_trn[:, :, :, np.newaxis], error_to_nontargets_trnk])
+
     for (kappa_theta, mixt_target_tr, mixt_random_tr, mixt_nontargets_tr, resp_trnk) in progress.ProgressDisplay(initial_parameters_list):
         # mixt_target_tr: t, r
         # mixt_nontargets_tr: t, r
@@ -81,12 +90,6 @@ def fit(T_space, responses, targets_angle, nontargets_angles=np.array([[]]), ini
         i = 0
         converged = False
 
-        # Precompute some matrices
-        error_to_target_trn = wrap(targets_angle - responses)
-        error_to_nontargets_trnk = wrap(nontargets_angles - responses[:, :, :, np.newaxis])
-        errors_all_trnk = np.c_[error_to_target_trn[:, :, :, np.newaxis], error_to_nontargets_trnk]
-
-
         # EM loop
         while i < max_iter and not converged:
 
@@ -96,9 +99,10 @@ def fit(T_space, responses, targets_angle, nontargets_angles=np.array([[]]), ini
             for T_i, T in enumerate(T_space):
                 for trecall_i, trecall in enumerate(T_space):
                     if trecall <= T:
-                        resp_trnk[T_i, trecall_i, :, 0] = mixt_target_tr[T_i, trecall_i]*vonmisespdf(error_to_target_trn[T_i, trecall_i], 0.0, compute_kappa(T, trecall, kappa_theta))
-
-                        resp_trnk[T_i, trecall_i, :, 1:T] = mixt_nontargets_tr[T_i, trecall_i]/(T - 1.0)*vonmisespdf(error_to_nontargets_trnk[T_i, trecall_i, :, :(T-1)], 0.0, compute_kappa(T, trecall, kappa_theta))
+                        utils_vonmises.vonmisespdf_cos(cos_errors_all_trnk[T_i, trecall_i, :, :T], compute_kappa(T, trecall, kappa_theta), out=resp_trnk[T_i, trecall_i, :, :T])
+                        resp_trnk[T_i, trecall_i, :, 0] *= mixt_target_tr[T_i, trecall_i]
+                        if T > 1:
+                            resp_trnk[T_i, trecall_i, :, 1:T] *= mixt_nontargets_tr[T_i, trecall_i]/(T - 1.0)
             resp_random_tr1 = mixt_random_tr[:, :, np.newaxis]/(2.*np.pi)
 
             W_trn = np.nansum(resp_trnk, axis=-1) + resp_random_tr1
@@ -129,7 +133,7 @@ def fit(T_space, responses, targets_angle, nontargets_angles=np.array([[]]), ini
             else:
                 # Estimate kappa_theta with a numerical M-step, 3D optimisaiton over the loglikelihood.
                 # Combine all samples, nitems and recall times.
-                kappa_theta = numerical_M_step(T_space, resp_trnk, errors_all_trnk, kappa_theta)
+                kappa_theta = numerical_M_step(T_space, resp_trnk, cos_errors_all_trnk, kappa_theta)
 
             # BIC
             result_dict = dict(
@@ -195,7 +199,7 @@ def compute_kappa_all(T_space, kappa_theta):
     return kappa_all
 
 
-def numerical_M_step(T_space, resp_trnk, errors_all_trnk, kappa_theta):
+def numerical_M_step(T_space, resp_trnk, cos_errors_all_trnk, kappa_theta):
     '''
         Perform a numerical M-step, optimizing the loglikelihood over kappa_theta
 
@@ -204,21 +208,21 @@ def numerical_M_step(T_space, resp_trnk, errors_all_trnk, kappa_theta):
     def loglikelihood_closure(params, args):
         '''
             params: kappa_theta = (alpha, beta, gamma)
-            args: (T_space, resp_trnk, errors_all_trnk)
+            args: (T_space, resp_trnk, cos_errors_all_trnk)
         '''
         LL_tot = 0
         for T_i, T in enumerate(args['T_space']):
             for trecall_i, trecall in enumerate(args['T_space']):
                 if trecall <= T:
-                    LL_tot += np.nansum(args['resp_trnk'][T_i, trecall_i]*compute_kappa(T, trecall, params)*np.cos(args['errors_all_trnk'][T_i, trecall_i])) \
-                                    -np.nansum(args['resp_trnk'][T_i, trecall_i])*np.log(spsp.i0(compute_kappa(T, trecall, params)))
+                    LL_tot += np.nansum(args['resp_trnk'][T_i, trecall_i]*compute_kappa(T, trecall, params)*args['cos_errors_all_trnk'][T_i, trecall_i]) \
+                                    -np.nansum(args['resp_trnk'][T_i, trecall_i])*utils_vonmises.log_i0(compute_kappa(T, trecall, params))
 
         if np.isnan(LL_tot):
             LL_tot = np.inf
 
         return -LL_tot
 
-    args = dict(T_space=T_space, resp_trnk=resp_trnk, errors_all_trnk=errors_all_trnk)
+    args = dict(T_space=T_space, resp_trnk=resp_trnk, cos_errors_all_trnk=cos_errors_all_trnk)
 
     res = spopt.minimize(loglikelihood_closure, kappa_theta, args=args, bounds=((0, 100), (-2.0, 0.0), (-2.0, 0.0)), options=dict(disp=False))
     # print res['x']
@@ -307,28 +311,6 @@ def initialise_parameters_random(N, T_space, nb_initialisations=10):
 
 
 
-def wrap(angles):
-    '''
-        Wrap angles in a -max_angle:max_angle space
-    '''
-
-    max_angle = np.pi
-
-    angles = np.mod(angles + max_angle, 2*max_angle) - max_angle
-
-    return angles
-
-
-def vonmisespdf(x, mu, K):
-    '''
-        Von Mises PDF (switch to Normal if high kappa)
-    '''
-    if K > 700.:
-        return np.sqrt(K)/(np.sqrt(2*np.pi))*np.exp(-0.5*(x -mu)**2.*K)
-    else:
-        return np.exp(K*np.cos(x-mu)) / (2.*np.pi * spsp.i0(K))
-
-
 def A1inv(R):
     '''
         Invert A1() function
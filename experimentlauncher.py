@@ -18,6 +18,7 @@ import numpy as np
 
 
 from utils import say_finished
+import utils_diskcache
 
 
 class ExperimentLauncher(object):
@@ -88,6 +89,8 @@ class ExperimentLauncher(object):
         parser.add_argument('--label',
             help='label added to output files', default='')
         parser.add_argument('--output_directory', nargs='?', default='Data/')
+        parser.add_argument('--statistics_cache_dir', default='',
+            help='Directory of the persistent cache of network response statistics (compute_covariance_KL), shared between jobs. Disabled if not set.')
         parser.add_argument('--action_to_do', choices=self.possible_launchers.keys(), default='launcher_do_simple_run',
             help='Launcher to run, actual code executed')
         parser.add_argument('--job_action', choices=self.possible_launchers.keys(), default='launcher_do_simple_run',
@@ -100,6 +103,8 @@ class ExperimentLauncher(object):
             help='Some file to be imported containing parameters (and/or functions)')
         parser.add_argument('--num_repetitions', type=int, default=1,
             help='For search actions, number of repetitions to average on')
+        parser.add_argument('--repetitions_nb_processes', type=int, default=1,
+            help='Number of worker processes running the repetitions of launcher_do_memory_curve_marginal_fi and launcher_do_noise_output_effect in parallel. They share the network and noise statistics through shared memory. 0 uses all CPUs.')
         parser.add_argument('--N', default=100, type=int,
             help='Number of datapoints')
         parser.add_argument('--T', default=1, type=int,
@@ -131,6 +136,22 @@ class ExperimentLauncher(object):
             help='How the new sample is chosen from a set of samples. Median is closer to the ML value but could have weird effects.')
         parser.add_argument('--slice_width', type=float, default=np.pi/40.,
             help='Size of bin width for Slice Sampler. Smaller usually better but slower.')
+        parser.add_argument('--slice_sampler_backend', choices=['python', 'numba', 'cython'], default='python',
+            help='Implementation of the slice sampler of the Gibbs Sampler. Compiled ones fall back to python if unavailable. Chains sampled together (precision estimates) then run one at a time, python vectorises them and is as fast for hundreds of chains.')
+        parser.add_argument('--covariance_structure', choices=['full', 'diagonal', 'lowrank'], default='full',
+            help='Structure of the covariance in the likelihood. diagonal and lowrank (diagonal plus rank k) are approximations, cheaper for large M.')
+        parser.add_argument('--covariance_rank', type=int, default=10,
+            help='Rank k of the lowrank covariance structure.')
+        parser.add_argument('--whitened_likelihood', action='store_true', default=False,
+            help='Precompute a whitening of the likelihood (full covariance only), datapoints are then whitened once.')
+        parser.add_argument('--inv_cdf_bins', type=int, default=1000,
+            help='Number of angles in the CDF tables of the inverse transform Sampler.')
+        parser.add_argument('--inv_cdf_adaptive', action='store_true', default=False,
+            help='Place the CDF tables angles where each posterior mass is, instead of a uniform grid. Better for sharp posteriors (large M, small sigmax).')
+        parser.add_argument('--inv_cdf_coarse_bins', type=int, default=128,
+            help='Number of angles of the coarse uniform pass placing the adaptive CDF tables angles.')
+        parser.add_argument('--inv_cdf_float32', action='store_true', default=False,
+            help='Store the CDF tables of the inverse transform Sampler in float32, halves their memory.')
         parser.add_argument('--stimuli_generation', choices=['constant', 'random', 'random_smallrange', 'constant_separated', 'separated', 'specific_stimuli'],
             default='random',
             help='How to generate the dataset.')
@@ -156,6 +177,8 @@ class ExperimentLauncher(object):
             help='Automatically attempt to set the rc_scale/ratio to cover the space evenly, depending on the number of neurons')
         parser.add_argument('--response_maxout', dest='response_maxout', action='store_true', default=False,
             help='Change the network response to be max = 1. Changes many things...')
+        parser.add_argument('--reuse_network', dest='reuse_network', action='store_true', default=False,
+            help='Reuse networks built with the same parameters (and seed) across runs, with their precomputed statistics.')
         parser.add_argument('--type_layer_one', choices=['conjunctive', 'feature'], default='feature',
             help='Select the type of population code for an hierarchical network')
         parser.add_argument('--sparsity', type=float, default=1.0,
@@ -211,6 +234,8 @@ class ExperimentLauncher(object):
             help='String used by JobWrapper for Result sync files. Used to avoid overwriting result files when running a job with the same parameters again.')
         parser.add_argument('--job_name', dest='job_name', default='',
             help='Unique job name, constructed from parameter values. Could be rebuilt on the fly, but easier to pass it if it exists.')
+        parser.add_argument('--heartbeat_interval', type=float, default=60.,
+            help='Seconds between the heartbeats written by a JobWrapper while computing (progress, ETA, peak memory), read by the Submitter.')
         parser.add_argument('--best_parameters_file', dest='best_parameters_file', default='',
             help='Reload parameters from a .npy file, created from PBS/SLURM runs. Expects some known dictionaries.')
         parser.add_argument('--load_all_from_parameters_file', default=False, action='store_true', help='If a best parameter file is given, should we force all used parameters or just the optimized/best ones?')
@@ -222,6 +247,12 @@ class ExperimentLauncher(object):
             help='If >0, will limit the number of datapoints used in FitExperiments. [0-1] uses percent total data, >1 use absolute number of samples.')
         parser.add_argument('--filter_datapoints_selection', dest='filter_datapoints_selection', choices=['sequential', 'random'], default='sequential',
             help='If filter_datapoints_size > 0, sets the method to choose which datapoints to use.')
+        parser.add_argument('--fit_samplers_max_memory', type=float, default=2000.,
+            help='Memory (MB) of the datasets/Samplers kept by FitExperimentAllT for all set sizes. Least recently used ones are evicted, and rebuilt identically when needed again.')
+        parser.add_argument('--fit_nb_processes', type=int, default=1,
+            help='Number of worker processes evaluating the set sizes/subjects/recall times of FitExperiments in parallel. 0 uses all CPUs.')
+        parser.add_argument('--em_fits_cache_dir', default='',
+            help='If set, model EM fits of FitExperimentSequentialAll (and their sampled responses) are cached in this directory, per model parameters and repetition.')
         parser.add_argument('--experiment_subject', default=0, type=int,
             help='Subject to use when loading subset of experimental data. Unused in other situations.')
         parser.add_argument('--bic_K', type=float, default=None,
@@ -293,6 +324,10 @@ class ExperimentLauncher(object):
         if self.args.seed:
             np.random.seed(self.args.seed)
 
+        # Persistent statistics cache
+        if self.args.statistics_cache_dir:
+            utils_diskcache.set_statistics_cache(self.args.statistics_cache_dir)
+
         # Run the launcher
         self.all_vars = self.possible_launchers[self.args.action_to_do](self.args)
 
@@ -8,6 +8,7 @@ Copyright (c) 2013 Gatsby Unit. All rights reserved.
 """
 
 import os
+import collections
 
 import numpy as np
 
@@ -21,6 +22,39 @@ import experimentlauncher
 import launchers
 import load_experimental_data
 import utils
+import utils_parallel
+
+
+# Default memory bound of the datasets/Samplers kept for all set sizes
+DEFAULT_SAMPLERS_MAX_MEMORY = 2000.
+
+
+def get_sampler_nbytes(sampler):
+    '''
+        Approximate memory used by a Sampler and its DataGenerator: their numpy arrays.
+
+        The network is not counted, it is shared.
+    '''
+
+    nbytes = 0
+    for obj in [sampler, sampler.data_gen]:
+        for value in vars(obj).itervalues():
+            if isinstance(value, np.ndarray):
+                nbytes += value.nbytes
+
+    return nbytes
+
+
+def get_experiment_data_dir(parameters):
+    '''
+        Directory of the experimental data: experiment_data_dir parameter, or next to WORKDIR_DROP
+    '''
+
+    return parameters.get('experiment_data_dir',
+                          os.path.normpath(os.path.join(
+                              os.environ['WORKDIR_DROP'],
+                              '../../experimental_data/'))
+                          )
 
 
 class FitExperimentAllT(object):
@@ -39,7 +73,10 @@ class FitExperimentAllT(object):
             Requires experiment_id to be set.
         '''
 
-        self.all_samplers = dict()
+        self.all_samplers = collections.OrderedDict()
+        self.samplers_random_states = dict()
+        self.evicted_thetas = dict()
+        self.random_network = None
         self.enforced_T = -1
         self.sampler = None
         self.cache_responses = dict()
@@ -51,13 +88,10 @@ class FitExperimentAllT(object):
 
         self.parameters = parameters
         self.debug = debug
+        self.samplers_max_bytes = parameters.get('fit_samplers_max_memory', DEFAULT_SAMPLERS_MAX_MEMORY)*1024**2
 
         self.experiment_id = parameters.get('experiment_id', '')
-        self.data_dir = parameters.get('experiment_data_dir',
-                                       os.path.normpath(os.path.join(
-                                           os.environ['WORKDIR_DROP'],
-                                           '../../experimental_data/'))
-                                       )
+        self.data_dir = get_experiment_data_dir(parameters)
 
         # Load data
         self.load_dataset()
@@ -122,6 +156,9 @@ class FitExperimentAllT(object):
         '''
             Setup everything needed (Sampler, etc) and then force a human experimental dataset.
 
+            The network (and its response statistics) is built once and shared by all T,
+            only the dataset, noise statistics and Sampler are instantiated per T.
+
             If already setup correctly, do nothing.
         '''
 
@@ -131,26 +168,94 @@ class FitExperimentAllT(object):
             self.enforced_T = T
 
             if T not in self.all_samplers:
-                print "\n>>> Setting up {} nitems, {} datapoints".format(T, self.num_datapoints)
+                self.all_samplers[T] = self.init_sampler_T(T)
+                self.evict_samplers()
 
-                # Update parameters
-                self.parameters['T'] = T
-                self.parameters['N'] = self.num_datapoints
-                self.parameters['fixed_cued_feature_time'] = self.experiment_data_to_fit[T]['probe'][0]  # should be scalar
+            # Most recently used last
+            self.sampler = self.all_samplers.pop(T)
+            self.all_samplers[T] = self.sampler
 
-                self.parameters['stimuli_to_use'] = self.experiment_data_to_fit[T]['item_features'][self.filter_datapoints_mask]
 
-                # Instantiate everything
-                (_, _, _, self.sampler) = launchers.init_everything(self.parameters)
+    def setup_experimental_stimuli_allT(self):
+        '''
+            Setup the Samplers of all T, e.g. before worker processes start so that they all use them.
 
-                # Fix responses to the human ones
-                self.sampler.set_theta(self.experiment_data_to_fit[T]['response'][self.filter_datapoints_mask])
-                self.store_responses('human')
+            Samplers evicted to stay in fit_samplers_max_memory are rebuilt identically when needed again.
+        '''
 
-                # Store it
-                self.all_samplers[self.enforced_T] = self.sampler
+        for T in self.T_space:
+            self.setup_experimental_stimuli_T(T)
 
-            self.sampler = self.all_samplers[self.enforced_T]
+
+    def init_random_network(self):
+        '''
+            Build the network, once. All T share it.
+        '''
+
+        if self.random_network is None:
+            self.random_network = launchers.get_random_network(self.parameters)
+
+
+    def init_sampler_T(self, T):
+        '''
+            Instantiate the dataset and Sampler for T, with the human responses.
+
+            A Sampler evicted before is rebuilt from the same random state, hence identical,
+            and gets its last responses back.
+        '''
+
+        print "\n>>> Setting up {} nitems, {} datapoints".format(T, self.num_datapoints)
+
+        # Update parameters
+        self.parameters['T'] = T
+        self.parameters['N'] = self.num_datapoints
+        self.parameters['fixed_cued_feature_time'] = self.experiment_data_to_fit[T]['probe'][0]  # should be scalar
+
+        self.parameters['stimuli_to_use'] = self.experiment_data_to_fit[T]['item_features'][self.filter_datapoints_mask]
+
+        self.init_random_network()
+
+        rebuilding = T in self.samplers_random_states
+        if rebuilding:
+            random_state = np.random.get_state()
+            np.random.set_state(self.samplers_random_states[T])
+        else:
+            self.samplers_random_states[T] = np.random.get_state()
+
+        # Instantiate everything else
+        (_, _, _, self.sampler) = launchers.init_everything(self.parameters, random_network=self.random_network)
+
+        # Fix responses to the human ones
+        self.sampler.set_theta(self.experiment_data_to_fit[T]['response'][self.filter_datapoints_mask])
+        self.store_responses('human')
+
+        if rebuilding:
+            np.random.set_state(random_state)
+            self.sampler.theta[:] = self.evicted_thetas.pop(T)
+
+        return self.sampler
+
+
+    def evict_samplers(self):
+        '''
+            Remove the least recently used Samplers until they fit in the memory bound (fit_samplers_max_memory).
+
+            The current Sampler is always kept. Their responses are saved to restore them when rebuilt.
+        '''
+
+        samplers_nbytes = dict([(T, get_sampler_nbytes(sampler)) for (T, sampler) in self.all_samplers.iteritems()])
+
+        for T in self.all_samplers.keys():
+            if sum(samplers_nbytes.values()) <= self.samplers_max_bytes:
+                break
+            if T == self.enforced_T:
+                continue
+
+            if self.debug:
+                print "Evicting sampler for T=%d" % T
+
+            self.evicted_thetas[T] = self.all_samplers.pop(T).theta.copy()
+            del samplers_nbytes[T]
 
 
     def store_responses(self, name):
@@ -208,18 +313,25 @@ class FitExperimentAllT(object):
         return result
 
 
-    def apply_fct_datasets_allT(self, fct_infos, return_array=False):
+    def apply_fct_datasets_allT(self, fct_infos, return_array=False, nb_processes=None, random_seed=None):
         '''
             Apply a function on all datasets
 
-            TODO(lmatthey) if setting up dataset is costly, might need to provide a list of fcts and avoid reconstructing the DataGenerator each time.
+            Each T is evaluated independently, in parallel worker processes if nb_processes > 1
+            (default: fit_nb_processes parameter, 0 uses all CPUs). Samplers are all set up here first,
+            workers use copies of them: changes the function makes to them are then not kept.
+            Each T is seeded from random_seed, results do not depend on the number of workers.
 
             result = fct_infos['fct'](self, fct_infos['parameters'])
         '''
 
-        result_allT = []
-        for T in self.T_space:
-            result_allT.append(self.apply_fct_dataset_T(T, fct_infos))
+        if nb_processes is None:
+            nb_processes = self.parameters.get('fit_nb_processes', 1)
+
+        # Build the network and Samplers before the workers start, they all share them
+        self.setup_experimental_stimuli_allT()
+
+        result_allT = utils_parallel.map_cells(self.apply_fct_dataset_T, [(T, fct_infos) for T in self.T_space], nb_processes=nb_processes, random_seed=random_seed)
 
         if return_array:
             # Bit stupid for now. Might want to handle list of dictionaries, but meh
@@ -323,6 +435,51 @@ def test_fit_experimentallt():
     return locals()
 
 
+def test_apply_fct_serial_parallel():
+    '''
+        apply_fct_datasets_allT should give the same results in serial and in parallel, on first and later calls
+    '''
+
+    experiment_parameters = dict(action_to_do='launcher_do_simple_run',
+                                 inference_method='none',
+                                 experiment_id='bays09',
+                                 M=100,
+                                 filter_datapoints_size=100,
+                                 filter_datapoints_selection='sequential',
+                                 num_samples=100,
+                                 selection_method='last',
+                                 sigmax=0.1,
+                                 sigmay=0.0001,
+                                 code_type='mixed',
+                                 slice_width=0.07,
+                                 burn_samples=100,
+                                 ratio_conj=0.7,
+                                 stimuli_generation_recall='random',
+                                 autoset_parameters=None,
+                                 label='test_apply_fct_serial_parallel'
+                                 )
+    experiment_launcher = experimentlauncher.ExperimentLauncher(run=True, arguments_dict=experiment_parameters)
+    experiment_parameters_full = experiment_launcher.args_dict
+
+    # Uses the Samplers and the random state of each T
+    fct_infos = dict(fct=lambda s, p: np.array([np.nansum(s.sampler.compute_loglikelihood_N()), np.random.rand()]))
+
+    # Serial then parallel, twice each
+    np.random.seed(10)
+    fit_exp = FitExperimentAllT(experiment_parameters_full)
+    results = [fit_exp.apply_fct_datasets_allT(fct_infos, return_array=True, nb_processes=nb_processes, random_seed=10) for nb_processes in [1, 1, 2, 2]]
+
+    # Parallel first, on the same Samplers
+    np.random.seed(10)
+    fit_exp = FitExperimentAllT(experiment_parameters_full)
+    results.extend([fit_exp.apply_fct_datasets_allT(fct_infos, return_array=True, nb_processes=nb_processes, random_seed=10) for nb_processes in [2, 1]])
+
+    for result in results[1:]:
+        assert np.allclose(result, results[0])
+
+    return locals()
+
+
 def test_loglike_modelselection():
     '''
         Check if the LL computation is correct for model selection
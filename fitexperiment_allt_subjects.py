@@ -14,8 +14,9 @@ import numpy as np
 import experimentlauncher
 import load_experimental_data
 import utils
+import utils_parallel
 
-from fitexperiment_allt import FitExperimentAllT
+from fitexperiment_allt import FitExperimentAllT, get_experiment_data_dir
 
 class FitExperimentAllTSubject(FitExperimentAllT):
     '''
@@ -109,6 +110,40 @@ class FitExperimentAllTSubject(FitExperimentAllT):
         return distances
 
 
+def apply_fct_subjects_allT(parameters, fct_infos, subject_space=None, nb_processes=None, random_seed=None, debug=True):
+    '''
+        Apply a function on all datasets of several subjects.
+
+        One FitExperimentAllTSubject is created per subject (networks, datasets and Samplers built here),
+        all (subject, T) cells are then evaluated in parallel worker processes, see FitExperimentAllT.apply_fct_datasets_allT.
+
+        Returns:
+        * dict(subject -> list of results over T), fit_experiments dict(subject -> FitExperimentAllTSubject)
+    '''
+
+    if subject_space is None:
+        subject_space = load_experimental_data.load_data(experiment_id=parameters['experiment_id'], data_dir=get_experiment_data_dir(parameters))['data_subject_split']['subjects_space']
+
+    if nb_processes is None:
+        nb_processes = parameters.get('fit_nb_processes', 1)
+
+    fit_experiments = dict()
+    cells = []
+    for subject in subject_space:
+        fit_experiments[subject] = FitExperimentAllTSubject(dict(parameters, experiment_subject=subject), debug=debug)
+        fit_experiments[subject].setup_experimental_stimuli_allT()
+
+        cells.extend([(fit_experiments[subject], T, fct_infos) for T in fit_experiments[subject].T_space])
+
+    results_cells = utils_parallel.map_cells(lambda fit_exp, T, fct_infos: fit_exp.apply_fct_dataset_T(T, fct_infos), cells, nb_processes=nb_processes, random_seed=random_seed)
+
+    results = dict()
+    for ((fit_exp, _, _), result) in zip(cells, results_cells):
+        results.setdefault(fit_exp.subject, []).append(result)
+
+    return (results, fit_experiments)
+
+
 ###########################################################################
 
 
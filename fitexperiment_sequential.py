@@ -21,9 +21,24 @@ import experimentlauncher
 import launchers
 import load_experimental_data
 import utils
+import utils_diskcache
+import utils_parallel
 import em_circularmixture_parametrickappa_doublepowerlaw
 
 
+# Parameters not changing the model EM fits, left out of their cache key
+EM_FITS_CACHE_IGNORED_PARAMETERS = [
+    # Set per dataset by setup_experimental_stimuli
+    'T', 'N', 'fixed_cued_feature_time', 'cued_feature_time', 'stimuli_to_use', 'time_weights_parameters', 'filter_datapoints_mask',
+    # Bookkeeping: naming, outputs, actions, logging
+    'label', 'output_directory', 'job_name', 'session_id', 'action_to_do', 'subaction', 'job_action', 'result_computation', 'search_type', 'input_filename', 'parameters_filename', 'best_parameters_file', 'load_all_from_parameters_file', 'num_repetitions', 'collect_responses', 'say_completed', 'verbose', 'pylab', 'plot_while_running', 'profile_dir', 'heartbeat_interval',
+    # Where data and caches are
+    'experiment_data_dir', 'statistics_cache_dir', 'em_fits_cache_dir',
+    # Parallelism, memory and implementation choices computing the same model
+    'fit_nb_processes', 'repetitions_nb_processes', 'fit_samplers_max_memory', 'slice_sampler_backend', 'whitened_likelihood',
+]
+
+
 class FitExperimentSequentialAll(object):
     '''
         Loads sequential experimental data, set up DataGenerator and associated RFN, Sampler to optimize parameters.
@@ -51,6 +66,8 @@ class FitExperimentSequentialAll(object):
         self.num_datapoints = -1
         self.data_em_fits = None
         self.model_em_fits = None
+        self.model_em_fits_key = None
+        self.model_em_fits_repetitions = dict()
 
         self.parameters = parameters
         self.debug = debug
@@ -209,20 +226,28 @@ class FitExperimentSequentialAll(object):
         return result
 
 
-    def apply_fct_datasets_all(self, fct_infos, return_array=False):
+    def apply_fct_datasets_all(self, fct_infos, return_array=False, nb_processes=None, random_seed=None):
         '''
             Apply a function on all datasets
 
-            TODO(lmatthey) if setting up dataset is costly, might need to provide a list of fcts and avoid reconstructing the DataGenerator each time.
+            Each (T, trecall) is evaluated independently, in parallel worker processes if nb_processes > 1
+            (default: fit_nb_processes parameter, 0 uses all CPUs). Samplers are all set up here first,
+            workers use copies of them: changes the function makes to them are then not kept.
+            Each (T, trecall) is seeded from random_seed, results do not depend on the number of workers.
 
             result = fct_infos['fct'](self, fct_infos['parameters'])
         '''
 
-        result_all = []
-        for T in self.T_space:
-            for trecall in range(1, T+1):
-                result_all.append(
-                    self.apply_fct_dataset(T, trecall, fct_infos))
+        if nb_processes is None:
+            nb_processes = self.parameters.get('fit_nb_processes', 1)
+
+        cells = [(T, trecall, fct_infos) for T in self.T_space for trecall in range(1, T+1)]
+
+        # Build the Samplers before the workers start, they all share them
+        for (T, trecall, _) in cells:
+            self.setup_experimental_stimuli(T, trecall)
+
+        result_all = utils_parallel.map_cells(self.apply_fct_dataset, cells, nb_processes=nb_processes, random_seed=random_seed)
 
         if return_array:
             # Bit stupid for now. Might want to handle list of dictionaries, but meh
@@ -249,73 +274,22 @@ class FitExperimentSequentialAll(object):
     def get_model_em_fits(self, num_repetitions=1, use_cache=True):
         '''Will setup experimental data, sample from the model, and fit a
         collapsed powerlaw mixture model on the outcome.
+
+        Fits of each repetition are cached (see get_model_em_fit_repetition), asking
+        for more repetitions only computes the new ones. use_cache=False recomputes everything.
         '''
-        if self.model_em_fits is None or not use_cache:
-            # Collect all data to fit.
-            T = self.T_space.size
+        model_em_fits_key = (self.get_model_em_fits_cache_key(), num_repetitions)
 
-            model_data_dict = {
-                'responses': np.nan*np.empty((T, T, self.num_datapoints)),
-                'targets': np.nan*np.empty((T, T, self.num_datapoints)),
-                'nontargets': np.nan*np.empty((
-                    T, T, self.num_datapoints, T - 1))}
-
-            search_progress = progress.Progress(
-                T*(T + 1)/2.*num_repetitions)
-
-            params_fit_double_all = []
-            for repet_i in xrange(num_repetitions):
-                for n_items_i, n_items in enumerate(self.T_space):
-                    for trecall_i, trecall in enumerate(self.T_space):
-                        if trecall <= n_items:
-                            self.setup_experimental_stimuli(n_items, trecall)
-
-                            print ("{:.2f}%, {} left - {} "
-                                   "== Data, N={}, trecall={}. {}/{}. ").format(
-                                       search_progress.percentage(),
-                                       search_progress.time_remaining_str(),
-                                       search_progress.eta_str(),
-                                       n_items, trecall, repet_i+1,
-                                       num_repetitions)
-
-                            if ('samples' in
-                                    self.get_names_stored_responses()
-                                    and repet_i < 1):
-                                self.restore_responses('samples')
-                            else:
-                                self.sampler.force_sampling_round()
-                                self.store_responses('samples')
-
-                            responses, targets, nontargets = (
-                                self.sampler.collect_responses())
-
-                            # collect all data
-                            model_data_dict['responses'][
-                                n_items_i,
-                                trecall_i] = responses
-                            model_data_dict['targets'][
-                                n_items_i,
-                                trecall_i] = targets
-                            model_data_dict['nontargets'][
-                                n_items_i,
-                                trecall_i,
-                                :,
-                                :n_items_i] = nontargets
-
-                            search_progress.increment()
-
-                # Fit the collapsed mixture model
-                params_fit_double = (
-                    em_circularmixture_parametrickappa_doublepowerlaw.fit(
-                        self.T_space,
-                        model_data_dict['responses'],
-                        model_data_dict['targets'],
-                        model_data_dict['nontargets']))
-                params_fit_double_all.append(params_fit_double)
+        if (self.model_em_fits is None or not use_cache or
+                self.model_em_fits_key != model_em_fits_key):
+            params_fit_double_all = [
+                self.get_model_em_fit_repetition(repet_i, use_cache=use_cache)
+                for repet_i in xrange(num_repetitions)]
 
             # Store statistics of powerlaw fits
             self.model_em_fits = collections.defaultdict(dict)
-            emfits_keys = params_fit_double.keys()
+            self.model_em_fits_key = model_em_fits_key
+            emfits_keys = params_fit_double_all[0].keys()
             for key in emfits_keys:
                 repets_param_fit_curr = [
                     param_fit_double[key]
@@ -331,6 +305,154 @@ class FitExperimentSequentialAll(object):
         return self.model_em_fits
 
 
+    def get_em_fits_cache(self):
+        '''
+            DiskCache of the model EM fits, in the em_fits_cache_dir parameter. None if not set.
+        '''
+
+        if self.parameters.get('em_fits_cache_dir', None):
+            return utils_diskcache.DiskCache(self.parameters['em_fits_cache_dir'])
+
+        return None
+
+
+    def get_model_em_fits_cache_key(self):
+        '''
+            Fingerprint of the model and dataset: all parameters except EM_FITS_CACHE_IGNORED_PARAMETERS,
+            and the datapoints used.
+
+            Recomputed at each call, parameters can be changed between fits.
+        '''
+
+        model_parameters = dict([
+            (key, value) for (key, value) in self.parameters.iteritems()
+            if key not in EM_FITS_CACHE_IGNORED_PARAMETERS])
+
+        return utils_diskcache.fingerprint(
+            self.__class__.__name__, self.experiment_id,
+            self.num_datapoints, self.filter_datapoints_mask,
+            model_parameters)
+
+
+    def get_model_em_fit_repetition(self, repet_i, use_cache=True):
+        '''Collapsed powerlaw mixture model fit of the model responses, for
+        one repetition.
+
+        Fits and sampled responses (per T, trecall) are cached, in memory and
+        on disk if em_fits_cache_dir is set, keyed by the model parameters and
+        repet_i. Cached entries are shared across processes and runs.
+        '''
+
+        cache_key = self.get_model_em_fits_cache_key()
+
+        if use_cache and (cache_key, repet_i) in self.model_em_fits_repetitions:
+            return self.model_em_fits_repetitions[(cache_key, repet_i)]
+
+        em_fits_cache = self.get_em_fits_cache()
+        fit_key = (cache_key, 'fit', repet_i)
+
+        params_fit_double = None
+        if use_cache and em_fits_cache is not None:
+            params_fit_double = em_fits_cache.get(fit_key)
+
+        if params_fit_double is None:
+            model_data_dict = self.collect_model_responses_repetition(
+                repet_i, use_cache=use_cache, em_fits_cache=em_fits_cache,
+                cache_key=cache_key)
+
+            # Fit the collapsed mixture model
+            params_fit_double = (
+                em_circularmixture_parametrickappa_doublepowerlaw.fit(
+                    self.T_space,
+                    model_data_dict['responses'],
+                    model_data_dict['targets'],
+                    model_data_dict['nontargets']))
+
+            if em_fits_cache is not None:
+                em_fits_cache.set(fit_key, params_fit_double)
+
+        self.model_em_fits_repetitions[(cache_key, repet_i)] = params_fit_double
+
+        return params_fit_double
+
+
+    def collect_model_responses_repetition(self, repet_i, use_cache=True,
+                                           em_fits_cache=None, cache_key=None):
+        '''Sample model responses for all T and trecall, for one repetition.
+
+        Responses of each (T, trecall) are taken from em_fits_cache if there,
+        cache_key defaults to get_model_em_fits_cache_key().
+        '''
+
+        if cache_key is None:
+            cache_key = self.get_model_em_fits_cache_key()
+
+        T = self.T_space.size
+
+        model_data_dict = {
+            'responses': np.nan*np.empty((T, T, self.num_datapoints)),
+            'targets': np.nan*np.empty((T, T, self.num_datapoints)),
+            'nontargets': np.nan*np.empty((
+                T, T, self.num_datapoints, T - 1))}
+
+        search_progress = progress.Progress(T*(T + 1)/2.)
+
+        for n_items_i, n_items in enumerate(self.T_space):
+            for trecall_i, trecall in enumerate(self.T_space):
+                if trecall <= n_items:
+                    responses_key = (cache_key,
+                                     'responses', n_items, trecall, repet_i)
+
+                    cached_responses = None
+                    if use_cache and em_fits_cache is not None:
+                        cached_responses = em_fits_cache.get(responses_key)
+
+                    if cached_responses is not None:
+                        responses, targets, nontargets = cached_responses
+                    else:
+                        self.setup_experimental_stimuli(n_items, trecall)
+
+                        print ("{:.2f}%, {} left - {} "
+                               "== Data, N={}, trecall={}. {}. ").format(
+                                   search_progress.percentage(),
+                                   search_progress.time_remaining_str(),
+                                   search_progress.eta_str(),
+                                   n_items, trecall, repet_i+1)
+
+                        if ('samples' in
+                                self.get_names_stored_responses()
+                                and repet_i < 1):
+                            self.restore_responses('samples')
+                        else:
+                            self.sampler.force_sampling_round()
+                            self.store_responses('samples')
+
+                        responses, targets, nontargets = (
+                            self.sampler.collect_responses())
+
+                        if em_fits_cache is not None:
+                            em_fits_cache.set(
+                                responses_key,
+                                (responses, targets, nontargets))
+
+                    # collect all data
+                    model_data_dict['responses'][
+                        n_items_i,
+                        trecall_i] = responses
+                    model_data_dict['targets'][
+                        n_items_i,
+                        trecall_i] = targets
+                    model_data_dict['nontargets'][
+                        n_items_i,
+                        trecall_i,
+                        :,
+                        :n_items_i] = nontargets
+
+                    search_progress.increment()
+
+        return model_data_dict
+
+
 class FitExperimentSequentialSubjectAll(FitExperimentSequentialAll):
     '''
         Loads sequential experimental data for a single subject, set up DataGenerator and associated RFN, Sampler to optimize parameters.
@@ -377,6 +499,66 @@ class FitExperimentSequentialSubjectAll(FitExperimentSequentialAll):
 ###########################################################################
 
 
+def test_model_em_fits_cache():
+    '''
+        Caching of the model EM fits, on synthetic responses (no experimental data needed).
+
+        Asking for more repetitions only fits the new ones, another object sharing em_fits_cache_dir
+        reuses them, changing the parameters fits again.
+    '''
+    import tempfile
+    import shutil
+
+    class FitExperimentSequentialSynthetic(FitExperimentSequentialAll):
+        def load_dataset(self):
+            self.T_space = np.array([1, 2])
+            self.num_datapoints = 30
+            self.nb_responses_collected = 0
+
+        def collect_model_responses_repetition(self, repet_i, use_cache=True,
+                                               em_fits_cache=None, cache_key=None):
+            self.nb_responses_collected += 1
+
+            random_state = np.random.RandomState(repet_i)
+            T = self.T_space.size
+
+            targets = random_state.uniform(-np.pi, np.pi, (T, T, self.num_datapoints))
+            responses = utils.wrap_angles(targets + random_state.vonmises(0.0, 1./self.parameters['sigmax']**2., targets.shape))
+            nontargets = random_state.uniform(-np.pi, np.pi, (T, T, self.num_datapoints, T - 1))
+
+            # Only trecall <= n_items
+            targets[0, 1] = responses[0, 1] = nontargets[0, 1] = np.nan
+
+            return dict(responses=responses, targets=targets, nontargets=nontargets)
+
+    em_fits_cache_dir = tempfile.mkdtemp(prefix='test_model_em_fits_cache')
+    parameters = dict(experiment_data_dir='', em_fits_cache_dir=em_fits_cache_dir, sigmax=0.3, label='first')
+
+    try:
+        fit_exp = FitExperimentSequentialSynthetic(parameters, debug=False)
+
+        fit_exp.get_model_em_fits(num_repetitions=5)
+        assert fit_exp.nb_responses_collected == 5
+
+        model_em_fits = fit_exp.get_model_em_fits(num_repetitions=10)
+        assert fit_exp.nb_responses_collected == 10
+
+        # Same model, other label: all fits from the disk cache
+        fit_exp_other = FitExperimentSequentialSynthetic(dict(parameters, label='second'), debug=False)
+        model_em_fits_other = fit_exp_other.get_model_em_fits(num_repetitions=10)
+        assert fit_exp_other.nb_responses_collected == 0
+        assert np.all(model_em_fits_other['mean']['kappa_theta'] == model_em_fits['mean']['kappa_theta'])
+
+        # Parameters changed: new fingerprint, new fits
+        fit_exp_other.parameters['sigmax'] = 0.5
+        assert fit_exp_other.get_model_em_fits_cache_key() != fit_exp.get_model_em_fits_cache_key()
+        fit_exp_other.get_model_em_fits(num_repetitions=2)
+        assert fit_exp_other.nb_responses_collected == 2
+        assert np.any(fit_exp_other.get_model_em_fits(num_repetitions=2)['mean']['kappa_theta'] != model_em_fits['mean']['kappa_theta'])
+    finally:
+        shutil.rmtree(em_fits_cache_dir)
+
+
 def test_fitexperimentsequentialall():
 
     # Set some parameters and let the others default
@@ -450,6 +632,8 @@ def test_fitexperimentsequentialall():
 
 
 if __name__ == '__main__':
+    test_model_em_fits_cache()
+
     if True:
         all_vars = test_fitexperimentsequentialall()
 
@@ -26,7 +26,39 @@ from utils import *
 import em_circularmixture
 import em_circularmixture_allitems_uniquekappa
 
+import utils_likelihood
+import utils_instrumentation
+
 import slicesampler
+import slicesampler_numba
+
+# Cython slice sampler, compiled when first needed, see load_slicesampler_c()
+_slicesampler_c = dict(loaded=False, module=None)
+
+
+def load_slicesampler_c():
+    '''
+        Compile (pyximport) and import the Cython slice sampler, once.
+
+        The pyximport hook is only installed while importing slicesampler_c.
+        Returns None if Cython or a compiler is missing.
+    '''
+
+    if not _slicesampler_c['loaded']:
+        _slicesampler_c['loaded'] = True
+        try:
+            import pyximport
+            importers = pyximport.install(pyimport=False, setup_args=dict(include_dirs=np.get_include()))
+            try:
+                import slicesampler_c
+                _slicesampler_c['module'] = slicesampler_c
+            finally:
+                pyximport.uninstall(*importers)
+        except Exception as e:
+            print "Cython slice sampler unavailable: %s" % e
+
+    return _slicesampler_c['module']
+
 
 # from dataio import *
 import progress
@@ -42,18 +74,39 @@ def loglike_theta_fct_single(new_theta, (thetas, datapoint, rn, theta_mu, theta_
     like_mean = datapoint - mean_fixed_contrib - \
                 ATtcB*rn.get_network_response(thetas)
 
+    utils_instrumentation.count('likelihood_evaluations')
+
     # Using inverse covariance as param
     # return theta_kappa*np.cos(thetas[sampled_feature_index] - theta_mu) - 0.5*np.dot(like_mean, np.dot(inv_covariance_fixed_contrib, like_mean))
-    return -0.5*np.dot(like_mean, np.dot(inv_covariance_fixed_contrib, like_mean))
+    return -0.5*utils_likelihood.quadratic_form(like_mean, inv_covariance_fixed_contrib)
     # return -1./(2*0.2**2)*np.sum(like_mean**2.)
 
+def loglike_theta_fct_tc_integratedout(new_theta, (thetas, datapoint, rn, theta_mu, theta_kappa, ATtcB_all, sampled_feature_index, mean_fixed_contrib_all, inv_covariance_fixed_contrib)):
+    '''
+        Compute the loglikelihood of: theta_r | n theta_r', with tc integrated out (uniform p(tc))
+
+        Same as loglike_theta_fct_single, but takes ATtcB and mean_fixed_contrib for all T.
+        The network response is computed once, the T recall times are broadcasted.
+    '''
+    # Put the new proposed point correctly
+    thetas[sampled_feature_index] = new_theta
+
+    like_mean = datapoint - mean_fixed_contrib_all - \
+                ATtcB_all[:, np.newaxis]*rn.get_network_response(thetas)
+
+    utils_instrumentation.count('likelihood_evaluations', ATtcB_all.size)
+
+    loglike_tc = -0.5*utils_likelihood.quadratic_form(like_mean, inv_covariance_fixed_contrib)
+
+    return utils_likelihood.marginalise_loglikelihood(loglike_tc)
+
 def loglike_theta_fct_single_min(x, thetas, datapoint, rn, theta_mu, theta_kappa, ATtcB, sampled_feature_index, mean_fixed_contrib, inv_covariance_fixed_contrib):
     return -loglike_theta_fct_single(x, (thetas, datapoint, rn, theta_mu, theta_kappa, ATtcB, sampled_feature_index, mean_fixed_contrib, inv_covariance_fixed_contrib))
 
 def like_theta_fct_single(x, thetas, datapoint, rn, theta_mu, theta_kappa, ATtcB, sampled_feature_index, mean_fixed_contrib, inv_covariance_fixed_contrib):
     return np.exp(loglike_theta_fct_single(x, (thetas, datapoint, rn, theta_mu, theta_kappa, ATtcB, sampled_feature_index, mean_fixed_contrib, inv_covariance_fixed_contrib)))
 
-class Sampler:
+class Sampler(utils_likelihood.SamplerLikelihood):
     '''
         Continuous angles Theta, with Von Mise prior.
         x | Theta ~ Normal. Using the population codes directly
@@ -131,6 +184,9 @@ class Sampler:
         # Precompute the parameters and cache them
         self.init_cache_parameters()
 
+        # Network arrays for the compiled slice samplers, set when first used
+        self.compiled_network_parameters = None
+
 
     def init_sampling_parameters(self, parameters_dict=None):
         '''
@@ -139,7 +195,7 @@ class Sampler:
         if parameters_dict is None:
             parameters_dict = dict()
 
-        default_parameters = dict(inference_method='sample', num_samples=200, burn_samples=100, selection_method='last', selection_num_samples=1, slice_width=np.pi/16., slice_jump_prob=0.3, integrate_tc_out=False, num_sampling_passes=1, cued_feature_type='single')
+        default_parameters = dict(inference_method='sample', num_samples=200, burn_samples=100, selection_method='last', selection_num_samples=1, slice_width=np.pi/16., slice_jump_prob=0.3, integrate_tc_out=False, num_sampling_passes=1, cued_feature_type='single', covariance_structure='full', covariance_rank=10, whitened_likelihood=False, slice_sampler_backend='python')
 
         # First defaults parameters
         for param_name, param_value in default_parameters.iteritems():
@@ -226,6 +282,7 @@ class Sampler:
 
 
 
+    @utils_instrumentation.timed('sampler.init_cache_parameters')
     def init_cache_parameters(self, amplify_diag=1.0):
         '''
             Most of our multiplicative factors are fixed, so precompute them, for all tc.
@@ -245,6 +302,9 @@ class Sampler:
         for t in xrange(self.T):
             (self.ATtcB[t], self.mean_fixed_contrib[t], self.inv_covariance_fixed_contrib) = self.precompute_parameters(t, amplify_diag=amplify_diag)
 
+        # Whitened likelihood
+        self.init_whitening_cache()
+
         # Compute the normalization
         self.compute_normalization()
 
@@ -280,31 +340,29 @@ class Sampler:
         inv_covariance_fixed_contrib = self.n_covariances_measured[-1]
 
         # Weird, this solves it. Measured covariances are wrong for generation...
-        inv_covariance_fixed_contrib[np.arange(self.M), np.arange(self.M)] *= amplify_diag
+        #   (skipped if not needed, the covariances can be read-only views of shared memory)
+        if amplify_diag != 1.0:
+            inv_covariance_fixed_contrib[np.arange(self.M), np.arange(self.M)] *= amplify_diag
 
-        # Precompute the inverse, should speedup quite nicely
-        inv_covariance_fixed_contrib = np.linalg.inv(inv_covariance_fixed_contrib)
+        # Precompute the inverse, should speedup quite nicely. Diagonal/low-rank approximations make the likelihood O(M k)
+        inv_covariance_fixed_contrib = utils_likelihood.invert_covariance(inv_covariance_fixed_contrib, structure=self.covariance_structure, rank=self.covariance_rank)
         # inv_covariance_fixed_contrib = np.eye(self.M)
 
         return (ATtcB, mean_fixed_contrib, inv_covariance_fixed_contrib)
 
 
-    def compute_normalization(self):
+    @utils_instrumentation.timed('sampler.compute_normalization')
+    def compute_normalization(self, num_points=500):
         '''
             Compute normalization factor for loglikelihood
-        '''
-
-        self.normalization = np.empty(self.N)
 
-        for n in xrange(self.N):
-            ## Pack parameters and integrate using scipy, super fast
-            params = (self.theta[n], self.NT[n], self.random_network, self.theta_gamma, self.theta_kappa, self.ATtcB[self.tc[n]], self.sampled_feature_index, self.mean_fixed_contrib[self.tc[n]], self.inv_covariance_fixed_contrib)
-
-            self.normalization[n] = np.log(spintg.quad(like_theta_fct_single, -np.pi, np.pi, args=params)[0])
+            Integral of the likelihood of all datapoints, from their loglikelihood grid (see compute_log_normalization).
+        '''
 
+        self.normalization = self.compute_log_normalization(num_points=num_points)
 
-    #######
 
+    @utils_instrumentation.timed('sampler.run_inference')
     def run_inference(self, parameters=None):
         '''
             Infer angles based on memory state
@@ -363,6 +421,7 @@ class Sampler:
         return loglikelihood
 
 
+    @utils_instrumentation.timed('sampler.sample_theta')
     def sample_theta(self, return_samples=False, subset_theta=None, debug=True):
         '''
             Sample the thetas
@@ -395,7 +454,7 @@ class Sampler:
             all_samples = np.zeros((permuted_datapoints.size, self.num_samples))
 
         if debug:
-            search_progress = progress.Progress((self.R - 1)*permuted_datapoints.size)
+            search_progress = progress.ThrottledProgress((self.R - 1)*permuted_datapoints.size, label='sample_theta')
 
         if len(self.theta_to_sample.shape) > 1:
             permutation_fct = np.random.permutation
@@ -444,17 +503,11 @@ class Sampler:
                 if debug:
                     search_progress.increment()
 
-                    if search_progress.done():
-                        eol = '\n'
-                    else:
-                        eol = '\r'
-
-                    line= "%.2f%%, %s - %s" % (search_progress.percentage(), search_progress.time_remaining_str(), search_progress.eta_str())
-                    sys.stdout.write("%s%s%s" % (line, " " * (78-len(line)), eol))
-                    sys.stdout.flush()
-
             i+= 1
 
+        if debug:
+            search_progress.finish()
+
         if return_samples:
             return all_samples
 
@@ -480,17 +533,80 @@ class Sampler:
         return should_lapse, sampled_orientation
 
 
+    def get_compiled_network_parameters(self):
+        '''
+            Network arrays used by the compiled slice samplers, extracted once.
+
+            Returns None, and switches back to the python slice sampler, if the compiled backend cannot be used.
+        '''
+
+        if self.compiled_network_parameters is None:
+            if self.slice_sampler_backend == 'cython':
+                backend_available = load_slicesampler_c() is not None
+            else:
+                backend_available = self.slice_sampler_backend == 'numba' and slicesampler_numba.numba_available
+
+            if not backend_available:
+                print "Slice sampler backend %s not available, using python" % self.slice_sampler_backend
+                self.slice_sampler_backend = 'python'
+                return None
+
+            try:
+                self.compiled_network_parameters = slicesampler_numba.get_network_parameters(self.random_network)
+            except ValueError as e:
+                print "%s. Using python slice sampler" % e
+                self.slice_sampler_backend = 'python'
+
+        return self.compiled_network_parameters
+
+
+    def use_compiled_slice_sampler(self):
+        '''
+            Whether the compiled slice samplers (numba or cython) are used for the current tc likelihood
+        '''
+
+        return self.slice_sampler_backend in ('numba', 'cython') and self.get_compiled_network_parameters() is not None
+
+
+    def get_samples_theta_compiled(self, n, sampled_feature_index=0, num_samples=None):
+        '''
+            Sample theta of datapoint n with the compiled slice sampler, given its current tc.
+
+            Same likelihood and sampler as the python version. Returns (samples, llh)
+        '''
+
+        if num_samples is None:
+            num_samples = self.num_samples
+
+        compiled_params = (self.theta[n].copy(), sampled_feature_index, self.NT[n] - self.mean_fixed_contrib[self.tc[n]], self.ATtcB[self.tc[n]], np.asarray(self.inv_covariance_fixed_contrib)) + self.compiled_network_parameters
+
+        if self.slice_sampler_backend == 'cython':
+            # Uses np.random directly, masks as uint8
+            compiled_params = compiled_params[:-1] + (compiled_params[-1].view(np.uint8), )
+            return load_slicesampler_c().sample_1D_circular(num_samples, self.theta[n, sampled_feature_index], self.burn_samples, self.slice_width, self.slice_jump_prob, *compiled_params)
+
+        return slicesampler_numba.sample_1D_circular(num_samples, self.theta[n, sampled_feature_index], self.burn_samples, self.slice_width, self.slice_jump_prob, np.random.randint(2**31 - 1), *compiled_params)
+
+
     def get_samples_theta_current_tc(self, n, sampled_feature_index=0):
 
+        if self.use_compiled_slice_sampler():
+            return self.get_samples_theta_compiled(n, sampled_feature_index)
+
         # Pack the parameters for the likelihood function.
         #   Here, as the loglike_function only varies one of the input, need to give the rest of the theta vector.
-        params = (self.theta[n], self.NT[n], self.random_network, self.theta_gamma, self.theta_kappa, self.ATtcB[self.tc[n]], sampled_feature_index, self.mean_fixed_contrib[self.tc[n]], self.inv_covariance_fixed_contrib)
+        if self.whitening_factor is not None:
+            loglike_fct = utils_likelihood.loglike_theta_fct_single_whitened
+            params = (self.theta[n], self.NT_whitened[self.tc[n], n], self.random_network, self.ATtcB[self.tc[n]], sampled_feature_index, self.whitening_factor)
+        else:
+            loglike_fct = loglike_theta_fct_single
+            params = (self.theta[n], self.NT[n], self.random_network, self.theta_gamma, self.theta_kappa, self.ATtcB[self.tc[n]], sampled_feature_index, self.mean_fixed_contrib[self.tc[n]], self.inv_covariance_fixed_contrib)
 
         theta_initial = self.theta[n, sampled_feature_index]
         # theta_initial = np.random.rand()*2.*np.pi-np.pi
 
         # Sample the new theta
-        samples, llh = slicesampler.sample_1D_circular(self.num_samples, theta_initial, loglike_theta_fct_single, burn=self.burn_samples, widths=self.slice_width, loglike_fct_params=params, debug=False, step_out=True, jump_probability=self.slice_jump_prob)
+        samples, llh = slicesampler.sample_1D_circular(self.num_samples, theta_initial, loglike_fct, burn=self.burn_samples, widths=self.slice_width, loglike_fct_params=params, debug=False, step_out=True, jump_probability=self.slice_jump_prob)
 
         return (samples, llh)
 
@@ -498,26 +614,86 @@ class Sampler:
     def get_samples_theta_tc_integratedout(self, n, sampled_feature_index=0):
         '''
             Sample theta, with tc integrated out.
-            Use rejection sampling (or something), discarding some samples.
 
-            Note: the actual number of samples returned is random, but around num_samples.
+            Samples directly from the likelihood marginalised over tc, p(tc) = 1/T, using a single slice sampler chain.
         '''
 
-        samples_integratedout = []
-        for tc in xrange(self.T):
-            params = (self.theta[n], self.NT[n], self.random_network, self.theta_gamma, self.theta_kappa, self.ATtcB[tc], sampled_feature_index, self.mean_fixed_contrib[tc], self.inv_covariance_fixed_contrib)
+        params = (self.theta[n], self.NT[n], self.random_network, self.theta_gamma, self.theta_kappa, self.ATtcB, sampled_feature_index, self.mean_fixed_contrib, self.inv_covariance_fixed_contrib)
+
+        theta_initial = self.theta[n, sampled_feature_index]
+
+        samples, _ = slicesampler.sample_1D_circular(self.num_samples, theta_initial, loglike_theta_fct_tc_integratedout, burn=self.burn_samples, widths=self.slice_width, loglike_fct_params=params, debug=False, step_out=True, jump_probability=self.slice_jump_prob)
 
-            theta_initial = self.theta[n, sampled_feature_index]
-            # theta_initial = np.random.rand()*2.*np.pi-np.pi
+        return samples
 
-            samples, _ = slicesampler.sample_1D_circular(self.num_samples, theta_initial, loglike_theta_fct_single, burn=self.burn_samples, widths=self.slice_width, loglike_fct_params=params, debug=False, step_out=True, jump_probability=self.slice_jump_prob)
 
-            # Now keep only some of them, following p(tc)
-            #   for now, p(tc) = 1/T
-            filter_samples = np.random.random_sample(num_samples) < 1./self.T
-            samples_integratedout.extend(samples[filter_samples])
+    def loglike_theta_chains(self, new_thetas, chains, (thetas, datapoints, tc)):
+        '''
+            Loglikelihood of the sampled feature of several chains, for slicesampler.sample_1D_circular_chains.
 
-        return np.array(samples_integratedout)
+            Chain c samples datapoint datapoints[c], its other features set to thetas[c].
+            Same likelihood as get_samples_theta_current_tc/get_samples_theta_tc_integratedout, batched over chains.
+        '''
+
+        thetas = thetas[chains]
+        thetas[:, self.sampled_feature_index] = new_thetas
+        datapoints = datapoints[chains]
+        tc = tc[chains]
+
+        if self.integrate_tc_out:
+            return utils_likelihood.marginalise_loglikelihood(utils_likelihood.loglike_theta_batch(thetas, self.NT[datapoints], self.random_network, self.ATtcB, self.mean_fixed_contrib, self.inv_covariance_fixed_contrib), axis=-1)
+        elif self.whitening_factor is not None:
+            return utils_likelihood.loglike_theta_batch_whitened(thetas, self.NT_whitened[tc, datapoints][:, np.newaxis], self.random_network, self.ATtcB[tc][:, np.newaxis], self.whitening_factor)[:, 0]
+        else:
+            return utils_likelihood.loglike_theta_batch(thetas, self.NT[datapoints], self.random_network, self.ATtcB[tc][:, np.newaxis], self.mean_fixed_contrib[tc][:, np.newaxis], self.inv_covariance_fixed_contrib)[:, 0]
+
+
+    def sample_theta_chains(self, datapoints, num_samples=None):
+        '''
+            Sample the sampled feature of the given datapoints, one independent chain per entry of datapoints.
+
+            All chains run together (slicesampler.sample_1D_circular_chains), each starting from the current theta
+            and discarding its own burn-in. The current thetas are not modified.
+            With a compiled slice_sampler_backend (and tc not integrated out), the chains run one after the other
+            in the compiled sampler instead.
+
+            return: datapoints.size x num_samples
+        '''
+
+        if num_samples is None:
+            num_samples = self.num_samples
+
+        datapoints = np.asarray(datapoints, dtype=int)
+
+        if not self.integrate_tc_out and self.use_compiled_slice_sampler():
+            return np.array([self.get_samples_theta_compiled(n, self.sampled_feature_index, num_samples=num_samples)[0] for n in datapoints]).reshape((datapoints.size, num_samples))
+        params = (self.theta[datapoints], datapoints, self.tc[datapoints])
+
+        samples, _ = slicesampler.sample_1D_circular_chains(num_samples, self.theta[datapoints, self.sampled_feature_index], self.loglike_theta_chains, burn=self.burn_samples, widths=self.slice_width, loglike_fct_params=params, step_out=True, jump_probability=self.slice_jump_prob)
+
+        return samples
+
+
+    @utils_instrumentation.timed('sampler.compute_precision_from_samples_chains')
+    def compute_precision_from_samples_chains(self, datapoints, num_samples=1000, num_repetitions=1, return_samples=False):
+        '''
+            Precision of the samples of num_repetitions chains per datapoint, all sampled at once.
+
+            return: dict(precisions=datapoints.size x num_repetitions, [samples=datapoints.size x num_repetitions x num_samples])
+        '''
+
+        datapoints = np.asarray(datapoints, dtype=int)
+
+        samples = self.sample_theta_chains(np.repeat(datapoints, num_repetitions), num_samples=num_samples).reshape((datapoints.size, num_repetitions, num_samples))
+
+        # Circular std dev of all chains, population vectors are over axis 0
+        circ_std_dev = angle_circular_std_dev(np.rollaxis(samples, -1))
+
+        output = dict(precisions=compute_angle_precision_from_std(circ_std_dev))
+        if return_samples:
+            output['samples'] = samples
+
+        return output
 
 
     def add_output_noise(self, sample):
@@ -551,6 +727,7 @@ class Sampler:
         self.theta[:, self.sampled_feature_index] = new_thetas
 
 
+    @utils_instrumentation.timed('sampler.set_theta_max_likelihood')
     def set_theta_max_likelihood(self, num_points=100, post_optimise=True):
         '''
             Update theta to their Max Likelihood values.
@@ -558,28 +735,18 @@ class Sampler:
         '''
 
         all_angles = np.linspace(-np.pi, np.pi, num_points, endpoint=False)
-        llh = np.zeros(num_points)
 
-        # Compute the array
-        for n in progress.ProgressDisplay(np.arange(self.N), display=progress.SINGLE_LINE):
-
-            # Pack the parameters for the likelihood function
-            params = (self.theta[n], self.NT[n], self.random_network, self.theta_gamma, self.theta_kappa, self.ATtcB[self.tc[n]], self.sampled_feature_index, self.mean_fixed_contrib[self.tc[n]], self.inv_covariance_fixed_contrib)
+        # Max Likelihood angles on the grid, used as initial values for the optimisation routine
+        ml_angles = self.compute_posterior_statistics(thetas=self.theta[:self.N], all_angles=all_angles)['ml_angle']
 
-            # Compute the loglikelihood for all possible first feature
-            # Use this as initial value for the optimisation routine
-            for i in xrange(num_points):
-                # Give the correct cued second feature
-                llh[i] = loglike_theta_fct_single(all_angles[i], params)
-
-            # opt_angles[n] = spopt.fminbound(loglike_theta_fct_single_min, -np.pi, np.pi, params, disp=3)
-            # opt_angles[n] = spopt.brent(loglike_theta_fct_single_min, params)
-            # opt_angles[n] = wrap_angles(np.array([np.mod(spopt.anneal(loglike_theta_fct_single_min, np.random.random_sample()*np.pi*2. - np.pi, args=params)[0], 2.*np.pi)]))
+        if post_optimise:
+            for n in progress.ProgressDisplay(np.arange(self.N), display=progress.SINGLE_LINE):
+                # Pack the parameters for the likelihood function
+                params = (self.theta[n], self.NT[n], self.random_network, self.theta_gamma, self.theta_kappa, self.ATtcB[self.tc[n]], self.sampled_feature_index, self.mean_fixed_contrib[self.tc[n]], self.inv_covariance_fixed_contrib)
 
-            if post_optimise:
-                self.theta[n, self.sampled_feature_index] = spopt.fmin(loglike_theta_fct_single_min, all_angles[np.argmax(llh)], args=params, disp=False)[0]
-            else:
-                self.theta[n, self.sampled_feature_index] = all_angles[np.argmax(llh)]
+                self.theta[n, self.sampled_feature_index] = spopt.fmin(loglike_theta_fct_single_min, ml_angles[n], args=params, disp=False)[0]
+        else:
+            self.theta[:self.N, self.sampled_feature_index] = ml_angles
 
         # Add output noise if desired.
         self.theta[:, self.sampled_feature_index] = self.add_output_noise_vectorized(self.theta[:, self.sampled_feature_index])
@@ -642,6 +809,7 @@ class Sampler:
         return np.nansum(self.compute_loglikelihood_N(integrate_tc_out=integrate_tc_out, precision=precision))
 
 
+    @utils_instrumentation.timed('sampler.compute_loglikelihood_N')
     def compute_loglikelihood_N(self, integrate_tc_out=False, precision=200, lapse_likelihood_lower_bound=False):
         '''
             Compute the loglikelihood for each datapoint, using the current setting of thetas and likelihood functions.
@@ -654,7 +822,8 @@ class Sampler:
             LL += self.compute_loglikelihood_N_convolved_output_noise(precision=precision)
         else:
             if integrate_tc_out:
-                LL += self.compute_loglikelihood_tc_integratedout()
+                # Marginalise over the recall times, p(tc) = 1/T
+                LL += utils_likelihood.marginalise_loglikelihood(self.compute_loglikelihood_tc_integratedout(), axis=1)
             else:
                 LL += self.compute_loglikelihood_current_tc()
 
@@ -681,49 +850,11 @@ class Sampler:
         return np.nansum(np.sort(all_loglikelihoods)[self.N/10:])
 
 
-    def compute_loglikelihood_current_tc(self):
+    def compute_loglikelihood_N_convolved_output_noise_spline(self, precision=100):
         '''
             Compute the loglikelihood for the current setting of thetas and tc and using the likelihood defined in loglike_theta_fct_single
-        '''
 
-        loglikelihood = np.empty(self.N)
-
-        for n in xrange(self.N):
-            # Pack the parameters for the likelihood function
-            params = (self.theta[n].copy(), self.NT[n], self.random_network, self.theta_gamma, self.theta_kappa, self.ATtcB[self.tc[n]], self.sampled_feature_index, self.mean_fixed_contrib[self.tc[n]], self.inv_covariance_fixed_contrib)
-
-            # Compute the loglikelihood for the current datapoint
-            loglikelihood[n] = loglike_theta_fct_single(self.theta[n, self.sampled_feature_index], params)
-
-        loglikelihood -= self.normalization[:self.N]
-
-        return loglikelihood
-
-
-    def compute_loglikelihood_tc_integratedout(self):
-        '''
-            Compute the loglikelihood for the current setting of thetas and using the likelihood defined in loglike_theta_fct_single
-            Integrates tc out.
-        '''
-
-        loglikelihood = np.empty((self.N, self.T))
-
-        for n in xrange(self.N):
-            for tc in xrange(self.T):
-                # Pack the parameters for the likelihood function
-                params = (self.theta[n].copy(), self.NT[n], self.random_network, self.theta_gamma, self.theta_kappa, self.ATtcB[tc], self.sampled_feature_index, self.mean_fixed_contrib[tc], self.inv_covariance_fixed_contrib)
-
-                # Compute the loglikelihood for the current datapoint
-                loglikelihood[n, tc] = loglike_theta_fct_single(self.theta[n, self.sampled_feature_index], params)
-
-        loglikelihood -= self.normalization[:self.N]
-
-        return loglikelihood
-
-
-    def compute_loglikelihood_N_convolved_output_noise(self, precision=100):
-        '''
-            Compute the loglikelihood for the current setting of thetas and tc and using the likelihood defined in loglike_theta_fct_single
+            Reference version of compute_loglikelihood_N_convolved_output_noise, one spline per datapoint.
         '''
 
         # TODO CONVERT ME
@@ -1094,6 +1225,7 @@ class Sampler:
 
     ########
 
+    @utils_instrumentation.timed('sampler.fit_mixture_model')
     def fit_mixture_model(self, compute_responsibilities=False, use_all_targets=False):
         '''
             Fit Paul Bays' Mixture model.
@@ -1139,80 +1271,16 @@ class Sampler:
         return KL_div(model_mixtprop, data_mixtprop)
 
 
-    def estimate_fisher_info_from_posterior(self, n=0, all_angles=None, num_points=500):
-        '''
-            Look at the curvature of the posterior to estimate the Fisher Information
-        '''
-
-        if all_angles is None:
-            all_angles = np.linspace(-np.pi, np.pi, num_points)
-
-        log_posterior = self.compute_likelihood_fullspace(n=n, all_angles=all_angles, num_points=num_points, should_exponentiate=False, remove_mean=True)[:, self.tc[n]].T
-
-        # Look if it seems Gaussian enough
-
-        # log_posterior = np.log(posterior.T)
-        log_posterior[np.isinf(log_posterior)] = 0.0
-        log_posterior[np.isnan(log_posterior)] = 0.0
-
-        dx = np.diff(all_angles)[0]
-
-        # posterior /= np.sum(posterior*dx)
-
-        np.seterr(all='raise')
-        try:
-            # Incorrect here, see Issue #23
-            # FI_estim_curv = np.trapz(-np.gradient(np.gradient(log_posterior))*posterior/dx**2., x)
-
-            ml_index = np.argmax(log_posterior)
-            curv_logp = -np.gradient(np.gradient(log_posterior))/dx**2.
-
-            # take the curvature at the ML value
-            FI_estim_curv = curv_logp[ml_index]
-        except FloatingPointError:
-            # print 'Overflow on n: %d' % n
-            FI_estim_curv = np.nan
-
-        np.seterr(all='warn')
-
-        return FI_estim_curv
-
-
-
-    def estimate_fisher_info_from_posterior_avg(self, num_points=500, full_stats=False):
-        '''
-            Estimate the Fisher Information from the curvature of the posterior.
-
-            Takes the mean over all datapoints.
-        '''
-
-        mean_FI = np.zeros(self.N)
-
-        all_angles = np.linspace(-np.pi, np.pi, num_points)
-
-        for i in progress.ProgressDisplay(np.arange(self.N), display=progress.SINGLE_LINE):
-            mean_FI[i] = self.estimate_fisher_info_from_posterior(n=i, all_angles=all_angles)
-
-        if full_stats:
-            return dict(mean=nanmean(mean_FI), std=nanstd(mean_FI), median=nanmedian(mean_FI), all=mean_FI)
-        else:
-            return nanmean(mean_FI)
-
-
     def estimate_fisher_info_from_posterior_avg_randomsubset(self, subset_size=1, num_points=500, full_stats=False):
         '''
             Estimate the Fisher Information from the curvature of the posterior.
 
-            Takes the mean over all datapoints.
+            Takes the mean over a random subset of datapoints.
         '''
 
-        mean_FI = np.zeros(subset_size)
         random_subset = np.random.randint(self.N, size=subset_size)
 
-        all_angles = np.linspace(-np.pi, np.pi, num_points)
-
-        for i in progress.ProgressDisplay(np.arange(subset_size), display=progress.SINGLE_LINE):
-            mean_FI[i] = self.estimate_fisher_info_from_posterior(n=random_subset[i], all_angles=all_angles)
+        mean_FI = self.compute_posterior_statistics(datapoints=random_subset, num_points=num_points)['fisher_info']
 
         if full_stats:
             return dict(mean=nanmean(mean_FI), std=nanstd(mean_FI), median=nanmedian(mean_FI), all=mean_FI)
@@ -1275,6 +1343,7 @@ class Sampler:
         return self.random_network.compute_fisher_information_theoretical(sigma=sigma)
 
 
+    @utils_instrumentation.timed('sampler.estimate_marginal_inverse_fisher_info_montecarlo')
     def estimate_marginal_inverse_fisher_info_montecarlo(self):
         '''
             Compute a Monte Carlo estimate of the Marginal Inverse Fisher Information.
@@ -1291,50 +1360,6 @@ class Sampler:
         return FI_estimates
 
 
-    def estimate_precision_from_posterior(self, n=0, num_points=500):
-        '''
-            Look at the posterior to estimate the precision directly
-        '''
-
-        posterior = self.plot_likelihood_correctlycuedtimes(n=n, num_points=num_points, should_plot=False, should_return=True, should_exponentiate = True, debug=False)[:, 0]
-
-        x = np.linspace(-np.pi, np.pi, num_points)
-        dx = np.diff(x)[0]
-
-        posterior /= np.sum(posterior*dx)
-
-        np.seterr(all='raise')
-        try:
-            # TODO Precision withouth square?
-            precision_estimated = 1./(-2.*np.log(np.abs(np.trapz(posterior*np.exp(1j*x), x))))
-        except FloatingPointError:
-            # print 'Overflow on n: %d' % n
-            precision_estimated = np.nan
-
-        np.seterr(all='warn')
-
-        return precision_estimated
-
-
-
-    def estimate_precision_from_posterior_avg(self, num_points=500, full_stats=False):
-        '''
-            Estimate the precision from the posterior.
-
-            Takes the mean over all datapoints.
-        '''
-
-        precisions = np.zeros(self.N)
-
-        for i in progress.ProgressDisplay(np.arange(self.N), display=progress.SINGLE_LINE):
-            precisions[i] = self.estimate_precision_from_posterior(n=i, num_points=num_points)
-
-        if full_stats:
-            return dict(mean=nanmean(precisions), std=nanstd(precisions), median=nanmedian(precisions), all=precisions)
-        else:
-            return nanmean(precisions)
-
-
     def estimate_precision_from_posterior_avg_randomsubset(self, subset_size=1, num_points=1000, full_stats=False):
         '''
             Estimate the precision from the posterior.
@@ -1344,10 +1369,7 @@ class Sampler:
 
         random_subset = np.random.randint(self.N, size=subset_size)
 
-        precisions = np.zeros(subset_size)
-
-        for i in progress.ProgressDisplay(xrange(subset_size), display=progress.SINGLE_LINE):
-            precisions[i] = self.estimate_precision_from_posterior(n=random_subset[i], num_points=num_points)
+        precisions = self.compute_posterior_statistics(datapoints=random_subset, num_points=num_points)['precision']
 
         if full_stats:
             return dict(mean=nanmean(precisions), std=nanstd(precisions), median=nanmedian(precisions), all=precisions)
@@ -1358,31 +1380,18 @@ class Sampler:
     def estimate_precision_from_samples(self, n=0, num_samples=1000, num_repetitions=1, selection_method='median', return_samples=False):
         '''
             Take samples of theta for a particular datapoint, and estimate the precision from their distribution.
-        '''
-
-        all_precisions = np.zeros(num_repetitions)
 
-        if return_samples:
-            all_samples = np.zeros((num_repetitions, num_samples))
-
-        for repet_i in xrange(num_repetitions):
-
-            # Get samples
-            samples = self.sample_theta(return_samples=True, subset_theta=[n])[0]
-
-            # Estimate the circular standard deviation of those samples
-            circ_std_dev = angle_circular_std_dev(samples)
+            The num_repetitions chains are sampled together.
+        '''
 
-            # And now get the precision (uncorrected for chance level)
-            all_precisions[repet_i] = compute_angle_precision_from_std(circ_std_dev)
+        res = self.compute_precision_from_samples_chains([n], num_samples=num_samples, num_repetitions=num_repetitions, return_samples=return_samples)
 
-            if return_samples:
-                all_samples[repet_i] = samples
+        all_precisions = res['precisions'][0]
 
         output = dict(mean=np.mean(all_precisions), std=np.std(all_precisions), all=all_precisions)
 
         if return_samples:
-            output['samples'] = all_samples
+            output['samples'] = res['samples'][0]
 
         return output
 
@@ -1390,26 +1399,20 @@ class Sampler:
     def estimate_precision_from_samples_avg(self, num_samples=1000, num_repetitions=1, full_stats=False, selection_method='median', return_samples=False):
         '''
             Estimate precision from the samples. Get it for every datapoint.
-        '''
-
-        all_precision = np.zeros(self.N)
-        all_precision_everything = np.zeros((self.N, num_repetitions))
 
-        if return_samples:
-            all_samples = np.zeros((self.N, num_repetitions, num_samples))
-
-        for i in progress.ProgressDisplay(xrange(self.N), display=progress.SINGLE_LINE):
-            # print i
-            res = self.estimate_precision_from_samples(n=i, num_samples=num_samples, num_repetitions=num_repetitions, selection_method=selection_method, return_samples=return_samples)
+            The chains of all datapoints and repetitions are sampled together.
+        '''
 
-            all_precision[i] = res['mean']
-            all_precision_everything[i] = res['all']
+        res = self.compute_precision_from_samples_chains(np.arange(self.N), num_samples=num_samples, num_repetitions=num_repetitions, return_samples=return_samples)
 
-            if return_samples:
-                all_samples[i] = res['samples']
+        all_precision_everything = res['precisions']
+        all_precision = np.mean(all_precision_everything, axis=-1)
 
         if full_stats:
-            return dict(mean=nanmean(all_precision), std=nanstd(all_precision), median=nanmedian(all_precision), all=all_precision_everything)
+            output = dict(mean=nanmean(all_precision), std=nanstd(all_precision), median=nanmedian(all_precision), all=all_precision_everything)
+            if return_samples:
+                output['samples'] = res['samples']
+            return output
         else:
             return nanmean(all_precision)
 
@@ -1418,27 +1421,21 @@ class Sampler:
         '''
             Estimate precision from the samples. Get it for every datapoint.
 
-            Takes the mean over a subset of datapoints.
+            Takes the mean over a subset of datapoints. The chains of all datapoints and repetitions are sampled together.
         '''
 
         random_subset = np.random.randint(self.N, size=subset_size)
 
-        all_precision = np.zeros(subset_size)
-        all_precision_everything = np.zeros((subset_size, num_repetitions))
-        if return_samples:
-            all_samples = np.zeros((subset_size, num_repetitions, num_samples))
-
+        res = self.compute_precision_from_samples_chains(random_subset, num_samples=num_samples, num_repetitions=num_repetitions, return_samples=return_samples)
 
-        for i in progress.ProgressDisplay(xrange(subset_size), display=progress.SINGLE_LINE):
-            res = self.estimate_precision_from_samples(n=random_subset[i], num_samples=num_samples, num_repetitions=num_repetitions, selection_method=selection_method, return_samples=return_samples)
-
-            all_precision[i] = res['mean']
-            all_precision_everything[i] = res['all']
-            if return_samples:
-                all_samples[i] = res['samples']
+        all_precision_everything = res['precisions']
+        all_precision = np.mean(all_precision_everything, axis=-1)
 
         if full_stats:
-            return dict(mean=nanmean(all_precision), std=nanstd(all_precision), median=nanmedian(all_precision), all=all_precision_everything)
+            output = dict(mean=nanmean(all_precision), std=nanstd(all_precision), median=nanmedian(all_precision), all=all_precision_everything)
+            if return_samples:
+                output['samples'] = res['samples']
+            return output
         else:
             return nanmean(all_precision)
 
@@ -1898,13 +1895,43 @@ class Sampler:
 
 
 ####################################
-if __name__ == '__main__':
+def build_test_sampler(**parameters):
+    '''
+        Sampler built on the data_gen and stat_meas of launchers.init_everything, experimentlauncher defaults overridden by parameters
+    '''
+    import experimentlauncher
+    import launchers
 
-    print "====> DEPRECATED, use experimentlauncher.py instead"
+    all_parameters = experimentlauncher.ExperimentLauncher(run=False, arguments_dict=dict(dict(inference_method='none', autoset_parameters=None, sigmay=0.0001), **parameters)).args_dict
 
-    import experimentlauncher
-    experiment_launcher = experimentlauncher.ExperimentLauncher(run=True)
+    (_, data_gen, stat_meas, _) = launchers.init_everything(all_parameters)
+
+    return Sampler(data_gen, n_parameters=stat_meas.model_parameters, tc=all_parameters['cued_feature_time'], sigma_output=all_parameters['sigma_output'], parameters_dict=all_parameters, lapse_rate=all_parameters['lapse_rate'])
+
+
+def test():
+    '''
+        Check the batched loglikelihoods against loglike_theta_fct_single and loglike_theta_fct_tc_integratedout
+    '''
+
+    np.random.seed(10)
 
-    plt.show()
+    sampler = build_test_sampler(code_type='conj', M=100, N=20, T=2)
+
+    loglikelihood = sampler.compute_loglikelihood_current_tc()
+    loglikelihood_integratedout = utils_likelihood.marginalise_loglikelihood(sampler.compute_loglikelihood_tc_integratedout(), axis=1)
+
+    for n in xrange(sampler.N):
+        t = sampler.tc[n]
+        params = (sampler.theta[n].copy(), sampler.NT[n], sampler.random_network, sampler.theta_gamma, sampler.theta_kappa, sampler.ATtcB[t], sampler.sampled_feature_index, sampler.mean_fixed_contrib[t], sampler.inv_covariance_fixed_contrib)
+        assert np.allclose(loglikelihood[n] + sampler.normalization[n], loglike_theta_fct_single(sampler.theta[n, sampler.sampled_feature_index], params), rtol=1e-8, atol=1e-8)
+
+        params = (sampler.theta[n].copy(), sampler.NT[n], sampler.random_network, sampler.theta_gamma, sampler.theta_kappa, sampler.ATtcB, sampler.sampled_feature_index, sampler.mean_fixed_contrib, sampler.inv_covariance_fixed_contrib)
+        assert np.allclose(loglikelihood_integratedout[n] + sampler.normalization[n], loglike_theta_fct_tc_integratedout(sampler.theta[n, sampler.sampled_feature_index], params), rtol=1e-8, atol=1e-8)
+
+
+
+if __name__ == '__main__':
+    test()
 
 
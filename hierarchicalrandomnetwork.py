@@ -9,6 +9,7 @@ Copyright (c) 2013 Gatsby Unit. All rights reserved.
 
 import pylab as plt
 import numpy as np
+import scipy.sparse as spsp
 # import scipy as sp
 # import scipy.special as scsp
 # import progress
@@ -18,6 +19,7 @@ import matplotlib.colors as pltcol
 
 from highdimensionnetwork import HighDimensionNetwork
 import utils
+import utils_fisherinformation
 
 
 class HierarchialRandomNetwork(object):
@@ -26,6 +28,8 @@ class HierarchialRandomNetwork(object):
         Consist of two layers:
         - The first one provides some smooth basis on a conjunctive space of features.
         - The second samples the first randomly and computes a non-linear weighted sum of them
+
+        With sparse_sampling, the sampling matrix is stored as a CSR sparse matrix (for large layers).
     '''
     def __init__(self, M, R=2, gain=1.0, ratio_hierarchical=None,
                  M_layer_one=100, type_layer_one='conjunctive',
@@ -33,7 +37,7 @@ class HierarchialRandomNetwork(object):
                  rcscale_layer_one=5.0, ratio_layer_one=200.0,
                  nonlinearity_fct='positive_linear', threshold=0.0,
                  sparsity_weights=0.7, distribution_weights='exponential',
-                 sigma_weights=0.5, normalise_weights=True, debug=True):
+                 sigma_weights=0.5, normalise_weights=True, sparse_sampling=False, debug=True):
 
         assert R == 2, 'HiearchialRandomNetwork defined over two features for now'
 
@@ -59,6 +63,7 @@ class HierarchialRandomNetwork(object):
         self.distribution_weights = distribution_weights
         self.type_layer_one = type_layer_one
         self.output_both_layers = output_both_layers
+        self.sparse_sampling = sparse_sampling
 
         self._ALL_NEURONS = np.arange(M)
 
@@ -80,7 +85,7 @@ class HierarchialRandomNetwork(object):
         # Initialise everything
         self.construct_layer_one(type_layer=type_layer_one)
         self.construct_nonlinearity_fct(fct=nonlinearity_fct, threshold=threshold)
-        self.construct_A_sampling(sparsity=sparsity_weights, distribution_weights=distribution_weights, sigma_weights=sigma_weights, normalise=normalise_weights)
+        self.construct_A_sampling(sparsity=sparsity_weights, distribution_weights=distribution_weights, sigma_weights=sigma_weights, normalise=normalise_weights, sparse=sparse_sampling)
 
         self.population_code_type = 'hierarchical'
         self.coordinates = 'full_angles_sym'
@@ -101,8 +106,7 @@ class HierarchialRandomNetwork(object):
                     self.M_layer_one,
                     R=self.R,
                     rcscale=self.rcscale_layer_one,
-                    autoset_parameters=self.optimal_coverage,
-                    response_type='bivariate_fisher')
+                    autoset_parameters=self.optimal_coverage)
 
         elif type_layer == 'feature':
             self.layer_one_network = \
@@ -123,18 +127,27 @@ class HierarchialRandomNetwork(object):
             Input:
                 fct: if function, used as it is. If string, switch between
                     exponential, identity, rectify
+
+            Also sets its derivative, nonlinearity_fct_derivative (finite differences for given functions).
         '''
 
         if utils.is_function(fct):
             # Function given, just use that
             self.nonlinearity_fct = fct
+
+            def finite_differences_derivative(x, epsilon=1e-6):
+                return (fct(x + epsilon) - fct(x - epsilon))/(2.*epsilon)
+
+            self.nonlinearity_fct_derivative = finite_differences_derivative
         else:
 
             # Switch based on some supported functions
             if fct == 'exponential':
                 self.nonlinearity_fct = np.exp
+                self.nonlinearity_fct_derivative = np.exp
             elif fct == 'identity':
                 self.nonlinearity_fct = lambda x: x
+                self.nonlinearity_fct_derivative = np.ones_like
             elif fct == 'positive_linear':
 
                 self.threshold = threshold
@@ -144,20 +157,33 @@ class HierarchialRandomNetwork(object):
 
                     def positive_linear(x):
                         return (4. * np.pi**2. * x - self.threshold).clip(0.0)
+
+                    def positive_linear_derivative(x):
+                        return 4. * np.pi**2. * (4. * np.pi**2. * x > self.threshold)
                 else:
                     def positive_linear(x):
                         return (x - self.threshold).clip(0.0)
 
+                    def positive_linear_derivative(x):
+                        return (x > self.threshold).astype(float)
+
                 self.nonlinearity_fct = positive_linear
+                self.nonlinearity_fct_derivative = positive_linear_derivative
 
 
-    def construct_A_sampling(self, sparsity=0.1, distribution_weights='randn', sigma_weights=0.1, normalise=False):
+    def construct_A_sampling(self, sparsity=0.1, distribution_weights='randn', sigma_weights=0.1, normalise=False, sparse=False):
         '''
             Creates the sampling matrix A for the network.
 
             Should have a small (sparsity amount) of non-zero weights. Weights are sampled independently from a gaussian distribution.
+
+            If sparse, A is a CSR matrix, built directly from its non-zero weights (different random draws than the dense version).
         '''
 
+        if sparse:
+            self.construct_A_sampling_sparse(sparsity=sparsity, distribution_weights=distribution_weights, sigma_weights=sigma_weights, normalise=normalise)
+            return
+
         if distribution_weights == 'randn':
             self.A_sampling = sigma_weights * np.random.randn(self.M_layer_two, self.M_layer_one) * (np.random.rand(self.M_layer_two, self.M_layer_one) <= sparsity)
         elif distribution_weights == 'exponential':
@@ -179,6 +205,30 @@ class HierarchialRandomNetwork(object):
             self.gain /= self.M_layer_one * sigma_weights
 
 
+    def construct_A_sampling_sparse(self, sparsity=0.1, distribution_weights='randn', sigma_weights=0.1, normalise=False):
+        '''
+            Creates the sampling matrix A as a CSR sparse matrix, see construct_A_sampling.
+
+            Only the non-zero weights are sampled, memory is linear in their number.
+        '''
+
+        if distribution_weights == 'randn':
+            weights_fct = lambda size: sigma_weights * np.random.randn(size)
+        elif distribution_weights == 'exponential':
+            weights_fct = lambda size: np.random.exponential(sigma_weights, size)
+        else:
+            raise ValueError('distribution_weights should be randn/exponential')
+
+        self.A_sampling = spsp.random(self.M_layer_two, self.M_layer_one, density=min(sparsity, 1.0), format='csr', data_rvs=weights_fct)
+
+        if normalise == 1:
+            # Normalise the rows to get a maximum activation level per neuron
+            self.A_sampling = spsp.diags(1. / np.asarray(self.A_sampling.sum(axis=1)).ravel()).dot(self.A_sampling).tocsr()
+        elif normalise == 2:
+            # Normalise the network activity by the number of layer one neurons
+            self.gain /= self.M_layer_one * sigma_weights
+
+
     ##
     # Network behaviour
     ##
@@ -242,9 +292,9 @@ class HierarchialRandomNetwork(object):
         '''
 
         if specific_neurons is None:
-            self.current_layer_two_response = self.gain * self.nonlinearity_fct(np.dot(self.A_sampling, layer_one_response))
+            self.current_layer_two_response = self.gain * self.nonlinearity_fct(self.A_sampling.dot(layer_one_response))
         else:
-            self.current_layer_two_response = self.gain * self.nonlinearity_fct(np.dot(self.A_sampling[specific_neurons], layer_one_response))
+            self.current_layer_two_response = self.gain * self.nonlinearity_fct(self.A_sampling[specific_neurons].dot(layer_one_response))
 
         return self.current_layer_two_response
 
@@ -258,7 +308,7 @@ class HierarchialRandomNetwork(object):
         self.current_layer_one_response = self.layer_one_network.get_network_response_opt2d(theta1, theta2)
 
         # Combine those responses according the the sampling matrices
-        self.current_layer_two_response = self.gain * self.nonlinearity_fct(np.dot(self.A_sampling, self.current_layer_one_response))
+        self.current_layer_two_response = self.gain * self.nonlinearity_fct(self.A_sampling.dot(self.current_layer_one_response))
 
         if self.output_both_layers:
             # Should return the activity of both layers collated
@@ -269,6 +319,91 @@ class HierarchialRandomNetwork(object):
             return self.current_layer_two_response
 
 
+    def get_layers_response_batch(self, stimuli_input):
+        '''
+            Responses of both layers for multiple stimuli at once.
+
+            Does not change current_layer_one_response/current_layer_two_response.
+
+            stimuli_input: S x R
+            return: (layer_one_responses S x M_layer_one, layer_two_inputs S x M_layer_two),
+                    layer_two_inputs being A x_1, before the nonlinearity.
+        '''
+
+        layer_one_responses = self.layer_one_network.get_network_response_batch(stimuli_input)
+        layer_two_inputs = self.A_sampling.dot(layer_one_responses.T).T
+
+        return layer_one_responses, layer_two_inputs
+
+
+    def get_network_response_batch(self, stimuli_input):
+        '''
+            Compute the response of the network for multiple stimuli at once.
+
+            Same output as get_network_response, does not change the current layer responses.
+
+            stimuli_input: S x R
+            return: S x M
+        '''
+
+        layer_one_responses, layer_two_inputs = self.get_layers_response_batch(stimuli_input)
+        layer_two_responses = self.gain * self.nonlinearity_fct(layer_two_inputs)
+
+        if self.output_both_layers:
+            return np.c_[layer_two_responses, layer_one_responses]
+        else:
+            return layer_two_responses
+
+
+    def get_jacobian_network_response_batch(self, stimuli_input):
+        '''
+            Derivatives of the network response for multiple stimuli, for all features at once.
+
+            Chain rule through the sampling matrix: d x_2 = gain f'(A x_1) A d x_1
+
+            stimuli_input: S x R
+            return: S x R x M
+        '''
+
+        stimuli_input = np.atleast_2d(stimuli_input)
+
+        layer_one_jacobian = self.layer_one_network.get_jacobian_network_response_batch(stimuli_input)
+        layer_one_jacobian[np.isnan(layer_one_jacobian)] = 0.0
+
+        _, layer_two_inputs = self.get_layers_response_batch(stimuli_input)
+
+        # A d x_1 for all stimuli and features in one product: (S R) x M_layer_one
+        layer_two_jacobian = self.A_sampling.dot(layer_one_jacobian.reshape((-1, self.M_layer_one)).T).T.reshape((stimuli_input.shape[0], self.R, self.M_layer_two))
+        layer_two_jacobian *= self.gain * self.nonlinearity_fct_derivative(layer_two_inputs)[:, np.newaxis, :]
+
+        if self.output_both_layers:
+            return np.concatenate((layer_two_jacobian, layer_one_jacobian), axis=-1)
+        else:
+            return layer_two_jacobian
+
+
+    def get_derivative_network_response_batch(self, stimuli_input, derivative_feature_target=0):
+        '''
+            Derivative of the network response along one feature, for multiple stimuli.
+
+            stimuli_input: S x R
+            return: S x M
+        '''
+
+        return self.get_jacobian_network_response_batch(stimuli_input)[:, derivative_feature_target]
+
+
+    def get_derivative_network_response(self, derivative_feature_target=0, stimulus_input=None):
+        '''
+            Compute and return the derivative of the network response.
+        '''
+
+        if stimulus_input is None:
+            stimulus_input = (0.0,) * self.R
+
+        return self.get_derivative_network_response_batch(np.array(stimulus_input, dtype=float)[np.newaxis], derivative_feature_target=derivative_feature_target)[0]
+
+
     def compute_maximum_activation_network(self, nb_samples=100):
         '''
             Try to estimate the maximum activation for the network.
@@ -278,11 +413,7 @@ class HierarchialRandomNetwork(object):
 
         test_samples = utils.sample_angle((nb_samples, self.R))
 
-        max_activation = 0
-        for test_sample in test_samples:
-            max_activation = max(np.nanmax(self.get_network_response(test_sample)), max_activation)
-
-        return max_activation
+        return np.nanmax(self.get_network_response_batch(test_samples))
 
     ##
     # Theoretical stuff
@@ -290,12 +421,30 @@ class HierarchialRandomNetwork(object):
 
     def compute_marginal_inverse_FI(self, k_items, inv_cov_stim, max_n_samples=int(1e5), min_distance=0.1, convergence_epsilon=1e-7, debug=False):
         '''
-            Computing the fisher information for a hierarchical code is not yet defined.
+            Compute a Monte Carlo estimate of the Marginal Inverse Fisher Information
+            Averages over stimuli values. Requires the inverse of the covariance of the memory.
+
+            Derivatives are computed in blocks of samples, see utils_fisherinformation.compute_marginal_inverse_FI.
+
+            Returns dict(inv_FI, inv_FI_std, FI, FI_std)
+        '''
+
+        return utils_fisherinformation.compute_marginal_inverse_FI(self.get_jacobian_network_response_batch, k_items, inv_cov_stim, self.M, R=self.R, max_n_samples=max_n_samples, min_distance=min_distance, convergence_epsilon=convergence_epsilon, debug=debug)
+
+
+    def compute_fisher_information(self, stimulus_input=None, sigma=0.01, cov_stim=None, kappa_different=False, params={}, inv_cov_stim=None):
+        '''
+            Fisher information of the first feature, for the given covariance (or isotropic noise of std sigma)
         '''
-        return dict(inv_FI=0.0, inv_FI_std=0.0, FI=0.0, FI_std=0.0)
 
-    def compute_fisher_information(self, stimulus_input=None, sigma=0.01, cov_stim=None, kappa_different=False, params={}):
-        return 0.0
+        der_f = self.get_derivative_network_response(derivative_feature_target=0, stimulus_input=stimulus_input)
+
+        if cov_stim is not None:
+            return np.dot(der_f, np.linalg.solve(cov_stim, der_f))
+        elif inv_cov_stim is not None:
+            return np.dot(der_f, utils_fisherinformation.dot_inverse_covariance(der_f, inv_cov_stim))
+        else:
+            return np.dot(der_f, der_f)/sigma**2.
 
 
     ##
@@ -429,6 +578,29 @@ def test_hierarchical_conjunctive():
     hrn.get_neuron_activity(0, precision=100)
 
 
+def test_batch_response_derivatives():
+    print 'Compare batched responses and derivatives, with dense and sparse sampling matrices'
+
+    stimuli = utils.sample_angle((20, 2))
+    epsilon = 1e-6
+
+    for sparse_sampling in [False, True]:
+        hrn = HierarchialRandomNetwork(100, M_layer_one=100, sparsity_weights=0.3, nonlinearity_fct='exponential', output_both_layers=True, sparse_sampling=sparse_sampling, debug=False)
+
+        responses = hrn.get_network_response_batch(stimuli)
+        assert np.allclose(responses, np.array([hrn.get_network_response(stimulus) for stimulus in stimuli]))
+
+        # Derivatives follow the sign convention of HighDimensionNetwork.get_derivative_network_response: d/dpreferred
+        jacobian = hrn.get_jacobian_network_response_batch(stimuli)
+        for r in xrange(2):
+            shift = np.zeros(2)
+            shift[r] = epsilon
+            finite_differences = (hrn.get_network_response_batch(stimuli - shift) - hrn.get_network_response_batch(stimuli + shift))/(2.*epsilon)
+            assert np.allclose(jacobian[:, r], finite_differences, rtol=1e-4, atol=1e-6)
+
+        assert np.allclose(hrn.get_derivative_network_response(1, stimuli[0]), jacobian[0, 1])
+
+
 if __name__ == '__main__':
     test_hierarchical_conjunctive()
 
@@ -22,6 +22,13 @@ import scipy.stats as spst
 import progress
 
 import utils
+import utils_diskcache
+import utils_vonmises
+import utils_fisherinformation
+
+
+# Number of responses (stimuli x neurons) computed at once by the blocked methods
+BLOCK_NUM_ELEMENTS = 2**20
 
 
 class HighDimensionNetwork(object):
@@ -50,6 +57,7 @@ class HighDimensionNetwork(object):
 
         self.get_network_response_opt = None
 
+        self.response_maxout = response_maxout
         if response_maxout:
             print ' -- new maxout response'
             self.get_network_response_bivariatefisher_callback = self.get_network_response_bivariatefisher_maxoutput
@@ -206,6 +214,7 @@ class HighDimensionNetwork(object):
             self.normalisation = np.zeros(self.M)
             self.normalisation_fisher_all = np.zeros((self.M, self.R))
             self.normalisation_gauss_all = np.zeros((self.M, self.R))
+            self.log_normalisation_fisher_all = np.zeros((self.M, self.R))
 
         # The normalising constant
         #   Overflows have happened, but they have no real consequence, as 1/inf = 0.0, appropriately.
@@ -215,10 +224,14 @@ class HighDimensionNetwork(object):
             self.normalisation_gauss_all = np.sqrt(self.neurons_sigma)/(np.sqrt(2*np.pi))
 
             self.normalisation = np.prod(self.normalisation_fisher_all, axis=-1)
+
+            # Finite for large kappas, used by the batched responses
+            self.log_normalisation_fisher_all = np.log(2.*np.pi) + utils_vonmises.log_i0(self.neurons_sigma)
         else:
             self.normalisation_fisher_all[specific_neurons] = 2.*np.pi*scsp.i0(self.neurons_sigma[specific_neurons])
             self.normalisation_gauss_all[specific_neurons] = np.sqrt(self.neurons_sigma[specific_neurons])/(np.sqrt(2*np.pi))
             self.normalisation[specific_neurons] = np.prod(self.normalisation_fisher_all[specific_neurons], axis=-1)
+            self.log_normalisation_fisher_all[specific_neurons] = np.log(2.*np.pi) + utils_vonmises.log_i0(self.neurons_sigma[specific_neurons])
 
 
     def compute_maximum_activation_network(self, nb_samples=100):
@@ -230,11 +243,7 @@ class HighDimensionNetwork(object):
 
         test_samples = utils.sample_angle((nb_samples, self.R))
 
-        max_activation = 0
-        for test_sample in test_samples:
-            max_activation = max(np.nanmax(self.get_network_response(test_sample)), max_activation)
-
-        return max_activation
+        return np.nanmax(self.get_network_response_blocks(test_samples))
 
 
 
@@ -314,6 +323,70 @@ class HighDimensionNetwork(object):
         return output
 
 
+    def get_network_response_batch(self, stimuli_input, dtype=np.float64):
+        '''
+            Compute the response of the network for multiple stimuli at once, for any R.
+
+            The log-response is accumulated one feature at a time, so memory stays S x M.
+            Large kappas use the Normal approximation of get_network_response_large_kappa_safe.
+            dtype=np.float32 halves memory and bandwidth, for large S/M.
+
+            stimuli_input: S x R
+            return: S x M
+        '''
+
+        stimuli_input = np.atleast_2d(stimuli_input).astype(dtype, copy=False)
+        neurons_preferred_stimulus = self.neurons_preferred_stimulus.astype(dtype, copy=False)
+        neurons_sigma = self.neurons_sigma.astype(dtype, copy=False)
+
+        log_output = np.zeros((stimuli_input.shape[0], self.M), dtype=dtype)
+
+        for r in xrange(self.R):
+            dmu = stimuli_input[:, r, np.newaxis] - neurons_preferred_stimulus[:, r]
+
+            if self.response_maxout:
+                log_output -= neurons_sigma[:, r]*(1. - np.cos(dmu))
+            else:
+                log_response_feature = neurons_sigma[:, r]*np.cos(dmu) - self.log_normalisation_fisher_all[:, r].astype(dtype)
+
+                if self.get_network_response_opt is not None:
+                    # Large kappa, Normal approximation
+                    index_gauss = self.neurons_sigma[:, r] > 700
+                    log_response_feature[:, index_gauss] = -0.5*neurons_sigma[index_gauss, r]*dmu[:, index_gauss]**2. + np.log(self.normalisation_gauss_all[index_gauss, r]).astype(dtype)
+
+                log_output += log_response_feature
+
+        output = np.exp(log_output, out=log_output)
+        output[:, self.mask_neurons_unset] = 0.0
+
+        return output
+
+
+    def get_network_response_blocks(self, stimuli_input, dtype=np.float64):
+        '''
+            Same as get_network_response_batch, computed by blocks of stimuli to bound the temporary memory.
+
+            stimuli_input: S x R
+            return: S x M
+        '''
+
+        stimuli_input = np.atleast_2d(stimuli_input)
+        block_size = self.get_block_size()
+
+        output = np.empty((stimuli_input.shape[0], self.M), dtype=dtype)
+        for block_start in xrange(0, stimuli_input.shape[0], block_size):
+            output[block_start:block_start + block_size] = self.get_network_response_batch(stimuli_input[block_start:block_start + block_size], dtype=dtype)
+
+        return output
+
+
+    def get_block_size(self):
+        '''
+            Number of stimuli per block for the blocked computations
+        '''
+        return max(1, BLOCK_NUM_ELEMENTS // self.M)
+
+
     def get_derivative_network_response(self, derivative_feature_target=0, stimulus_input=None):
         '''
             Compute and return the derivative of the network response.
@@ -332,6 +405,31 @@ class HighDimensionNetwork(object):
         return der_f
 
 
+    def get_jacobian_network_response_batch(self, stimuli_input, dtype=np.float64):
+        '''
+            Derivatives of the network response for multiple stimuli, for all features at once.
+
+            Same as get_derivative_network_response for each feature.
+
+            stimuli_input: S x R
+            return: S x R x M
+        '''
+
+        stimuli_input = np.atleast_2d(stimuli_input).astype(dtype, copy=False)
+        neurons_preferred_stimulus = self.neurons_preferred_stimulus.astype(dtype, copy=False)
+        neurons_sigma = self.neurons_sigma.astype(dtype, copy=False)
+
+        responses = self.get_network_response_batch(stimuli_input, dtype=dtype)
+
+        jacobian = np.empty((stimuli_input.shape[0], self.R, self.M), dtype=dtype)
+        for r in xrange(self.R):
+            jacobian[:, r] = neurons_sigma[:, r]*np.sin(stimuli_input[:, r, np.newaxis] - neurons_preferred_stimulus[:, r])*responses
+
+        jacobian[:, :, self.mask_neurons_unset] = 0.0
+
+        return jacobian
+
+
     ####
 
     def compute_network_response_statistics(self, num_samples=5000, ignore_cache=False):
@@ -343,34 +441,83 @@ class HighDimensionNetwork(object):
         '''
 
         if ignore_cache or self.network_response_statistics is None:
-            # Should compute it
+            # Look in the persistent cache, if enabled
+            statistics_cache = utils_diskcache.get_statistics_cache()
+            cache_key = self.get_statistics_cache_key(num_samples=num_samples)
 
-            # Sample responses to measure the statistics on
-            responses = self.collect_network_responses(num_samples=num_samples)
+            if statistics_cache is not None and not ignore_cache:
+                self.network_response_statistics = statistics_cache.get(cache_key)
 
-            # Compute the mean and covariance
-            computed_mean = np.mean(responses, axis=0)
-            computed_cov = np.cov(responses.T)
+            if self.network_response_statistics is None or ignore_cache:
+                # Should compute it
 
-            # Cache them
-            self.network_response_statistics = {'mean': computed_mean, 'cov': computed_cov}
+                # Mean and covariance of responses over the entire space, accumulated by blocks
+                random_angles = utils.sample_angle((num_samples, self.R))
+
+                (computed_mean, computed_cov) = self.compute_responses_mean_covariance_blocks(random_angles)
+
+                # Cache them
+                self.network_response_statistics = {'mean': computed_mean, 'cov': computed_cov}
+
+                if statistics_cache is not None:
+                    statistics_cache.set(cache_key, self.network_response_statistics)
 
         # Return the cached values
         return self.network_response_statistics
 
 
+    def get_statistics_cache_key(self, **statistics_parameters):
+        '''
+            Key of the network response statistics in the persistent cache (utils_diskcache).
+
+            Identifies the network by its preferred stimuli and tuning parameters.
+        '''
+
+        return ('HighDimensionNetwork.compute_network_response_statistics', self.neurons_preferred_stimulus, self.neurons_sigma, self.mask_neurons_unset, self.response_maxout, statistics_parameters)
+
+
     def collect_network_responses(self, num_samples=5000):
         '''
             Sample network responses (population code outputs) over the entire space, to be used for empirical estimates
         '''
 
-        responses = np.empty((num_samples, self.M))
-
         random_angles = utils.sample_angle((num_samples, self.R))
-        for i in progress.ProgressDisplay(xrange(num_samples), display=progress.SINGLE_LINE):
-            responses[i] = self.get_network_response(random_angles[i])
 
-        return responses
+        return self.get_network_response_blocks(random_angles)
+
+
+    def compute_responses_mean_covariance_blocks(self, stimuli_input):
+        '''
+            Mean and covariance (as np.cov) of the network responses to the given stimuli.
+
+            Responses are computed and accumulated by blocks, never all stored.
+            Sums are taken around the mean of the first block, to limit cancellations.
+
+            stimuli_input: S x R
+            return: (mean M, covariance M x M)
+        '''
+
+        num_samples = stimuli_input.shape[0]
+        block_size = self.get_block_size()
+
+        responses_sum = np.zeros(self.M)
+        responses_outer_sum = np.zeros((self.M, self.M))
+        shift = None
+
+        for block_start in xrange(0, num_samples, block_size):
+            responses = self.get_network_response_batch(stimuli_input[block_start:block_start + block_size])
+
+            if shift is None:
+                shift = np.mean(responses, axis=0)
+            responses -= shift
+
+            responses_sum += np.sum(responses, axis=0)
+            responses_outer_sum += np.dot(responses.T, responses)
+
+        shifted_mean = responses_sum/num_samples
+        covariance = (responses_outer_sum - num_samples*np.outer(shifted_mean, shifted_mean))/(num_samples - 1.)
+
+        return (shifted_mean + shift, covariance)
 
     ########################################################################################################################
 
@@ -402,13 +549,7 @@ class HighDimensionNetwork(object):
             return: N x M
         '''
 
-        nb_samples = stimuli_input.shape[0]
-        net_samples = np.zeros((nb_samples, self.M))
-
-        for i in xrange(nb_samples):
-            net_samples[i] = self.sample_network_response(stimuli_input[i], sigma=sigma)
-
-        return net_samples
+        return self.get_network_response_blocks(stimuli_input) + sigma * np.random.randn(stimuli_input.shape[0], self.M)
 
     # ===================================================================
 
@@ -445,13 +586,13 @@ class HighDimensionNetwork(object):
         coverage_1D = self.init_feature_space(precision)
 
         possible_stimuli = np.array(utils.cross(self.R*[coverage_1D.tolist()]))
-        activity = np.empty((possible_stimuli.shape[0], self.M))
+        activity = self.get_network_response_blocks(possible_stimuli)
 
-        for stimulus_i, stimulus in enumerate(possible_stimuli):
-            activity[stimulus_i] = self.get_network_response(stimulus, specific_neurons=specific_neurons)
+        if specific_neurons is not None:
+            activity = activity[:, specific_neurons]
 
         # Reshape
-        activity.shape = self.R * (precision, ) + (self.M, )
+        activity.shape = self.R * (precision, ) + (activity.shape[-1], )
 
         mean_activity = activity
 
@@ -514,37 +655,19 @@ class HighDimensionNetwork(object):
         '''
 
         if items_thetas is None:
-            all_items = [np.array([0.0, 0.0])]
-            # Add extra items
-            for item_i in xrange(nitems - 1):
-                new_item = utils.sample_angle(size=2)
-                while not utils.enforce_distance_set(new_item,
-                                                     all_items,
-                                                     min_distance):
-                    new_item = utils.sample_angle(size=2)
-
-                all_items.append(new_item)
-
-            items_thetas = np.array(all_items)
+            items_thetas = utils_fisherinformation.sample_items_thetas(1, nitems, min_distance=min_distance, R=self.R)[0]
         else:
             nitems = items_thetas.shape[0]
 
-        # Compute all derivatives
-        deriv_mu = np.zeros((2*nitems, self.M))
-        for i in xrange(nitems):
-            deriv_mu[2*i] = self.get_derivative_network_response(derivative_feature_target=0, stimulus_input=items_thetas[i])
-            deriv_mu[2*i + 1] = self.get_derivative_network_response(derivative_feature_target=1, stimulus_input=items_thetas[i])
+        # Compute all derivatives, all features of item i at i*R + r
+        deriv_mu = self.get_jacobian_network_response_batch(items_thetas).reshape((1, nitems*self.R, self.M))
         deriv_mu[np.isnan(deriv_mu)] = 0.0
 
         # Compute the Fisher information matrix
-        FI_nobj = np.dot(deriv_mu, np.dot(inv_cov_stim, deriv_mu.T))
+        FI_nobj = utils_fisherinformation.compute_fisher_information_matrices(deriv_mu, inv_cov_stim)
+        inv_FI_nobj = utils_fisherinformation.invert_fisher_information_matrices(FI_nobj)
 
-        try:
-            inv_FI_nobj = np.linalg.inv(FI_nobj)
-        except np.linalg.linalg.LinAlgError:
-            inv_FI_nobj = np.nan*np.empty(FI_nobj.shape)
-
-        return inv_FI_nobj[0, 0], FI_nobj[0, 0]
+        return inv_FI_nobj[0, 0, 0], FI_nobj[0, 0, 0]
 
 
     def compute_marginal_inverse_FI(self,
@@ -558,66 +681,12 @@ class HighDimensionNetwork(object):
             Compute a Monte Carlo estimate of the Marginal Inverse Fisher Information
             Averages over stimuli values. Requires the inverse of the covariance of the memory.
 
+            Derivatives are computed in blocks of samples, see utils_fisherinformation.compute_marginal_inverse_FI.
+
             Returns dict(inv_FI, inv_FI_std, FI, FI_std)
         '''
 
-        min_num_samples_std = int(2e3)
-
-        marginal_fi_dict = dict(inv_FI=0,
-                                inv_FI_std=0,
-                                FI=0,
-                                FI_std=0
-                                )
-        inv_FI_cum = 0
-        FI_cum = 0
-        FI_cum_var = 0
-        inv_FI_cum_var = 0
-        epsilon = 0
-
-        new_estimates = np.zeros(4)
-        previous_estimates = np.zeros(4)
-
-        for i in xrange(max_n_samples):
-            # Get sample of invFI and FI
-            inv_FI_sample, FI_sample = self.compute_sample_inverse_FI(
-                inv_cov_stim, nitems=nitems, min_distance=min_distance
-            )
-
-            # Compute mean
-            inv_FI_cum += inv_FI_sample/float(max_n_samples)
-            FI_cum += FI_sample/float(max_n_samples)
-
-            # Compute std (wrong but oh well...)
-            if i > min_num_samples_std:
-                inv_FI_cum_var += (inv_FI_sample -
-                    inv_FI_cum*max_n_samples/(i+1.))**2./float(max_n_samples)
-                FI_cum_var += (FI_sample -
-                    FI_cum*max_n_samples/(i+1.))**2./float(max_n_samples)
-
-            # Compute current running averages
-            marginal_fi_dict['inv_FI'] = inv_FI_cum*max_n_samples/(i+1.)
-            marginal_fi_dict['inv_FI_std'] = np.sqrt(
-                inv_FI_cum_var*max_n_samples/(i+1.))/np.sqrt(i+1)
-            marginal_fi_dict['FI'] = FI_cum*max_n_samples/(i+1.)
-            marginal_fi_dict['FI_std'] = np.sqrt(
-                FI_cum_var*max_n_samples/(i+1.))/np.sqrt(i+1)
-
-            if i > 1.5*min_num_samples_std:
-                # Check convergence
-                for k_i, k in enumerate(marginal_fi_dict):
-                    new_estimates[k_i] = marginal_fi_dict[k]
-
-                epsilon = np.nansum(np.abs(previous_estimates - new_estimates))
-
-                if epsilon <= convergence_epsilon:
-                    # Converged, stop the loop
-                    if debug:
-                        print "Converged after %d samples" % i
-                    break
-
-                previous_estimates = new_estimates
-
-        return marginal_fi_dict
+        return utils_fisherinformation.compute_marginal_inverse_FI(self.get_jacobian_network_response_batch, nitems, inv_cov_stim, self.M, R=self.R, max_n_samples=max_n_samples, min_distance=min_distance, convergence_epsilon=convergence_epsilon, debug=debug)
 
 
     def compute_fisher_information_theoretical(self, sigma=None):
@@ -1049,6 +1118,32 @@ def test_large_kappa_network_response():
     rn.get_network_response()
 
 
+def test_batch_network_response():
+    print "Testing if batched and single network responses/derivatives are the same, for R=2..5..."
+
+    for R in [2, 3, 5]:
+        for response_maxout in [False, True]:
+            rn = HighDimensionNetwork.create_mixed(int(20*R + 4**R), R=R, ratio_feature_conjunctive=0.5, autoset_parameters=True, response_maxout=response_maxout)
+            rnd_angles = utils.sample_angle((50, R))
+
+            responses = rn.get_network_response_batch(rnd_angles)
+            assert np.allclose(responses, np.array([rn.get_network_response(curr_angles) for curr_angles in rnd_angles]))
+            assert np.allclose(rn.get_network_response_batch(rnd_angles, dtype=np.float32), responses, rtol=1e-3, atol=1e-6)
+
+            jacobian = rn.get_jacobian_network_response_batch(rnd_angles)
+            for r in xrange(R):
+                assert np.allclose(jacobian[:, r], np.array([rn.get_derivative_network_response(r, curr_angles) for curr_angles in rnd_angles]))
+
+            mean, covariance = rn.compute_responses_mean_covariance_blocks(rnd_angles)
+            assert np.allclose(mean, np.mean(responses, axis=0))
+            assert np.allclose(covariance, np.cov(responses.T))
+
+    # Large kappa, Normal approximation
+    rn = HighDimensionNetwork.create_full_conjunctive(25, R=2, rcscale=1000.)
+    rnd_angles = utils.sample_angle((50, 2))
+    assert np.allclose(rn.get_network_response_batch(rnd_angles), np.array([rn.get_network_response(curr_angles) for curr_angles in rnd_angles]))
+
+
 if __name__ == '__main__':
     pass
 
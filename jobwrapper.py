@@ -15,6 +15,9 @@ import os
 import resultcomputation
 import experimentlauncher
 import utils
+import utils_instrumentation
+import utils_heartbeat
+import progress
 
 
 class JobWrapper(object):
@@ -40,13 +43,23 @@ class JobWrapper(object):
         self.result = np.nan
         self.job_state = 'idle'
 
+        # Per-stage timings and counters of the computation, see utils_instrumentation
+        self.instrumentation = None
+
         if experiment_parameters.get('result_computation', '') != '':
             self.result_computation = resultcomputation.ResultComputation(experiment_parameters['result_computation'], debug=debug)
 
             self.result_filename = self.create_result_filename()
+            self.heartbeat_filename = self.create_result_filename(prefix='heartbeat_sync_job_', extension='.json')
+            self.cancel_filename = self.create_result_filename(prefix='cancel_sync_job_', extension='')
         else:
             self.result_computation = None
             self.result_filename = None
+            self.heartbeat_filename = None
+            self.cancel_filename = None
+
+        # Seconds between heartbeats written while computing, see utils_heartbeat
+        self.heartbeat_interval = experiment_parameters.get('heartbeat_interval', 60.)
 
         if self.debug:
             print "JobWrapper initialised\n Name: %s" % (self.job_name)
@@ -93,19 +106,55 @@ class JobWrapper(object):
         #  this will create some output arrays, that will be accessible later on if desired.
         print "--- Running job %s ---" % self.job_name
 
+        # Only record this job
+        utils_instrumentation.reset()
+
         # Now the action_to_do for the WrappedJob really is job_action. All other parameters are the same
         self.experiment_parameters['action_to_do'] = self.experiment_parameters['job_action']
 
-        experiment_launcher = experimentlauncher.ExperimentLauncher(run=True, arguments_dict=self.experiment_parameters, job_wrapped=True)
-        print "--- job completed ---"
-
-        # Compute metric result out of the results from the computation if desired
-        if self.result_computation is not None:
-            if self.debug:
-                print "Running %s" % self.result_computation
+        # Tell the Submitter we are alive, how far we got and how much memory we use.
+        heartbeat = None
+        if self.heartbeat_filename is not None:
+            heartbeat = utils_heartbeat.HeartbeatWriter(self.heartbeat_filename, interval=self.heartbeat_interval, cancel_filename=self.cancel_filename, status_fct=lambda: dict(job_name=self.job_name))
+            heartbeat.start()
+
+        try:
+            with utils_instrumentation.stage('job'):
+                with utils_instrumentation.stage('experiment'):
+                    experiment_launcher = experimentlauncher.ExperimentLauncher(run=True, arguments_dict=self.experiment_parameters, job_wrapped=True)
+                print "--- job completed ---"
+
+                # Compute metric result out of the results from the computation if desired
+                if self.result_computation is not None:
+                    if self.debug:
+                        print "Running %s" % self.result_computation
+
+                    # Compute the result
+                    self.result = self.result_computation.compute_result(experiment_launcher.all_vars)
+        except KeyboardInterrupt:
+            if heartbeat is None or not heartbeat.cancel_requested:
+                raise
+
+            # Cancelled by the Submitter, store a nan result so that it stops waiting on us
+            print "--- job cancelled ---"
+            heartbeat.stop(job_state='cancelled')
+            self.instrumentation = utils_instrumentation.get_summary()
+            self.job_state = 'cancelled'
+            self.store_result()
+
+            return dict()
+        except Exception as e:
+            if heartbeat is not None:
+                heartbeat.stop(job_state='failed', error=repr(e))
+            raise
+
+        if heartbeat is not None:
+            heartbeat.stop(job_state='completed')
+
+        self.instrumentation = utils_instrumentation.get_summary()
 
-            # Compute the result
-            self.result = self.result_computation.compute_result(experiment_launcher.all_vars)
+        if self.debug:
+            print utils_instrumentation.format_summary(self.instrumentation)
 
         # Store result, also indicating that this Job has completed
         self.complete_job()
@@ -123,12 +172,12 @@ class JobWrapper(object):
     ############
     ### Handle results
 
-    def create_result_filename(self, prefix='result_sync_job_'):
+    def create_result_filename(self, prefix='result_sync_job_', extension='.npy'):
         '''
             Create a filename from the unique job name
         '''
 
-        return os.path.join(self.experiment_parameters['output_directory'], prefix + self.job_name + '.npy')
+        return os.path.join(self.experiment_parameters['output_directory'], prefix + self.job_name + extension)
 
 
     def store_result(self):
@@ -138,7 +187,7 @@ class JobWrapper(object):
             This file should have a specific name format, as it is awaited upon by this Job (but not the instance running on PBS).
         '''
 
-        dict_output_result = dict(job_state=self.job_state, result=self.result)
+        dict_output_result = dict(job_state=self.job_state, result=self.result, instrumentation=self.instrumentation)
 
         np.save(self.result_filename, dict_output_result)
 
@@ -148,9 +197,10 @@ class JobWrapper(object):
             Reloads result of computation from a specifically formatted file.
         '''
 
-        dict_input_result = np.load(self.result_filename).item()
+        dict_input_result = np.load(self.result_filename, allow_pickle=True).item()
 
         self.result = dict_input_result['result']
+        self.instrumentation = dict_input_result.get('instrumentation', None)
 
 
 
@@ -181,6 +231,60 @@ class JobWrapper(object):
         return self.result
 
 
+    def get_instrumentation(self):
+        '''
+            Return the per-stage timings and counters of the computation (see utils_instrumentation).
+            None if not available (not finished, or result stored by an older version).
+        '''
+
+        if self.result_computation is not None and self.job_state == 'completed' and self.instrumentation is None:
+            try:
+                self.reload_result()
+            except IOError:
+                pass
+
+        return self.instrumentation
+
+
+    ############
+    ### Handle heartbeats
+
+    def get_heartbeat(self):
+        '''
+            Return the last heartbeat written by our sister JobWrapper while computing (see utils_heartbeat).
+            None if there is none (not started yet, or no result computation).
+        '''
+
+        if self.heartbeat_filename is None:
+            return None
+
+        return progress.read_heartbeat(self.heartbeat_filename)
+
+
+    def request_cancel(self):
+        '''
+            Ask our sister JobWrapper to stop computing. It will store a nan result (job_state 'cancelled').
+
+            Only works through the filesystem, the job sees it at its next heartbeat.
+        '''
+
+        if self.cancel_filename is not None:
+            open(self.cancel_filename, 'w').close()
+
+
+    def clear_heartbeat(self):
+        '''
+            Remove the heartbeat and cancel files of a previous run, before (re)submitting this job.
+        '''
+
+        for filename in (self.heartbeat_filename, self.cancel_filename):
+            if filename is not None and os.path.exists(filename):
+                try:
+                    os.remove(filename)
+                except OSError:
+                    pass
+
+
 def test_job_wrapper():
     '''
         Basic test
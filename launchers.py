@@ -20,36 +20,150 @@ from sampler_invtransf_randomfactorialnetwork import *
 
 from highdimensionnetwork import *
 
+import collections
+
+import utils_sharedmemory
+import utils_instrumentation
+import utils_parallel
+
 
 
 ################### INITIALISERS ####################
 # Define everything here, so that other launchers can call them directly (unless they do something funky)
 
-def init_everything(parameters):
+# Parameters defining a network, see init_random_network_cached
+NETWORK_PARAMETERS = ['code_type', 'M', 'R', 'rc_scale', 'rc_scale2', 'feat_ratio', 'ratio_conj', 'autoset_parameters', 'response_maxout', 'M_layer_one', 'sparsity', 'normalise_weights', 'sigma_weights', 'type_layer_one', 'distribution_weights', 'threshold', 'output_both_layers', 'ratio_hierarchical', 'seed']
+MAX_CACHED_NETWORKS = 4
 
-    # Forces some parameters
-    parameters['time_weights_parameters'] = dict(weighting_alpha=parameters['alpha'], weighting_beta=1.0, specific_weighting=0.1, weight_prior='uniform')
+_networks_cache = collections.OrderedDict()
 
-    if parameters.get('fixed_cued_feature_time', -1) >= 0:
-        parameters['cued_feature_time'] = parameters['fixed_cued_feature_time']
-    else:
-        parameters['cued_feature_time'] = parameters['T'] - 1
 
-    # Build the random network
-    random_network = init_random_network(parameters)
+def init_everything(parameters, random_network=None, stat_meas=None):
+    '''
+        Build the network, dataset, noise statistics and Sampler.
 
-    # print "Building the database"
-    data_gen = init_data_gen(random_network, parameters)
+        If random_network is given, it is used instead of building a new one (e.g. one network shared by all set sizes).
+        Same for the noise statistics stat_meas, which need to have been measured on random_network.
+    '''
 
-    # Measure the noise structure
-    stat_meas = init_stat_measurer(random_network, parameters)
+    with utils_instrumentation.stage('init_everything'):
+        # Forces some parameters
+        init_forced_parameters(parameters)
+
+        if random_network is None:
+            with utils_instrumentation.stage('init_random_network'):
+                random_network = get_random_network(parameters)
+
+        # print "Building the database"
+        with utils_instrumentation.stage('init_data_gen'):
+            data_gen = init_data_gen(random_network, parameters)
+
+        # Measure the noise structure
+        if stat_meas is None:
+            with utils_instrumentation.stage('init_stat_measurer'):
+                stat_meas = init_stat_measurer(random_network, parameters)
 
-    # Init sampler
-    sampler = Sampler(data_gen, n_parameters=stat_meas.model_parameters, tc=parameters['cued_feature_time'], sigma_output=parameters['sigma_output'], parameters_dict=parameters, renormalize_sigma_output=parameters.get('renormalize_sigma_output', False), lapse_rate=parameters['lapse_rate'])
+        # Init sampler
+        with utils_instrumentation.stage('init_sampler'):
+            sampler = init_sampler(data_gen, stat_meas, parameters)
 
     return (random_network, data_gen, stat_meas, sampler)
 
 
+def export_everything(shared_memory, random_network, stat_meas, data_gen=None):
+    '''
+        Put the network, noise statistics and dataset (if given) in shared memory (utils_sharedmemory.SharedMemory).
+
+        Returns a small picklable description, to give to init_everything_shared() in worker processes.
+    '''
+
+    return shared_memory.export_object((random_network, stat_meas, data_gen))
+
+
+def init_everything_shared(parameters, description):
+    '''
+        Same as init_everything, reusing the network, noise statistics and dataset exported by export_everything().
+
+        Their arrays are read-only views of the shared memory. The dataset is built if it was not exported, then the Sampler.
+    '''
+
+    with utils_instrumentation.stage('init_everything'):
+        init_forced_parameters(parameters)
+
+        (random_network, stat_meas, data_gen) = utils_sharedmemory.import_object(description)
+
+        if data_gen is None:
+            with utils_instrumentation.stage('init_data_gen'):
+                data_gen = init_data_gen(random_network, parameters)
+
+        with utils_instrumentation.stage('init_sampler'):
+            sampler = init_sampler(data_gen, stat_meas, parameters)
+
+    return (random_network, data_gen, stat_meas, sampler)
+
+
+def map_repetitions(parameters, repetition_fct, nb_repetitions, nb_processes=1, random_seed=None):
+    '''
+        [repetition_fct(sampler, repet_i) for repet_i in xrange(nb_repetitions)], on new Samplers for parameters.
+
+        Repetitions run in worker processes if nb_processes > 1 (see utils_parallel.map_cells), each seeded
+        with random_seed + repet_i: results do not depend on the number of processes.
+
+        Each repetition builds its own network, dataset and Sampler (init_everything).
+        With reuse_network, the network and noise statistics are built once here and shared by all repetitions,
+        workers get them through shared memory (export_everything/init_everything_shared).
+
+        Results of repetition_fct need to be picklable.
+    '''
+
+    nb_processes = utils_parallel.get_nb_processes(nb_processes, nb_repetitions)
+    repetitions_cells = [(repet_i, ) for repet_i in xrange(nb_repetitions)]
+
+    init_forced_parameters(parameters)
+
+    if not parameters.get('reuse_network', False):
+        def repetition_new_network(repet_i):
+            return repetition_fct(init_everything(parameters.copy())[3], repet_i)
+
+        return utils_parallel.map_cells(repetition_new_network, repetitions_cells, nb_processes=nb_processes, random_seed=random_seed)
+
+    random_network = get_random_network(parameters)
+    stat_meas = init_stat_measurer(random_network, parameters)
+
+    if nb_processes == 1:
+        def repetition_reused_network(repet_i):
+            return repetition_fct(init_everything(parameters.copy(), random_network=random_network, stat_meas=stat_meas)[3], repet_i)
+
+        return utils_parallel.map_cells(repetition_reused_network, repetitions_cells, nb_processes=1, random_seed=random_seed)
+
+    with utils_sharedmemory.SharedMemory() as shared_memory:
+        description = export_everything(shared_memory, random_network, stat_meas)
+
+        def repetition_shared(repet_i):
+            (_, _, _, sampler) = init_everything_shared(parameters.copy(), description)
+            result = repetition_fct(sampler, repet_i)
+
+            del sampler
+            utils_sharedmemory.detach(description)
+
+            return result
+
+        return utils_parallel.map_cells(repetition_shared, repetitions_cells, nb_processes=nb_processes, random_seed=random_seed)
+
+
+def init_forced_parameters(parameters):
+    '''
+        Parameters derived from the others, set in-place
+    '''
+
+    parameters['time_weights_parameters'] = dict(weighting_alpha=parameters['alpha'], weighting_beta=1.0, specific_weighting=0.1, weight_prior='uniform')
+
+    if parameters.get('fixed_cued_feature_time', -1) >= 0:
+        parameters['cued_feature_time'] = parameters['fixed_cued_feature_time']
+    else:
+        parameters['cued_feature_time'] = parameters['T'] - 1
+
+
 
 def init_random_network(parameters):
 
@@ -74,6 +188,49 @@ def init_random_network(parameters):
     return random_network
 
 
+def get_random_network(parameters):
+    '''
+        Build the random network, or reuse the one built for the same network parameters if reuse_network is set
+    '''
+
+    if parameters.get('reuse_network', False):
+        return init_random_network_cached(parameters)
+    else:
+        return init_random_network(parameters)
+
+
+def get_network_cache_key(parameters):
+    '''
+        Key identifying a network: all parameters used by init_random_network, and the seed
+    '''
+
+    return tuple([(name, repr(parameters.get(name, None))) for name in NETWORK_PARAMETERS])
+
+
+def init_random_network_cached(parameters):
+    '''
+        Same as init_random_network, but reuses networks already built with the same parameters.
+
+        Networks keep their precomputed statistics (compute_network_response_statistics, used by compute_covariance_KL),
+        so these are not estimated again. Repetitions then share the same network, as if the seed was fixed.
+        The MAX_CACHED_NETWORKS most recently used networks are kept.
+    '''
+
+    key = get_network_cache_key(parameters)
+
+    if key in _networks_cache:
+        random_network = _networks_cache.pop(key)
+    else:
+        random_network = init_random_network(parameters)
+
+    # Most recently used last
+    _networks_cache[key] = random_network
+    while len(_networks_cache) > MAX_CACHED_NETWORKS:
+        _networks_cache.popitem(last=False)
+
+    return random_network
+
+
 def init_data_gen(random_network, parameters):
     '''
         Initialisating the DataGenerator
@@ -90,6 +247,14 @@ def init_stat_measurer(random_network, parameters):
     return stat_meas
 
 
+def init_sampler(data_gen, stat_meas, parameters):
+    '''
+        Initialising the Sampler, from the dataset and the measured noise structure
+    '''
+
+    return Sampler(data_gen, n_parameters=stat_meas.model_parameters, tc=parameters['cued_feature_time'], sigma_output=parameters['sigma_output'], parameters_dict=parameters, renormalize_sigma_output=parameters.get('renormalize_sigma_output', False), lapse_rate=parameters['lapse_rate'])
+
+
 def launcher_do_simple_run(args):
     '''
         Basic use-case when playing around with the components.
@@ -120,3 +285,43 @@ def launcher_do_simple_run(args):
 
 
 
+
+
+def _test_map_repetitions_fct(sampler, repet_i):
+    '''
+        Summary of the network, noise statistics, dataset and random state of a repetition, see test_map_repetitions()
+    '''
+
+    return dict(repet_i=repet_i, network_response=sampler.random_network.get_network_response(np.array([0.5, -1.0])), noise_mean=sampler.n_means_start, Y_sum=sampler.data_gen.Y.sum(), random_draw=np.random.rand())
+
+
+def test_map_repetitions():
+    '''
+        Repetitions give the same results with 1 and 2 processes, networks and noise statistics are only shared with reuse_network
+    '''
+    import experimentlauncher
+
+    parameters = experimentlauncher.ExperimentLauncher(run=False, arguments_dict=dict(code_type='mixed', M=50, N=20, T=2, sigmax=0.1, sigmay=0.0001, inference_method='none', autoset_parameters=None)).args_dict
+
+    for reuse_network in [False, True]:
+        parameters['reuse_network'] = reuse_network
+
+        # Seeded as by the --seed option: the shared network and noise statistics are built from the global random state
+        np.random.seed(5)
+        results_serial = map_repetitions(parameters.copy(), _test_map_repetitions_fct, 3, nb_processes=1, random_seed=10)
+        np.random.seed(5)
+        results_parallel = map_repetitions(parameters.copy(), _test_map_repetitions_fct, 3, nb_processes=2, random_seed=10)
+
+        assert [res['repet_i'] for res in results_parallel] == range(3)
+        for (res_serial, res_parallel) in zip(results_serial, results_parallel):
+            for key in ['network_response', 'noise_mean', 'Y_sum', 'random_draw']:
+                assert np.allclose(res_serial[key], res_parallel[key]), (reuse_network, key)
+
+        same_noise_statistics = np.allclose(results_serial[0]['noise_mean'], results_serial[1]['noise_mean'])
+        assert same_noise_statistics == reuse_network, reuse_network
+        assert not np.allclose(results_serial[0]['Y_sum'], results_serial[1]['Y_sum'])
+
+
+
+if __name__ == '__main__':
+    test_map_repetitions()
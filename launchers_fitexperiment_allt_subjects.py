@@ -60,9 +60,6 @@ def launcher_do_fitexperiment_subject_allmetrics(args):
 
         ### WORK WORK WORK work? ###
 
-        # Let's build a FitExperimentAllT
-        fit_exp = FitExperimentAllTSubject(all_parameters)
-
         # Setup and evaluate some statistics
         def compute_everything(self, parameters):
             results = dict()
@@ -119,7 +116,10 @@ def launcher_do_fitexperiment_subject_allmetrics(args):
 
             return results
 
-        res_listdicts = fit_exp.apply_fct_datasets_allT(dict(fct=compute_everything, parameters=all_parameters))
+        # Build a FitExperimentAllTSubject and evaluate all T, in parallel if desired (fit_nb_processes)
+        (res_subjects, fit_experiments) = apply_fct_subjects_allT(all_parameters, dict(fct=compute_everything, parameters=all_parameters), subject_space=[all_parameters['experiment_subject']])
+        fit_exp = fit_experiments[all_parameters['experiment_subject']]
+        res_listdicts = res_subjects[all_parameters['experiment_subject']]
 
         # Put everything back together (yeah advanced python muck)
         for key in res_listdicts[0]:
@@ -198,71 +198,84 @@ def launcher_do_memory_curve_marginal_fi(args):
         result_target = np.nan*np.ones((T_space.size, all_parameters['N'], all_parameters['num_repetitions']))
         result_nontargets = np.nan*np.ones((T_space.size, all_parameters['N'], all_parameters['T']-1, all_parameters['num_repetitions']))
 
-    search_progress = progress.Progress(T_space.size*all_parameters['num_repetitions'])
+    def run_repetition(sampler, repet_i):
+        '''
+            Sample, then compute the precision, EM mixture model fit and marginal inverse Fisher information
+        '''
 
-    for repet_i in xrange(all_parameters['num_repetitions']):
-        for T_i, T in enumerate(T_space):
-            print "%.2f%%, %s left - %s" % (search_progress.percentage(), search_progress.time_remaining_str(), search_progress.eta_str())
+        print "Fit for T=%d, %d/%d" % (all_parameters['T'], repet_i+1, all_parameters['num_repetitions'])
 
-            print "Fit for T=%d, %d/%d" % (T, repet_i+1, all_parameters['num_repetitions'])
+        ### WORK WORK WORK work? ###
 
-            # Update parameter
-            all_parameters['T'] = T
+        # Sample
+        sampler.run_inference(all_parameters)
 
-            ### WORK WORK WORK work? ###
+        # Compute precision
+        print "get precision..."
+        outputs = dict(precision=sampler.get_precision())
 
-            # Fix some parameters
-            # all_parameters['stimuli_generation'] = 'separated'
-            # all_parameters['slice_width'] = np.pi/64.
+        # Fit mixture model
+        print "fit mixture model..."
+        curr_params_fit = sampler.fit_mixture_model(use_all_targets=False)
+        curr_params_fit['mixt_nontargets_sum'] = np.sum(curr_params_fit['mixt_nontargets'])
+        outputs['em_fits'] = [curr_params_fit[key] for key in ('kappa', 'mixt_target', 'mixt_nontargets_sum', 'mixt_random', 'train_LL')]
 
-            # Instantiate
-            (_, _, _, sampler) = launchers.init_everything(all_parameters)
+        # Compute marginal inverse fisher info
+        print "compute marginal inverse fisher info"
+        marginal_fi_dict = sampler.estimate_marginal_inverse_fisher_info_montecarlo()
+        outputs['marginal_inv_fi'] = [marginal_fi_dict[key] for key in ('inv_FI', 'inv_FI_std', 'FI', 'FI_std')]
 
-            # Sample
-            sampler.run_inference(all_parameters)
+        # If needed, store responses
+        if all_parameters['subaction'] == 'collect_responses':
+            outputs['responses'] = sampler.collect_responses()
+            print "collected responses"
 
-            # Compute precision
-            print "get precision..."
-            result_all_precisions[T_i, repet_i] = sampler.get_precision()
+        print outputs['precision'], curr_params_fit, marginal_fi_dict
 
-            # Fit mixture model
-            print "fit mixture model..."
-            curr_params_fit = sampler.fit_mixture_model(use_all_targets=False)
-            curr_params_fit['mixt_nontargets_sum'] = np.sum(curr_params_fit['mixt_nontargets'])
-            result_em_fits[T_i, :, repet_i] = [curr_params_fit[key] for key in ('kappa', 'mixt_target', 'mixt_nontargets_sum', 'mixt_random', 'train_LL')]
+        return outputs
 
-            # Compute marginal inverse fisher info
-            print "compute marginal inverse fisher info"
-            marginal_fi_dict = sampler.estimate_marginal_inverse_fisher_info_montecarlo()
-            result_marginal_inv_fi[T_i, :, repet_i] = [marginal_fi_dict[key] for key in ('inv_FI', 'inv_FI_std', 'FI', 'FI_std')]
+    search_progress = progress.Progress(T_space.size*all_parameters['num_repetitions'])
 
-            # If needed, store responses
-            if all_parameters['subaction'] == 'collect_responses':
-                (responses, target, nontarget) = sampler.collect_responses()
-                result_responses[T_i, :, repet_i] = responses
-                result_target[T_i, :, repet_i] = target
-                result_nontargets[T_i, :, :T_i, repet_i] = nontarget
+    for T_i, T in enumerate(T_space):
+        print "%.2f%%, %s left - %s" % (search_progress.percentage(), search_progress.time_remaining_str(), search_progress.eta_str())
 
-                print "collected responses"
+        # Update parameter
+        all_parameters['T'] = T
 
+        # Fix some parameters
+        # all_parameters['stimuli_generation'] = 'separated'
+        # all_parameters['slice_width'] = np.pi/64.
 
-            print result_all_precisions[T_i, repet_i], curr_params_fit, marginal_fi_dict
+        # Instantiate and run all repetitions, in parallel if desired
+        repetitions_outputs = launchers.map_repetitions(all_parameters, run_repetition, all_parameters['num_repetitions'], nb_processes=all_parameters.get('repetitions_nb_processes', 1))
 
-            ## Run callback function if exists
-            if plots_during_simulation_callback:
-                print "Doing plots..."
-                try:
-                    # Best super safe, if this fails then the simulation must continue!
-                    plots_during_simulation_callback['function'](locals(), plots_during_simulation_callback['parameters'])
-                    print "plots done."
-                except:
-                    print "error during plotting callback function", plots_during_simulation_callback['function'], plots_during_simulation_callback['parameters']
+        for repet_i, outputs in enumerate(repetitions_outputs):
+            result_all_precisions[T_i, repet_i] = outputs['precision']
+            result_em_fits[T_i, :, repet_i] = outputs['em_fits']
+            result_marginal_inv_fi[T_i, :, repet_i] = outputs['marginal_inv_fi']
+
+            if 'responses' in outputs:
+                (responses, target, nontarget) = outputs['responses']
+                result_responses[T_i, :, repet_i] = responses
+                result_target[T_i, :, repet_i] = target
+                result_nontargets[T_i, :, :T_i, repet_i] = nontarget
 
-            ### /Work ###
             search_progress.increment()
-            if run_counter % save_every == 0 or search_progress.done():
-                dataio.save_variables_default(locals())
-            run_counter += 1
+
+        ## Run callback function if exists
+        if plots_during_simulation_callback:
+            print "Doing plots..."
+            try:
+                # Best super safe, if this fails then the simulation must continue!
+                plots_during_simulation_callback['function'](locals(), plots_during_simulation_callback['parameters'])
+                print "plots done."
+            except:
+                print "error during plotting callback function", plots_during_simulation_callback['function'], plots_during_simulation_callback['parameters']
+
+        ### /Work ###
+        if run_counter % save_every == 0 or search_progress.done():
+            dataio.save_variables_default(locals())
+        run_counter += 1
 
     # Finished
     dataio.save_variables_default(locals())
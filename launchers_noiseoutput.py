@@ -60,65 +60,77 @@ def launcher_do_noise_output_effect(args):
         result_target = np.nan*np.ones((sigmaoutput_space.size, all_parameters['N'], all_parameters['num_repetitions']))
         result_nontargets = np.nan*np.ones((sigmaoutput_space.size, all_parameters['N'], all_parameters['T']-1, all_parameters['num_repetitions']))
 
-    search_progress = progress.Progress(sigmaoutput_space.size*all_parameters['num_repetitions'])
+    def run_repetition(sampler, repet_i):
+        '''
+            Sample, then compute the precision and EM mixture model fit
+        '''
 
-    for repet_i in xrange(all_parameters['num_repetitions']):
-        for sigmaoutput_i, sigma_output in enumerate(sigmaoutput_space):
-            print "%.2f%%, %s left - %s" % (search_progress.percentage(), search_progress.time_remaining_str(), search_progress.eta_str())
+        print "Fit for sigma_output=%.3f, %d/%d" % (all_parameters['sigma_output'], repet_i+1, all_parameters['num_repetitions'])
 
-            print "Fit for sigma_output=%.3f, %d/%d" % (sigma_output, repet_i+1, all_parameters['num_repetitions'])
+        ### WORK WORK WORK work? ###
 
-            # Update parameter
-            all_parameters['sigma_output'] = sigma_output
+        # Sample
+        sampler.run_inference(all_parameters)
 
-            ### WORK WORK WORK work? ###
+        # Compute precision
+        print "get precision..."
+        outputs = dict(precision=sampler.get_precision())
 
-            # Fix some parameters
-            # all_parameters['stimuli_generation'] = 'separated'
-            # all_parameters['slice_width'] = np.pi/64.
+        # Fit mixture model
+        print "fit mixture model..."
+        curr_params_fit = sampler.fit_mixture_model(use_all_targets=False)
+        outputs['em_fits'] = [curr_params_fit[key] for key in ('kappa', 'mixt_target', 'mixt_nontargets_sum', 'mixt_random', 'train_LL', 'bic')]
 
-            # Instantiate
-            (_, _, _, sampler) = launchers.init_everything(all_parameters)
+        # If needed, store responses
+        if all_parameters['collect_responses']:
+            outputs['responses'] = sampler.collect_responses()
+            print "collected responses"
 
-            # Sample
-            sampler.run_inference(all_parameters)
+        print outputs['precision'], curr_params_fit
 
-            # Compute precision
-            print "get precision..."
-            result_all_precisions[sigmaoutput_i, repet_i] = sampler.get_precision()
+        return outputs
 
-            # Fit mixture model
-            print "fit mixture model..."
-            curr_params_fit = sampler.fit_mixture_model(use_all_targets=False)
-            result_em_fits[sigmaoutput_i, :, repet_i] = [curr_params_fit[key] for key in ('kappa', 'mixt_target', 'mixt_nontargets_sum', 'mixt_random', 'train_LL', 'bic')]
+    search_progress = progress.Progress(sigmaoutput_space.size*all_parameters['num_repetitions'])
 
-            # If needed, store responses
-            if all_parameters['collect_responses']:
-                (responses, target, nontarget) = sampler.collect_responses()
-                result_responses[sigmaoutput_i, :, repet_i] = responses
-                result_target[sigmaoutput_i, :, repet_i] = target
-                result_nontargets[sigmaoutput_i, :, :(all_parameters['T']-1), repet_i] = nontarget
+    for sigmaoutput_i, sigma_output in enumerate(sigmaoutput_space):
+        print "%.2f%%, %s left - %s" % (search_progress.percentage(), search_progress.time_remaining_str(), search_progress.eta_str())
+
+        # Update parameter
+        all_parameters['sigma_output'] = sigma_output
 
-                print "collected responses"
+        # Fix some parameters
+        # all_parameters['stimuli_generation'] = 'separated'
+        # all_parameters['slice_width'] = np.pi/64.
 
+        # Instantiate and run all repetitions, in parallel if desired
+        repetitions_outputs = launchers.map_repetitions(all_parameters, run_repetition, all_parameters['num_repetitions'], nb_processes=all_parameters.get('repetitions_nb_processes', 1))
 
-            print result_all_precisions[sigmaoutput_i, repet_i], curr_params_fit
+        for repet_i, outputs in enumerate(repetitions_outputs):
+            result_all_precisions[sigmaoutput_i, repet_i] = outputs['precision']
+            result_em_fits[sigmaoutput_i, :, repet_i] = outputs['em_fits']
 
-            ## Run callback function if exists
-            if plots_during_simulation_callback:
-                print "Doing plots..."
-                try:
-                    # Best super safe, if this fails then the simulation must continue!
-                    plots_during_simulation_callback['function'](locals(), plots_during_simulation_callback['parameters'])
-                    print "plots done."
-                except:
-                    print "error during plotting callback function", plots_during_simulation_callback['function'], plots_during_simulation_callback['parameters']
+            if 'responses' in outputs:
+                (responses, target, nontarget) = outputs['responses']
+                result_responses[sigmaoutput_i, :, repet_i] = responses
+                result_target[sigmaoutput_i, :, repet_i] = target
+                result_nontargets[sigmaoutput_i, :, :(all_parameters['T']-1), repet_i] = nontarget
 
-            ### /Work ###
             search_progress.increment()
-            if run_counter % save_every == 0 or search_progress.done():
-                dataio.save_variables_default(locals())
-            run_counter += 1
+
+        ## Run callback function if exists
+        if plots_during_simulation_callback:
+            print "Doing plots..."
+            try:
+                # Best super safe, if this fails then the simulation must continue!
+                plots_during_simulation_callback['function'](locals(), plots_during_simulation_callback['parameters'])
+                print "plots done."
+            except:
+                print "error during plotting callback function", plots_during_simulation_callback['function'], plots_during_simulation_callback['parameters']
+
+        ### /Work ###
+        if run_counter % save_every == 0 or search_progress.done():
+            dataio.save_variables_default(locals())
+        run_counter += 1
 
     # Finished
     dataio.save_variables_default(locals())
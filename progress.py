@@ -35,6 +35,19 @@ for part in task:
     progress.increment()
     update_gui(progress.percentage(), progress.time_remaining())
 
+In inner loops, use ThrottledProgress instead: increment() only updates a
+counter, the clock is checked about every 'interval' seconds and the status
+line is only printed on a terminal:
+from progress import *
+progress = ThrottledProgress(task_size, label='sample_theta')
+for part in task:
+    do_work()
+    progress.increment()
+progress.finish()
+
+All trackers alive and not done are listed by get_active_status(), which job
+monitors (utils_heartbeat.HeartbeatWriter) put in their heartbeat file.
+
 This code is released under the Python 2.6.2 license.
 """
 
@@ -44,6 +57,10 @@ __version__ = "1.0.0"
 import time
 import math
 import sys
+import os
+import json
+import socket
+import weakref
 
 # When _gather_stats is true, every time a Progress class is used to completion
 # it will log statistics to ~/.progress_stats
@@ -56,6 +73,41 @@ if _gather_stats:
 MULTI_LINE = 0
 SINGLE_LINE = 1
 
+def write_heartbeat(filename, status):
+    """Write a status dictionary as JSON, atomically (readers never see a
+    partial file)."""
+    tmp_filename = "%s.%d.tmp" % (filename, os.getpid())
+    with open(tmp_filename, 'w') as f:
+        json.dump(status, f)
+    os.rename(tmp_filename, filename)
+
+def read_heartbeat(filename):
+    """Return the status dictionary written by write_heartbeat, or None if
+    there is none (yet)."""
+    try:
+        with open(filename, 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+# Progress and ThrottledProgress objects, oldest first, see get_active_status()
+_trackers = []
+
+def _register_tracker(tracker):
+    _trackers[:] = [tracker_ref for tracker_ref in _trackers if tracker_ref() is not None]
+    _trackers.append(weakref.ref(tracker))
+
+def get_active_status():
+    """Return the status of all progress trackers still alive and not done,
+    oldest (usually outermost loop) first. Can be called from another thread
+    (e.g. a heartbeat writer)."""
+    statuses = []
+    for tracker_ref in list(_trackers):
+        tracker = tracker_ref()
+        if tracker is not None and not tracker.done():
+            statuses.append(tracker.get_status())
+    return statuses
+
 def _time():
     """Return time in seconds. I made a separate function so I can easily
     simulate an OS where that number is only accurate to the nearest second.
@@ -190,6 +242,8 @@ class Progress:
         self.pes_total = 0
         self.pes_samples = 0
 
+        _register_tracker(self)
+
     def update(self, work):
         """Updates the work completed to 'work'."""
         if work > self.total_work:
@@ -353,6 +407,28 @@ class Progress:
         """
         return time.strftime(format, time.localtime(self.eta()))
 
+    def get_status(self, done=False):
+        """Returns the status, in the format of ThrottledProgress.get_status().
+        The time remaining is from the overall rate, as this only reads the
+        last history entry (safe to call from another thread)."""
+        t = _time()
+        (work_done, time_updated) = self.history[-1]
+        elapsed = time_updated - self.start[1]
+        if work_done > 0 and elapsed > 0:
+            time_remaining = (self.total_work - work_done) * elapsed / work_done - (t - time_updated)
+        else:
+            time_remaining = -1
+        status = dict(label=self.unit or '', pid=os.getpid(),
+                      host=socket.gethostname(), work_done=work_done,
+                      total_work=self.total_work,
+                      fraction=float(work_done) / max(self.total_work, 1),
+                      time_started=self.start[1], time_updated=t,
+                      time_elapsed=t - self.start[1],
+                      time_remaining=time_remaining,
+                      eta=t + time_remaining if time_remaining >= 0 else None,
+                      done=done)
+        return status
+
     def status_line(self, task=None):
         """Return a status line. Optionally a task name can be passed in to be
         included as well."""
@@ -481,10 +557,174 @@ class ProgressDisplay:
             print self.progress.status_line()
         return self.iterator.next()
 
+class ThrottledProgress:
+    """Progress tracker cheap enough for inner loops.
+
+    increment() only updates counters. The clock is read every
+    'calls_between_checks' calls, adapted so that this happens about every
+    'interval' seconds. Only then is a status line printed.
+
+    The status line is only printed if stdout is a terminal, unless 'display'
+    is given. The status (see get_status()) is reported to job heartbeats
+    through get_active_status().
+
+    progress = ThrottledProgress(task_size, label='sample_theta')
+    for part in task:
+        do_work()
+        progress.increment()
+    progress.finish()
+    """
+    def __init__(self, total_work, label='', interval=0.5, display=None,
+                 status_fct=None):
+        """'status_fct', if given, returns a string appended to the status
+        line (only called when the line is printed)."""
+        self.total_work = total_work
+        self.label = label
+        self.interval = interval
+        if display is None:
+            display = hasattr(sys.stdout, 'isatty') and sys.stdout.isatty()
+        self.display = display
+        self.status_fct = status_fct
+
+        self.work_done = 0
+        self.calls_between_checks = 1
+        self.calls_to_check = 1
+
+        self.time_started = _time()
+        self.time_checked = self.time_started
+        self.time_displayed = -float('inf')
+        self.finished = False
+
+        _register_tracker(self)
+
+    def increment(self, work=1):
+        """Increments the work completed by 'work' units."""
+        self.work_done += work
+        self.calls_to_check -= 1
+        if self.calls_to_check <= 0:
+            self.check()
+
+    def check(self):
+        """Read the clock, print the status if due."""
+        t = _time()
+
+        # Check the clock about every interval, growing at most 2x at a time
+        elapsed = t - self.time_checked
+        if elapsed > 0:
+            calls = self.calls_between_checks * self.interval / elapsed
+            self.calls_between_checks = max(1, int(min(calls, 2 * self.calls_between_checks)))
+        else:
+            self.calls_between_checks *= 2
+        self.calls_to_check = self.calls_between_checks
+        self.time_checked = t
+
+        if self.display and t - self.time_displayed >= self.interval:
+            self.time_displayed = t
+            self.print_status_line()
+
+    def finish(self):
+        """Print the final status line. The tracker is not active anymore,
+        even if not all work was done."""
+        self.finished = True
+        if self.display:
+            self.print_status_line(eol="\n")
+
+    def percentage(self):
+        """Returns the percent of work completed so far."""
+        return 100.0 * self.work_done / self.total_work
+
+    def done(self):
+        """Returns True when all work is done, or finish() was called."""
+        return self.finished or self.work_done >= self.total_work
+
+    def time_elapsed(self):
+        return _time() - self.time_started
+
+    def time_remaining(self):
+        """Returns the estimated time (in seconds) remaining, from the
+        overall rate so far. -1 if unknown."""
+        elapsed = self.time_elapsed()
+        if self.work_done <= 0 or elapsed <= 0:
+            return -1
+        return (self.total_work - self.work_done) * elapsed / self.work_done
+
+    def time_remaining_str(self):
+        """Returns self.time_remaining() as a string."""
+        return time_string(self.time_remaining())
+
+    def eta(self):
+        """Returns the time (similar to time.time()) when the work will be
+        complete."""
+        return _time() + self.time_remaining()
+
+    def eta_str(self, format="%d.%m %H:%M"):
+        """Returns a formatted time description of the time of completion."""
+        return time.strftime(format, time.localtime(self.eta()))
+
+    def get_status(self):
+        """Returns the status, as reported by get_active_status()."""
+        t = _time()
+        time_remaining = self.time_remaining()
+        status = dict(label=self.label, pid=os.getpid(),
+                      host=socket.gethostname(), work_done=self.work_done,
+                      total_work=self.total_work,
+                      fraction=float(self.work_done) / max(self.total_work, 1),
+                      time_started=self.time_started, time_updated=t,
+                      time_elapsed=t - self.time_started,
+                      time_remaining=time_remaining,
+                      eta=t + time_remaining if time_remaining >= 0 else None,
+                      done=self.done())
+        return status
+
+    def print_status_line(self, eol="\r", line_length=78):
+        """Write the status line to stdout, padded to 'line_length'."""
+        line = "%.2f%%, %s - %s" % (self.percentage(), self.time_remaining_str(), self.eta_str())
+        if self.label:
+            line = "%s: %s" % (self.label, line)
+        if self.status_fct is not None:
+            line = "%s %s" % (line, self.status_fct())
+        sys.stdout.write("%s%s%s" % (line, " " * (line_length - len(line)), eol))
+        sys.stdout.flush()
+
 def _test():
     import doctest
+    _test_throttled()
     return doctest.testmod()
 
+def _test_throttled():
+    """Check that ThrottledProgress rarely reads the clock, and reports its
+    status while active."""
+    global _time
+    clock_reads = [0]
+    original_time = _time
+    def counting_time():
+        clock_reads[0] += 1
+        return original_time()
+    _time = counting_time
+
+    try:
+        progress = ThrottledProgress(100000, label='test', interval=0.05, display=False)
+        for i in xrange(50000):
+            progress.increment()
+        status = [active for active in get_active_status() if active.get('label') == 'test'][0]
+        for i in xrange(50000):
+            progress.increment()
+        progress.finish()
+    finally:
+        _time = original_time
+
+    assert clock_reads[0] < 1000, clock_reads[0]
+    assert status['work_done'] == 50000 and status['fraction'] == 0.5 and not status['done']
+    assert status['pid'] == os.getpid()
+    assert progress.get_status()['done']
+    assert not [active for active in get_active_status() if active.get('label') == 'test']
+
+    # Stopped early
+    progress = ThrottledProgress(10, label='test_finish', display=False)
+    progress.increment()
+    progress.finish()
+    assert not [active for active in get_active_status() if active.get('label') == 'test_finish']
+
 def _demo_sleep():
     for i in ProgressDisplay(range(5)):
         time.sleep(1)
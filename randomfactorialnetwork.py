@@ -19,6 +19,7 @@ import scipy.special as scsp
 from scipy.spatial.distance import pdist
 
 import progress
+import utils_diskcache
 
 from utils import *
 
@@ -555,24 +556,45 @@ class RandomFactorialNetwork():
         '''
 
         if ignore_cache or self.network_response_statistics is None:
-            # Should compute it
+            # Look in the persistent cache, if enabled
+            statistics_cache = utils_diskcache.get_statistics_cache()
+            cache_key = self.get_statistics_cache_key(precision=precision, params=params)
 
-            # Sample responses to measure the statistics on
-            responses = self.collect_network_responses(precision=precision, params=params)
+            if statistics_cache is not None and not ignore_cache:
+                self.network_response_statistics = statistics_cache.get(cache_key)
 
-            responses.shape = (precision**2., int(self.M))
+            if self.network_response_statistics is None or ignore_cache:
+                # Should compute it
 
-            # Compute the mean and covariance
-            computed_mean = np.mean(responses, axis=0)
-            computed_cov = np.cov(responses.T)
+                # Sample responses to measure the statistics on
+                responses = self.collect_network_responses(precision=precision, params=params)
 
-            # Cache them
-            self.network_response_statistics = {'mean': computed_mean, 'cov': computed_cov}
+                responses.shape = (int(precision**2.), int(self.M))
+
+                # Compute the mean and covariance
+                computed_mean = np.mean(responses, axis=0)
+                computed_cov = np.cov(responses.T)
+
+                # Cache them
+                self.network_response_statistics = {'mean': computed_mean, 'cov': computed_cov}
+
+                if statistics_cache is not None:
+                    statistics_cache.set(cache_key, self.network_response_statistics)
 
         # Return the cached values
         return self.network_response_statistics
 
 
+    def get_statistics_cache_key(self, **statistics_parameters):
+        '''
+            Key of the network response statistics in the persistent cache (utils_diskcache).
+
+            Identifies the network by its preferred stimuli and tuning parameters.
+        '''
+
+        return ('RandomFactorialNetwork.compute_network_response_statistics', self.response_type, self.gain, self.neurons_preferred_stimulus, self.neurons_sigma, self.normalisation, self.mask_neurons_unset, statistics_parameters)
+
+
     def collect_network_responses(self, precision = 20, params = {}):
         '''
             Sample network responses (population code outputs) over the entire space, to be used for empirical estimates
@@ -896,13 +918,10 @@ class RandomFactorialNetwork():
 
         previous_estimates = np.zeros(4)
 
-        search_progress = progress.Progress(max_n_samples)
+        # Current estimates are only formatted when the status line is printed
+        search_progress = progress.ThrottledProgress(max_n_samples, label='marginal_inverse_FI', display=None if debug else False, status_fct=lambda: "%d %s %s %s %s %f" % (i, inv_FI_estimate, inv_FI_std_estimate, FI_estimate, FI_std_estimate, epsilon))
         for i in xrange(max_n_samples):
 
-            if i % 1000 == 0 and debug:
-                sys.stdout.write("%.1f%%, %s: %d %s %s %s %s %f\r" % (search_progress.percentage(), search_progress.time_remaining_str(), i, inv_FI_estimate, inv_FI_std_estimate, FI_estimate, FI_std_estimate, epsilon))
-                sys.stdout.flush()
-
             # Get sample of invFI and FI
             sample_FI_dict = self.compute_sample_inv_fisher_information_kitems(k_items, inv_cov_stim, min_distance)
 
@@ -937,8 +956,7 @@ class RandomFactorialNetwork():
 
                 previous_estimates = new_estimates
 
-        if debug:
-            print "\n"
+        search_progress.finish()
 
         return dict(inv_FI=inv_FI_estimate, inv_FI_std=inv_FI_std_estimate, FI=FI_estimate, FI_std=FI_std_estimate)
 
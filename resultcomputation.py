@@ -10,6 +10,7 @@ Copyright (c) 2014 . All rights reserved.
 import numpy as np
 import load_experimental_data
 import utils
+import utils_instrumentation
 import scipy.stats.mstats as mstats
 
 
@@ -71,7 +72,8 @@ class ResultComputation():
             TODO Find how to handle parameters... Should either load them from a file, or provide them as ExperimentLauncher arguments, but this is slightly tedious
         '''
 
-        return self.computation_fct(all_variables)
+        with utils_instrumentation.stage('result_computation.%s' % self.computation_name):
+            return self.computation_fct(all_variables)
 
 
 
@@ -24,6 +24,9 @@ import utils
 import em_circularmixture
 import em_circularmixture_allitems_uniquekappa
 
+import utils_likelihood
+import utils_instrumentation
+
 # import slicesampler
 
 # from dataio import *
@@ -40,9 +43,11 @@ def loglike_theta_fct_single(new_theta, (thetas, datapoint, rn, theta_mu, theta_
     like_mean = datapoint - mean_fixed_contrib - \
         ATtcB*rn.get_network_response(thetas)
 
+    utils_instrumentation.count('likelihood_evaluations')
+
     # Using inverse covariance as param
     # return theta_kappa*np.cos(thetas[sampled_feature_index] - theta_mu) - 0.5*np.dot(like_mean, np.dot(inv_covariance_fixed_contrib, like_mean))
-    return -0.5*np.dot(like_mean, np.dot(inv_covariance_fixed_contrib, like_mean))
+    return -0.5*utils_likelihood.quadratic_form(like_mean, inv_covariance_fixed_contrib)
     # return -1./(2*0.2**2)*np.sum(like_mean**2.)
 
 
@@ -54,7 +59,44 @@ def like_theta_fct_single(x, thetas, datapoint, rn, theta_mu, theta_kappa, ATtcB
     return np.exp(loglike_theta_fct_single(x, (thetas, datapoint, rn, theta_mu, theta_kappa, ATtcB, sampled_feature_index, mean_fixed_contrib, inv_covariance_fixed_contrib)))
 
 
-class Sampler:
+def invert_cdfs(cdfs, edges, quantiles):
+    '''
+        Invert piecewise linear CDFs, one per row, at the given quantiles.
+
+        All rows are inverted with a single searchsorted, by offsetting each CDF by its row index.
+
+        cdfs:       n x (B + 1), increasing from 0 to 1
+        edges:      n x (B + 1), or (B + 1) if shared by all rows
+        quantiles:  n x S, in [0, 1]
+
+        return: n x S
+    '''
+
+    nb_edges = cdfs.shape[1]
+    rows_offset = np.arange(cdfs.shape[0])[:, np.newaxis]
+
+    # Bin of each quantile, cdfs[bin] <= u < cdfs[bin + 1]
+    bins_index = np.searchsorted((cdfs + rows_offset).ravel(), (quantiles + rows_offset).ravel(), side='right').reshape(quantiles.shape) - 1
+    bins_index -= rows_offset*nb_edges
+    np.clip(bins_index, 0, nb_edges - 2, out=bins_index)
+
+    # Linear interpolation inside the bin
+    cdf_left = cdfs[rows_offset, bins_index]
+    cdf_width = cdfs[rows_offset, bins_index + 1] - cdf_left
+    cdf_width[cdf_width <= 0.0] = np.inf
+    position_in_bin = np.clip((quantiles - cdf_left)/cdf_width, 0.0, 1.0)
+
+    if edges.ndim > 1:
+        edges_left = edges[rows_offset, bins_index]
+        edges_right = edges[rows_offset, bins_index + 1]
+    else:
+        edges_left = edges[bins_index]
+        edges_right = edges[bins_index + 1]
+
+    return edges_left + position_in_bin*(edges_right - edges_left)
+
+
+class Sampler(utils_likelihood.SamplerLikelihood):
     '''
         This sampler uses inverse transform sampling, should speed stuff up.
 
@@ -63,21 +105,34 @@ class Sampler:
         y_t | x_t, y_{t-1} ~ Normal
 
     '''
-    def __init__(self, data_gen, tc=None, theta_prior_dict=dict(kappa=0.01, gamma=0.0), n_parameters=dict(), sigma_output=0.0, parameters_dict=None, renormalize_sigma_output=False, lapse_rate=0.0, inv_cdf_bins=1000):
+    def __init__(self, data_gen, tc=None, theta_prior_dict=dict(kappa=0.01, gamma=0.0), n_parameters=dict(), sigma_output=0.0, parameters_dict=None, renormalize_sigma_output=False, lapse_rate=0.0, inv_cdf_bins=None, inv_cdf_float32=None, inv_cdf_adaptive=None, inv_cdf_coarse_bins=None):
         '''
             Initialise the sampler
 
             n_parameters:         {means: T x M, covariances: T x M x M}
-        '''
+            inv_cdf_bins:         number of angles in the CDF tables used for inverse transform sampling
+            inv_cdf_float32:      store the CDF tables in float32, halves their memory
+            inv_cdf_adaptive:     use a grid adapted to each posterior instead of a uniform one.
+                                  A coarse uniform pass of inv_cdf_coarse_bins angles places the inv_cdf_bins angles where the posterior mass is.
 
-
-        self.inv_cdf_bins = inv_cdf_bins
+            The inv_cdf_* options are otherwise taken from parameters_dict (defaults in init_sampling_parameters).
+        '''
 
         self.theta_prior_dict = theta_prior_dict
 
         # Initialise sampling parameters
         self.init_sampling_parameters(parameters_dict)
 
+        # Explicit arguments take precedence over parameters_dict
+        for (param_name, param_value) in dict(inv_cdf_bins=inv_cdf_bins, inv_cdf_float32=inv_cdf_float32, inv_cdf_adaptive=inv_cdf_adaptive, inv_cdf_coarse_bins=inv_cdf_coarse_bins).iteritems():
+            if param_value is not None:
+                setattr(self, param_name, param_value)
+
+        if self.inv_cdf_float32:
+            self.inv_cdf_dtype = np.float32
+        else:
+            self.inv_cdf_dtype = np.float64
+
         # Initialise noise parameters
         self.set_noise_parameters(n_parameters)
 
@@ -147,7 +202,7 @@ class Sampler:
         if parameters_dict is None:
             parameters_dict = dict()
 
-        default_parameters = dict(inference_method='sample', num_samples=200, burn_samples=100, selection_method='last', selection_num_samples=1, slice_width=np.pi/16., slice_jump_prob=0.3, integrate_tc_out=False, num_sampling_passes=1, cued_feature_type='single')
+        default_parameters = dict(inference_method='sample', num_samples=200, burn_samples=100, selection_method='last', selection_num_samples=1, slice_width=np.pi/16., slice_jump_prob=0.3, integrate_tc_out=False, num_sampling_passes=1, cued_feature_type='single', covariance_structure='full', covariance_rank=10, whitened_likelihood=False, inv_cdf_bins=1000, inv_cdf_float32=False, inv_cdf_adaptive=False, inv_cdf_coarse_bins=128)
 
         # First defaults parameters
         for param_name, param_value in default_parameters.iteritems():
@@ -238,6 +293,7 @@ class Sampler:
 
 
 
+    @utils_instrumentation.timed('sampler.init_cache_parameters')
     def init_cache_parameters(self):
         '''
             Most of our multiplicative factors are fixed, so precompute them, for all tc.
@@ -261,13 +317,16 @@ class Sampler:
              self.inv_covariance_fixed_contrib
              ) = self.precompute_parameters(t)
 
+        # Whitened likelihood
+        self.init_whitening_cache()
+
         # Compute the normalization
         self.compute_normalization()
 
         # Setup the inverse transform parameters
-        self.angle_space = np.linspace(-np.pi, np.pi, self.inv_cdf_bins, endpoint=False)
-        self.inverse_cdfs = dict()
-        # self.compute_inverse_transform_parameters()
+        self.angle_space = np.linspace(-np.pi, np.pi, self.inv_cdf_bins, endpoint=False) + np.pi/self.inv_cdf_bins
+        self.cdfs = None
+        self.cdfs_edges = None
 
 
     def init_output_noise(self, sigma_output, renormalize=True):
@@ -302,56 +361,163 @@ class Sampler:
         if self.T > 1:
             covariance_fixed_contrib += self.n_covariances_measured[-2]
 
-        # Precompute the inverse, should speedup quite nicely
-        inv_covariance_fixed_contrib = np.linalg.inv(covariance_fixed_contrib)
+        # Precompute the inverse, should speedup quite nicely. Diagonal/low-rank approximations make the likelihood O(M k)
+        inv_covariance_fixed_contrib = utils_likelihood.invert_covariance(covariance_fixed_contrib, structure=self.covariance_structure, rank=self.covariance_rank)
         # inv_covariance_fixed_contrib = np.eye(self.M)
 
         return (ATtcB, mean_fixed_contrib, covariance_fixed_contrib, inv_covariance_fixed_contrib)
 
 
-    def compute_normalization(self):
+    @utils_instrumentation.timed('sampler.compute_normalization')
+    def compute_normalization(self, num_points=500):
         '''
             Compute normalization factor for loglikelihood
+
+            Integral of the likelihood of all datapoints, from their loglikelihood grid (see compute_log_normalization).
         '''
 
         print "Computing normalisations ..."
 
+        self.normalization = self.compute_log_normalization(num_points=num_points)
 
-        self.normalization = np.empty(self.N)
+        print "... done"
 
-        for n in xrange(self.N):
-            ## Pack parameters and integrate using scipy, super fast
-            params = (self.theta[n], self.NT[n], self.random_network, self.theta_gamma, self.theta_kappa, self.ATtcB[self.tc[n]], self.sampled_feature_index, self.mean_fixed_contrib[self.tc[n]], self.inv_covariance_fixed_contrib)
 
-            self.normalization[n] = np.log(spintg.quad(like_theta_fct_single, -np.pi, np.pi, args=params)[0])
+    @utils_instrumentation.timed('sampler.compute_inverse_transform_parameters')
+    def compute_inverse_transform_parameters(self):
+        '''
+            Setup the CDF tables used to sample, for all datapoints at once.
 
-        print "... done"
+            Each angle of the grid is the center of a bin of constant density,
+            self.cdfs[n, i] is the cumulative probability up to self.cdfs_edges[n, i].
+
+            cdfs:       N x (inv_cdf_bins + 1)
+            cdfs_edges: N x (inv_cdf_bins + 1) if adaptive, shared (inv_cdf_bins + 1) otherwise
+        '''
 
+        if self.inv_cdf_adaptive:
+            self.cdfs_edges = self.compute_adaptive_edges().astype(self.inv_cdf_dtype)
+            bins_center = (self.cdfs_edges[:, 1:] + self.cdfs_edges[:, :-1])/2.
+            bins_width = np.diff(self.cdfs_edges, axis=1)
+        else:
+            self.cdfs_edges = np.linspace(-np.pi, np.pi, self.inv_cdf_bins + 1)
+            bins_center = self.cdfs_edges[:-1] + np.pi/self.inv_cdf_bins
+            bins_width = 2.*np.pi/self.inv_cdf_bins
+
+        self.cdfs = self.compute_cdfs(bins_center, bins_width).astype(self.inv_cdf_dtype)
 
-    def compute_inverse_transform_parameters(self, n):
+
+    def compute_cdfs(self, bins_center, bins_width, datapoints=None):
         '''
-            Setup the Inverse CDF used to sample
+            Compute the CDFs of the posteriors of the given datapoints, for piecewise constant densities.
+
+            bins_center, bins_width: shared (B), or one per datapoint (N x B)
+
+            return: N x (B + 1)
         '''
 
-        curr_likelihood = np.empty(self.angle_space.size)
-        curr_cumulative = np.empty(self.angle_space.size)
+        if datapoints is None:
+            datapoints = np.arange(self.N)
+
+        tc = self.tc[datapoints]
 
-        # Get likelihood over finite space
-        for x_i, x in enumerate(self.angle_space):
-            curr_likelihood[x_i] = like_theta_fct_single(x, self.theta[n], self.NT[n], self.random_network, self.theta_gamma, self.theta_kappa, self.ATtcB[self.tc[n]], self.sampled_feature_index, self.mean_fixed_contrib[self.tc[n]], self.inv_covariance_fixed_contrib)
+        # Likelihood over finite space, for all datapoints
+        loglikelihood = self.compute_loglikelihood_grid(self.theta[datapoints], datapoints, tc, bins_center)
+        loglikelihood -= np.max(loglikelihood, axis=1)[:, np.newaxis]
 
         # Cumulative and normalize it
-        np.cumsum(curr_likelihood, out=curr_cumulative)
-        curr_cumulative /= curr_cumulative[-1]
-        curr_cumulative[0] = 0.
-        curr_cumulative[-1] = 1.0
+        cdfs = np.zeros((datapoints.size, loglikelihood.shape[1] + 1))
+        cdfs[:, 1:] = np.cumsum(np.exp(loglikelihood)*bins_width, axis=1)
+        cdfs /= cdfs[:, -1:]
+
+        return cdfs
+
+
+    def compute_adaptive_edges(self, uniform_fraction=0.05):
+        '''
+            Place the bins edges of each datapoint where its posterior mass is.
+
+            A coarse uniform grid gives an estimate of the posterior mass, spread to neighbouring coarse bins
+            and mixed with a uniform distribution (uniform_fraction) so that the whole circle stays covered.
+            The fine edges are the quantiles of this estimate.
+
+            return: N x (inv_cdf_bins + 1)
+        '''
 
-        # Interpolate the inverse
-        self.inverse_cdfs[n] = spinter.interp1d(curr_cumulative, self.angle_space, kind='linear', assume_sorted=True)
+        coarse_edges = np.linspace(-np.pi, np.pi, self.inv_cdf_coarse_bins + 1)
+        coarse_cdfs = self.compute_cdfs(coarse_edges[:-1] + np.pi/self.inv_cdf_coarse_bins, 2.*np.pi/self.inv_cdf_coarse_bins)
+
+        coarse_mass = np.diff(coarse_cdfs, axis=1)
+        coarse_mass = (np.roll(coarse_mass, 1, axis=1) + coarse_mass + np.roll(coarse_mass, -1, axis=1))/3.
+        coarse_mass = (1. - uniform_fraction)*coarse_mass + uniform_fraction/self.inv_cdf_coarse_bins
+
+        coarse_cdfs[:, 1:] = np.cumsum(coarse_mass, axis=1)
+        coarse_cdfs[:, -1] = 1.0
+
+        quantiles = np.tile(np.linspace(0., 1., self.inv_cdf_bins + 1)[1:-1], (self.N, 1))
+
+        edges = np.empty((self.N, self.inv_cdf_bins + 1))
+        edges[:, 0] = -np.pi
+        edges[:, 1:-1] = invert_cdfs(coarse_cdfs, coarse_edges, quantiles)
+        edges[:, -1] = np.pi
+
+        return edges
+
+
+    def sample_inverse_cdfs(self, datapoints, num_samples):
+        '''
+            Sample num_samples angles for each of the given datapoints, by inverting their CDF tables.
+
+            return: datapoints.size x num_samples
+        '''
+
+        if self.cdfs is None:
+            self.compute_inverse_transform_parameters()
+
+        datapoints = np.asarray(datapoints)
+
+        if self.cdfs_edges.ndim > 1:
+            edges = self.cdfs_edges[datapoints]
+        else:
+            edges = self.cdfs_edges
+
+        samples = invert_cdfs(self.cdfs[datapoints], edges, np.random.rand(datapoints.size, num_samples))
+
+        return utils.wrap_angles(samples)
+
+
+    def estimate_inverse_cdf_error(self, datapoints=None, dense_bins=5000):
+        '''
+            Estimate the error of the CDF tables used for sampling, versus a dense uniform grid.
+
+            Returns the Kolmogorov-Smirnov distance (max absolute difference of the CDFs) for each datapoint.
+        '''
+
+        if self.cdfs is None:
+            self.compute_inverse_transform_parameters()
+
+        if datapoints is None:
+            datapoints = np.arange(self.N)
+        datapoints = np.asarray(datapoints)
+
+        dense_edges = np.linspace(-np.pi, np.pi, dense_bins + 1)
+        dense_cdfs = self.compute_cdfs(dense_edges[:-1] + np.pi/dense_bins, 2.*np.pi/dense_bins, datapoints=datapoints)
+
+        error = np.empty(datapoints.size)
+        for i, n in enumerate(datapoints):
+            if self.cdfs_edges.ndim > 1:
+                edges = self.cdfs_edges[n]
+            else:
+                edges = self.cdfs_edges
+
+            error[i] = np.max(np.abs(np.interp(dense_edges, edges, self.cdfs[n]) - dense_cdfs[i]))
+
+        return error
 
 
     #######
 
+    @utils_instrumentation.timed('sampler.run_inference')
     def run_inference(self, parameters=None):
         '''
             Infer angles based on memory state
@@ -410,6 +576,7 @@ class Sampler:
         return loglikelihood
 
 
+    @utils_instrumentation.timed('sampler.sample_theta')
     def sample_theta(self, return_samples=False, subset_theta=None, debug=False):
         '''
             Sample the thetas
@@ -442,7 +609,7 @@ class Sampler:
             all_samples = np.zeros((permuted_datapoints.size, self.num_samples))
 
         if debug:
-            search_progress = progress.Progress((self.R - 1)*permuted_datapoints.size)
+            search_progress = progress.ThrottledProgress((self.R - 1)*permuted_datapoints.size, label='sample_theta')
 
         if len(self.theta_to_sample.shape) > 1:
             permutation_fct = np.random.permutation
@@ -452,6 +619,11 @@ class Sampler:
 
         cache_randomdraws = np.random.rand(self.N, self.R-1)
 
+        if not self.integrate_tc_out:
+            # Draw the samples for all datapoints and features at once
+            nb_features = self.theta_to_sample.shape[1] if len(self.theta_to_sample.shape) > 1 else 1
+            cache_samples = self.sample_inverse_cdfs(np.repeat(permuted_datapoints, nb_features), self.num_samples).reshape((permuted_datapoints.size, nb_features, self.num_samples))
+
         # Do everything in log-domain, to avoid numerical errors
         i = 0
         # for n in progress.ProgressDisplay(permuted_datapoints, display=progress.SINGLE_LINE):
@@ -467,7 +639,7 @@ class Sampler:
                 if not has_lapsed:
                     # Get samples from the current memory distribution
                     if not self.integrate_tc_out:
-                        samples = self.get_samples_theta_current_tc(n, sampled_feature_index=sampled_feature_index)
+                        samples = cache_samples[i, sampled_feature_index_i]
                     else:
                         samples = self.get_samples_theta_tc_integratedout(n, sampled_feature_index=sampled_feature_index)
 
@@ -492,17 +664,11 @@ class Sampler:
                 if debug:
                     search_progress.increment()
 
-                    if search_progress.done():
-                        eol = '\n'
-                    else:
-                        eol = '\r'
-
-                    line = "%.2f%%, %s - %s" % (search_progress.percentage(), search_progress.time_remaining_str(), search_progress.eta_str())
-                    sys.stdout.write("%s%s%s" % (line, " " * (78-len(line)), eol))
-                    sys.stdout.flush()
-
             i += 1
 
+        if debug:
+            search_progress.finish()
+
         if return_samples:
             return all_samples
 
@@ -531,16 +697,10 @@ class Sampler:
 
     def get_samples_theta_current_tc(self, n, sampled_feature_index=0):
         '''
-            Uses the inverse CDF pre-computed above to get samples fast.
+            Uses the CDF tables pre-computed above to get samples fast.
         '''
 
-        if n not in self.inverse_cdfs:
-            self.compute_inverse_transform_parameters(n)
-
-        # Use the inverse transform!
-        samples = self.inverse_cdfs[n](np.random.rand(self.num_samples))
-
-        return samples
+        return self.sample_inverse_cdfs(np.array([n]), self.num_samples)[0]
 
 
     def get_samples_theta_tc_integratedout(self, n, sampled_feature_index=0):
@@ -604,6 +764,7 @@ class Sampler:
         self.theta[:, self.sampled_feature_index] = new_thetas
 
 
+    @utils_instrumentation.timed('sampler.set_theta_max_likelihood')
     def set_theta_max_likelihood(self, num_points=100, post_optimise=True):
         '''
             Update theta to their Max Likelihood values.
@@ -611,28 +772,18 @@ class Sampler:
         '''
 
         all_angles = np.linspace(-np.pi, np.pi, num_points, endpoint=False)
-        llh = np.zeros(num_points)
 
-        # Compute the array
-        for n in progress.ProgressDisplay(np.arange(self.N), display=progress.SINGLE_LINE):
-
-            # Pack the parameters for the likelihood function
-            params = (self.theta[n], self.NT[n], self.random_network, self.theta_gamma, self.theta_kappa, self.ATtcB[self.tc[n]], self.sampled_feature_index, self.mean_fixed_contrib[self.tc[n]], self.inv_covariance_fixed_contrib)
+        # Max Likelihood angles on the grid, used as initial values for the optimisation routine
+        ml_angles = self.compute_posterior_statistics(thetas=self.theta[:self.N], all_angles=all_angles)['ml_angle']
 
-            # Compute the loglikelihood for all possible first feature
-            # Use this as initial value for the optimisation routine
-            for i in xrange(num_points):
-                # Give the correct cued second feature
-                llh[i] = loglike_theta_fct_single(all_angles[i], params)
-
-            # opt_angles[n] = spopt.fminbound(loglike_theta_fct_single_min, -np.pi, np.pi, params, disp=3)
-            # opt_angles[n] = spopt.brent(loglike_theta_fct_single_min, params)
-            # opt_angles[n] = utils.wrap_angles(np.array([np.mod(spopt.anneal(loglike_theta_fct_single_min, np.random.random_sample()*np.pi*2. - np.pi, args=params)[0], 2.*np.pi)]))
+        if post_optimise:
+            for n in progress.ProgressDisplay(np.arange(self.N), display=progress.SINGLE_LINE):
+                # Pack the parameters for the likelihood function
+                params = (self.theta[n], self.NT[n], self.random_network, self.theta_gamma, self.theta_kappa, self.ATtcB[self.tc[n]], self.sampled_feature_index, self.mean_fixed_contrib[self.tc[n]], self.inv_covariance_fixed_contrib)
 
-            if post_optimise:
-                self.theta[n, self.sampled_feature_index] = spopt.fmin(loglike_theta_fct_single_min, all_angles[np.argmax(llh)], args=params, disp=False)[0]
-            else:
-                self.theta[n, self.sampled_feature_index] = all_angles[np.argmax(llh)]
+                self.theta[n, self.sampled_feature_index] = spopt.fmin(loglike_theta_fct_single_min, ml_angles[n], args=params, disp=False)[0]
+        else:
+            self.theta[:self.N, self.sampled_feature_index] = ml_angles
 
         # Add output noise if desired.
         self.theta[:, self.sampled_feature_index] = self.add_output_noise_vectorized(self.theta[:, self.sampled_feature_index])
@@ -650,6 +801,10 @@ class Sampler:
         # Reset the cued theta
         self.theta[np.arange(self.N), self.data_gen.cued_features[:self.N, 0]] = self.data_gen.stimuli_correct[np.arange(self.N), self.data_gen.cued_features[:self.N, 1], self.data_gen.cued_features[:self.N, 0]]
 
+        # CDF tables depend on the cued theta
+        self.cdfs = None
+        self.cdfs_edges = None
+
     def collect_responses(self):
         '''
             Gather and return the responses, target angles and non-target angles
@@ -710,6 +865,7 @@ class Sampler:
         return np.nansum(self.compute_loglikelihood_N(integrate_tc_out=integrate_tc_out, precision=precision))
 
 
+    @utils_instrumentation.timed('sampler.compute_loglikelihood_N')
     def compute_loglikelihood_N(self, integrate_tc_out=False, precision=200, lapse_likelihood_lower_bound=False):
         '''
             Compute the loglikelihood for each datapoint, using the current setting of thetas and likelihood functions.
@@ -722,7 +878,8 @@ class Sampler:
             LL += self.compute_loglikelihood_N_convolved_output_noise(precision=precision)
         else:
             if integrate_tc_out:
-                LL += self.compute_loglikelihood_tc_integratedout()
+                # Marginalise over the recall times, p(tc) = 1/T
+                LL += utils_likelihood.marginalise_loglikelihood(self.compute_loglikelihood_tc_integratedout(), axis=1)
             else:
                 LL += self.compute_loglikelihood_current_tc()
 
@@ -756,49 +913,11 @@ class Sampler:
         return np.nansum(np.sort(all_loglikelihoods)[int(np.round(self.N*(1-p))):])
 
 
-    def compute_loglikelihood_current_tc(self):
+    def compute_loglikelihood_N_convolved_output_noise_spline(self, precision=100):
         '''
             Compute the loglikelihood for the current setting of thetas and tc and using the likelihood defined in loglike_theta_fct_single
-        '''
-
-        loglikelihood = np.empty(self.N)
-
-        for n in xrange(self.N):
-            # Pack the parameters for the likelihood function
-            params = (self.theta[n].copy(), self.NT[n], self.random_network, self.theta_gamma, self.theta_kappa, self.ATtcB[self.tc[n]], self.sampled_feature_index, self.mean_fixed_contrib[self.tc[n]], self.inv_covariance_fixed_contrib)
-
-            # Compute the loglikelihood for the current datapoint
-            loglikelihood[n] = loglike_theta_fct_single(self.theta[n, self.sampled_feature_index], params)
 
-        loglikelihood -= self.normalization[:self.N]
-
-        return loglikelihood
-
-
-    def compute_loglikelihood_tc_integratedout(self):
-        '''
-            Compute the loglikelihood for the current setting of thetas and using the likelihood defined in loglike_theta_fct_single
-            Integrates tc out.
-        '''
-
-        loglikelihood = np.empty((self.N, self.T))
-
-        for n in xrange(self.N):
-            for tc in xrange(self.T):
-                # Pack the parameters for the likelihood function
-                params = (self.theta[n].copy(), self.NT[n], self.random_network, self.theta_gamma, self.theta_kappa, self.ATtcB[tc], self.sampled_feature_index, self.mean_fixed_contrib[tc], self.inv_covariance_fixed_contrib)
-
-                # Compute the loglikelihood for the current datapoint
-                loglikelihood[n, tc] = loglike_theta_fct_single(self.theta[n, self.sampled_feature_index], params)
-
-        loglikelihood -= self.normalization[:self.N]
-
-        return loglikelihood
-
-
-    def compute_loglikelihood_N_convolved_output_noise(self, precision=100):
-        '''
-            Compute the loglikelihood for the current setting of thetas and tc and using the likelihood defined in loglike_theta_fct_single
+            Reference version of compute_loglikelihood_N_convolved_output_noise, one spline per datapoint.
         '''
 
         # TODO CONVERT ME
@@ -1124,6 +1243,7 @@ class Sampler:
 
     ########
 
+    @utils_instrumentation.timed('sampler.fit_mixture_model')
     def fit_mixture_model(self, compute_responsibilities=False, use_all_targets=False):
         '''
             Fit Paul Bays' Mixture model.
@@ -1169,80 +1289,16 @@ class Sampler:
         return utils.KL_div(model_mixtprop, data_mixtprop)
 
 
-    def estimate_fisher_info_from_posterior(self, n=0, all_angles=None, num_points=500):
-        '''
-            Look at the curvature of the posterior to estimate the Fisher Information
-        '''
-
-        if all_angles is None:
-            all_angles = np.linspace(-np.pi, np.pi, num_points)
-
-        log_posterior = self.compute_likelihood_fullspace(n=n, all_angles=all_angles, num_points=num_points, should_exponentiate=False, remove_mean=True)[:, self.tc[n]].T
-
-        # Look if it seems Gaussian enough
-
-        # log_posterior = np.log(posterior.T)
-        log_posterior[np.isinf(log_posterior)] = 0.0
-        log_posterior[np.isnan(log_posterior)] = 0.0
-
-        dx = np.diff(all_angles)[0]
-
-        # posterior /= np.sum(posterior*dx)
-
-        np.seterr(all='raise')
-        try:
-            # Incorrect here, see Issue #23
-            # FI_estim_curv = np.trapz(-np.gradient(np.gradient(log_posterior))*posterior/dx**2., x)
-
-            ml_index = np.argmax(log_posterior)
-            curv_logp = -np.gradient(np.gradient(log_posterior))/dx**2.
-
-            # take the curvature at the ML value
-            FI_estim_curv = curv_logp[ml_index]
-        except FloatingPointError:
-            # print 'Overflow on n: %d' % n
-            FI_estim_curv = np.nan
-
-        np.seterr(all='warn')
-
-        return FI_estim_curv
-
-
-
-    def estimate_fisher_info_from_posterior_avg(self, num_points=500, full_stats=False):
-        '''
-            Estimate the Fisher Information from the curvature of the posterior.
-
-            Takes the mean over all datapoints.
-        '''
-
-        mean_FI = np.zeros(self.N)
-
-        all_angles = np.linspace(-np.pi, np.pi, num_points)
-
-        for i in progress.ProgressDisplay(np.arange(self.N), display=progress.SINGLE_LINE):
-            mean_FI[i] = self.estimate_fisher_info_from_posterior(n=i, all_angles=all_angles)
-
-        if full_stats:
-            return dict(mean=utils.nanmean(mean_FI), std=utils.nanstd(mean_FI), median=utils.nanmedian(mean_FI), all=mean_FI)
-        else:
-            return utils.nanmean(mean_FI)
-
-
     def estimate_fisher_info_from_posterior_avg_randomsubset(self, subset_size=1, num_points=500, full_stats=False):
         '''
             Estimate the Fisher Information from the curvature of the posterior.
 
-            Takes the mean over all datapoints.
+            Takes the mean over a random subset of datapoints.
         '''
 
-        mean_FI = np.zeros(subset_size)
         random_subset = np.random.randint(self.N, size=subset_size)
 
-        all_angles = np.linspace(-np.pi, np.pi, num_points)
-
-        for i in progress.ProgressDisplay(np.arange(subset_size), display=progress.SINGLE_LINE):
-            mean_FI[i] = self.estimate_fisher_info_from_posterior(n=random_subset[i], all_angles=all_angles)
+        mean_FI = self.compute_posterior_statistics(datapoints=random_subset, num_points=num_points)['fisher_info']
 
         if full_stats:
             return dict(mean=utils.nanmean(mean_FI), std=utils.nanstd(mean_FI), median=utils.nanmedian(mean_FI), all=mean_FI)
@@ -1322,6 +1378,7 @@ class Sampler:
         return fisher_info_all
 
 
+    @utils_instrumentation.timed('sampler.estimate_marginal_inverse_fisher_info_montecarlo')
     def estimate_marginal_inverse_fisher_info_montecarlo(self):
         '''
             Compute a Monte Carlo estimate of the Marginal Inverse Fisher Information.
@@ -1341,43 +1398,16 @@ class Sampler:
         return FI_estimates
 
 
-    def estimate_precision_from_posterior(self, n=0, num_points=500):
-        '''
-            Look at the posterior to estimate the precision directly
-        '''
-
-        posterior = self.plot_likelihood_correctlycuedtimes(n=n, num_points=num_points, should_plot=False, should_return=True, should_exponentiate=True, debug=False)[:, 0]
-
-        x = np.linspace(-np.pi, np.pi, num_points)
-        dx = np.diff(x)[0]
-
-        posterior /= np.sum(posterior*dx)
-
-        np.seterr(all='raise')
-        try:
-            # TODO Precision withouth square?
-            precision_estimated = 1./(-2.*np.log(np.abs(np.trapz(posterior*np.exp(1j*x), x))))
-        except FloatingPointError:
-            # print 'Overflow on n: %d' % n
-            precision_estimated = np.nan
-
-        np.seterr(all='warn')
-
-        return precision_estimated
-
-
-
-    def estimate_precision_from_posterior_avg(self, num_points=500, full_stats=False):
+    def estimate_precision_from_posterior_avg_randomsubset(self, subset_size=1, num_points=1000, full_stats=False):
         '''
             Estimate the precision from the posterior.
 
-            Takes the mean over all datapoints.
+            Takes the mean over a subset of datapoints.
         '''
 
-        precisions = np.zeros(self.N)
+        random_subset = np.random.randint(self.N, size=subset_size)
 
-        for i in progress.ProgressDisplay(np.arange(self.N), display=progress.SINGLE_LINE):
-            precisions[i] = self.estimate_precision_from_posterior(n=i, num_points=num_points)
+        precisions = self.compute_posterior_statistics(datapoints=random_subset, num_points=num_points)['precision']
 
         if full_stats:
             return dict(mean=utils.nanmean(precisions), std=utils.nanstd(precisions), median=utils.nanmedian(precisions), all=precisions)
@@ -1385,24 +1415,29 @@ class Sampler:
             return utils.nanmean(precisions)
 
 
-    def estimate_precision_from_posterior_avg_randomsubset(self, subset_size=1, num_points=1000, full_stats=False):
+    @utils_instrumentation.timed('sampler.compute_precision_from_samples_chains')
+    def compute_precision_from_samples_chains(self, datapoints, num_samples=1000, num_repetitions=1, return_samples=False):
         '''
-            Estimate the precision from the posterior.
+            Precision of num_repetitions sets of samples per datapoint.
 
-            Takes the mean over a subset of datapoints.
+            All samples come from one inversion of the CDF tables (independent samples, no burn-in),
+            the current thetas are not modified.
+
+            return: dict(precisions=datapoints.size x num_repetitions, [samples=datapoints.size x num_repetitions x num_samples])
         '''
 
-        random_subset = np.random.randint(self.N, size=subset_size)
+        datapoints = np.asarray(datapoints, dtype=int)
 
-        precisions = np.zeros(subset_size)
+        samples = self.sample_inverse_cdfs(np.repeat(datapoints, num_repetitions), num_samples).reshape((datapoints.size, num_repetitions, num_samples))
 
-        for i in progress.ProgressDisplay(xrange(subset_size), display=progress.SINGLE_LINE):
-            precisions[i] = self.estimate_precision_from_posterior(n=random_subset[i], num_points=num_points)
+        # Circular std dev of all sets of samples, population vectors are over axis 0
+        circ_std_dev = utils.angle_circular_std_dev(np.rollaxis(samples, -1))
 
-        if full_stats:
-            return dict(mean=utils.nanmean(precisions), std=utils.nanstd(precisions), median=utils.nanmedian(precisions), all=precisions)
-        else:
-            return utils.nanmean(precisions)
+        output = dict(precisions=utils.compute_angle_precision_from_std(circ_std_dev))
+        if return_samples:
+            output['samples'] = samples
+
+        return output
 
 
     def estimate_precision_from_samples(self, n=0, num_samples=1000, num_repetitions=1, selection_method='median', return_samples=False):
@@ -1410,29 +1445,14 @@ class Sampler:
             Take samples of theta for a particular datapoint, and estimate the precision from their distribution.
         '''
 
-        all_precisions = np.zeros(num_repetitions)
+        res = self.compute_precision_from_samples_chains([n], num_samples=num_samples, num_repetitions=num_repetitions, return_samples=return_samples)
 
-        if return_samples:
-            all_samples = np.zeros((num_repetitions, num_samples))
-
-        for repet_i in xrange(num_repetitions):
-
-            # Get samples
-            samples = self.sample_theta(return_samples=True, subset_theta=[n])[0]
-
-            # Estimate the circular standard deviation of those samples
-            circ_std_dev = utils.angle_circular_std_dev(samples)
-
-            # And now get the precision (uncorrected for chance level)
-            all_precisions[repet_i] = utils.compute_angle_precision_from_std(circ_std_dev)
-
-            if return_samples:
-                all_samples[repet_i] = samples
+        all_precisions = res['precisions'][0]
 
         output = dict(mean=np.mean(all_precisions), std=np.std(all_precisions), all=all_precisions)
 
         if return_samples:
-            output['samples'] = all_samples
+            output['samples'] = res['samples'][0]
 
         return output
 
@@ -1442,24 +1462,16 @@ class Sampler:
             Estimate precision from the samples. Get it for every datapoint.
         '''
 
-        all_precision = np.zeros(self.N)
-        all_precision_everything = np.zeros((self.N, num_repetitions))
+        res = self.compute_precision_from_samples_chains(np.arange(self.N), num_samples=num_samples, num_repetitions=num_repetitions, return_samples=return_samples)
 
-        if return_samples:
-            all_samples = np.zeros((self.N, num_repetitions, num_samples))
-
-        for i in progress.ProgressDisplay(xrange(self.N), display=progress.SINGLE_LINE):
-            # print i
-            res = self.estimate_precision_from_samples(n=i, num_samples=num_samples, num_repetitions=num_repetitions, selection_method=selection_method, return_samples=return_samples)
-
-            all_precision[i] = res['mean']
-            all_precision_everything[i] = res['all']
-
-            if return_samples:
-                all_samples[i] = res['samples']
+        all_precision_everything = res['precisions']
+        all_precision = np.mean(all_precision_everything, axis=-1)
 
         if full_stats:
-            return dict(mean=utils.nanmean(all_precision), std=utils.nanstd(all_precision), median=utils.nanmedian(all_precision), all=all_precision_everything)
+            output = dict(mean=utils.nanmean(all_precision), std=utils.nanstd(all_precision), median=utils.nanmedian(all_precision), all=all_precision_everything)
+            if return_samples:
+                output['samples'] = res['samples']
+            return output
         else:
             return utils.nanmean(all_precision)
 
@@ -1473,22 +1485,16 @@ class Sampler:
 
         random_subset = np.random.randint(self.N, size=subset_size)
 
-        all_precision = np.zeros(subset_size)
-        all_precision_everything = np.zeros((subset_size, num_repetitions))
-        if return_samples:
-            all_samples = np.zeros((subset_size, num_repetitions, num_samples))
-
+        res = self.compute_precision_from_samples_chains(random_subset, num_samples=num_samples, num_repetitions=num_repetitions, return_samples=return_samples)
 
-        for i in progress.ProgressDisplay(xrange(subset_size), display=progress.SINGLE_LINE):
-            res = self.estimate_precision_from_samples(n=random_subset[i], num_samples=num_samples, num_repetitions=num_repetitions, selection_method=selection_method, return_samples=return_samples)
-
-            all_precision[i] = res['mean']
-            all_precision_everything[i] = res['all']
-            if return_samples:
-                all_samples[i] = res['samples']
+        all_precision_everything = res['precisions']
+        all_precision = np.mean(all_precision_everything, axis=-1)
 
         if full_stats:
-            return dict(mean=utils.nanmean(all_precision), std=utils.nanstd(all_precision), median=utils.nanmedian(all_precision), all=all_precision_everything)
+            output = dict(mean=utils.nanmean(all_precision), std=utils.nanstd(all_precision), median=utils.nanmedian(all_precision), all=all_precision_everything)
+            if return_samples:
+                output['samples'] = res['samples']
+            return output
         else:
             return utils.nanmean(all_precision)
 
@@ -1879,11 +1885,238 @@ class Sampler:
 
 
 ####################################
-if __name__ == '__main__':
+def build_test_sampler(**parameters):
+    '''
+        Sampler built by launchers.init_everything, experimentlauncher defaults overridden by parameters
+    '''
+    import experimentlauncher
+    import launchers
 
-    print "====> DEPRECATED, use experimentlauncher.py instead"
+    all_parameters = experimentlauncher.ExperimentLauncher(run=False, arguments_dict=dict(dict(inference_method='none', autoset_parameters=None, sigmay=0.0001), **parameters)).args_dict
 
-    # import experimentlauncher
-    # experiment_launcher = experimentlauncher.ExperimentLauncher(run=True)
+    return launchers.init_everything(all_parameters)[3]
 
-    # plt.show()
+
+def loglikelihood_reference(sampler, tc, inv_covariance=None):
+    '''
+        Loglikelihood of all datapoints for recall times tc, one loglike_theta_fct_single call at a time
+
+        inv_covariance: defaults to the sampler inv_covariance_fixed_contrib
+    '''
+
+    if inv_covariance is None:
+        inv_covariance = sampler.inv_covariance_fixed_contrib
+
+    loglikelihood = np.empty(sampler.N)
+    for n in xrange(sampler.N):
+        params = (sampler.theta[n].copy(), sampler.NT[n], sampler.random_network, sampler.theta_gamma, sampler.theta_kappa, sampler.ATtcB[tc[n]], sampler.sampled_feature_index, sampler.mean_fixed_contrib[tc[n]], inv_covariance)
+        loglikelihood[n] = loglike_theta_fct_single(sampler.theta[n, sampler.sampled_feature_index], params)
+
+    return loglikelihood - sampler.normalization[:sampler.N]
+
+
+def test_loglikelihood_batched():
+    '''
+        Check the batched loglikelihoods against loglike_theta_fct_single
+    '''
+
+    np.random.seed(10)
+
+    sampler = build_test_sampler(code_type='conj', M=100, N=20, T=2)
+    tc = sampler.tc[:sampler.N]
+
+    assert np.allclose(sampler.compute_loglikelihood_current_tc(), loglikelihood_reference(sampler, tc), rtol=1e-8, atol=1e-8)
+
+    loglikelihood_tc = sampler.compute_loglikelihood_tc_integratedout()
+    assert loglikelihood_tc.shape == (sampler.N, sampler.T)
+    for t in xrange(sampler.T):
+        assert np.allclose(loglikelihood_tc[:, t], loglikelihood_reference(sampler, np.ones(sampler.N, dtype=int)*t), rtol=1e-8, atol=1e-8)
+
+
+def test_loglikelihood_whitened():
+    '''
+        Check the whitened loglikelihoods against the unwhitened ones and loglike_theta_fct_single
+    '''
+
+    np.random.seed(10)
+
+    sampler = build_test_sampler(code_type='conj', M=100, N=20, T=2, whitened_likelihood=True)
+    assert sampler.whitening_factor is not None
+
+    tc = sampler.tc[:sampler.N]
+    datapoints = np.arange(sampler.N)
+    all_angles = np.linspace(-np.pi, np.pi, 50, endpoint=False)
+
+    loglikelihood_whitened = sampler.compute_loglikelihood_current_tc()
+    loglikelihood_tc_whitened = sampler.compute_loglikelihood_tc_integratedout()
+    loglikelihood_grid_whitened = sampler.compute_loglikelihood_grid(sampler.theta[:sampler.N], datapoints, tc, all_angles)
+
+    assert np.allclose(loglikelihood_whitened, loglikelihood_reference(sampler, tc), rtol=1e-6, atol=1e-6)
+
+    sampler.whitened_likelihood = False
+    sampler.init_whitening_cache()
+    assert sampler.whitening_factor is None
+
+    assert np.allclose(loglikelihood_tc_whitened, sampler.compute_loglikelihood_tc_integratedout(), rtol=1e-6, atol=1e-6)
+    assert np.allclose(loglikelihood_grid_whitened, sampler.compute_loglikelihood_grid(sampler.theta[:sampler.N], datapoints, tc, all_angles), rtol=1e-6, atol=1e-6)
+
+
+def test_loglikelihood_lowrank():
+    '''
+        Check the diagonal plus low rank inverse covariances against dense inverses
+    '''
+
+    np.random.seed(10)
+
+    sampler = build_test_sampler(code_type='conj', M=100, N=20, T=2)
+    tc = sampler.tc[:sampler.N]
+    loglikelihood_full = sampler.compute_loglikelihood_current_tc()
+
+    sampler.covariance_structure = 'lowrank'
+    approximation_errors = []
+    loglikelihood_differences = []
+    for rank in [10, 50, sampler.M - 1]:
+        sampler.covariance_rank = rank
+        sampler.init_cache_parameters()
+        assert isinstance(sampler.inv_covariance_fixed_contrib, utils_likelihood.LowRankInverseCovariance)
+
+        # Woodbury quadratic form, same as the dense inverse of the approximated covariance
+        loglikelihood_lowrank = sampler.compute_loglikelihood_current_tc()
+        assert np.allclose(loglikelihood_lowrank, loglikelihood_reference(sampler, tc, inv_covariance=np.linalg.inv(sampler.inv_covariance_fixed_contrib.get_covariance())), rtol=1e-8, atol=1e-8)
+
+        approximation_errors.append(sampler.estimate_covariance_approximation_error())
+        loglikelihood_differences.append(np.max(np.abs(loglikelihood_lowrank - loglikelihood_full)))
+        print "Rank %d, relative Frobenius error %.3g, max loglikelihood difference %.3g" % (rank, approximation_errors[-1]['relative_frobenius'], loglikelihood_differences[-1])
+
+    # Converges to the full covariance with the rank
+    assert approximation_errors[0]['kl_divergence'] > approximation_errors[1]['kl_divergence']
+    assert approximation_errors[1]['relative_frobenius'] < 0.05 and loglikelihood_differences[1] < 0.2
+    assert approximation_errors[-1]['relative_frobenius'] < 1e-10 and loglikelihood_differences[-1] < 1e-8
+
+
+def test_posterior_grid():
+    '''
+        Check the grid loglikelihoods against loglike_theta_fct_single, and the grid normalisation against scipy quad
+    '''
+
+    np.random.seed(10)
+
+    # Sharp and multimodal posteriors, 500 points are not enough for most datapoints
+    sampler = build_test_sampler(code_type='mixed', M=400, N=10, T=2, sigmax=0.01)
+
+    all_angles = np.linspace(-np.pi, np.pi, 500, endpoint=False)
+    loglikelihood_fullspace = sampler.compute_loglikelihood_N_fullspace(all_angles=all_angles)
+    posterior_statistics = sampler.compute_posterior_statistics(all_angles=all_angles)
+
+    for n in xrange(sampler.N):
+        t = sampler.tc[n]
+        params = (sampler.data_gen.stimuli_correct[n, t].copy(), sampler.NT[n], sampler.random_network, sampler.theta_gamma, sampler.theta_kappa, sampler.ATtcB[t], sampler.sampled_feature_index, sampler.mean_fixed_contrib[t], sampler.inv_covariance_fixed_contrib)
+        loglikelihood_reference_n = np.array([loglike_theta_fct_single(angle, params) for angle in all_angles])
+        assert np.allclose(loglikelihood_fullspace[n], loglikelihood_reference_n, rtol=1e-8, atol=1e-8)
+        assert posterior_statistics['ml_angle'][n] == all_angles[np.argmax(loglikelihood_reference_n)]
+
+        # Normalisation of the current thetas
+        params = (sampler.theta[n].copy(), sampler.NT[n], sampler.random_network, sampler.theta_gamma, sampler.theta_kappa, sampler.ATtcB[t], sampler.sampled_feature_index, sampler.mean_fixed_contrib[t], sampler.inv_covariance_fixed_contrib)
+        loglikelihood_max = np.max(loglikelihood_fullspace[n])
+        integral = spintg.quad(lambda x: np.exp(loglike_theta_fct_single(x, params) - loglikelihood_max), -np.pi, np.pi, points=np.linspace(-np.pi, np.pi, 49)[1:-1], limit=500)[0]
+
+        assert np.abs(sampler.normalization[n] - np.log(integral) - loglikelihood_max) < 1e-4
+
+
+def test_convolved_output_noise():
+    '''
+        Check the Fourier convolution with the output noise against a direct convolution on a dense grid, and the spline reference
+    '''
+
+    for (code_type, sigmax) in [('conj', 0.1), ('mixed', 0.05)]:
+        np.random.seed(10)
+
+        sampler = build_test_sampler(code_type=code_type, M=100, N=20, T=2, sigmax=sigmax, sigma_output=0.1)
+
+        # p(theta) = int p(x | n) vonmises(theta - x; kappa_output) dx / int p(x | n) dx
+        dense_space = np.linspace(-np.pi, np.pi, 20000, endpoint=False)
+        loglikelihood_dense = sampler.compute_loglikelihood_N_fullspace(all_angles=dense_space)
+        posterior_dense = np.exp(loglikelihood_dense - np.max(loglikelihood_dense, axis=1)[:, np.newaxis])
+        thetas = sampler.theta[np.arange(sampler.N), sampler.theta_target_index[:sampler.N]]
+        loglikelihood_reference_dense = np.log(np.sum(posterior_dense*utils.vonmisespdf(thetas[:, np.newaxis] - dense_space, 0.0, sampler.kappa_output), axis=1)/np.sum(posterior_dense, axis=1))
+
+        loglikelihood_fourier = sampler.compute_loglikelihood_N_convolved_output_noise(precision=100)
+        loglikelihood_spline = sampler.compute_loglikelihood_N_convolved_output_noise_spline(precision=100)
+
+        print "Convolved loglikelihood error, Fourier: %.3g, spline: %.3g" % (np.max(np.abs(loglikelihood_fourier - loglikelihood_reference_dense)), np.max(np.abs(loglikelihood_spline - loglikelihood_reference_dense)))
+        assert np.allclose(loglikelihood_fourier, loglikelihood_reference_dense, rtol=0.0, atol=1e-5)
+
+        # The spline reference discretises the kernel and misses the last grid interval in its normalisation
+        assert np.allclose(loglikelihood_spline, loglikelihood_reference_dense, rtol=0.0, atol=0.25)
+
+
+def test_inverse_cdf():
+    '''
+        Check the CDF tables used for inverse transform sampling
+    '''
+
+    np.random.seed(10)
+
+    # Batched inversion, same as one linear interpolation per row
+    cdfs = np.zeros((5, 31))
+    cdfs[:, 1:] = np.cumsum(np.random.rand(5, 30), axis=1)
+    cdfs /= cdfs[:, -1:]
+    edges = np.sort(np.random.uniform(-np.pi, np.pi, size=(5, 31)), axis=1)
+    quantiles = np.random.rand(5, 100)
+    samples = invert_cdfs(cdfs, edges, quantiles)
+    for n in xrange(5):
+        assert np.allclose(samples[n], np.interp(quantiles[n], cdfs[n], edges[n]), rtol=1e-10, atol=1e-10)
+        assert np.allclose(invert_cdfs(cdfs[n:n+1], edges[0], quantiles[n:n+1])[0], np.interp(quantiles[n], cdfs[n], edges[0]), rtol=1e-10, atol=1e-10)
+
+    # Batched CDF tables, same as one loglike_theta_fct_single call per datapoint and angle
+    sampler = build_test_sampler(code_type='conj', M=100, N=10, T=2, inv_cdf_bins=200)
+    sampler.compute_inverse_transform_parameters()
+    bins_center = sampler.cdfs_edges[:-1] + np.pi/sampler.inv_cdf_bins
+    for n in xrange(sampler.N):
+        t = sampler.tc[n]
+        params = (sampler.theta[n].copy(), sampler.NT[n], sampler.random_network, sampler.theta_gamma, sampler.theta_kappa, sampler.ATtcB[t], sampler.sampled_feature_index, sampler.mean_fixed_contrib[t], sampler.inv_covariance_fixed_contrib)
+        likelihood = np.exp(np.array([loglike_theta_fct_single(angle, params) for angle in bins_center]) - sampler.normalization[n])
+        cdf = np.cumsum(np.r_[0.0, likelihood])
+        assert np.allclose(sampler.cdfs[n], cdf/cdf[-1], rtol=1e-8, atol=1e-10)
+
+    # Samples follow the tables
+    samples = sampler.sample_inverse_cdfs(np.zeros(20000, dtype=int), 1)[:, 0]
+    assert np.max(np.abs(np.searchsorted(np.sort(samples), sampler.cdfs_edges)/20000. - sampler.cdfs[0])) < 0.02
+
+    # float32 tables
+    cdfs_float64 = sampler.cdfs
+    sampler.inv_cdf_dtype = np.float32
+    sampler.compute_inverse_transform_parameters()
+    assert sampler.cdfs.dtype == np.float32
+    assert np.allclose(sampler.cdfs, cdfs_float64, rtol=0.0, atol=1e-6)
+
+    # Sharp posteriors: with the same number of bins, the adaptive grid stays close to a dense uniform grid, a uniform grid does not
+    sampler = build_test_sampler(code_type='conj', M=400, N=20, T=1, sigmax=0.02, inv_cdf_bins=100, inv_cdf_adaptive=True)
+    assert sampler.inv_cdf_bins == 100 and sampler.inv_cdf_adaptive
+
+    error_adaptive = sampler.estimate_inverse_cdf_error(dense_bins=5000)
+
+    sampler.inv_cdf_adaptive = False
+    sampler.cdfs = None
+    error_uniform = sampler.estimate_inverse_cdf_error(dense_bins=5000)
+
+    print "Inverse CDF error, adaptive: %.4f, uniform: %.4f" % (np.max(error_adaptive), np.max(error_uniform))
+    assert np.max(error_adaptive) < 0.02
+    assert np.max(error_uniform) > 10.*np.max(error_adaptive)
+
+
+def test():
+    '''
+        Check the likelihood fast paths against their reference implementations
+    '''
+
+    test_loglikelihood_batched()
+    test_loglikelihood_whitened()
+    test_loglikelihood_lowrank()
+    test_posterior_grid()
+    test_convolved_output_noise()
+    test_inverse_cdf()
+
+
+if __name__ == '__main__':
+    test()
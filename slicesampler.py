@@ -301,6 +301,120 @@ def sample_1D_circular(N, x_initial, loglike_fct, burn=100, widths=1., last_logl
     return samples, last_loglikehood
 
 
+def sample_1D_circular_chains(N, x_initial, loglike_fct, burn=100, widths=1., loglike_fct_params=None, step_out=True, thinning=1, jump_probability=0.1):
+    '''
+        Slice sampling of C independent 1D circular chains at once.
+
+        Same algorithm as sample_1D_circular, run in lockstep for all chains: each step evaluates the
+        loglikelihood of all the chains still needing it with one call.
+
+        Inputs:
+            N                   1x1     Number of samples to gather per chain
+            x_initial           Cx1     initial states
+            loglike_fct         @fn     function logprobstar = logdist(x, chains, loglike_fct_params),
+                                        loglikelihood of chain chains[i] at x[i] for all i
+            burn                1x1     burn-in samples, discarded for every chain
+            widths              1x1     step sizes for slice sampling.
+
+        Outputs:
+            samples             CxN     samples
+            last_loglikelihood  Cx1
+    '''
+
+    x_new = np.array(x_initial, dtype=float).reshape(-1)
+    num_chains = x_new.size
+    all_chains = np.arange(num_chains)
+
+    samples = np.zeros((num_chains, N))
+    last_loglikelihood = loglike_fct(x_new, all_chains, loglike_fct_params)
+
+    j = 0
+    for i in xrange(thinning*N + burn):
+
+        # Probabilistic jumps with Metropolis-Hasting for some chains
+        jumping = np.random.rand(num_chains) < jump_probability
+
+        chains = all_chains[jumping]
+        if chains.size > 0:
+            xprime = np.random.random_sample(chains.size)*2.*np.pi - np.pi
+
+            # MH ratio
+            llh_x_prime = loglike_fct(xprime, chains, loglike_fct_params)
+            accepted = np.log(np.random.rand(chains.size)) < llh_x_prime - last_loglikelihood[chains]
+
+            x_new[chains[accepted]] = xprime[accepted]
+            last_loglikelihood[chains[accepted]] = llh_x_prime[accepted]
+
+        # Slice sampling for the others
+        chains = all_chains[~jumping]
+        if chains.size > 0:
+            log_uprime = last_loglikelihood[chains] + np.log(np.random.rand(chains.size))
+            x_current = x_new[chains]
+
+            # Create horizontal intervals (x_l, x_r) enclosing x_new. Place them randomly.
+            rr = np.random.rand(chains.size)
+            x_l = x_current - rr*widths
+            x_r = x_current + (1.-rr)*widths
+
+            # Grow the intervals to get unbiased slices
+            if step_out:
+                (x_l, x_r) = _step_out_chains(x_l, x_r, widths, chains, log_uprime, loglike_fct, loglike_fct_params)
+
+            # Sample new points, shrinking the intervals of the rejected ones
+            pending = np.arange(chains.size)
+            while pending.size > 0:
+                xprime = np.random.random_sample(pending.size)*(x_r[pending] - x_l[pending]) + x_l[pending]
+
+                llh_x_prime = loglike_fct(xprime, chains[pending], loglike_fct_params)
+                accepted = llh_x_prime > log_uprime[pending]
+
+                x_new[chains[pending[accepted]]] = xprime[accepted]
+                last_loglikelihood[chains[pending[accepted]]] = llh_x_prime[accepted]
+
+                xprime = xprime[~accepted]
+                pending = pending[~accepted]
+
+                if np.any(xprime == x_current[pending]):
+                    raise RuntimeError("Slice sampler shrank too far.")
+
+                shrink_right = xprime > x_current[pending]
+                x_r[pending[shrink_right]] = x_current[pending[shrink_right]]
+                x_l[pending[~shrink_right]] = x_current[pending[~shrink_right]]
+
+        # Store these samples
+        if i >= burn and (i % thinning == 0):
+            samples[:, j] = x_new
+            j += 1
+
+    return samples, last_loglikelihood
+
+
+def _step_out_chains(x_l, x_r, widths, chains, log_uprime, loglike_fct, loglike_fct_params):
+    '''
+        Step out the left and right bounds of the slices of all chains, until they leave the slice or reach -pi/pi.
+
+        Both sides of all chains are stepped together, one loglikelihood call per step.
+    '''
+
+    x_bounds = np.r_[x_l, x_r]
+    steps = np.r_[-widths*np.ones(x_l.size), widths*np.ones(x_r.size)]
+    chains = np.r_[chains, chains]
+    log_uprime = np.r_[log_uprime, log_uprime]
+
+    stepping = np.flatnonzero(loglike_fct(x_bounds, chains, loglike_fct_params) > log_uprime)
+
+    while stepping.size > 0:
+        x_bounds[stepping] += steps[stepping]
+        llh_bounds = loglike_fct(x_bounds[stepping], chains[stepping], loglike_fct_params)
+
+        at_limit = np.sign(steps[stepping])*x_bounds[stepping] >= np.pi
+        x_bounds[stepping[at_limit]] = np.sign(steps[stepping[at_limit]])*np.pi
+
+        stepping = stepping[(llh_bounds > log_uprime[stepping]) & ~at_limit]
+
+    return (x_bounds[:x_l.size], x_bounds[x_l.size:])
+
+
 def test_sample():
 
     loglike_theta_fct = lambda x, (mu, kappa): kappa*np.cos(x - mu) - np.log(2.*np.pi) - np.log(scsp.i0(kappa))
@@ -312,6 +426,26 @@ def test_sample():
     # print samples
 
 
+def test_sample_chains():
+    '''
+        Chains sampled together should have the Von Mises statistics of their own parameters
+    '''
+
+    kappas = np.array([0.5, 4.0, 20.0])
+    loglike_theta_fct = lambda x, chains, kappas: kappas[chains]*np.cos(x)
+
+    np.random.seed(10)
+    samples, last_llh = sample_1D_circular_chains(3000, np.zeros(2*kappas.size), loglike_theta_fct, burn=100, widths=np.pi/4., loglike_fct_params=np.tile(kappas, 2))
+
+    assert samples.shape == (2*kappas.size, 3000)
+    assert np.allclose(last_llh, np.tile(kappas, 2)*np.cos(samples[:, -1]))
+
+    # Mean resultant length of a Von Mises: I1(kappa)/I0(kappa)
+    R_expected = scsp.i1(kappas)/scsp.i0(kappas)
+    R_samples = np.abs(np.mean(np.exp(1j*samples), axis=1))
+    assert np.allclose(R_samples, np.tile(R_expected, 2), atol=0.05)
+
+
 
 if __name__ == '__main__':
 
@@ -1,12 +1,20 @@
 # encoding: utf-8
-# cython: infer_types=True
 # cython: boundscheck=False
 # cython: wraparound=False
+# cython: cdivision=True
 
 """
 CYTHON VERSION
 
-slicesampler.pyx
+slicesampler_c.pyx
+
+Slice sampler of slicesampler.sample_1D_circular, with a typed C-level likelihood:
+the Gaussian likelihood of the samplers (loglike_theta_fct_single) for a bivariate fisher population code.
+
+The network is given as plain arrays, as returned by slicesampler_numba.get_network_parameters.
+
+Built on import with pyximport (see gibbs_sampler_continuous_fullcollapsed_randomfactorialnetwork),
+or beforehand with: cythonize -i slicesampler_c.pyx
 
 Created by Loic Matthey on 2011-08-03.
 Copyright (c) 2011 Gatsby Unit. All rights reserved.
@@ -15,198 +23,203 @@ Copyright (c) 2011 Gatsby Unit. All rights reserved.
 import numpy as np
 cimport numpy as np
 
-from libc.math cimport cos, log, M_PI, exp
+from libc.math cimport cos, log, exp, M_PI
 
 cimport cython
 
-# Set DTYPE
-DFLOAT = np.float
-DINT = np.int
-# "ctypedef" assigns a corresponding compile-time type to DTYPE_t. For
-# every type in the numpy module there's a corresponding compile-time
-# type with a _t-suffix.
 ctypedef np.float64_t DFLOAT_t
-ctypedef np.int_t DINT_t
+ctypedef np.uint8_t DBOOL_t
+
+
+cdef class UniformBuffer:
+    '''
+        Uniform random numbers from numpy, drawn by blocks to avoid a Python call per draw.
+    '''
+    cdef DFLOAT_t[::1] buffer
+    cdef Py_ssize_t position
 
-@cython.boundscheck(False)
-cpdef np.ndarray sample_1D_circular(DINT_t N, DFLOAT_t x_initial, DINT_t burn, DFLOAT_t widths, list loglike_fct_params, DINT_t step_out, DINT_t thinning, DINT_t debug):
-        
+    def __init__(self, Py_ssize_t size=4096):
+        self.buffer = np.random.random_sample(size)
+        self.position = 0
+
+    cdef inline DFLOAT_t next(self):
+        if self.position >= self.buffer.shape[0]:
+            self.buffer = np.random.random_sample(self.buffer.shape[0])
+            self.position = 0
+        self.position += 1
+        return self.buffer[self.position - 1]
+
+
+cdef DFLOAT_t loglike_theta(DFLOAT_t new_theta, DFLOAT_t[::1] thetas, Py_ssize_t sampled_feature_index, DFLOAT_t[::1] datapoint_centered, DFLOAT_t ATtcB, DFLOAT_t[:, ::1] inv_covariance_fixed_contrib, DFLOAT_t[:, ::1] preferred_stimulus, DFLOAT_t[:, ::1] neurons_sigma, DFLOAT_t[::1] log_normalisation, DBOOL_t[::1] mask_neurons_unset, DFLOAT_t[::1] like_mean) nogil:
     '''
-        Simple implementation of slice sampling for 1D variable
-        
+        Compute the loglikelihood of: theta_r | n_tc theta_r' tc
+
+        Same as loglike_theta_fct_single, with datapoint_centered = datapoint - mean_fixed_contrib.
+        like_mean is an M buffer.
+    '''
+
+    cdef Py_ssize_t M = neurons_sigma.shape[0]
+    cdef Py_ssize_t R = neurons_sigma.shape[1]
+    cdef Py_ssize_t m, r, i, j
+    cdef DFLOAT_t activation, row_sum
+    cdef DFLOAT_t quadratic_form = 0.0
+
+    thetas[sampled_feature_index] = new_theta
+
+    # like_mean = datapoint - mean_fixed_contrib - ATtcB*mu(theta)
+    for m in range(M):
+        if mask_neurons_unset[m]:
+            like_mean[m] = datapoint_centered[m]
+        else:
+            activation = -log_normalisation[m]
+            for r in range(R):
+                activation += neurons_sigma[m, r]*cos(thetas[r] - preferred_stimulus[m, r])
+            like_mean[m] = datapoint_centered[m] - ATtcB*exp(activation)
+
+    for i in range(M):
+        row_sum = 0.0
+        for j in range(M):
+            row_sum += inv_covariance_fixed_contrib[i, j]*like_mean[j]
+        quadratic_form += like_mean[i]*row_sum
+
+    return -0.5*quadratic_form
+
+
+def loglike_theta_py(DFLOAT_t new_theta, DFLOAT_t[::1] thetas, Py_ssize_t sampled_feature_index, DFLOAT_t[::1] datapoint_centered, DFLOAT_t ATtcB, DFLOAT_t[:, ::1] inv_covariance_fixed_contrib, DFLOAT_t[:, ::1] preferred_stimulus, DFLOAT_t[:, ::1] neurons_sigma, DFLOAT_t[::1] log_normalisation, DBOOL_t[::1] mask_neurons_unset):
+    '''
+        Python access to the C likelihood, for testing
+    '''
+    cdef DFLOAT_t[::1] like_mean = np.empty(datapoint_centered.shape[0])
+
+    return loglike_theta(new_theta, thetas, sampled_feature_index, datapoint_centered, ATtcB, inv_covariance_fixed_contrib, preferred_stimulus, neurons_sigma, log_normalisation, mask_neurons_unset, like_mean)
+
+
+def sample_1D_circular(Py_ssize_t N, DFLOAT_t x_initial, Py_ssize_t burn, DFLOAT_t widths, DFLOAT_t jump_probability, DFLOAT_t[::1] thetas, Py_ssize_t sampled_feature_index, DFLOAT_t[::1] datapoint_centered, DFLOAT_t ATtcB, DFLOAT_t[:, ::1] inv_covariance_fixed_contrib, DFLOAT_t[:, ::1] preferred_stimulus, DFLOAT_t[:, ::1] neurons_sigma, DFLOAT_t[::1] log_normalisation, DBOOL_t[::1] mask_neurons_unset):
+    '''
+        Slice sampling of a 1D circular variable, with Metropolis-Hastings jumps.
+
+        Same algorithm as slicesampler.sample_1D_circular (step_out=True, thinning=1), for the loglike_theta likelihood.
+        Random numbers come from np.random.
+
         Inputs:
             N                   1x1     Number of samples to gather
             x_initial           1x1     initial state
             burn                1x1     after burning period of this length
-            widths              1x1     step sizes for slice sampling. Should correspond.
-            step_out            bool    set to true if widths may sometimes be far too small
-            loglike_fct_params  dict    any extra arguments are passed on to logdist
-        
+            widths              1x1     step sizes for slice sampling.
+            jump_probability    1x1     probability of MCMC jump
+            others: parameters of loglike_theta, mask_neurons_unset as uint8
+
         Outputs:
-            samples  Nx1   samples
-            
-            Iain Murray May 2004, tweaks June 2009, a diagnostic added Feb 2010
-            See Pseudo-code in David MacKay's text book p375
+            samples             Nx1     samples
+            last_loglikelihood  1x1
     '''
-    
-    
-    # Initialisation
-    cdef np.ndarray[DFLOAT_t, ndim=1] samples = np.zeros(N, dtype=DFLOAT)
-    cdef DINT_t j = 0
-    cdef DINT_t i
-    cdef DINT_t all_n = thinning*N+burn
-    cdef DFLOAT_t xprime
-    cdef DFLOAT_t llh_l, llh_r, llh_x_prime
-    cdef DFLOAT_t rr
-    cdef DFLOAT_t x_l, x_r
-    cdef DFLOAT_t log_uprime
-    cdef DINT_t tot_accepted = 0
-    cdef DINT_t tot_rejected = 0
-    
-    cdef DFLOAT_t last_loglikehood = loglike_collapsed(x_initial, loglike_fct_params[0], loglike_fct_params[1], loglike_fct_params[2], loglike_fct_params[3], loglike_fct_params[4],
-    loglike_fct_params[5], loglike_fct_params[6], loglike_fct_params[7])
-    
-    cdef DFLOAT_t x_new  = x_initial
-    
-    # N samples
-    for i in range(all_n):
-        
+
+    cdef np.ndarray[DFLOAT_t, ndim=1] samples = np.zeros(N)
+    cdef DFLOAT_t[::1] like_mean = np.empty(datapoint_centered.shape[0])
+    cdef UniformBuffer uniform = UniformBuffer()
+
+    cdef Py_ssize_t i
+    cdef Py_ssize_t j = 0
+    cdef DFLOAT_t xprime, llh_x_prime, llh_l, llh_r, rr, x_l, x_r, log_uprime
+
+    cdef DFLOAT_t last_loglikelihood = loglike_theta(x_initial, thetas, sampled_feature_index, datapoint_centered, ATtcB, inv_covariance_fixed_contrib, preferred_stimulus, neurons_sigma, log_normalisation, mask_neurons_unset, like_mean)
+    cdef DFLOAT_t x_new = x_initial
+
+    for i in range(N + burn):
+
         # Add a probabilistic jump with Metropolis-Hasting
-        if np.random.rand() < 0.001:
-            # print "Jump!"
-            xprime = np.random.rand()*2.*M_PI - M_PI
-            
+        if uniform.next() < jump_probability:
+            xprime = uniform.next()*2.*M_PI - M_PI
+
             # MH ratio
-            llh_x_prime = loglike_collapsed(xprime, loglike_fct_params[0], loglike_fct_params[1], loglike_fct_params[2], loglike_fct_params[3], loglike_fct_params[4],
-    loglike_fct_params[5], loglike_fct_params[6], loglike_fct_params[7])
-            if log(np.random.rand()) <  llh_x_prime - last_loglikehood:
-                # Accepted!
+            llh_x_prime = loglike_theta(xprime, thetas, sampled_feature_index, datapoint_centered, ATtcB, inv_covariance_fixed_contrib, preferred_stimulus, neurons_sigma, log_normalisation, mask_neurons_unset, like_mean)
+            if log(uniform.next()) < llh_x_prime - last_loglikelihood:
                 x_new = xprime
-                last_loglikehood = llh_x_prime
-                tot_accepted += 1
-            else:
-                # rejected, keep x_new
-                tot_rejected += 1
+                last_loglikelihood = llh_x_prime
         else:
-            # Normal slice sampling
-            log_uprime  = last_loglikehood + log(np.random.rand())
-            # print "log_uprime: %.3f, lastllh: %.3f" % (log_uprime, last_loglikehood)
-            
+            log_uprime = last_loglikelihood + log(uniform.next())
+
             # Create a horizontal interval (x_l, x_r) enclosing x_new. Place it randomly.
-            rr     = np.random.rand()
-            x_l    = x_new -  rr*widths
-            x_r    = x_new + (1.-rr)*widths
-            
+            rr = uniform.next()
+            x_l = x_new - rr*widths
+            x_r = x_new + (1.-rr)*widths
+
             # Grow the interval to get an unbiased slice
-            if step_out==1:
-                llh_l = loglike_collapsed(x_l, loglike_fct_params[0], loglike_fct_params[1], loglike_fct_params[2], loglike_fct_params[3], loglike_fct_params[4],
-    loglike_fct_params[5], loglike_fct_params[6], loglike_fct_params[7])
-                # s = 0
-                while llh_l > log_uprime:
-                    # print "stepping out left: [%.3f < %.3f < %.3f] %.3f %.3f" % (x_l, x_new, x_r, log_uprime, llh_l)
-                    x_l     -= widths
-                    llh_l   = loglike_collapsed(x_l, loglike_fct_params[0], loglike_fct_params[1], loglike_fct_params[2], loglike_fct_params[3], loglike_fct_params[4],
-    loglike_fct_params[5], loglike_fct_params[6], loglike_fct_params[7])
-                    if x_l <= -M_PI:
-                        x_l = -M_PI
-                        break
-                    
-                    # s+=1
-                # print s
-                
-                llh_r = loglike_collapsed(x_r, loglike_fct_params[0], loglike_fct_params[1], loglike_fct_params[2], loglike_fct_params[3], loglike_fct_params[4],
-    loglike_fct_params[5], loglike_fct_params[6], loglike_fct_params[7])
-                while llh_r > log_uprime:
-                    x_r     += widths
-                    llh_r   = loglike_collapsed(x_r, loglike_fct_params[0], loglike_fct_params[1], loglike_fct_params[2], loglike_fct_params[3], loglike_fct_params[4],
-    loglike_fct_params[5], loglike_fct_params[6], loglike_fct_params[7])
-                    if x_r >= M_PI:
-                        x_r = M_PI
-                        break
-                
-            
+            llh_l = loglike_theta(x_l, thetas, sampled_feature_index, datapoint_centered, ATtcB, inv_covariance_fixed_contrib, preferred_stimulus, neurons_sigma, log_normalisation, mask_neurons_unset, like_mean)
+            while llh_l > log_uprime:
+                x_l -= widths
+                llh_l = loglike_theta(x_l, thetas, sampled_feature_index, datapoint_centered, ATtcB, inv_covariance_fixed_contrib, preferred_stimulus, neurons_sigma, log_normalisation, mask_neurons_unset, like_mean)
+                if x_l <= -M_PI:
+                    x_l = -M_PI
+                    break
+
+            llh_r = loglike_theta(x_r, thetas, sampled_feature_index, datapoint_centered, ATtcB, inv_covariance_fixed_contrib, preferred_stimulus, neurons_sigma, log_normalisation, mask_neurons_unset, like_mean)
+            while llh_r > log_uprime:
+                x_r += widths
+                llh_r = loglike_theta(x_r, thetas, sampled_feature_index, datapoint_centered, ATtcB, inv_covariance_fixed_contrib, preferred_stimulus, neurons_sigma, log_normalisation, mask_neurons_unset, like_mean)
+                if x_r >= M_PI:
+                    x_r = M_PI
+                    break
+
             # Sample a new point, shrinking the interval
             while True:
-                xprime = np.random.rand()*(x_r - x_l) + x_l
-                
-                last_loglikehood = loglike_collapsed(xprime, loglike_fct_params[0], loglike_fct_params[1], loglike_fct_params[2], loglike_fct_params[3], loglike_fct_params[4],
-    loglike_fct_params[5], loglike_fct_params[6], loglike_fct_params[7])
-                if last_loglikehood > log_uprime:
-                    # Accept this sample
+                xprime = uniform.next()*(x_r - x_l) + x_l
+
+                last_loglikelihood = loglike_theta(xprime, thetas, sampled_feature_index, datapoint_centered, ATtcB, inv_covariance_fixed_contrib, preferred_stimulus, neurons_sigma, log_normalisation, mask_neurons_unset, like_mean)
+                if last_loglikelihood > log_uprime:
                     x_new = xprime
                     break
                 elif xprime > x_new:
-                    x_r  = x_new
+                    x_r = x_new
                 elif xprime < x_new:
                     x_l = x_new
                 else:
                     raise RuntimeError("Slice sampler shrank too far.")
-        
+
         # Store this sample
-        if i >= burn and (i % thinning == 0):
-            if debug:
-                print "Sample %d: %.3f" % (j+1, x_new)
+        if i >= burn:
             samples[j] = x_new
             j += 1
-    
-    # print tot_accepted/float(tot_accepted+tot_rejected)
-    
-    return samples
 
-cdef DFLOAT_t loglike_collapsed(DFLOAT_t x, np.ndarray[DFLOAT_t, ndim=1] datapoint, object rn, DINT_t sampled_feature_index, DFLOAT_t theta_mu, DFLOAT_t theta_kappa, DFLOAT_t ATtcB, np.ndarray[DFLOAT_t, ndim=1] mean_fixed_contrib, np.ndarray[DFLOAT_t, ndim=2] covariance_fixed_contrib):
+    return samples, last_loglikelihood
+
+
+def test():
     '''
-        Logposterior of the fullcollapsed model
+        Compare the C likelihood and sampler to loglike_theta_fct_single and slicesampler.sample_1D_circular
     '''
-    
-    cdef np.ndarray[DFLOAT_t, ndim=1] like_mean
-    cdef DFLOAT_t output
-    
-    like_mean = datapoint - mean_fixed_contrib - ATtcB*np.dot(rn.popcodes[sampled_feature_index].mean_response(x), rn.W[sampled_feature_index].T)
-    
-    output = theta_kappa*cos(x - theta_mu)
-    output -= 0.5*np.dot(like_mean, np.linalg.solve(covariance_fixed_contrib, like_mean))
-    # output -= 0.5*np.dot(like_mean, like_mean)
-    
-    return output
-
-
-cdef DFLOAT_t loglike_vonmises(DFLOAT_t x, DFLOAT_t mu, DFLOAT_t kappa):
-    return kappa*cos(x - mu)
-    # return log(exp(-40.*(x-3.)*(x-3.)) + exp(-30.*(x+3.)*(x+3)))
-
-
-def test_sample(N):
-    
-    loglike_fct_params = np.array([0.0, 0.1])
-    #sample_1D_circular(int N, DFLOAT_t x_initial, int burn, DFLOAT_t widths, np.ndarray loglike_fct_params, int step_out, int thinning, int debug):
-    samples = sample_1D_circular(N, np.random.rand(), 500, 3.0, loglike_fct_params, 1, 3, 0)
-    
-    return samples
-
-
-if __name__ == '__main__':
-    
-    
-    if True:
-        # Try with Von Mises
-        loglike_fct_params = np.array([0.0, 0.1])
-        
-        # Get samples
-        # samples2, last_llh = sample_1D_circular(50000, np.random.rand(), burn=500, widths=0.01, loglike_fct_params=loglike_fct_params, step_out=True, debug=True, loglike_min = -np.log((2./2.0)*np.pi*scsp.i0(loglike_fct_params[1])))
-        # samples2, last_llh = slicesampler.sample_1D_circular(50000, np.random.rand(), loglike_theta_fct, burn=500, widths=0.01, loglike_fct_params=loglike_fct_params, step_out=True, debug=True)
-        
-        # Plot
-        # x = np.linspace(-4., 4., 100)
-        #         n, left_x = np.histogram(samples2, bins=x)
-        #         
-        #         like_out = np.exp(loglike_theta_fct(x, loglike_fct_params))
-        #         like_out /= np.abs(np.max(like_out))
-        #         # like_out -= np.mean(like_out)
-        #         
-        #         plt.figure()
-        #         plt.bar(x[:-1], n/np.max(n.astype(float)), facecolor='green', alpha=0.75, width=np.diff(x)[0])
-        #         plt.plot(x, like_out, 'r')
-    
-    
-    
-    
+    import scipy.stats as spst
+
+    import slicesampler
+    import slicesampler_numba
+    from highdimensionnetwork import HighDimensionNetwork
+    from gibbs_sampler_continuous_fullcollapsed_randomfactorialnetwork import loglike_theta_fct_single
+
+    M = 50
+    np.random.seed(10)
+
+    random_network = HighDimensionNetwork.create_full_conjunctive(M, R=2, rcscale=3.0)
+    (preferred_stimulus, neurons_sigma, log_normalisation, mask_neurons_unset) = slicesampler_numba.get_network_parameters(random_network)
+    network_parameters = (preferred_stimulus, neurons_sigma, log_normalisation, mask_neurons_unset.view(np.uint8))
+
+    stimulus = np.array([0.5, -1.0])
+    ATtcB = 1.0
+    mean_fixed_contrib = np.zeros(M)
+    inv_covariance = np.eye(M)/0.1**2.
+    datapoint = random_network.get_network_response(stimulus) + 0.1*np.random.randn(M)
+
+    params = (stimulus.copy(), datapoint, random_network, 0.0, 0.0, ATtcB, 0, mean_fixed_contrib, inv_covariance)
+    compiled_params = (stimulus.copy(), 0, datapoint - mean_fixed_contrib, ATtcB, inv_covariance) + network_parameters
+
+    # Likelihoods should match
+    for new_theta in np.linspace(-np.pi, np.pi, 11):
+        assert np.allclose(loglike_theta_fct_single(new_theta, params), loglike_theta_py(new_theta, *compiled_params))
+
+    # Samples should come from the same distribution
+    samples_python, _ = slicesampler.sample_1D_circular(3000, 0.0, loglike_theta_fct_single, burn=100, widths=np.pi/16., loglike_fct_params=params, step_out=True, jump_probability=0.3)
+    samples_compiled, _ = sample_1D_circular(3000, 0.0, 100, np.pi/16., 0.3, *compiled_params)
+
+    print "Python: %.3f +- %.3f, cython: %.3f +- %.3f" % (spst.circmean(samples_python, -np.pi, np.pi), spst.circstd(samples_python), spst.circmean(samples_compiled, -np.pi, np.pi), spst.circstd(samples_compiled))
+
+    assert np.abs(spst.circmean(samples_python, -np.pi, np.pi) - spst.circmean(samples_compiled, -np.pi, np.pi)) < 0.1
+    assert np.abs(spst.circstd(samples_python) - spst.circstd(samples_compiled)) < 0.1
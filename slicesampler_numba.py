@@ -2,216 +2,245 @@
 # -*- coding: utf-8 -*-
 
 """
-slicesampler.py
+slicesampler_numba.py
+
+Compiled (numba, nopython) version of slicesampler.sample_1D_circular, specialised to the Gaussian
+likelihood of the samplers (loglike_theta_fct_single) for a bivariate fisher population code.
+
+The network is given as plain arrays (see get_network_parameters), so no Python object is used in the compiled code.
+If numba is not installed, the same functions run as normal Python (slow), numba_available is then False.
 
 Created by Loic Matthey on 2011-08-03.
 Copyright (c) 2011 Gatsby Unit. All rights reserved.
 """
 
 import numpy as np
-# import scipy.special as scsp
 
-import numba as nub
+import utils_vonmises
+
+try:
+    import numba
+    numba_available = True
+    jit = numba.njit
+except ImportError:
+    numba_available = False
+
+    def jit(fct):
+        return fct
+
+
+def get_network_parameters(random_network):
+    '''
+        Extract the arrays needed to compute the network response in compiled code.
+
+        Supports the bivariate fisher codes of HighDimensionNetwork and RandomFactorialNetwork (including maxout responses).
+        Normalisations are computed in log-space, so they stay finite for large kappas.
+
+        Returns (preferred_stimulus, neurons_sigma, log_normalisation, mask_neurons_unset)
+    '''
+
+    for attribute in ['neurons_preferred_stimulus', 'neurons_sigma', 'mask_neurons_unset']:
+        if getattr(random_network, attribute, None) is None:
+            raise ValueError('Network not supported by the compiled sampler, needs %s' % attribute)
+
+    if getattr(random_network, 'response_type', 'bivariate_fisher') != 'bivariate_fisher':
+        raise ValueError('Network not supported by the compiled sampler, response_type %s' % random_network.response_type)
+
+    preferred_stimulus = np.ascontiguousarray(random_network.neurons_preferred_stimulus, dtype=np.float64)
+    neurons_sigma = np.ascontiguousarray(random_network.neurons_sigma, dtype=np.float64)
+    mask_neurons_unset = np.ascontiguousarray(random_network.mask_neurons_unset, dtype=np.bool_)
+
+    if getattr(random_network, 'response_maxout', False):
+        # exp(sum kappa (cos - 1))
+        log_normalisation = np.sum(neurons_sigma, axis=-1)
+    else:
+        # exp(sum kappa cos) / prod 2 pi I0(kappa)
+        log_normalisation = np.sum(np.log(2.*np.pi) + utils_vonmises.log_i0(neurons_sigma), axis=-1)
 
-# # @nub.autojit(nub.double(nub.double, nub.double, nub.double))
-# @nub.autojit()
-# def loglike_vonmises(x, params):
-#     mu = params[0]
-#     kappa = params[1]
-#     out = kappa*np.cos(x - mu) - np.log(2.*np.pi) - np.log(scsp.i0(kappa))
+    # Unset neurons have NaN parameters, they are skipped anyway
+    preferred_stimulus[mask_neurons_unset] = 0.0
+    neurons_sigma[mask_neurons_unset] = 0.0
+    log_normalisation[mask_neurons_unset] = 0.0
 
-#     return out
+    return (preferred_stimulus, neurons_sigma, log_normalisation, mask_neurons_unset)
 
-# @nub.autojit(locals={'thetas':nub.double[:], 'datapoint':nub.double[:], 'ATtcB':nub.double, 'sampled_feature_index':nub.int_, 'mean_fixed_contrib':nub.double[:], 'inv_covariance_fixed_contrib':nub.double[:,:]})
-@nub.jit(nub.f8(nub.f8, nub.f8[:], nub.f8[:], nub.object_, nub.f8, nub.int_, nub.f8[:], nub.f8[:, :]))
-def loglike_fct(new_theta, thetas, datapoint, rn, ATtcB, sampled_feature_index, mean_fixed_contrib, inv_covariance_fixed_contrib):
+
+@jit
+def network_response(thetas, preferred_stimulus, neurons_sigma, log_normalisation, mask_neurons_unset, out):
+    '''
+        Bivariate fisher network response for one stimulus, written into out (M)
+    '''
+
+    (M, R) = neurons_sigma.shape
+
+    for m in range(M):
+        if mask_neurons_unset[m]:
+            out[m] = 0.0
+        else:
+            activation = -log_normalisation[m]
+            for r in range(R):
+                activation += neurons_sigma[m, r]*np.cos(thetas[r] - preferred_stimulus[m, r])
+            out[m] = np.exp(activation)
+
+    return out
+
+
+@jit
+def loglike_theta(new_theta, thetas, sampled_feature_index, datapoint_centered, ATtcB, inv_covariance_fixed_contrib, preferred_stimulus, neurons_sigma, log_normalisation, mask_neurons_unset, like_mean):
     '''
         Compute the loglikelihood of: theta_r | n_tc theta_r' tc
+
+        Same as loglike_theta_fct_single, with datapoint_centered = datapoint - mean_fixed_contrib.
+        like_mean is an M buffer.
     '''
-    
-    # print 'what?', params, len(params)
-
-    # thetas = params[0]
-    # datapoint = params[1]
-    # # rn = params[2]
-    # # theta_mu = params[3]
-    # # theta_kappa = params[4]
-    # ATtcB = nub.double(params[5])
-    # sampled_feature_index = params[6]
-    # mean_fixed_contrib = params[7]
-    # inv_covariance_fixed_contrib = params[8]
-
-    # Put the new proposed point correctly
+
     thetas[sampled_feature_index] = new_theta
 
-    # print nub.typeof(mean_fixed_contrib), nub.typeof(inv_covariance_fixed_contrib)
-    # print inv_covariance_fixed_contrib
+    network_response(thetas, preferred_stimulus, neurons_sigma, log_normalisation, mask_neurons_unset, like_mean)
 
-    # a = rn.get_network_response_numba(thetas)
+    M = like_mean.shape[0]
+    for m in range(M):
+        like_mean[m] = datapoint_centered[m] - ATtcB*like_mean[m]
 
-    like_mean = datapoint - mean_fixed_contrib - ATtcB*rn.get_network_response_numba(thetas)
+    quadratic_form = 0.0
+    for i in range(M):
+        row_sum = 0.0
+        for j in range(M):
+            row_sum += inv_covariance_fixed_contrib[i, j]*like_mean[j]
+        quadratic_form += like_mean[i]*row_sum
 
-    # Using inverse covariance as param
-    # return theta_kappa*np.cos(thetas[sampled_feature_index] - theta_mu) - 0.5*np.dot(like_mean, np.dot(inv_covariance_fixed_contrib, like_mean))
-    return -0.5*nub.double(np.dot(like_mean, np.dot(inv_covariance_fixed_contrib, like_mean)))
-    # return like_mean
-    # return -1./(2*0.2**2)*np.sum(like_mean**2.)
+    return -0.5*quadratic_form
 
-# loglike_fct = nub.jit(nub.f8(nub.f8, nub.f8[:], nub.f8[:], nub.object_, nub.f8, nub.int_, nub.f8[:], nub.f8[:, :]))(loglike_fct)
 
-@nub.autojit(nub.double[:](nub.int32, nub.double, nub.list_of_obj, nub.int32, nub.double, nub.double))
-def sample_1D_circular_numba(N, x_initial, loglike_fct_params, burn, widths, jump_probability):
+@jit
+def sample_1D_circular(N, x_initial, burn, widths, jump_probability, random_seed, thetas, sampled_feature_index, datapoint_centered, ATtcB, inv_covariance_fixed_contrib, preferred_stimulus, neurons_sigma, log_normalisation, mask_neurons_unset):
     '''
-        Simple implementation of slice sampling for 1D variable
-        
+        Slice sampling of a 1D circular variable, with Metropolis-Hastings jumps.
+
+        Same algorithm as slicesampler.sample_1D_circular (step_out=True, thinning=1), for the loglike_theta likelihood.
+
         Inputs:
             N                   1x1     Number of samples to gather
             x_initial           1x1     initial state
-            loglike_fct_params  list    any extra arguments are passed on to logdist
             burn                1x1     after burning period of this length
-            widths              1x1     step sizes for slice sampling. Should correspond.
+            widths              1x1     step sizes for slice sampling.
             jump_probability    1x1     probability of MCMC jump
-        
+            random_seed         1x1     seed of the (numba) random generator
+            others: parameters of loglike_theta
+
         Outputs:
-            samples  Nx1   samples
-            
-            Iain Murray May 2004, tweaks June 2009, a diagnostic added Feb 2010
-            See Pseudo-code in David MacKay's text book p375
+            samples             Nx1     samples
+            last_loglikelihood  1x1
     '''
-    
-
-    # Initialisation
-    # print 'numba!'
-    # print loglike_fct
-    # print loglike_fct_params
-
-    debug=False
-    thinning= 1
-    loglike_min = -np.inf
-    jump=True
-    last_loglikehood = loglike_fct(x_initial, loglike_fct_params[0], loglike_fct_params[1], loglike_fct_params[2], loglike_fct_params[3], loglike_fct_params[4], loglike_fct_params[5], loglike_fct_params[6])
-    step_out = True
-    
-
-    samples = np.zeros(N, dtype=np.float)
-    
-    x_new  = x_initial
+
+    np.random.seed(random_seed)
+
+    samples = np.zeros(N)
+    like_mean = np.empty(datapoint_centered.shape[0])
+
+    last_loglikelihood = loglike_theta(x_initial, thetas, sampled_feature_index, datapoint_centered, ATtcB, inv_covariance_fixed_contrib, preferred_stimulus, neurons_sigma, log_normalisation, mask_neurons_unset, like_mean)
+
+    x_new = x_initial
     j = 0
-    tot_accepted = 0
-    tot_rejected = 0
-    
-
-    # N samples
-    # print 'for'
-    for i in xrange(thinning*N+burn):
-        
+
+    for i in range(N + burn):
+
         # Add a probabilistic jump with Metropolis-Hasting
-        if jump and np.random.rand() < jump_probability:
-            # print "Jump!"
+        if np.random.rand() < jump_probability:
             xprime = np.random.random_sample()*2.*np.pi - np.pi
-            
+
             # MH ratio
-            llh_x_prime = loglike_fct(x_initial, loglike_fct_params[0], loglike_fct_params[1], loglike_fct_params[2], loglike_fct_params[3], loglike_fct_params[4], loglike_fct_params[5], loglike_fct_params[6])
-            if np.log(np.random.rand()) <  llh_x_prime - last_loglikehood:
-                # Accepted!
+            llh_x_prime = loglike_theta(xprime, thetas, sampled_feature_index, datapoint_centered, ATtcB, inv_covariance_fixed_contrib, preferred_stimulus, neurons_sigma, log_normalisation, mask_neurons_unset, like_mean)
+            if np.log(np.random.rand()) < llh_x_prime - last_loglikelihood:
                 x_new = xprime
-                last_loglikehood = llh_x_prime
-                tot_accepted += 1
-            else:
-                # rejected, keep x_new
-                tot_rejected += 1
+                last_loglikelihood = llh_x_prime
         else:
-            log_uprime  = last_loglikehood + np.log(np.random.rand())
-            # print "log_uprime: %.3f, lastllh: %.3f" % (log_uprime, last_loglikehood)
-            
+            log_uprime = last_loglikelihood + np.log(np.random.rand())
+
             # Create a horizontal interval (x_l, x_r) enclosing x_new. Place it randomly.
-            rr     = np.random.rand()
-            x_l    = x_new -  rr*widths
-            x_r    = x_new + (1.-rr)*widths
-            
+            rr = np.random.rand()
+            x_l = x_new - rr*widths
+            x_r = x_new + (1.-rr)*widths
+
             # Grow the interval to get an unbiased slice
-            if step_out:
-                if log_uprime < loglike_min:
-                    # The current slice is too small for the likelihood, step_out will just hit the bounds.
+            llh_l = loglike_theta(x_l, thetas, sampled_feature_index, datapoint_centered, ATtcB, inv_covariance_fixed_contrib, preferred_stimulus, neurons_sigma, log_normalisation, mask_neurons_unset, like_mean)
+            while llh_l > log_uprime:
+                x_l -= widths
+                llh_l = loglike_theta(x_l, thetas, sampled_feature_index, datapoint_centered, ATtcB, inv_covariance_fixed_contrib, preferred_stimulus, neurons_sigma, log_normalisation, mask_neurons_unset, like_mean)
+                if x_l <= -np.pi:
                     x_l = -np.pi
+                    break
+
+            llh_r = loglike_theta(x_r, thetas, sampled_feature_index, datapoint_centered, ATtcB, inv_covariance_fixed_contrib, preferred_stimulus, neurons_sigma, log_normalisation, mask_neurons_unset, like_mean)
+            while llh_r > log_uprime:
+                x_r += widths
+                llh_r = loglike_theta(x_r, thetas, sampled_feature_index, datapoint_centered, ATtcB, inv_covariance_fixed_contrib, preferred_stimulus, neurons_sigma, log_normalisation, mask_neurons_unset, like_mean)
+                if x_r >= np.pi:
                     x_r = np.pi
-                else:
-                    llh_l = loglike_fct(x_initial, loglike_fct_params[0], loglike_fct_params[1], loglike_fct_params[2], loglike_fct_params[3], loglike_fct_params[4], loglike_fct_params[5], loglike_fct_params[6])
-                    # s = 0
-                    while llh_l > log_uprime:
-                        # print "stepping out left: [%.3f < %.3f < %.3f] %.3f %.3f" % (x_l, x_new, x_r, log_uprime, llh_l)
-                        x_l     -= widths
-                        llh_l   = loglike_fct(x_initial, loglike_fct_params[0], loglike_fct_params[1], loglike_fct_params[2], loglike_fct_params[3], loglike_fct_params[4], loglike_fct_params[5], loglike_fct_params[6])
-                        if x_l <= -np.pi:
-                            x_l = -np.pi
-                            break
-                    
-                        # s+=1
-                    # print s
-                
-                    llh_r = loglike_fct(x_initial, loglike_fct_params[0], loglike_fct_params[1], loglike_fct_params[2], loglike_fct_params[3], loglike_fct_params[4], loglike_fct_params[5], loglike_fct_params[6])
-                    while llh_r > log_uprime:
-                        x_r     += widths
-                        llh_r   = loglike_fct(x_initial, loglike_fct_params[0], loglike_fct_params[1], loglike_fct_params[2], loglike_fct_params[3], loglike_fct_params[4], loglike_fct_params[5], loglike_fct_params[6])
-                        if x_r >= np.pi:
-                            x_r = np.pi
-                            break
-            
-            
+                    break
+
             # Sample a new point, shrinking the interval
             while True:
                 xprime = np.random.random_sample()*(x_r - x_l) + x_l
-                
-                last_loglikehood = loglike_fct(x_initial, loglike_fct_params[0], loglike_fct_params[1], loglike_fct_params[2], loglike_fct_params[3], loglike_fct_params[4], loglike_fct_params[5], loglike_fct_params[6])
 
-                if last_loglikehood > log_uprime:
-                    # Accept this sample
-                    # print 'Accept', i
+                last_loglikelihood = loglike_theta(xprime, thetas, sampled_feature_index, datapoint_centered, ATtcB, inv_covariance_fixed_contrib, preferred_stimulus, neurons_sigma, log_normalisation, mask_neurons_unset, like_mean)
+                if last_loglikelihood > log_uprime:
                     x_new = xprime
                     break
                 elif xprime > x_new:
-                    x_r  = x_new
+                    x_r = x_new
                 elif xprime < x_new:
                     x_l = x_new
                 else:
-                    print "Slice sampler shrank too far."
-                    return -1
-        
+                    raise RuntimeError("Slice sampler shrank too far.")
+
         # Store this sample
-        if i >= burn and (i % thinning == 0):
-            if debug:
-                print "Sample {}: {:.3f}".format(j+1, x_new)
+        if i >= burn:
             samples[j] = x_new
             j += 1
-    
-    # print "Done. \nJumps:%d, %d" % (tot_accepted, tot_rejected)
-    
-    return samples
 
+    return samples, last_loglikelihood
+
+
+def test():
+    '''
+        Compare the compiled likelihood and sampler to loglike_theta_fct_single and slicesampler.sample_1D_circular
+    '''
+    import scipy.stats as spst
+
+    import slicesampler
+    from highdimensionnetwork import HighDimensionNetwork
+    from gibbs_sampler_continuous_fullcollapsed_randomfactorialnetwork import loglike_theta_fct_single
+
+    M = 50
+    np.random.seed(10)
+
+    random_network = HighDimensionNetwork.create_full_conjunctive(M, R=2, rcscale=3.0)
+    network_parameters = get_network_parameters(random_network)
+
+    stimulus = np.array([0.5, -1.0])
+    ATtcB = 1.0
+    mean_fixed_contrib = np.zeros(M)
+    inv_covariance = np.eye(M)/0.1**2.
+    datapoint = random_network.get_network_response(stimulus) + 0.1*np.random.randn(M)
+
+    params = (stimulus.copy(), datapoint, random_network, 0.0, 0.0, ATtcB, 0, mean_fixed_contrib, inv_covariance)
+    compiled_params = (stimulus.copy(), 0, datapoint - mean_fixed_contrib, ATtcB, inv_covariance) + network_parameters
+
+    # Likelihoods should match
+    for new_theta in np.linspace(-np.pi, np.pi, 11):
+        assert np.allclose(loglike_theta_fct_single(new_theta, params), loglike_theta(new_theta, *(compiled_params + (np.empty(M), ))))
+
+    # Samples should come from the same distribution
+    samples_python, _ = slicesampler.sample_1D_circular(3000, 0.0, loglike_theta_fct_single, burn=100, widths=np.pi/16., loglike_fct_params=params, step_out=True, jump_probability=0.3)
+    samples_compiled, _ = sample_1D_circular(3000, 0.0, 100, np.pi/16., 0.3, 1, *compiled_params)
+
+    print "Python: %.3f +- %.3f, compiled: %.3f +- %.3f" % (spst.circmean(samples_python, -np.pi, np.pi), spst.circstd(samples_python), spst.circmean(samples_compiled, -np.pi, np.pi), spst.circstd(samples_compiled))
+
+    assert np.abs(spst.circmean(samples_python, -np.pi, np.pi) - spst.circmean(samples_compiled, -np.pi, np.pi)) < 0.1
+    assert np.abs(spst.circstd(samples_python) - spst.circstd(samples_compiled)) < 0.1
 
-# def test_sample():
-    
-#     loglike_fct_params = np.array([0.0, 0.1])
-    
-#     # Get samples
-#     samples, last_llh = sample_1D_circular(1000, np.random.rand(), loglike_fct_params, 50, np.pi/8., 0.3)
-    
-#     # print samples
 
-# sample_1D_circular_numba = nub.jit(nub.double[:](nub.int32, nub.double, nub.double[:], nub.int32, nub.double, nub.double))(sample_1D_circular)
 
 if __name__ == '__main__':
-    
-    if True:
-        # test von mises
-        loglike_fct_params = [0.0, 4.0]
-        
-        # Get samples
-        samples = sample_1D_circular_numba(5000, 0.1, loglike_fct_params, 50, np.pi/8., 0.3)
-
-    # if True:
-        # test full loglike
-        # params = (self.theta[n], self.NT[n], self.random_network, self.theta_gamma, self.theta_kappa, self.ATtcB[self.tc[n]], sampled_feature_index, self.mean_fixed_contrib[self.tc[n]], self.inv_covariance_fixed_contrib)
-    
-    
-    
+    test()
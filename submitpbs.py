@@ -26,6 +26,8 @@ import utils
 import dataio
 
 import jobwrapper
+import utils_heartbeat
+import utils_surrogate
 
 import cma
 
@@ -118,6 +120,9 @@ class SubmitPBS():
         self.submit_label = submit_label
         self.pbs_submit_cmd = pbs_submit_cmd
 
+        # Processes started by the 'sh_background' local executor
+        self.local_processes = []
+
         # Keep track of submitted jobs numbers and available queue size if desired
         self.limit_max_queued_jobs = limit_max_queued_jobs
         self.update_running_jobs_number()
@@ -401,6 +406,9 @@ class SubmitPBS():
         # Submit the job
         if self.pbs_submit_cmd == 'sh':
             subprocess.call("sh " + new_script_filename, shell=True)
+        elif self.pbs_submit_cmd == 'sh_background':
+            # Local executor, not waiting on the job (like qsub/sbatch would)
+            self.local_processes.append(subprocess.Popen(["sh", new_script_filename]))
         else:
             os.popen(self.pbs_submit_cmd + " " + new_script_filename)
 
@@ -611,6 +619,7 @@ class SubmitPBS():
             Parameters:
                 - submission_parameters_dict['cma_population_size']
                 - submission_parameters_dict['cma_sigma0']
+                - submission_parameters_dict['cma_use_surrogate']: pre-screen candidates with a surrogate model, see cma_evaluate_with_surrogate()
 
             Uses submission_parameters_dict['dict_parameters_range'] to know which parameters to optimize.
                 They should all provide their range, CMA-ES searches in x_0 +- 3*cma_sigma0*scaling.
@@ -633,6 +642,12 @@ class SubmitPBS():
         cma_tolx = submission_parameters_dict.get('cma_tolx', None)
         cma_tolfun = submission_parameters_dict.get('tolfun', None)
         cma_use_transforms = submission_parameters_dict.get('cma_use_transforms', False)
+        cma_use_surrogate = submission_parameters_dict.get('cma_use_surrogate', False)
+        surrogate_parameters = dict(model=submission_parameters_dict.get('cma_surrogate_model', 'quadratic'),
+                                    fraction_evaluated=submission_parameters_dict.get('cma_surrogate_fraction_evaluated', 0.25),
+                                    min_kendall_tau=submission_parameters_dict.get('cma_surrogate_min_kendall_tau', 0.85),
+                                    max_training_points=submission_parameters_dict.get('cma_surrogate_max_training_points', None),
+                                    nan_replacement=cma_nan_replacement)
 
         # Extract the parameters ranges
         dict_parameters_range = submission_parameters_dict['dict_parameters_range']
@@ -709,6 +724,9 @@ class SubmitPBS():
         ## Instantiate a CMADataLogger. Will write to the current directory
         cma_log = cma.CMADataLogger(name_prefix=os.path.join(self.plot_output_dir, cma_logger_filename)).register(cma_es)
 
+        # Accuracy of the surrogate and number of true evaluations, per iteration
+        surrogate_log = []
+
         ## Iteration loop!
         # Catch CTRL-C, to allow for final state saving.
         try:
@@ -738,7 +756,14 @@ class SubmitPBS():
 
 
                 ## Evaluate the parameters fitness, submit them!!
-                fitness_results = self.submit_minibatch_jobswrapper(parameters_candidates_dict, submission_parameters_dict)
+                if cma_use_surrogate:
+                    # Only the most promising ones, the others get the surrogate fitness.
+                    # Parameters normalised by the current coordinate-wise stds of CMA-ES (sigma alone ignores the shrinking covariance)
+                    fitness_results, evaluated_mask, surrogate_infos = self.cma_evaluate_with_surrogate(parameters_candidates_dict, parameter_names_sorted, submission_parameters_dict, surrogate_parameters, cma_es.result()[6])
+                    surrogate_log.append(surrogate_infos)
+                else:
+                    fitness_results = self.submit_minibatch_jobswrapper(parameters_candidates_dict, submission_parameters_dict)
+                    evaluated_mask = np.ones(len(parameters_candidates_dict), dtype=bool)
 
                 # replace np.nan by large values...
                 fitness_results[np.isnan(fitness_results)] = cma_nan_replacement
@@ -746,7 +771,7 @@ class SubmitPBS():
                 if self.debug:
                     self.logger.info(">> Minibatch completed (%d jobs)." % len(parameters_candidates_array))
                     for curr_param_dict_i, curr_param_dict in enumerate(parameters_candidates_dict):
-                        self.logger.info(" - {params} \t -> {result}".format(params=utils.pprint_dict(curr_param_dict, key_sorted=parameter_names_sorted), result=fitness_results[curr_param_dict_i]))
+                        self.logger.info(" - {params} \t -> {result}{surrogate}".format(params=utils.pprint_dict(curr_param_dict, key_sorted=parameter_names_sorted), result=fitness_results[curr_param_dict_i], surrogate='' if evaluated_mask[curr_param_dict_i] else ' (surrogate)'))
 
                 ## Do something after each CMA-ES iteration if desired
                 if cma_iter_callback_function_infos is not None:
@@ -788,9 +813,123 @@ class SubmitPBS():
         self.logger.info(" -> result: %s" % cma_es.best.f)
         self.logger.info(cma_es.best.get())
 
+        if surrogate_log:
+            nb_candidates = np.sum([infos['nb_candidates'] for infos in surrogate_log])
+            nb_evaluated = np.sum([infos['nb_evaluated'] for infos in surrogate_log])
+            self.logger.info("Surrogate: %d true evaluations for %d candidates (%.1fx fewer), mean Kendall tau %.2f" % (nb_evaluated, nb_candidates, float(nb_candidates)/max(nb_evaluated, 1), utils.nanmean(np.array([infos['kendall_tau'] for infos in surrogate_log]))))
+
         self.logger.info("=== CMA_ES FINISHED ===")
 
-        return dict(result_final=cma_es.result(), result_tracking_dict=self.result_tracking_dict, best_params=cma_es.best.get(), best_f=cma_es.best.f)
+        return dict(result_final=cma_es.result(), result_tracking_dict=self.result_tracking_dict, best_params=cma_es.best.get(), best_f=cma_es.best.f, surrogate_log=surrogate_log)
+
+
+    def cma_evaluate_with_surrogate(self, parameters_candidates_dict, parameter_names_sorted, submission_parameters_dict, surrogate_parameters, scales):
+        '''
+            Evaluate the fitness of the CMA-ES candidates, only submitting the most promising ones according to a surrogate model (as lq-CMA-ES).
+
+            The surrogate (utils_surrogate, 'quadratic' or 'gp') is trained on all results evaluated so far (self.result_tracking_dict),
+            closest to the candidates. Then:
+                1. the fraction_evaluated best candidates according to the surrogate are submitted,
+                2. if the Kendall tau between their predicted and true fitness is below min_kendall_tau,
+                   the surrogate is refit and the next best fraction_evaluated are submitted, and so on.
+                3. candidates not submitted get the surrogate fitness, shifted to rank after the evaluated ones
+                   (they were predicted to be worse anyway).
+            Without enough results to train a surrogate, all candidates are submitted.
+
+            surrogate_parameters: dict(model, fraction_evaluated, min_kendall_tau, max_training_points, nan_replacement)
+
+            Returns (fitness_results, evaluated_mask, surrogate_infos), surrogate_infos being
+                dict(nb_candidates, nb_evaluated, kendall_tau, model_type, nb_training_points)
+        '''
+
+        nb_candidates = len(parameters_candidates_dict)
+        candidates_array = np.array(self.cma_list_parameters_dict_to_array(parameters_candidates_dict, parameter_names_sorted), dtype=float)
+        center = np.mean(candidates_array, axis=0)
+
+        fitness_results = np.empty(nb_candidates)
+        evaluated_mask = np.zeros(nb_candidates, dtype=bool)
+        predictions_before_evaluation = np.nan*np.empty(nb_candidates)
+
+        batch_size = min(max(int(np.ceil(surrogate_parameters['fraction_evaluated']*nb_candidates)), 3), nb_candidates)
+        kendall_tau = np.nan
+        surrogate = None
+
+        while not np.all(evaluated_mask):
+            surrogate = self.cma_fit_surrogate(parameter_names_sorted, center, scales, surrogate_parameters)
+
+            if surrogate is None:
+                # Not enough data yet, evaluate everything left
+                to_evaluate = np.nonzero(~evaluated_mask)[0]
+            else:
+                predictions = surrogate.predict(candidates_array)
+                remaining = np.nonzero(~evaluated_mask)[0]
+                to_evaluate = remaining[np.argsort(predictions[remaining])[:batch_size]]
+                predictions_before_evaluation[to_evaluate] = predictions[to_evaluate]
+
+            results = self.submit_minibatch_jobswrapper([parameters_candidates_dict[i] for i in to_evaluate], submission_parameters_dict)
+            fitness_results[to_evaluate] = np.asarray(results, dtype=float).reshape(to_evaluate.size)
+            evaluated_mask[to_evaluate] = True
+
+            if surrogate is None:
+                break
+
+            # Accuracy of the surrogate, on the candidates it chose before seeing their result
+            kendall_tau = utils_surrogate.kendall_tau(predictions_before_evaluation[evaluated_mask], fitness_results[evaluated_mask])
+            if kendall_tau >= surrogate_parameters['min_kendall_tau']:
+                break
+
+        if not np.all(evaluated_mask):
+            # Surrogate (refit with all results) for the others, ranked after the evaluated ones
+            surrogate = self.cma_fit_surrogate(parameter_names_sorted, center, scales, surrogate_parameters)
+            predictions = surrogate.predict(candidates_array[~evaluated_mask])
+
+            evaluated_finite = fitness_results[evaluated_mask][np.isfinite(fitness_results[evaluated_mask])]
+            if evaluated_finite.size > 0:
+                worst_evaluated = np.max(evaluated_finite)
+            else:
+                worst_evaluated = surrogate_parameters['nan_replacement']
+
+            fitness_results[~evaluated_mask] = predictions - np.min(predictions) + worst_evaluated
+
+        surrogate_infos = dict(nb_candidates=nb_candidates, nb_evaluated=int(np.sum(evaluated_mask)), kendall_tau=kendall_tau, model_type=getattr(surrogate, 'model_type', None), nb_training_points=getattr(surrogate, 'nb_training_points', 0))
+
+        self.logger.info("> Surrogate %s (%d points): evaluated %d/%d candidates, Kendall tau %.2f" % (surrogate_infos['model_type'], surrogate_infos['nb_training_points'], surrogate_infos['nb_evaluated'], nb_candidates, kendall_tau))
+
+        return fitness_results, evaluated_mask, surrogate_infos
+
+
+    def cma_fit_surrogate(self, parameter_names_sorted, center, scales, surrogate_parameters):
+        '''
+            Fit a surrogate of the fitness on all the results seen so far (self.result_tracking_dict), closest to center.
+
+            Returns None if there are not enough results yet.
+        '''
+
+        # All the (parameters, result) pairs evaluated for these parameter names
+        parameters_evaluated = []
+        results_evaluated = []
+        for parameters_tuple, result_dict in self.result_tracking_dict.iteritems():
+            parameters = dict(parameters_tuple)
+            if sorted(parameters.keys()) == parameter_names_sorted and result_dict['result'] is not None and np.size(result_dict['result']) == 1:
+                parameters_evaluated.append(self.cma_parameters_dict_to_array(parameters, parameter_names_sorted))
+                results_evaluated.append(float(np.asarray(result_dict['result']).flat[0]))
+
+        if len(results_evaluated) == 0:
+            return None
+
+        surrogate = utils_surrogate.create_surrogate(surrogate_parameters['model'])
+
+        max_training_points = surrogate_parameters['max_training_points']
+        if max_training_points is None:
+            # Enough for a full quadratic model, local around the current candidates
+            max_training_points = 2*utils_surrogate.QuadraticSurrogate.nb_coefficients(len(parameter_names_sorted), 'full')
+
+        X_training, y_training = utils_surrogate.select_training_points(parameters_evaluated, results_evaluated, center, scales, max_points=max_training_points)
+
+        if y_training.size < surrogate.min_training_points(len(parameter_names_sorted)):
+            return None
+
+        return surrogate.fit(X_training, y_training, center, scales)
 
 
     def check_parameters_candidate(self, list_parameters_candidates_dict, parameter_names_sorted, dict_parameters_range):
@@ -871,6 +1010,7 @@ class SubmitPBS():
         submit_jobs = submission_parameters_dict.get('submit_jobs', False)
         result_callback_function_infos = submission_parameters_dict.get('result_callback_function_infos', None)
         wait_jobs_completed = submission_parameters_dict.get('wait_jobs_completed', True)
+        cancel_overrunning_jobs = submission_parameters_dict.get('cancel_overrunning_jobs', False)
 
         # Track status of parameters: parameters -> dict(status=['waiting', 'submitted', 'completed'], result=None, jobwrapper=None, parameters=None)
 
@@ -898,7 +1038,7 @@ class SubmitPBS():
 
         if wait_jobs_completed:
             ## Wait for Jobs to be completed (could do another version where you send multiple jobs before waiting)
-            self.wait_all_jobs_collect_results(result_callback_function_infos=result_callback_function_infos, sleeping_period=sleeping_period, completion_progress=completed_parameters_progress, pbs_submission_infos=pbs_submission_infos)
+            self.wait_all_jobs_collect_results(result_callback_function_infos=result_callback_function_infos, sleeping_period=sleeping_period, completion_progress=completed_parameters_progress, pbs_submission_infos=pbs_submission_infos, cancel_overrunning_jobs=cancel_overrunning_jobs)
 
             ## Now return the list of results, in the same ordering
             result_shape = (1,)
@@ -936,11 +1076,13 @@ class SubmitPBS():
 
             Sets some default values in the process.
 
-            dict[job_name] -> dict(status=['waiting', 'submitted', 'completed'], result=None, jobwrapper=None, job_submission_parameters=None, parameters=None)
+            dict[job_name] -> dict(status=['waiting', 'submitted', 'completed'], result=None, instrumentation=None, jobwrapper=None, job_submission_parameters=None, parameters=None, deadline=None, heartbeat=None, heartbeat_seen=None)
+
+            deadline is when we give up waiting on the job, heartbeat is its last heartbeat and heartbeat_seen when (on our clock) it last changed.
         '''
 
-        self.jobs_tracking_dict[job.job_name] = dict(status='waiting', job=job, job_submission_parameters=job.experiment_parameters, result=None, parameters=parameters, time_started=None, number_submissions=0)
-        self.result_tracking_dict[tuple(parameters.items())] = dict(jobname=job.job_name, result=None)
+        self.jobs_tracking_dict[job.job_name] = dict(status='waiting', job=job, job_submission_parameters=job.experiment_parameters, result=None, instrumentation=None, parameters=parameters, time_started=None, number_submissions=0, deadline=None, heartbeat=None, heartbeat_seen=None)
+        self.result_tracking_dict[tuple(parameters.items())] = dict(jobname=job.job_name, result=None, instrumentation=None)
 
 
     def complete_job(self, job_name):
@@ -948,12 +1090,14 @@ class SubmitPBS():
             Complete a job:
                 - Change its status
                 - Update its result
-                - Put the result in the result_tracking_dict
+                - Put the result and the instrumentation summary (stage timings) in the result_tracking_dict
         '''
 
         self.jobs_tracking_dict[job_name]['status'] = 'completed'
         self.jobs_tracking_dict[job_name]['result'] = self.jobs_tracking_dict[job_name]['job'].get_result()
+        self.jobs_tracking_dict[job_name]['instrumentation'] = self.jobs_tracking_dict[job_name]['job'].get_instrumentation()
         self.result_tracking_dict[tuple(self.jobs_tracking_dict[job_name]['parameters'].items())]['result'] = self.jobs_tracking_dict[job_name]['result']
+        self.result_tracking_dict[tuple(self.jobs_tracking_dict[job_name]['parameters'].items())]['instrumentation'] = self.jobs_tracking_dict[job_name]['instrumentation']
 
 
     def submit_jobwrapper(self, job, pbs_submission_infos, submit=False, debug_overwrite=False):
@@ -969,6 +1113,9 @@ class SubmitPBS():
 
         # Handle cases were the exact same job already ran (and thus the result_sync_* file already exists), in that case do not submit it, it will be reloaded automatically.
         if not job.check_completed():
+            # Forget heartbeats of a previous submission
+            job.clear_heartbeat()
+
             debug_pre = self.debug
             self.debug = debug_overwrite
             # This may block, depending on pbs_submission_infos (e.g. if limit on concurrent jobs is set)
@@ -978,18 +1125,45 @@ class SubmitPBS():
         job.flag_job_submitted()
         self.jobs_tracking_dict[job.job_name]['status'] = 'submitted'
         self.jobs_tracking_dict[job.job_name]['time_started'] = time.time()
+        self.jobs_tracking_dict[job.job_name]['deadline'] = time.time() + utils.convert_deltatime_str_to_seconds(self.pbs_options['walltime'])*1.2
+        self.jobs_tracking_dict[job.job_name]['heartbeat'] = None
+        self.jobs_tracking_dict[job.job_name]['heartbeat_seen'] = None
         self.jobs_tracking_dict[job.job_name]['number_submissions'] += 1
 
 
-    def wait_all_jobs_collect_results(self, result_callback_function_infos=None, sleeping_period=dict(min=60, max=180), completion_progress=None, pbs_submission_infos=None, max_number_submissions=3):
+    def check_job_heartbeat(self, job_name, heartbeat_stale_factor=3.):
+        '''
+            Read the heartbeat of a submitted job and tell in which state it is, see utils_heartbeat.check_heartbeat():
+                'unknown', 'running', 'dead', or its final state ('completed', 'failed', 'cancelled')
+
+            Staleness is measured on our clock, from when we saw the heartbeat change, so clocks of the nodes do not matter.
+        '''
+
+        job_dict = self.jobs_tracking_dict[job_name]
+
+        (state, job_dict['heartbeat'], job_dict['heartbeat_seen']) = utils_heartbeat.check_heartbeat(job_dict['job'].get_heartbeat(), job_dict['heartbeat'], job_dict['heartbeat_seen'], heartbeat_stale_factor=heartbeat_stale_factor)
+
+        return state
+
+
+    def wait_all_jobs_collect_results(self, result_callback_function_infos=None, sleeping_period=dict(min=60, max=180), completion_progress=None, pbs_submission_infos=None, max_number_submissions=3, heartbeat_stale_factor=3., cancel_overrunning_jobs=False):
         '''
             Wait for all Jobs to be completed, and collect the results when they are
             Optionally accepts a callback method on finding a result.
                 result_callback_function_infos:
                 'function':    f(job=JobWrapper, parameters=dict())
                 'parameters':  dict()
+
+            Uses the heartbeats of the jobs (see check_job_heartbeat() and utils_heartbeat.decide_job_action()):
+                - dead or failed jobs are resubmitted right away (at most max_number_submissions times, then discarded)
+                - jobs still running past their deadline (1.2x walltime) get it extended by their predicted remaining time
+                - jobs without heartbeat are resubmitted after their deadline
+                - if cancel_overrunning_jobs, jobs predicted to need more than the walltime are cancelled (nan result),
+                  instead of being killed by the scheduler at the end of their allocation
         '''
 
+        walltime = utils.convert_deltatime_str_to_seconds(self.pbs_options['walltime'])
+
         # Construct the list of submitted jobs.
         # Will use a deque (queue) because it's more efficient and nice
         submitted_job_names = collections.deque([job_name for job_name, job_dict in self.jobs_tracking_dict.iteritems() if job_dict['status'] == 'submitted'])
@@ -1028,13 +1202,39 @@ class SubmitPBS():
 
                 else:
                     ## Not done. Wait a bit and check the next job's state.
-                    # Check how long we've waited
-                    waited_time = time.time() - self.jobs_tracking_dict[current_job_name]['time_started']
-                    if (waited_time > utils.convert_deltatime_str_to_seconds(self.pbs_options['walltime'])*1.2):
-                        # Waited too long...
+                    job_dict = self.jobs_tracking_dict[current_job_name]
+
+                    # Check how long we've waited, and what its heartbeat says
+                    waited_time = time.time() - job_dict['time_started']
+                    heartbeat_state = self.check_job_heartbeat(current_job_name, heartbeat_stale_factor=heartbeat_stale_factor)
+                    heartbeat = job_dict['heartbeat']
+
+                    action = utils_heartbeat.decide_job_action(heartbeat_state, heartbeat, job_dict['deadline'], walltime, cancel_overrunning_jobs=cancel_overrunning_jobs, cancel_requested=job_dict['job'].cancel_filename is not None and os.path.exists(job_dict['job'].cancel_filename))
+
+                    if action == 'resubmit' and heartbeat_state == 'dead':
+                        # Stopped beating, no need to wait for the deadline
+                        self.logger.info("Job %s stopped its heartbeat %d sec ago (%s), considered dead         " % (current_job_name, time.time() - job_dict['heartbeat_seen'], heartbeat['host']))
+
+                    elif action == 'resubmit' and heartbeat_state == 'failed':
+                        self.logger.info("Job %s failed on %s: %s         " % (current_job_name, heartbeat['host'], heartbeat.get('error', '')))
+
+                    elif action == 'cancel':
+                        # Will get killed by the scheduler before finishing, free its allocation now
+                        self.logger.info("Job %s needs %s more (%.1f%% done), over the walltime. Cancelling it         " % (current_job_name, progress.time_string(heartbeat['time_remaining']), 100.*heartbeat['fraction']))
+                        job_dict['job'].request_cancel()
+
+                    elif action == 'extend':
+                        # Slow but alive, extend its deadline
+                        job_dict['deadline'] = time.time() + (heartbeat['time_remaining'] or 0.0) + walltime*0.2
+                        if self.debug:
+                            self.logger.info("Job %s still running past its deadline, extended by %d sec         " % (current_job_name, job_dict['deadline'] - time.time()))
+
+                    resubmit = action == 'resubmit'
+
+                    if resubmit:
                         # try to resubmit it!
                         if self.debug:
-                            self.logger.info("Waited more than walltime for job %s, resubmitting it (%d/%d)         " % (current_job_name, self.jobs_tracking_dict[current_job_name]['number_submissions'], max_number_submissions))
+                            self.logger.info("Giving up on job %s, resubmitting it (%d/%d)         " % (current_job_name, self.jobs_tracking_dict[current_job_name]['number_submissions'], max_number_submissions))
 
                         # Only resubmit a certain number of times...
                         if self.jobs_tracking_dict[current_job_name]['number_submissions'] < max_number_submissions:
@@ -1052,7 +1252,13 @@ class SubmitPBS():
                     sleep_time_rnd = np.random.randint(sleeping_period['min'], sleeping_period['max'])
 
                     if self.debug:
-                        status_str = "Waiting on Job %s, waited %d/%d. Sleeping for %d sec now." % (current_job_name, waited_time, utils.convert_deltatime_str_to_seconds(self.pbs_options['walltime'])*1.2, sleep_time_rnd)
+                        status_str = "Waiting on Job %s, waited %d/%d. Sleeping for %d sec now." % (current_job_name, waited_time, job_dict['deadline'] - job_dict['time_started'], sleep_time_rnd)
+
+                        if heartbeat is not None and heartbeat_state == 'running':
+                            # What the job says about itself
+                            if heartbeat['fraction'] is not None:
+                                status_str += " Job at %.1f%%, %s left." % (100.*heartbeat['fraction'], progress.time_string(heartbeat['time_remaining'] or -1))
+                            status_str += " %.0f MB." % heartbeat['peak_rss_mb']
 
                         if completion_progress is not None:
                             # Also add how much time to completion
@@ -1312,6 +1518,194 @@ def test_cmaes_optimisation_3d():
     submit_pbs.perform_cma_es_optimization(submission_parameters_dict)
 
 
+def test_heartbeat_local():
+    '''
+        Test for the heartbeats of JobWrappers, running jobs locally in the background.
+
+        The jobs are a small script writing heartbeats (with utils_heartbeat.HeartbeatWriter) and its result sync file,
+        no experimentlauncher run. On their first submission, one job fails and another one dies silently:
+        both get resubmitted by wait_all_jobs_collect_results, from their heartbeats.
+    '''
+    import tempfile
+    import shutil
+
+    run_label = 'test_heartbeat_local'
+    simul_out_dir = tempfile.mkdtemp(prefix=run_label)
+    cwd = os.getcwd()
+
+    job_script = os.path.join(simul_out_dir, 'heartbeat_job.py')
+    with open(job_script, 'w') as f:
+        f.write('''
+import sys
+import os
+import time
+import numpy as np
+
+sys.path.insert(0, %r)
+import utils_heartbeat
+import progress
+
+options = dict(zip([arg.lstrip('-') for arg in sys.argv[1::2]], sys.argv[2::2]))
+result_filename = os.path.join(options['output_directory'], 'result_sync_job_%%s.npy' %% options['job_name'])
+heartbeat_filename = os.path.join(options['output_directory'], 'heartbeat_sync_job_%%s.json' %% options['job_name'])
+
+# Misbehave on the first submission only
+submitted_filename = os.path.join(options['output_directory'], 'submitted_%%s' %% options['job_name'])
+first_submission = not os.path.exists(submitted_filename)
+open(submitted_filename, 'a').close()
+
+heartbeat = utils_heartbeat.HeartbeatWriter(heartbeat_filename, interval=float(options['heartbeat_interval']), status_fct=lambda: dict(job_name=options['job_name']))
+heartbeat.start()
+
+tracker = progress.Progress(10)
+for i in xrange(10):
+    time.sleep(0.1)
+    tracker.increment()
+
+if first_submission and options['behaviour'] == 'die':
+    os._exit(1)
+elif first_submission and options['behaviour'] == 'fail':
+    heartbeat.stop(job_state='failed', error='failing on purpose')
+else:
+    heartbeat.stop(job_state='completed')
+    np.save(result_filename, dict(job_state='completed', result=float(options['result']), instrumentation=None))
+''' % os.path.dirname(os.path.abspath(__file__)))
+
+    submission_parameters_dict = dict(
+        submit_jobs=True,
+        sleeping_period=dict(min=1, max=2),
+        pbs_submission_infos=dict(description='Testing heartbeats',
+                            command=sys.executable + ' ' + job_script,
+                            other_options=dict(action_to_do='launcher_do_simple_run',
+                                               output_directory=simul_out_dir,
+                                               label=run_label,
+                                               session_id='heartbeat',
+                                               heartbeat_interval=0.2,
+                                               result_computation='random'
+                                               ),
+                            walltime='00:05:00',
+                            memory='2gb',
+                            simul_out_dir=simul_out_dir,
+                            source_dir=simul_out_dir,
+                            pbs_submit_cmd='sh_background',
+                            submit_label=run_label)
+    )
+
+    submit_pbs = SubmitPBS(pbs_submission_infos=submission_parameters_dict['pbs_submission_infos'], debug=True)
+
+    try:
+        parameters_to_submit = [dict(behaviour='complete', result=1.), dict(behaviour='fail', result=2.), dict(behaviour='die', result=3.)]
+        results = submit_pbs.submit_minibatch_jobswrapper(parameters_to_submit, submission_parameters_dict)
+
+        print "Results:", results.flatten()
+        assert np.all(results.flatten() == [1., 2., 3.])
+
+        for job_name, job_dict in submit_pbs.jobs_tracking_dict.iteritems():
+            heartbeat = job_dict['job'].get_heartbeat()
+            print job_name, job_dict['parameters']['behaviour'], heartbeat['job_state'], "%.1f MB" % heartbeat['peak_rss_mb'], "%d submissions" % job_dict['number_submissions']
+            assert heartbeat['job_state'] == 'completed' and heartbeat['job_name'] == job_name
+            assert job_dict['number_submissions'] == (1 if job_dict['parameters']['behaviour'] == 'complete' else 2)
+    finally:
+        for process in submit_pbs.local_processes:
+            process.wait()
+        os.chdir(cwd)
+        shutil.rmtree(simul_out_dir)
+
+
+def test_cmaes_surrogate():
+    '''
+        Test for the surrogate-assisted perform_cma_es_optimization, without submitting anything.
+
+        submit_minibatch_jobswrapper is replaced by an analytic fitness (rotated ellipsoid), filling result_tracking_dict as completed jobs would.
+    '''
+    import tempfile
+
+    np.random.seed(10)
+
+    rotation = np.linalg.qr(np.random.randn(2, 2))[0]
+    optimum = np.array([0.3, 0.6])
+    fitness = lambda x: np.sum(np.dot(x - optimum, rotation)**2.*np.array([1., 10.]))
+
+    run_label = 'test_cmaes_surrogate'
+    simul_out_dir = tempfile.mkdtemp(prefix=run_label)
+    dict_par_range = dict(ratio_conj=dict(low=0.0, high=1.0, dtype=float), sigmax=dict(low=0.0, high=1.0, dtype=float))
+    parameter_names_sorted = sorted(dict_par_range.keys())
+
+    submission_parameters_dict = dict(
+        dict_parameters_range=dict_par_range,
+        cma_population_size=20,
+        cma_sigma0=1.0,
+        cma_use_bounds=True,
+        cma_tolx=1e-5,
+        cma_use_surrogate=True,
+        pbs_submission_infos=dict(description='Testing CMA-ES surrogate',
+                                  command='echo',
+                                  other_options=dict(),
+                                  walltime='00:05:00',
+                                  memory='2gb',
+                                  simul_out_dir=simul_out_dir,
+                                  source_dir=simul_out_dir,
+                                  pbs_submit_cmd='sh_background',
+                                  submit_label=run_label)
+    )
+
+    submit_pbs = SubmitPBS(pbs_submission_infos=submission_parameters_dict['pbs_submission_infos'], debug=False)
+
+    submitted_parameters = []
+    def submit_minibatch_analytic(parameters_to_submit, submission_parameters_dict):
+        results = np.empty((len(parameters_to_submit), 1))
+        for (parameters_i, parameters) in enumerate(parameters_to_submit):
+            results[parameters_i] = fitness(submit_pbs.cma_parameters_dict_to_array(parameters, parameter_names_sorted))
+            submit_pbs.result_tracking_dict[tuple(parameters.items())] = dict(jobname='analytic_%d' % len(submitted_parameters), result=results[parameters_i, 0], instrumentation=None)
+            submitted_parameters.append(parameters)
+        return results
+    submit_pbs.submit_minibatch_jobswrapper = submit_minibatch_analytic
+
+    surrogate_parameters = dict(model='quadratic', fraction_evaluated=0.25, min_kendall_tau=0.85, max_training_points=None, nan_replacement=1e9)
+    scales = 0.2*np.ones(2)
+    candidates = lambda nb_candidates: [dict(zip(parameter_names_sorted, x)) for x in np.random.uniform(0.2, 0.7, size=(nb_candidates, 2))]
+
+    # Nothing to train a surrogate on yet: all candidates are evaluated
+    (fitness_results, evaluated_mask, surrogate_infos) = submit_pbs.cma_evaluate_with_surrogate(candidates(20), parameter_names_sorted, submission_parameters_dict, surrogate_parameters, scales)
+    assert np.all(evaluated_mask) and surrogate_infos['nb_evaluated'] == 20 and len(submitted_parameters) == 20
+
+    # Exact quadratic surrogate: only the best quarter is evaluated, the others rank after them
+    parameters_candidates_dict = candidates(20)
+    (fitness_results, evaluated_mask, surrogate_infos) = submit_pbs.cma_evaluate_with_surrogate(parameters_candidates_dict, parameter_names_sorted, submission_parameters_dict, surrogate_parameters, scales)
+    true_fitness = np.array([fitness(x) for x in submit_pbs.cma_list_parameters_dict_to_array(parameters_candidates_dict, parameter_names_sorted)])
+    assert surrogate_infos['nb_evaluated'] == np.sum(evaluated_mask) == 5 and len(submitted_parameters) == 25
+    assert surrogate_infos['kendall_tau'] >= surrogate_parameters['min_kendall_tau']
+    assert np.allclose(fitness_results[evaluated_mask], true_fitness[evaluated_mask])
+    assert np.all(true_fitness[evaluated_mask] <= np.min(true_fitness[~evaluated_mask]) + 1e-10)
+    assert np.min(fitness_results[~evaluated_mask]) >= np.max(fitness_results[evaluated_mask])
+    assert np.all(np.argsort(fitness_results)[5:] == np.nonzero(~evaluated_mask)[0][np.argsort(true_fitness[~evaluated_mask])])
+
+    # Surrogate never accurate enough: everything ends up evaluated, batch after batch
+    (fitness_results, evaluated_mask, surrogate_infos) = submit_pbs.cma_evaluate_with_surrogate(candidates(20), parameter_names_sorted, submission_parameters_dict, dict(surrogate_parameters, min_kendall_tau=1.1), scales)
+    assert np.all(evaluated_mask) and surrogate_infos['nb_evaluated'] == 20 and len(submitted_parameters) == 45
+
+    # Full optimisation, converges with fewer true evaluations than candidates
+    submit_pbs.result_tracking_dict = dict()
+    del submitted_parameters[:]
+    cma_outputs = submit_pbs.perform_cma_es_optimization(submission_parameters_dict)
+
+    nb_candidates = np.sum([infos['nb_candidates'] for infos in cma_outputs['surrogate_log']])
+    print "Best: %s -> %g, %d true evaluations for %d candidates" % (cma_outputs['best_params'][0], cma_outputs['best_f'], len(submitted_parameters), nb_candidates)
+    assert np.allclose(cma_outputs['best_params'][0], optimum, atol=1e-3)
+    assert cma_outputs['best_f'] < 1e-6
+    assert len(submitted_parameters) < nb_candidates/2
+
+
+def test():
+    '''
+        Tests running locally, without PBS nor experimental data
+    '''
+
+    test_heartbeat_local()
+    test_cmaes_surrogate()
+
+
+
 
 
 if __name__ == '__main__':
@@ -1342,6 +1736,9 @@ if __name__ == '__main__':
         test_cmaes_optimisation()
         # test_cmaes_optimisation_3d()
 
+    # Surrogate-assisted CMA-ES on an analytic fitness, runs locally
+    test()
+
 
 
 
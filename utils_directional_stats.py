@@ -17,6 +17,9 @@ import matplotlib.pyplot as plt
 
 import statsmodels.distributions as stmodsdist
 
+import utils_vonmises
+from utils_vonmises import vonmisespdf
+
 #################### DIRECTIONAL STATISTICS ############################
 
 def init_feature_space(precision=20, endpoint=True):
@@ -27,16 +30,6 @@ def init_feature_space(precision=20, endpoint=True):
     return np.linspace(-np.pi, np.pi, precision, endpoint=endpoint)
 
 
-def vonmisespdf(x, mu, K):
-    '''
-        Von Mises PDF (switch to Normal if high kappa)
-    '''
-    if K > 700.:
-        return np.sqrt(K)/(np.sqrt(2*np.pi))*np.exp(-0.5*(x -mu)**2.*K)
-    else:
-        return np.exp(K*np.cos(x-mu)) / (2.*np.pi * spsp.i0(K))
-
-
 def sample_angle(size=1):
     return np.random.random(size=size)*2.*np.pi - np.pi
 
@@ -67,9 +60,7 @@ def wrap_angles(angles, bound=np.pi):
     #     while np.any(angles > bound):
     #         angles[angles > bound] -= 2.*bound
 
-    angles = np.mod(angles + bound, 2*bound) - bound
-
-    return angles
+    return utils_vonmises.wrap(angles, max_angle=bound)
 
 def kappa_to_stddev(kappa):
     '''
@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+utils_diskcache.py
+
+Persistent on-disk cache of computed results, shared by all processes/jobs using the same directory.
+
+Entries are pickled to one file each, named after a fingerprint of their key (see fingerprint()).
+Files are written atomically (temporary file + rename), so concurrent cluster jobs can share a directory.
+When the cache grows above max_size_bytes, the least recently used entries are removed.
+
+The network response statistics cache (used by compute_covariance_KL) is disabled by default.
+Enable it with set_statistics_cache(directory), the --statistics_cache_dir argument,
+or the STATISTICS_CACHE_DIR environment variable.
+
+Created by Loic Matthey on 2015-07-30.
+Copyright (c) 2015 Gatsby Unit. All rights reserved.
+"""
+
+import os
+import hashlib
+import tempfile
+import cPickle as pickle
+
+import numpy as np
+
+
+DEFAULT_MAX_SIZE_BYTES = 2*1024**3
+
+# Cache of network response statistics, see get_statistics_cache()
+_statistics_cache = dict(cache=None, initialised=False)
+
+
+def fingerprint(*values):
+    '''
+        Hash of the given values: arrays (data, dtype and shape), lists/tuples/dicts of them, or anything with a stable repr.
+    '''
+
+    hasher = hashlib.sha1()
+    _update_fingerprint(hasher, values)
+
+    return hasher.hexdigest()
+
+
+def _update_fingerprint(hasher, value):
+    if isinstance(value, np.ndarray):
+        hasher.update('array%s%s' % (value.dtype.str, value.shape))
+        hasher.update(np.ascontiguousarray(value).view(np.uint8))
+    elif isinstance(value, (list, tuple)):
+        hasher.update('%s%d' % (type(value).__name__, len(value)))
+        for item in value:
+            _update_fingerprint(hasher, item)
+    elif isinstance(value, dict):
+        hasher.update('dict%d' % len(value))
+        for key in sorted(value.keys()):
+            _update_fingerprint(hasher, key)
+            _update_fingerprint(hasher, value[key])
+    else:
+        hasher.update(repr(value))
+
+
+class DiskCache(object):
+    '''
+        Key -> value cache, stored in a directory.
+
+        Keys are fingerprinted (any value accepted by fingerprint()), values need to be picklable.
+    '''
+
+    def __init__(self, directory, max_size_bytes=DEFAULT_MAX_SIZE_BYTES):
+        self.directory = directory
+        self.max_size_bytes = max_size_bytes
+
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                # Created concurrently
+                if not os.path.isdir(self.directory):
+                    raise
+
+
+    def get_path(self, key):
+        return os.path.join(self.directory, fingerprint(key) + '.pkl')
+
+
+    def get(self, key, default=None):
+        '''
+            Return the value stored for key, or default. Marks the entry as recently used.
+        '''
+
+        path = self.get_path(key)
+
+        try:
+            with open(path, 'rb') as cache_file:
+                value = pickle.load(cache_file)
+        except (IOError, EOFError, pickle.UnpicklingError):
+            # Missing, evicted concurrently or corrupted
+            return default
+
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+        return value
+
+
+    def set(self, key, value):
+        '''
+            Store value for key, then evict old entries if the cache is too large.
+        '''
+
+        (file_descriptor, temporary_path) = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(file_descriptor, 'wb') as cache_file:
+            pickle.dump(value, cache_file, pickle.HIGHEST_PROTOCOL)
+        os.rename(temporary_path, self.get_path(key))
+
+        self.evict()
+
+
+    def __contains__(self, key):
+        return os.path.exists(self.get_path(key))
+
+
+    def get_entries(self):
+        '''
+            List of (last access time, size, path), oldest first
+        '''
+        entries = []
+        for filename in os.listdir(self.directory):
+            if filename.endswith('.pkl'):
+                path = os.path.join(self.directory, filename)
+                try:
+                    stat = os.stat(path)
+                    entries.append((stat.st_mtime, stat.st_size, path))
+                except OSError:
+                    pass
+
+        return sorted(entries)
+
+
+    def evict(self, max_size_bytes=None):
+        '''
+            Remove the least recently used entries until the cache is below max_size_bytes
+        '''
+
+        if max_size_bytes is None:
+            max_size_bytes = self.max_size_bytes
+
+        entries = self.get_entries()
+        total_size = sum([entry[1] for entry in entries])
+
+        for (_, size, path) in entries:
+            if total_size <= max_size_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total_size -= size
+
+
+    def clear(self):
+        self.evict(max_size_bytes=0)
+
+
+
+def set_statistics_cache(directory, max_size_bytes=DEFAULT_MAX_SIZE_BYTES):
+    '''
+        Store network response statistics in directory. None disables the cache.
+    '''
+
+    if directory:
+        _statistics_cache['cache'] = DiskCache(directory, max_size_bytes=max_size_bytes)
+    else:
+        _statistics_cache['cache'] = None
+    _statistics_cache['initialised'] = True
+
+
+def get_statistics_cache():
+    '''
+        DiskCache for network response statistics, or None if disabled.
+
+        Set up from the STATISTICS_CACHE_DIR environment variable if set_statistics_cache() was not called.
+    '''
+
+    if not _statistics_cache['initialised']:
+        set_statistics_cache(os.environ.get('STATISTICS_CACHE_DIR', None))
+
+    return _statistics_cache['cache']
+
+
+def test():
+    '''
+        Check storage, fingerprints and eviction
+    '''
+    import shutil
+    import time
+
+    directory = tempfile.mkdtemp()
+    try:
+        cache = DiskCache(directory, max_size_bytes=10*1024)
+
+        assert fingerprint(np.arange(3)) != fingerprint(np.arange(3.))
+        assert fingerprint(dict(a=1, b=np.ones(2))) == fingerprint(dict(b=np.ones(2), a=1))
+
+        cache.set(('stats', np.arange(10)), dict(mean=np.ones(3)))
+        assert np.all(cache.get(('stats', np.arange(10)))['mean'] == 1)
+        assert cache.get(('stats', np.arange(11))) is None
+
+        # Oldest entries get removed past 10KB, the last used ones stay
+        for i in xrange(5):
+            cache.set(i, np.zeros(300))
+            time.sleep(0.01)
+        assert 0 not in cache
+        assert 4 in cache
+        assert sum([entry[1] for entry in cache.get_entries()]) <= 10*1024
+    finally:
+        shutil.rmtree(directory)
+
+
+
+if __name__ == '__main__':
+    test()
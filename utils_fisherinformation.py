@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+utils_fisherinformation.py
+
+Batched Monte Carlo estimates of the (marginal) Fisher Information of population codes.
+
+The networks provide the Jacobian of their responses for many stimuli at once (S x R x M),
+these functions build the Fisher Information matrices of blocks of samples with matrix products
+instead of looping over stimuli.
+
+Created by Loic Matthey on 2015-07-31.
+Copyright (c) 2015 Gatsby Unit. All rights reserved.
+"""
+
+import numpy as np
+
+import utils_directional_stats
+
+# Number of floats of the derivatives of one block of samples
+BLOCK_NUM_ELEMENTS = 2**22
+
+
+def sample_items_thetas(num_samples, nitems, min_distance=0.1, R=2):
+    '''
+        Sample num_samples sets of nitems stimuli.
+
+        The first item is fixed at (0, 0), others are uniform, at least min_distance away from the previous items
+        on every feature (as utils.enforce_distance_set). Items are sampled one after the other, all sets at once.
+
+        return: num_samples x nitems x R
+    '''
+
+    items_thetas = np.zeros((num_samples, nitems, R))
+
+    for item_i in xrange(1, nitems):
+        to_sample = np.ones(num_samples, dtype=bool)
+
+        while np.any(to_sample):
+            items_thetas[to_sample, item_i] = utils_directional_stats.sample_angle((np.sum(to_sample), R))
+
+            distances = np.abs(utils_directional_stats.wrap_angles(items_thetas[:, item_i:item_i+1] - items_thetas[:, :item_i]))
+            to_sample = np.any(np.any(distances <= min_distance, axis=-1), axis=-1)
+
+    return items_thetas
+
+
+def dot_inverse_covariance(x, inv_cov_stim):
+    '''
+        Sigma^-1 x along the last axis of x, for dense or structured (utils_likelihood) inverse covariances
+    '''
+
+    # Flatten to a matrix, np.dot only uses BLAS in 2D
+    x_2d = x.reshape((-1, x.shape[-1]))
+
+    if isinstance(inv_cov_stim, np.ndarray):
+        return np.dot(x_2d, inv_cov_stim).reshape(x.shape)
+    else:
+        return inv_cov_stim.dot(x_2d).reshape(x.shape)
+
+
+def compute_fisher_information_matrices(items_derivatives, inv_cov_stim):
+    '''
+        Fisher Information matrices of sets of items.
+
+        items_derivatives: S x (nitems*R) x M, derivatives of the network response
+        return: S x (nitems*R) x (nitems*R)
+    '''
+
+    return np.matmul(items_derivatives, np.swapaxes(dot_inverse_covariance(items_derivatives, inv_cov_stim), -1, -2))
+
+
+def invert_fisher_information_matrices(FI_matrices):
+    '''
+        Inverse of a stack of Fisher Information matrices, NaN for singular ones
+    '''
+
+    try:
+        return np.linalg.inv(FI_matrices)
+    except np.linalg.LinAlgError:
+        inv_FI_matrices = np.nan*np.empty(FI_matrices.shape)
+        for i in xrange(FI_matrices.shape[0]):
+            try:
+                inv_FI_matrices[i] = np.linalg.inv(FI_matrices[i])
+            except np.linalg.LinAlgError:
+                pass
+
+        return inv_FI_matrices
+
+
+def compute_marginal_inverse_FI(jacobian_fct, nitems, inv_cov_stim, M, R=2, max_n_samples=int(1e5), min_distance=0.1, convergence_epsilon=1e-7, block_size=None, debug=True):
+    '''
+        Monte Carlo estimate of the Marginal Inverse Fisher Information of item 1, feature 1,
+        averaged over the values of the other items.
+
+        Samples are processed in blocks: derivatives for all items of a block come from one call to jacobian_fct,
+        Fisher Information matrices from matrix products.
+        Stops after max_n_samples samples, or once the estimates change by less than convergence_epsilon between blocks.
+
+        Inputs:
+            jacobian_fct    function: S x R stimuli -> S x R x M derivatives of the network response
+            inv_cov_stim    M x M inverse covariance of the memory, or structured (utils_likelihood)
+
+        Returns dict(inv_FI, inv_FI_std, FI, FI_std), stds are standard errors of the estimates.
+    '''
+
+    min_num_samples_std = int(2e3)
+
+    if block_size is None:
+        block_size = int(np.clip(BLOCK_NUM_ELEMENTS/(nitems*R*M), 1, min_num_samples_std))
+
+    marginal_fi_dict = dict(inv_FI=0, inv_FI_std=0, FI=0, FI_std=0)
+    sums = np.zeros(2)
+    sums_squares = np.zeros(2)
+    # Samples with a finite estimate, per statistic (singular Fisher Information matrices give NaN inverses)
+    num_finite_samples = np.zeros(2)
+    num_samples = 0
+    previous_estimates = None
+
+    while num_samples < max_n_samples:
+        block_num_samples = min(block_size, max_n_samples - num_samples)
+
+        items_thetas = sample_items_thetas(block_num_samples, nitems, min_distance=min_distance, R=R)
+
+        # Derivatives for item i, feature r are at i*R + r
+        items_derivatives = jacobian_fct(items_thetas.reshape((-1, R))).reshape((block_num_samples, nitems*R, M))
+        items_derivatives[np.isnan(items_derivatives)] = 0.0
+
+        FI_matrices = compute_fisher_information_matrices(items_derivatives, inv_cov_stim)
+        inv_FI_matrices = invert_fisher_information_matrices(FI_matrices)
+
+        block_estimates = np.array([inv_FI_matrices[:, 0, 0], FI_matrices[:, 0, 0]])
+        block_finite = np.isfinite(block_estimates)
+        block_estimates[~block_finite] = 0.0
+        sums += np.sum(block_estimates, axis=-1)
+        sums_squares += np.sum(block_estimates**2., axis=-1)
+        num_finite_samples += np.sum(block_finite, axis=-1)
+        num_samples += block_num_samples
+
+        # NaN for a statistic without any finite sample
+        with np.errstate(divide='ignore', invalid='ignore'):
+            means = sums/num_finite_samples
+            stds = np.sqrt(np.clip(sums_squares/num_finite_samples - means**2., 0.0, np.inf)/num_finite_samples)
+
+        marginal_fi_dict['inv_FI'] = means[0]
+        marginal_fi_dict['inv_FI_std'] = stds[0]
+        marginal_fi_dict['FI'] = means[1]
+        marginal_fi_dict['FI_std'] = stds[1]
+
+        if num_samples > 1.5*min_num_samples_std:
+            # Check convergence
+            new_estimates = np.r_[means, stds]
+            if previous_estimates is not None and np.nansum(np.abs(previous_estimates - new_estimates)) <= convergence_epsilon:
+                if debug:
+                    print "Converged after %d samples" % num_samples
+                break
+
+            previous_estimates = new_estimates
+
+    return marginal_fi_dict
+
+
+def test():
+    '''
+        Check the sampled items and the batched Fisher Information against a direct computation
+    '''
+
+    np.random.seed(10)
+
+    items_thetas = sample_items_thetas(500, 4, min_distance=0.3)
+    assert np.all(items_thetas[:, 0] == 0.0)
+    for i in xrange(4):
+        for j in xrange(i):
+            assert np.all(np.abs(utils_directional_stats.wrap_angles(items_thetas[:, i] - items_thetas[:, j])) > 0.3)
+
+    # Linear code along each feature: constant derivatives, FI = d^T Sigma^-1 d
+    M = 20
+    derivatives = np.random.randn(2, M)
+    inv_cov_stim = np.eye(M)/0.5**2.
+
+    def jacobian_fct(stimuli):
+        return np.tile(derivatives, (stimuli.shape[0], 1, 1))
+
+    marginal_fi = compute_marginal_inverse_FI(jacobian_fct, 1, inv_cov_stim, M, max_n_samples=100, debug=False)
+
+    FI = np.dot(derivatives, np.dot(inv_cov_stim, derivatives.T))
+    assert np.allclose(marginal_fi['FI'], FI[0, 0])
+    assert np.allclose(marginal_fi['inv_FI'], np.linalg.inv(FI)[0, 0])
+    assert np.allclose(marginal_fi['FI_std'], 0.0)
+
+    # Half of the samples without derivatives: their singular FI matrices do not count in the inverse FI
+    def jacobian_half_fct(stimuli):
+        jacobian = jacobian_fct(stimuli)
+        jacobian[::2] = 0.0
+        return jacobian
+
+    marginal_fi = compute_marginal_inverse_FI(jacobian_half_fct, 1, inv_cov_stim, M, max_n_samples=100, block_size=10, debug=False)
+    assert np.allclose(marginal_fi['inv_FI'], np.linalg.inv(FI)[0, 0])
+    assert np.allclose(marginal_fi['inv_FI_std'], 0.0)
+    assert np.allclose(marginal_fi['FI'], FI[0, 0]/2.)
+
+
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,336 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+utils_heartbeat.py
+
+Heartbeat files of running jobs, written on the shared filesystem next to their result sync file.
+
+A HeartbeatWriter thread periodically writes a JSON status (see progress.write_heartbeat) with:
+    - job_state ('running', then 'completed', 'failed' or 'cancelled'), pid, host, time_started, time_updated
+    - peak_rss_mb: peak resident memory of the process
+    - progress: status of the active progress trackers (see progress.get_active_status), outermost first
+    - fraction, time_remaining, eta: taken from the outermost tracker (None if there is none)
+
+The submitter asks a job to stop by creating its cancel file. The writer sees it at its next beat and
+interrupts the main thread: KeyboardInterrupt is raised there as soon as it runs Python code again.
+
+Times in the heartbeat are from the clock of the node running the job, monitors should rather look at when
+the heartbeat last changed, on their own clock.
+
+Monitors (e.g. SubmitPBS.wait_all_jobs_collect_results) get the state of a job with check_heartbeat(),
+and what to do about it with decide_job_action().
+
+Created by Loic Matthey on 2015-08-18.
+Copyright (c) 2015 Gatsby Unit. All rights reserved.
+"""
+
+import os
+import sys
+import time
+import socket
+import resource
+import threading
+import thread
+
+import progress
+
+
+def get_peak_rss():
+    '''
+        Peak resident memory of this process so far, in MB
+    '''
+
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    if sys.platform == 'darwin':
+        # Bytes on OSX, KB on Linux
+        return peak_rss/1024.**2
+    else:
+        return peak_rss/1024.
+
+
+class HeartbeatWriter(object):
+    '''
+        Writes the heartbeat of this process every interval seconds, from a daemon thread.
+
+        heartbeat = HeartbeatWriter(filename, interval=60., cancel_filename=filename_cancel)
+        heartbeat.start()
+        try:
+            do_work()
+        except KeyboardInterrupt:
+            if not heartbeat.cancel_requested:
+                raise
+        heartbeat.stop(job_state='completed')
+    '''
+
+    def __init__(self, filename, interval=60., cancel_filename=None, status_fct=None):
+        '''
+            status_fct, if given, returns a dictionary added to each heartbeat (e.g. the job name)
+        '''
+
+        self.filename = filename
+        self.interval = interval
+        self.cancel_filename = cancel_filename
+        self.status_fct = status_fct
+
+        self.time_started = time.time()
+        self.cancel_requested = False
+
+        self._stop_event = threading.Event()
+        self._thread = None
+
+
+    def start(self):
+        '''
+            Write the first heartbeat and start the thread
+        '''
+
+        self.time_started = time.time()
+        self.cancel_requested = False
+        self._stop_event.clear()
+
+        self.write()
+
+        self._thread = threading.Thread(target=self._run, name='heartbeat')
+        self._thread.daemon = True
+        self._thread.start()
+
+
+    def stop(self, job_state='completed', **kwargs):
+        '''
+            Stop the thread and write the final heartbeat. Extra kwargs are added to it (e.g. error message)
+        '''
+
+        self._stop_event.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+
+        self.write(job_state=job_state, **kwargs)
+
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            self.write()
+
+            if not self.cancel_requested and self.check_cancel_file():
+                self.cancel_requested = True
+                self.write(job_state='cancelling')
+
+                # Raises KeyboardInterrupt in the main thread
+                thread.interrupt_main()
+
+
+    def check_cancel_file(self):
+        return self.cancel_filename is not None and os.path.exists(self.cancel_filename)
+
+
+    def get_status(self, job_state='running'):
+        '''
+            Heartbeat content, see module documentation
+        '''
+
+        now = time.time()
+        active_progress = progress.get_active_status()
+
+        status = dict(job_state=job_state, pid=os.getpid(), host=socket.gethostname(), interval=self.interval, time_started=self.time_started, time_updated=now, time_elapsed=now - self.time_started, peak_rss_mb=get_peak_rss(), progress=active_progress, fraction=None, time_remaining=None, eta=None)
+
+        if active_progress:
+            status['fraction'] = active_progress[0]['fraction']
+            if active_progress[0]['time_remaining'] >= 0:
+                status['time_remaining'] = active_progress[0]['time_remaining']
+                status['eta'] = now + status['time_remaining']
+
+        if self.status_fct is not None:
+            status.update(self.status_fct())
+
+        return status
+
+
+    def write(self, job_state='running', **kwargs):
+        '''
+            Write the heartbeat now. Never raises, monitoring should not break the computation.
+        '''
+
+        try:
+            status = self.get_status(job_state=job_state)
+            status.update(kwargs)
+            progress.write_heartbeat(self.filename, status)
+        except (IOError, OSError):
+            pass
+
+
+def check_heartbeat(heartbeat, last_heartbeat=None, last_seen=None, heartbeat_stale_factor=3., now=None):
+    '''
+        State of a job from its heartbeat (None if there is none), as seen by a monitor:
+            - 'unknown': no heartbeat yet (still queued, or not started)
+            - 'running': alive, its heartbeat changed less than heartbeat_stale_factor heartbeat intervals ago
+            - 'dead': was running but its heartbeat stopped changing (killed by the scheduler, node failure...)
+            - 'completed', 'failed', 'cancelled': finished
+
+        last_heartbeat is the heartbeat seen before, last_seen when (on the monitor clock) it last changed.
+
+        Returns (state, last_heartbeat, last_seen), the last two updated.
+    '''
+
+    if now is None:
+        now = time.time()
+
+    if heartbeat is None:
+        return ('unknown', last_heartbeat, last_seen)
+
+    if last_heartbeat is None or heartbeat['time_updated'] != last_heartbeat['time_updated']:
+        last_heartbeat = heartbeat
+        last_seen = now
+
+    if heartbeat['job_state'] not in ('running', 'cancelling'):
+        return (heartbeat['job_state'], last_heartbeat, last_seen)
+
+    if now - last_seen > heartbeat_stale_factor*heartbeat['interval']:
+        return ('dead', last_heartbeat, last_seen)
+
+    return ('running', last_heartbeat, last_seen)
+
+
+def decide_job_action(state, heartbeat, deadline, walltime, now=None, cancel_overrunning_jobs=False, cancel_requested=False):
+    '''
+        What a monitor should do about a job without result yet, given its state from check_heartbeat():
+            - 'resubmit': dead or failed, or no (running) heartbeat and past its deadline
+            - 'cancel': running, cancel_overrunning_jobs set and predicted to need more than the walltime
+                        (cancel_requested: already asked)
+            - 'extend': running past its deadline, extend it by the predicted remaining time
+            - 'wait'
+    '''
+
+    if now is None:
+        now = time.time()
+
+    if state in ('dead', 'failed'):
+        return 'resubmit'
+
+    if state == 'running':
+        if cancel_overrunning_jobs and not cancel_requested and heartbeat['time_remaining'] is not None and heartbeat['time_elapsed'] + heartbeat['time_remaining'] > walltime:
+            return 'cancel'
+        elif now > deadline:
+            return 'extend'
+        else:
+            return 'wait'
+
+    if now > deadline:
+        return 'resubmit'
+
+    return 'wait'
+
+
+def test_job_monitoring():
+    '''
+        States and decisions of a monitor, from fabricated heartbeat files
+    '''
+
+    import tempfile
+    import shutil
+
+    directory = tempfile.mkdtemp()
+    filename = os.path.join(directory, 'heartbeat.json')
+
+    def beat(job_state='running', time_updated=1000., time_elapsed=100., time_remaining=None):
+        progress.write_heartbeat(filename, dict(job_state=job_state, interval=60., time_updated=time_updated, time_elapsed=time_elapsed, time_remaining=time_remaining, fraction=None))
+        return progress.read_heartbeat(filename)
+
+    walltime = 3600.
+    deadline = 5000.
+
+    try:
+        # Nothing yet
+        assert check_heartbeat(progress.read_heartbeat(filename), now=0.) == ('unknown', None, None)
+        assert decide_job_action('unknown', None, deadline, walltime, now=10.) == 'wait'
+        assert decide_job_action('unknown', None, deadline, walltime, now=deadline + 1.) == 'resubmit'
+
+        # Running, seen changing at 100 on the monitor clock
+        (state, last_heartbeat, last_seen) = check_heartbeat(beat(), now=100.)
+        assert state == 'running' and last_seen == 100.
+        assert decide_job_action(state, last_heartbeat, deadline, walltime, now=200.) == 'wait'
+
+        # Same heartbeat, not stale yet, then stale: dead
+        (state, last_heartbeat, last_seen) = check_heartbeat(beat(), last_heartbeat, last_seen, heartbeat_stale_factor=3., now=250.)
+        assert state == 'running' and last_seen == 100.
+        (state, last_heartbeat, last_seen) = check_heartbeat(beat(), last_heartbeat, last_seen, heartbeat_stale_factor=3., now=100. + 3*60. + 1.)
+        assert state == 'dead'
+        assert decide_job_action(state, last_heartbeat, deadline, walltime, now=300.) == 'resubmit'
+
+        # It changes again: alive, whatever the clock of its node says
+        (state, last_heartbeat, last_seen) = check_heartbeat(beat(time_updated=10.), last_heartbeat, last_seen, now=400.)
+        assert state == 'running' and last_seen == 400.
+
+        # Past its deadline: extend. Predicted to overrun the walltime: cancel, if asked to and not done already
+        heartbeat = beat(time_updated=20., time_elapsed=3000., time_remaining=1000.)
+        (state, last_heartbeat, last_seen) = check_heartbeat(heartbeat, last_heartbeat, last_seen, now=deadline + 1.)
+        assert decide_job_action(state, last_heartbeat, deadline, walltime, now=deadline + 1.) == 'extend'
+        assert decide_job_action(state, last_heartbeat, deadline, walltime, now=deadline - 1., cancel_overrunning_jobs=True) == 'cancel'
+        assert decide_job_action(state, last_heartbeat, deadline, walltime, now=deadline - 1., cancel_overrunning_jobs=True, cancel_requested=True) == 'wait'
+
+        # Failed: resubmit right away. Completed or cancelled: wait for the result file until the deadline
+        (state, last_heartbeat, last_seen) = check_heartbeat(beat(job_state='failed', time_updated=30.), last_heartbeat, last_seen, now=500.)
+        assert state == 'failed'
+        assert decide_job_action(state, last_heartbeat, deadline, walltime, now=500.) == 'resubmit'
+        for job_state in ['completed', 'cancelled']:
+            (state, last_heartbeat, last_seen) = check_heartbeat(beat(job_state=job_state, time_updated=40.), last_heartbeat, last_seen, now=600.)
+            assert state == job_state
+            assert decide_job_action(state, last_heartbeat, deadline, walltime, now=600.) == 'wait'
+            assert decide_job_action(state, last_heartbeat, deadline, walltime, now=deadline + 1.) == 'resubmit'
+
+        # A finished job never becomes dead
+        assert check_heartbeat(beat(job_state='completed', time_updated=40.), last_heartbeat, last_seen, now=1e6)[0] == 'completed'
+    finally:
+        shutil.rmtree(directory)
+
+
+def test():
+    '''
+        Check the heartbeats written, and cancellation through the cancel file
+    '''
+
+    import tempfile
+    import shutil
+
+    directory = tempfile.mkdtemp()
+    filename = os.path.join(directory, 'heartbeat.json')
+    cancel_filename = os.path.join(directory, 'cancel')
+
+    try:
+        heartbeat = HeartbeatWriter(filename, interval=0.05, cancel_filename=cancel_filename, status_fct=lambda: dict(job_name='test'))
+        heartbeat.start()
+
+        tracker = progress.Progress(10)
+        tracker.update(5)
+        time.sleep(0.2)
+
+        status = progress.read_heartbeat(filename)
+        assert status['job_state'] == 'running' and status['job_name'] == 'test'
+        assert status['fraction'] == 0.5 and status['peak_rss_mb'] > 0
+        assert status['time_updated'] > status['time_started']
+
+        # Cancel, the loop gets interrupted
+        open(cancel_filename, 'w').close()
+        try:
+            for i in xrange(100):
+                time.sleep(0.02)
+            assert False, 'Not cancelled'
+        except KeyboardInterrupt:
+            assert heartbeat.cancel_requested
+
+        heartbeat.stop(job_state='cancelled')
+        status = progress.read_heartbeat(filename)
+        assert status['job_state'] == 'cancelled'
+
+        # No more beats after stop()
+        time.sleep(0.2)
+        assert progress.read_heartbeat(filename)['time_updated'] == status['time_updated']
+    finally:
+        shutil.rmtree(directory)
+
+
+
+if __name__ == '__main__':
+    test()
+    test_job_monitoring()
@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+utils_instrumentation.py
+
+Lightweight per-stage timers and counters, to see where the time of a run goes.
+
+Stages are named blocks of code, timed with their wall time and number of calls:
+
+    with utils_instrumentation.stage('init_stat_measurer'):
+        stat_meas = StatisticsMeasurer(data_gen)
+
+    @utils_instrumentation.timed('sampler.sample_theta')
+    def sample_theta(self, ...):
+
+Counters (e.g. likelihood evaluations) are added to the total and to all currently active stages:
+
+    utils_instrumentation.count('likelihood_evaluations', datapoints.size*all_angles.size)
+
+Everything is recorded in this process, get_summary() returns it as plain dictionaries/floats
+(JobWrapper stores it with its result), merge_summary() adds the one of another process (e.g. a worker).
+Nested calls of a stage with the same name are timed once.
+
+Created by Loic Matthey on 2015-08-12.
+Copyright (c) 2015 Gatsby Unit. All rights reserved.
+"""
+
+import time
+import functools
+import collections
+
+
+# Global switch, stage() and count() do nothing when False
+_state = dict(enabled=True)
+
+# Stages: name -> dict(time, calls, counts)
+_stages = collections.OrderedDict()
+
+# Currently running stages, name -> depth (to time recursive/nested calls of the same stage once)
+_active_stages = collections.OrderedDict()
+
+# Total of counters, over all stages
+_counters = collections.defaultdict(int)
+
+
+def set_enabled(enabled=True):
+    _state['enabled'] = enabled
+
+
+def reset():
+    '''
+        Forget everything recorded so far (e.g. at the start of a job)
+    '''
+
+    _stages.clear()
+    _active_stages.clear()
+    _counters.clear()
+
+
+class stage(object):
+    '''
+        Context manager timing a stage, see module documentation.
+    '''
+
+    __slots__ = ('name', 'time_start')
+
+    def __init__(self, name):
+        self.name = name
+        self.time_start = None
+
+    def __enter__(self):
+        if not _state['enabled']:
+            return self
+
+        if self.name not in _stages:
+            _stages[self.name] = dict(time=0.0, calls=0, counts=collections.defaultdict(int))
+        _stages[self.name]['calls'] += 1
+
+        depth = _active_stages.get(self.name, 0)
+        _active_stages[self.name] = depth + 1
+        if depth == 0:
+            self.time_start = time.time()
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.name not in _active_stages:
+            # Disabled on enter, or reset() in between
+            return False
+
+        _active_stages[self.name] -= 1
+        if _active_stages[self.name] == 0:
+            del _active_stages[self.name]
+            _stages[self.name]['time'] += time.time() - self.time_start
+
+        return False
+
+
+def timed(name):
+    '''
+        Decorator, timing each call of the function as the stage name
+    '''
+
+    def decorator(fct):
+        @functools.wraps(fct)
+        def timed_fct(*args, **kwargs):
+            with stage(name):
+                return fct(*args, **kwargs)
+
+        return timed_fct
+
+    return decorator
+
+
+def count(name, increment=1):
+    '''
+        Increment a counter, in total and for all active stages
+    '''
+
+    if not _state['enabled']:
+        return
+
+    _counters[name] += increment
+    for stage_name in _active_stages:
+        _stages[stage_name]['counts'][name] += increment
+
+
+def get_summary():
+    '''
+        Everything recorded so far, as plain dictionaries (picklable, JSON-able)
+
+        Returns dict(stages=dict(name -> dict(time, calls, counts=dict)), counters=dict)
+    '''
+
+    stages = collections.OrderedDict()
+    for (name, recorded) in _stages.iteritems():
+        stages[name] = dict(time=recorded['time'], calls=recorded['calls'], counts=dict(recorded['counts']))
+
+    return dict(stages=stages, counters=dict(_counters))
+
+
+def merge_summary(summary):
+    '''
+        Add a summary recorded in another process (e.g. a worker, see utils_parallel.map_cells) to this one.
+
+        Its counters are also added to the stages currently active here (unless they already contain them),
+        as if counted in this process.
+    '''
+
+    if not _state['enabled']:
+        return
+
+    for (name, recorded) in summary['stages'].iteritems():
+        if name not in _stages:
+            _stages[name] = dict(time=0.0, calls=0, counts=collections.defaultdict(int))
+        _stages[name]['time'] += recorded['time']
+        _stages[name]['calls'] += recorded['calls']
+        for (counter, value) in recorded['counts'].iteritems():
+            _stages[name]['counts'][counter] += value
+
+    for (counter, value) in summary['counters'].iteritems():
+        _counters[counter] += value
+        for stage_name in _active_stages:
+            if stage_name not in summary['stages']:
+                _stages[stage_name]['counts'][counter] += value
+
+
+def format_summary(summary=None):
+    '''
+        Table of the stages, slowest first
+    '''
+
+    if summary is None:
+        summary = get_summary()
+
+    lines = ["%-50s %10s %8s  %s" % ('stage', 'time (s)', 'calls', 'counts')]
+    for (name, recorded) in sorted(summary['stages'].items(), key=lambda item: -item[1]['time']):
+        counts_str = ', '.join(["%s=%d" % (counter, value) for (counter, value) in sorted(recorded['counts'].items())])
+        lines.append("%-50s %10.3f %8d  %s" % (name, recorded['time'], recorded['calls'], counts_str))
+
+    return '\n'.join(lines)
+
+
+def test():
+    '''
+        Check times, calls and counts of nested stages
+    '''
+
+    reset()
+
+    @timed('outer')
+    def outer(n):
+        for i in xrange(n):
+            with stage('inner'):
+                count('evaluations', 10)
+                time.sleep(0.01)
+        count('outer_only')
+
+    outer(3)
+    outer(2)
+
+    summary = get_summary()
+
+    assert summary['stages']['outer']['calls'] == 2
+    assert summary['stages']['inner']['calls'] == 5
+    assert summary['stages']['outer']['counts'] == dict(evaluations=50, outer_only=2)
+    assert summary['stages']['inner']['counts'] == dict(evaluations=50)
+    assert summary['counters'] == dict(evaluations=50, outer_only=2)
+    assert 0.05 <= summary['stages']['inner']['time'] <= summary['stages']['outer']['time']
+
+    # Recursive stages are timed once
+    @timed('recursive')
+    def recursive(depth):
+        time.sleep(0.01)
+        if depth > 0:
+            recursive(depth - 1)
+
+    recursive(2)
+    assert get_summary()['stages']['recursive']['calls'] == 3
+    assert get_summary()['stages']['recursive']['time'] < 0.06
+
+    # Disabled, nothing recorded
+    set_enabled(False)
+    outer(1)
+    set_enabled(True)
+    assert get_summary()['stages']['outer']['calls'] == 2
+
+    # Summary of another process, its counters also go to the active stages
+    other_summary = dict(stages=dict(inner=dict(time=1.0, calls=2, counts=dict(evaluations=5))), counters=dict(evaluations=5))
+    with stage('merging'):
+        merge_summary(other_summary)
+    summary = get_summary()
+    assert summary['stages']['inner']['calls'] == 7 and summary['stages']['inner']['time'] >= 1.05
+    assert summary['stages']['inner']['counts']['evaluations'] == 55
+    assert summary['stages']['merging']['counts'] == dict(evaluations=5)
+    assert summary['counters']['evaluations'] == 55
+
+    print format_summary()
+    reset()
+
+
+
+if __name__ == '__main__':
+    test()
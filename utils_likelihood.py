@@ -0,0 +1,872 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+utils_likelihood.py
+
+Batched evaluation of the samplers' Gaussian likelihood, over many datapoints and angles at once.
+
+The samplers define the loglikelihood of one datapoint in loglike_theta_fct_single:
+    -0.5 (x - mean_fixed_contrib - ATtcB mu(theta))^T inv_covariance (x - mean_fixed_contrib - ATtcB mu(theta))
+The functions here compute the same quantity for arrays of datapoints/thetas, with the network
+responses obtained in chunks to bound memory.
+
+inv_covariance can be a dense M x M array, or a LowRankInverseCovariance (diagonal plus rank-k
+approximation of the covariance, see invert_covariance), for which quadratic forms cost O(M k).
+
+Each evaluated likelihood is counted as 'likelihood_evaluations', see utils_instrumentation.
+
+For dense inverses, the likelihood can also be whitened: with inv_covariance = L L^T,
+    x^T inv_covariance x = ||L^T x||^2
+so datapoints are whitened once, and only the network responses are whitened at each evaluation (see whiten).
+
+SamplerLikelihood holds the Sampler methods built on these, shared by both samplers.
+
+Created by Loic Matthey on 2015-07-27.
+Copyright (c) 2015 Gatsby Unit. All rights reserved.
+"""
+
+import numpy as np
+import scipy.special as spsp
+import scipy.linalg as spla
+import scipy.linalg.blas as spblas
+
+import utils_math
+import utils_vonmises
+import utils_instrumentation
+
+
+# Maximum number of elements of the (datapoints x angles x M) network responses arrays held in memory at once
+MAX_CHUNK_ELEMENTS = 2**22
+
+
+class LowRankInverseCovariance(object):
+    '''
+        Inverse of a covariance approximated as diagonal plus low rank: Sigma ~ D + U U^T
+
+        Using Woodbury: Sigma^-1 = D^-1 - V V^T, with V = D^-1 U chol(I + U^T D^-1 U)^-T.
+        Without U, this is a diagonal covariance.
+
+        np.asarray() gives the dense M x M inverse (computed once), so code needing the full matrix still works.
+    '''
+
+    def __init__(self, diagonal, low_rank=None):
+        '''
+            diagonal: M
+            low_rank: M x k, or None
+        '''
+
+        self.diagonal = diagonal
+        self.inv_diagonal = 1./diagonal
+
+        if low_rank is None:
+            low_rank = np.zeros((diagonal.size, 0))
+        self.low_rank = low_rank
+
+        # Cholesky of the k x k capacitance matrix
+        capacitance = np.eye(low_rank.shape[1]) + np.dot(low_rank.T*self.inv_diagonal, low_rank)
+        self.capacitance_cholesky = np.linalg.cholesky(capacitance)
+
+        if low_rank.shape[1] > 0:
+            self.low_rank_inverse = spla.solve_triangular(self.capacitance_cholesky, low_rank.T*self.inv_diagonal, lower=True).T
+        else:
+            self.low_rank_inverse = low_rank
+
+        self.shape = (diagonal.size, diagonal.size)
+        self.rank = low_rank.shape[1]
+        self.dense = None
+
+
+    @classmethod
+    def from_covariance(cls, covariance, rank=0, min_diagonal_ratio=1e-3):
+        '''
+            Approximate a covariance by its top rank eigenvectors, plus a diagonal matching the remaining variances.
+
+            As in probabilistic PCA, the mean of the discarded eigenvalues is removed from the top ones,
+            so a covariance made of an isotropic noise plus a rank k term is recovered exactly.
+            The diagonal is kept above min_diagonal_ratio times the mean variance, so the approximation stays positive definite.
+        '''
+
+        M = covariance.shape[0]
+        rank = min(rank, M - 1)
+
+        if rank > 0:
+            (eigenvalues, eigenvectors) = spla.eigh(covariance, eigvals=(M - rank, M - 1))
+            noise_floor = (np.trace(covariance) - np.sum(eigenvalues))/(M - rank)
+
+            low_rank = eigenvectors*np.sqrt(np.clip(eigenvalues - noise_floor, 0.0, None))
+            low_rank_variances = np.sum(low_rank**2., axis=1)
+        else:
+            low_rank = None
+            low_rank_variances = 0.0
+
+        diagonal = np.diag(covariance) - low_rank_variances
+        diagonal = np.clip(diagonal, min_diagonal_ratio*np.mean(np.diag(covariance)), None)
+
+        return cls(diagonal, low_rank)
+
+
+    def quadratic_form(self, x):
+        '''
+            x^T Sigma^-1 x, along the last axis of x
+        '''
+
+        return np.dot(x**2., self.inv_diagonal) - np.sum(np.dot(x, self.low_rank_inverse)**2., axis=-1)
+
+
+    def dot(self, x):
+        '''
+            Sigma^-1 x, along the last axis of x
+        '''
+
+        return x*self.inv_diagonal - np.dot(np.dot(x, self.low_rank_inverse), self.low_rank_inverse.T)
+
+
+    def get_covariance(self):
+        '''
+            Dense approximated covariance D + U U^T
+        '''
+
+        return np.diag(self.diagonal) + np.dot(self.low_rank, self.low_rank.T)
+
+
+    def log_determinant(self):
+        '''
+            log det of the approximated covariance, by the matrix determinant lemma
+        '''
+
+        return np.sum(np.log(self.diagonal)) + 2.*np.sum(np.log(np.diag(self.capacitance_cholesky)))
+
+
+    def approximation_error(self, covariance):
+        '''
+            Compare the approximation to the exact covariance.
+
+            Returns:
+                - relative_frobenius: ||Sigma - D - U U^T|| / ||Sigma||
+                - kl_divergence: KL(N(0, Sigma) || N(0, D + U U^T)), in nats
+        '''
+
+        relative_frobenius = np.linalg.norm(covariance - self.get_covariance())/np.linalg.norm(covariance)
+
+        # tr(Sigma_approx^-1 Sigma), without forming the dense inverse
+        trace = np.dot(np.diag(covariance), self.inv_diagonal) - np.sum(self.low_rank_inverse*np.dot(covariance, self.low_rank_inverse))
+        kl_divergence = 0.5*(trace - self.shape[0] + self.log_determinant() - np.linalg.slogdet(covariance)[1])
+
+        return dict(relative_frobenius=relative_frobenius, kl_divergence=kl_divergence)
+
+
+    def __array__(self, dtype=None):
+        if self.dense is None:
+            self.dense = np.diag(self.inv_diagonal) - np.dot(self.low_rank_inverse, self.low_rank_inverse.T)
+
+        return np.asarray(self.dense, dtype=dtype)
+
+
+
+def invert_covariance(covariance, structure='full', rank=10):
+    '''
+        Inverse covariance used by the likelihood.
+
+        structure:
+            - full:     dense inverse
+            - diagonal: only keeps the variances
+            - lowrank:  diagonal plus the top rank eigenvectors, see LowRankInverseCovariance
+    '''
+
+    if structure == 'full':
+        return np.linalg.inv(covariance)
+    elif structure == 'diagonal':
+        return LowRankInverseCovariance.from_covariance(covariance, rank=0)
+    elif structure == 'lowrank':
+        return LowRankInverseCovariance.from_covariance(covariance, rank=rank)
+    else:
+        raise ValueError('Unknown covariance structure %s' % structure)
+
+
+def quadratic_form(x, inv_covariance):
+    '''
+        x^T inv_covariance x, along the last axis of x.
+
+        inv_covariance: M x M array, or LowRankInverseCovariance
+    '''
+
+    if isinstance(inv_covariance, LowRankInverseCovariance):
+        return inv_covariance.quadratic_form(x)
+
+    if x.ndim == 1:
+        return np.dot(x, np.dot(inv_covariance, x))
+
+    # np.dot only uses BLAS for matrices
+    x_inv_covariance = np.dot(x.reshape((-1, x.shape[-1])), inv_covariance).reshape(x.shape)
+
+    return np.einsum('...m,...m->...', x, x_inv_covariance)
+
+
+def get_whitening_factor(inv_covariance):
+    '''
+        Lower triangular L, with inv_covariance = L L^T.
+
+        Stored in Fortran order, as used by the triangular BLAS routines in whiten().
+    '''
+
+    return np.asfortranarray(np.linalg.cholesky(np.asarray(inv_covariance)))
+
+
+def whiten(x, whitening_factor):
+    '''
+        L^T x, along the last axis of x.
+
+        Uses triangular BLAS products, half the operations of a dense matrix product.
+    '''
+
+    if x.ndim == 1:
+        return spblas.dtrmv(whitening_factor, x, trans=1, lower=1)
+
+    # (L^T X^T)^T, X^T is Fortran ordered so BLAS works without copies
+    x_2d = np.ascontiguousarray(x, dtype=np.float64).reshape((-1, x.shape[-1]))
+    return spblas.dtrmm(1.0, whitening_factor, x_2d.T, lower=1, trans_a=1).T.reshape(x.shape)
+
+
+def get_network_response_batch(random_network, stimuli_input):
+    '''
+        Network responses for multiple stimuli.
+
+        Uses the batched implementation of the network if it has one, loops otherwise.
+
+        stimuli_input: S x R
+        return: S x M
+    '''
+
+    if hasattr(random_network, 'get_network_response_batch'):
+        return random_network.get_network_response_batch(stimuli_input)
+
+    responses = np.empty((stimuli_input.shape[0], random_network.M))
+    for i in xrange(stimuli_input.shape[0]):
+        responses[i] = random_network.get_network_response(stimuli_input[i])
+
+    return responses
+
+
+def loglike_theta_batch(thetas, datapoints, random_network, ATtcB, mean_fixed_contrib, inv_covariance_fixed_contrib):
+    '''
+        Loglikelihood of each datapoint at its thetas, for K sets of time parameters at once.
+
+        The network response is computed once per datapoint, the K variants of ATtcB/mean_fixed_contrib
+        (e.g. all possible recall times) are applied by broadcasting.
+
+        thetas:             N x R
+        datapoints:         N x M
+        ATtcB:              K, or N x K
+        mean_fixed_contrib: K x M, or N x K x M
+
+        return: N x K
+    '''
+
+    responses = get_network_response_batch(random_network, thetas)
+
+    like_mean = datapoints[:, np.newaxis, :] - mean_fixed_contrib - np.asarray(ATtcB)[..., np.newaxis]*responses[:, np.newaxis, :]
+
+    utils_instrumentation.count('likelihood_evaluations', like_mean.shape[0]*like_mean.shape[1])
+
+    return -0.5*quadratic_form(like_mean, inv_covariance_fixed_contrib)
+
+
+def get_network_response_whitened(random_network, stimuli_input, whitening_factor):
+    '''
+        Whitened network responses for multiple stimuli: L^T mu(theta)
+
+        stimuli_input: S x R
+        return: S x M
+    '''
+
+    return whiten(get_network_response_batch(random_network, stimuli_input), whitening_factor)
+
+
+def loglike_theta_batch_whitened(thetas, datapoints_whitened, random_network, ATtcB, whitening_factor):
+    '''
+        Same as loglike_theta_batch, for whitened datapoints: L^T (datapoint - mean_fixed_contrib).
+
+        thetas:              N x R
+        datapoints_whitened: N x K x M
+        ATtcB:               K, or N x K
+
+        return: N x K
+    '''
+
+    responses_whitened = get_network_response_whitened(random_network, thetas, whitening_factor)
+
+    like_mean = datapoints_whitened - np.asarray(ATtcB)[..., np.newaxis]*responses_whitened[:, np.newaxis, :]
+
+    utils_instrumentation.count('likelihood_evaluations', like_mean.shape[0]*like_mean.shape[1])
+
+    return -0.5*np.sum(like_mean**2., axis=-1)
+
+
+def loglike_theta_fct_single_whitened(new_theta, (thetas, datapoint_whitened, rn, ATtcB, sampled_feature_index, whitening_factor)):
+    '''
+        Same as loglike_theta_fct_single, for a whitened datapoint: L^T (datapoint - mean_fixed_contrib)
+    '''
+
+    # Put the new proposed point correctly
+    thetas[sampled_feature_index] = new_theta
+
+    like_mean = datapoint_whitened - ATtcB*whiten(rn.get_network_response(thetas), whitening_factor)
+
+    utils_instrumentation.count('likelihood_evaluations')
+
+    return -0.5*np.dot(like_mean, like_mean)
+
+
+def marginalise_loglikelihood(loglikelihood, axis=-1):
+    '''
+        Marginalise loglikelihoods over a uniformly distributed variable (e.g. the recall time), along axis.
+
+        log(1/K sum_k exp(loglikelihood_k))
+    '''
+
+    return spsp.logsumexp(loglikelihood, axis=axis) - np.log(loglikelihood.shape[axis])
+
+
+def posterior_curvature_at_maximum(log_posterior, dx):
+    '''
+        Curvature of each log posterior at its maximum: -d^2/dx^2 log p, by finite differences (np.gradient twice).
+
+        Non-finite loglikelihoods are set to the mean of the row, non-finite curvatures are returned as NaN.
+
+        log_posterior: N x A, on a regular grid of step dx
+        return: N
+    '''
+
+    log_posterior = np.atleast_2d(log_posterior)
+    finite = np.isfinite(log_posterior)
+
+    # Center each row on the mean of its finite values
+    with np.errstate(invalid='ignore', divide='ignore'):
+        rows_mean = np.sum(np.where(finite, log_posterior, 0.0), axis=-1, keepdims=True)/np.sum(finite, axis=-1, keepdims=True)
+    log_posterior = np.where(finite, log_posterior - rows_mean, 0.0)
+
+    ml_indices = np.argmax(log_posterior, axis=-1)
+
+    with np.errstate(all='ignore'):
+        curvatures = -np.gradient(np.gradient(log_posterior, axis=-1), axis=-1)/dx**2.
+    curvatures = curvatures[np.arange(log_posterior.shape[0]), ml_indices]
+
+    curvatures[~np.isfinite(curvatures)] = np.nan
+
+    return curvatures
+
+
+def posterior_circular_precision(log_posterior, all_angles):
+    '''
+        Precision of each posterior, 1/(-2 log R), R the mean resultant length of the normalised posterior.
+
+        all_angles is a regular grid over the whole circle (endpoint excluded), so sums are exact periodic integrals.
+        Degenerate posteriors give NaN.
+
+        log_posterior: N x A
+        return: N
+    '''
+
+    log_posterior = np.atleast_2d(log_posterior)
+
+    with np.errstate(all='ignore'):
+        posterior = np.exp(log_posterior - np.max(log_posterior, axis=-1, keepdims=True))
+        posterior /= np.sum(posterior, axis=-1, keepdims=True)
+
+        precisions = 1./(-2.*np.log(np.abs(np.dot(posterior, np.exp(1j*all_angles)))))
+
+    precisions[~np.isfinite(precisions)] = np.nan
+
+    return precisions
+
+
+def loglike_theta_grid(thetas, datapoints, random_network, ATtcB, sampled_feature_index, mean_fixed_contrib, inv_covariance_fixed_contrib, all_angles):
+    '''
+        Loglikelihood of each datapoint, for its sampled feature set to every angle of all_angles.
+
+        Other features are kept to their value in thetas.
+        all_angles can be shared by all datapoints (A), or specific to each of them (N x A).
+
+        thetas:             N x R
+        datapoints:         N x M
+        ATtcB:              N, or scalar
+        mean_fixed_contrib: N x M, or M
+
+        return: N x A
+    '''
+
+    (N, M) = datapoints.shape
+    A = all_angles.shape[-1]
+
+    ATtcB = np.broadcast_to(ATtcB, (N, ))
+    mean_fixed_contrib = np.broadcast_to(mean_fixed_contrib, (N, M))
+
+    loglikelihood = np.empty((N, A))
+    utils_instrumentation.count('likelihood_evaluations', N*A)
+
+    for (chunk, like_mean) in _iterate_network_response_grid(thetas, random_network, sampled_feature_index, all_angles, M):
+        N_chunk = chunk.stop - chunk.start
+
+        # like_mean = datapoint - mean_fixed_contrib - ATtcB*mu(theta), in-place
+        like_mean *= -ATtcB[chunk, np.newaxis, np.newaxis]
+        like_mean += (datapoints[chunk] - mean_fixed_contrib[chunk])[:, np.newaxis, :]
+
+        # Flattened for a single matrix product
+        loglikelihood[chunk] = -0.5*quadratic_form(like_mean.reshape((N_chunk*A, M)), inv_covariance_fixed_contrib).reshape((N_chunk, A))
+
+    return loglikelihood
+
+
+def loglike_theta_grid_whitened(thetas, datapoints_whitened, random_network, ATtcB, sampled_feature_index, whitening_factor, all_angles):
+    '''
+        Same as loglike_theta_grid, for whitened datapoints: L^T (datapoint - mean_fixed_contrib).
+
+        datapoints_whitened: N x M
+
+        return: N x A
+    '''
+
+    (N, M) = datapoints_whitened.shape
+    A = all_angles.shape[-1]
+
+    ATtcB = np.broadcast_to(ATtcB, (N, ))
+
+    loglikelihood = np.empty((N, A))
+    utils_instrumentation.count('likelihood_evaluations', N*A)
+
+    for (chunk, responses) in _iterate_network_response_grid(thetas, random_network, sampled_feature_index, all_angles, M):
+        like_mean = whiten(responses, whitening_factor)
+        like_mean *= -ATtcB[chunk, np.newaxis, np.newaxis]
+        like_mean += datapoints_whitened[chunk, np.newaxis, :]
+
+        loglikelihood[chunk] = -0.5*np.sum(like_mean**2., axis=-1)
+
+    return loglikelihood
+
+
+def _iterate_network_response_grid(thetas, random_network, sampled_feature_index, all_angles, M):
+    '''
+        Network responses for each datapoint, with its sampled feature set to every angle of all_angles.
+
+        Goes over chunks of datapoints to bound memory, yields (chunk slice, responses: N_chunk x A x M).
+    '''
+
+    (N, R) = thetas.shape
+    A = all_angles.shape[-1]
+    all_angles = np.broadcast_to(all_angles, (N, A))
+
+    chunk_size = max(1, MAX_CHUNK_ELEMENTS/(A*M))
+    for start in xrange(0, N, chunk_size):
+        chunk = slice(start, min(start + chunk_size, N))
+        N_chunk = chunk.stop - chunk.start
+
+        # Put the angles at the correct place
+        thetas_chunk = np.repeat(thetas[chunk, np.newaxis, :], A, axis=1)
+        thetas_chunk[:, :, sampled_feature_index] = all_angles[chunk]
+
+        yield (chunk, get_network_response_batch(random_network, thetas_chunk.reshape((N_chunk*A, R))).reshape((N_chunk, A, M)))
+
+
+def convolve_vonmises_fft(values, kappa):
+    '''
+        Circular convolution of values with a Von Mises kernel of concentration kappa, along the last axis.
+
+        values are assumed to be sampled on a regular grid covering [-pi, pi).
+        The discretised kernel is normalised to sum to one, so the total mass along the axis is preserved.
+    '''
+
+    num_points = values.shape[-1]
+    all_angles = np.linspace(-np.pi, np.pi, num_points, endpoint=False)
+
+    # Kernel centered on the first element, so that the result is not shifted
+    kernel = np.fft.ifftshift(utils_vonmises.vonmisespdf(all_angles, 0.0, kappa))
+    kernel /= np.sum(kernel)
+
+    convolved = np.fft.irfft(np.fft.rfft(values, axis=-1)*np.fft.rfft(kernel), n=num_points, axis=-1)
+
+    # Remove small negative values due to roundoff
+    np.clip(convolved, 0.0, None, out=convolved)
+
+    return convolved
+
+
+def convolve_vonmises_fourier(values, kappa, x):
+    '''
+        Circular convolution of values with a Von Mises density of concentration kappa, evaluated at x, along the last axis.
+
+        values: N x A, sampled on a regular grid covering [-pi, pi)
+        x:      N
+
+        Multiplies the Fourier coefficients of values by the exact ones of the Von Mises, I_k(kappa)/I_0(kappa),
+        and sums the resulting Fourier series at x. Unlike convolve_vonmises_fft and interpolate_periodic,
+        this does not discretise the kernel nor interpolate linearly between grid points.
+
+        return: N
+    '''
+
+    num_points = values.shape[-1]
+
+    coefficients = np.fft.rfft(values, axis=-1)/num_points
+    frequencies = np.arange(coefficients.shape[-1])
+    coefficients *= spsp.ive(frequencies, kappa)/spsp.ive(0, kappa)
+
+    # Real series: positive frequencies count for their negative counterpart, except the constant and Nyquist terms
+    weights = np.ones(frequencies.size)*2.
+    weights[0] = 1.
+    if num_points % 2 == 0:
+        weights[-1] = 1.
+
+    phases = np.exp(1j*(np.asarray(x)[:, np.newaxis] + np.pi)*frequencies)
+    output = np.dot(np.real(coefficients*phases), weights)
+
+    # Remove small negative values due to roundoff
+    np.clip(output, 0.0, None, out=output)
+
+    return output
+
+
+def interpolate_periodic(values, x, x_min=-np.pi, period=2.*np.pi):
+    '''
+        Periodic linear interpolation of each row of values, at the corresponding element of x.
+
+        values: N x A, sampled on a regular grid starting at x_min and covering one period
+        x:      N
+
+        return: N
+    '''
+
+    num_points = values.shape[-1]
+    rows = np.arange(values.shape[0])
+
+    position = np.mod(x - x_min, period)*num_points/period
+    position[np.isnan(position)] = 0.0
+
+    index_low = np.floor(position).astype(int)
+    weight_high = position - index_low
+    index_low %= num_points
+    index_high = (index_low + 1) % num_points
+
+    output = (1. - weight_high)*values[rows, index_low] + weight_high*values[rows, index_high]
+    output[np.isnan(x)] = np.nan
+
+    return output
+
+
+class SamplerLikelihood:
+    '''
+        Likelihood methods shared by the Samplers (gibbs_sampler_continuous_fullcollapsed_randomfactorialnetwork
+        and sampler_invtransf_randomfactorialnetwork), which inherit from it.
+
+        Uses the Sampler attributes: NT, N, theta, tc, data_gen, sampled_feature_index, random_network, ATtcB, mean_fixed_contrib,
+        inv_covariance_fixed_contrib, noise_covariance, whitened_likelihood, whitening_factor, NT_whitened and normalization.
+    '''
+
+    def compute_loglikelihood_current_tc(self):
+        '''
+            Compute the loglikelihood for the current setting of thetas and tc and using the likelihood defined in loglike_theta_fct_single
+        '''
+
+        tc = self.tc[:self.N]
+
+        # Batched over datapoints, same as loglike_theta_fct_single
+        if self.whitening_factor is not None:
+            loglikelihood = loglike_theta_batch_whitened(self.theta, self.NT_whitened[tc, np.arange(self.N)][:, np.newaxis], self.random_network, self.ATtcB[tc][:, np.newaxis], self.whitening_factor)[:, 0]
+        else:
+            loglikelihood = loglike_theta_batch(self.theta, self.NT, self.random_network, self.ATtcB[tc][:, np.newaxis], self.mean_fixed_contrib[tc][:, np.newaxis], self.inv_covariance_fixed_contrib)[:, 0]
+
+        loglikelihood -= self.normalization[:self.N]
+
+        return loglikelihood
+
+
+    def compute_loglikelihood_tc_integratedout(self):
+        '''
+            Compute the loglikelihood for the current setting of thetas and using the likelihood defined in loglike_theta_fct_single
+            Integrates tc out.
+
+            Network responses are computed once per datapoint, all recall times are applied by broadcasting.
+
+            return: N x T
+        '''
+
+        if self.whitening_factor is not None:
+            loglikelihood = loglike_theta_batch_whitened(self.theta, np.swapaxes(self.NT_whitened, 0, 1), self.random_network, self.ATtcB, self.whitening_factor)
+        else:
+            loglikelihood = loglike_theta_batch(self.theta, self.NT, self.random_network, self.ATtcB, self.mean_fixed_contrib, self.inv_covariance_fixed_contrib)
+
+        loglikelihood -= self.normalization[:self.N, np.newaxis]
+
+        return loglikelihood
+
+
+    def init_whitening_cache(self):
+        '''
+            Whitened likelihood cache, used if whitened_likelihood is set and the covariance is full.
+
+            With inv_covariance_fixed_contrib = L L^T, stores L and the whitened datapoints for all tc:
+                NT_whitened[t] = L^T (NT - mean_fixed_contrib[t])
+            The likelihood is then -0.5 ||NT_whitened[t] - ATtcB[t] L^T mu(theta)||^2.
+        '''
+
+        self.whitening_factor = None
+        self.NT_whitened = None
+
+        if self.whitened_likelihood and isinstance(self.inv_covariance_fixed_contrib, np.ndarray):
+            self.whitening_factor = get_whitening_factor(self.inv_covariance_fixed_contrib)
+            self.NT_whitened = whiten(self.NT[np.newaxis] - self.mean_fixed_contrib[:, np.newaxis], self.whitening_factor)
+
+
+    def estimate_covariance_approximation_error(self):
+        '''
+            Error made by approximating the likelihood covariance, see covariance_structure.
+
+            Returns dict(relative_frobenius, kl_divergence), both 0 for the full covariance.
+        '''
+
+        if not isinstance(self.inv_covariance_fixed_contrib, LowRankInverseCovariance):
+            return dict(relative_frobenius=0.0, kl_divergence=0.0)
+
+        return self.inv_covariance_fixed_contrib.approximation_error(self.noise_covariance)
+
+
+    def compute_loglikelihood_N_fullspace(self, t=None, all_angles=None, num_points=1000):
+        '''
+            Computes the loglikelihood of all datapoints on the entire space, batched version of compute_loglikelihood_nt_fullspace.
+
+            t: time/item used for each datapoint, scalar or array of size N. Uses the current tc if None.
+
+            return: N x num_points, unnormalised
+        '''
+
+        if all_angles is None:
+            all_angles = np.linspace(-np.pi, np.pi, num_points, endpoint=False)
+
+        if t is None:
+            t = self.tc[:self.N]
+        t = np.broadcast_to(t, (self.N, ))
+
+        return self.compute_loglikelihood_grid(self.data_gen.stimuli_correct[np.arange(self.N), t], np.arange(self.N), t, all_angles)
+
+
+    def compute_loglikelihood_grid(self, thetas, datapoints, tc, all_angles):
+        '''
+            Loglikelihood of the given datapoints, with their sampled feature set to all angles of all_angles.
+
+            thetas: thetas of the datapoints, tc their recall times. Uses the whitened cache if available.
+
+            return: datapoints.size x A, unnormalised
+        '''
+
+        if self.whitening_factor is not None:
+            return loglike_theta_grid_whitened(thetas, self.NT_whitened[tc, datapoints], self.random_network, self.ATtcB[tc], self.sampled_feature_index, self.whitening_factor, all_angles)
+
+        return loglike_theta_grid(thetas, self.NT[datapoints], self.random_network, self.ATtcB[tc], self.sampled_feature_index, self.mean_fixed_contrib[tc], self.inv_covariance_fixed_contrib, all_angles)
+
+
+    @utils_instrumentation.timed('sampler.compute_posterior_statistics')
+    def compute_posterior_statistics(self, datapoints=None, all_angles=None, num_points=500, thetas=None):
+        '''
+            Statistics of the posterior over the sampled feature, other features kept to their correct cued values
+            (or to their values in thetas, of size datapoints.size x R, if given).
+
+            All come from one (datapoints x angles) loglikelihood grid, see compute_loglikelihood_grid:
+                ml_angle:           Max Likelihood angle
+                log_normalization:  log of the integral of the likelihood
+                fisher_info:        curvature of the log posterior at its maximum
+                precision:          circular precision of the posterior
+
+            all_angles should cover [-pi, pi) regularly, endpoint excluded.
+
+            return: dict of arrays of size datapoints.size
+        '''
+
+        if datapoints is None:
+            datapoints = np.arange(self.N)
+        if all_angles is None:
+            all_angles = np.linspace(-np.pi, np.pi, num_points, endpoint=False)
+
+        dx = all_angles[1] - all_angles[0]
+        t = self.tc[datapoints]
+
+        if thetas is None:
+            thetas = self.data_gen.stimuli_correct[datapoints, t]
+
+        log_posterior = self.compute_loglikelihood_grid(thetas, datapoints, t, all_angles)
+
+        return dict(ml_angle=all_angles[np.argmax(np.where(np.isnan(log_posterior), -np.inf, log_posterior), axis=-1)],
+                    log_normalization=marginalise_loglikelihood(log_posterior) + np.log(all_angles.size*dx),
+                    fisher_info=posterior_curvature_at_maximum(log_posterior, dx),
+                    precision=posterior_circular_precision(log_posterior, all_angles))
+
+
+    def compute_log_normalization(self, num_points=500, max_num_points=16000, tolerance=1e-4):
+        '''
+            log of the integral of the likelihood of all datapoints, from their loglikelihood grid (see compute_loglikelihood_grid).
+
+            The periodic trapezoidal rule converges very fast once the grid resolves the posterior. The grid is doubled
+            for datapoints where it and its every other point disagree by more than tolerance, up to max_num_points.
+
+            return: array of size N
+        '''
+
+        log_normalization = np.empty(self.N)
+        datapoints = np.arange(self.N)
+
+        while datapoints.size > 0:
+            all_angles = np.linspace(-np.pi, np.pi, num_points, endpoint=False)
+            log_posterior = self.compute_loglikelihood_grid(self.theta[datapoints], datapoints, self.tc[datapoints], all_angles)
+
+            log_normalization[datapoints] = marginalise_loglikelihood(log_posterior) + np.log(2.*np.pi)
+            log_normalization_coarse = marginalise_loglikelihood(log_posterior[:, ::2]) + np.log(2.*np.pi)
+
+            num_points *= 2
+            if num_points > max_num_points:
+                break
+            datapoints = datapoints[~(np.abs(log_normalization[datapoints] - log_normalization_coarse) <= tolerance)]
+
+        return log_normalization
+
+
+    def compute_loglikelihood_N_convolved_output_noise(self, precision=100, max_precision=16000, tolerance=1e-4):
+        '''
+            Compute the loglikelihood for the current setting of thetas and tc, for the posterior convolved with the output noise.
+
+            Batched over datapoints: all posteriors are computed on a grid of precision points,
+            convolved with the Von Mises output noise in Fourier space and evaluated at the current thetas, see convolve_vonmises_fourier.
+            As in compute_log_normalization, the grid is doubled for datapoints where it and its every other point
+            disagree by more than tolerance, up to max_precision.
+        '''
+
+        loglikelihoods = np.empty(self.N)
+        datapoints = np.arange(self.N)
+        thetas = self.theta[datapoints, self.theta_target_index[:self.N]]
+
+        while datapoints.size > 0:
+            posterior_space = np.linspace(-np.pi, np.pi, precision, endpoint=False)
+            t = self.tc[datapoints]
+
+            loglikelihood_space = self.compute_loglikelihood_grid(self.data_gen.stimuli_correct[datapoints, t], datapoints, t, posterior_space)
+
+            # Remove the max per datapoint before exponentiating, it cancels out with the normalisation
+            posterior_space_N = np.exp(loglikelihood_space - np.max(loglikelihood_space, axis=1)[:, np.newaxis])
+
+            # The convolution preserves the integral of the posterior
+            loglikelihoods[datapoints] = np.log(convolve_vonmises_fourier(posterior_space_N, self.kappa_output, thetas[datapoints])) - np.log(np.mean(posterior_space_N, axis=1)*2.*np.pi)
+            loglikelihoods_coarse = np.log(convolve_vonmises_fourier(posterior_space_N[:, ::2], self.kappa_output, thetas[datapoints])) - np.log(np.mean(posterior_space_N[:, ::2], axis=1)*2.*np.pi)
+
+            precision *= 2
+            if precision > max_precision:
+                break
+            converged = (np.abs(loglikelihoods[datapoints] - loglikelihoods_coarse) <= tolerance) | np.isnan(thetas[datapoints])
+            datapoints = datapoints[~converged]
+
+        return loglikelihoods
+
+
+    def estimate_fisher_info_from_posterior(self, n=0, all_angles=None, num_points=500):
+        '''
+            Look at the curvature of the posterior to estimate the Fisher Information
+        '''
+
+        return self.compute_posterior_statistics(datapoints=np.array([n]), all_angles=all_angles, num_points=num_points)['fisher_info'][0]
+
+
+    def estimate_fisher_info_from_posterior_avg(self, num_points=500, full_stats=False):
+        '''
+            Estimate the Fisher Information from the curvature of the posterior.
+
+            Takes the mean over all datapoints.
+        '''
+
+        mean_FI = self.compute_posterior_statistics(num_points=num_points)['fisher_info']
+
+        if full_stats:
+            return dict(mean=utils_math.nanmean(mean_FI), std=utils_math.nanstd(mean_FI), median=utils_math.nanmedian(mean_FI), all=mean_FI)
+        else:
+            return utils_math.nanmean(mean_FI)
+
+
+    def estimate_precision_from_posterior(self, n=0, num_points=500):
+        '''
+            Look at the posterior to estimate the precision directly
+        '''
+
+        return self.compute_posterior_statistics(datapoints=np.array([n]), num_points=num_points)['precision'][0]
+
+
+    def estimate_precision_from_posterior_avg(self, num_points=500, full_stats=False):
+        '''
+            Estimate the precision from the posterior.
+
+            Takes the mean over all datapoints.
+        '''
+
+        precisions = self.compute_posterior_statistics(num_points=num_points)['precision']
+
+        if full_stats:
+            return dict(mean=utils_math.nanmean(precisions), std=utils_math.nanstd(precisions), median=utils_math.nanmedian(precisions), all=precisions)
+        else:
+            return utils_math.nanmean(precisions)
+
+
+def test():
+    '''
+        Check the FFT convolution and the periodic interpolation
+    '''
+
+    all_angles = np.linspace(-np.pi, np.pi, 200, endpoint=False)
+    dx = all_angles[1] - all_angles[0]
+
+    # Convolving two Von Mises centered on mu1 and 0 gives a peak at mu1
+    values = utils_vonmises.vonmisespdf(all_angles, 1.0, 10.0)[np.newaxis, :]
+    convolved = convolve_vonmises_fft(values, 20.0)
+    assert np.allclose(all_angles[np.argmax(convolved)], 1.0, atol=dx)
+    assert np.allclose(np.sum(convolved), np.sum(values))
+
+    # Fourier convolution, against a direct convolution on a dense grid
+    dense_angles = np.linspace(-np.pi, np.pi, 10000, endpoint=False)
+    x = np.array([1.0, 0.2, -2.5])
+    convolved_dense = np.sum(utils_vonmises.vonmisespdf(dense_angles, 1.0, 10.0)*utils_vonmises.vonmisespdf(x[:, np.newaxis] - dense_angles, 0.0, 20.0), axis=1)*2.*np.pi/dense_angles.size
+    assert np.allclose(convolve_vonmises_fourier(values.repeat(3, axis=0), 20.0, x), convolved_dense, rtol=1e-8, atol=1e-12)
+
+    # Interpolation is exact on the grid, and wraps around
+    values = np.cos(all_angles)[np.newaxis, :].repeat(3, axis=0)
+    x = np.array([all_angles[10], all_angles[10] + 2.*np.pi, np.pi - dx/2.])
+    interpolated = interpolate_periodic(values, x)
+    assert np.allclose(interpolated[:2], np.cos(all_angles[10]))
+    assert np.allclose(interpolated[2], np.cos(np.pi), atol=1e-3)
+
+    # Woodbury inverse matches the dense inverse of the approximated covariance
+    M = 40
+    low_rank = np.random.randn(M, 3)
+    covariance = np.dot(low_rank, low_rank.T) + 0.5*np.eye(M)
+    inv_covariance = invert_covariance(covariance, structure='lowrank', rank=3)
+    x = np.random.randn(5, M)
+    assert np.allclose(np.asarray(inv_covariance), np.linalg.inv(inv_covariance.get_covariance()))
+    assert np.allclose(quadratic_form(x, inv_covariance), quadratic_form(x, np.asarray(inv_covariance)))
+    assert np.allclose(inv_covariance.dot(x), np.dot(x, np.asarray(inv_covariance)))
+    assert np.allclose(inv_covariance.log_determinant(), np.linalg.slogdet(inv_covariance.get_covariance())[1])
+
+    # Whitened quadratic forms
+    whitening_factor = get_whitening_factor(np.linalg.inv(covariance))
+    assert np.allclose(np.sum(whiten(x, whitening_factor)**2., axis=-1), quadratic_form(x, np.linalg.inv(covariance)))
+    assert np.allclose(np.dot(whiten(x[0], whitening_factor), whiten(x[0], whitening_factor)), quadratic_form(x[0], np.linalg.inv(covariance)))
+
+    # Exact for a diagonal plus rank 3 covariance, worse when only keeping the diagonal
+    assert inv_covariance.approximation_error(covariance)['relative_frobenius'] < 1e-10
+    assert np.abs(inv_covariance.approximation_error(covariance)['kl_divergence']) < 1e-8
+    assert invert_covariance(covariance, structure='diagonal').approximation_error(covariance)['kl_divergence'] > 0.1
+
+    # Von Mises posteriors: curvature kappa at the mode, resultant length I1(kappa)/I0(kappa)
+    kappas = np.array([[2.], [10.], [50.]])
+    log_posterior = kappas*np.cos(all_angles - 0.5)
+    log_posterior[0, 3] = np.inf
+    log_posterior[1, 3] = np.nan
+    assert np.allclose(posterior_curvature_at_maximum(log_posterior[1:], dx), kappas[1:, 0], rtol=1e-2)
+    assert np.allclose(posterior_circular_precision(log_posterior[2:], all_angles), 1./(-2.*np.log(spsp.i1(50.)/spsp.i0(50.))))
+    assert np.isnan(posterior_circular_precision(log_posterior[:1], all_angles)[0])
+
+
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+utils_parallel.py
+
+Evaluate independent cells of work (e.g. set sizes, subjects, recall times) in worker processes.
+
+The function is set before the Pool is created, so that forked workers inherit it: it can be a closure
+or a bound method holding networks and Samplers, only cell indices and results are pickled.
+Each cell is seeded from a base seed and its index, so results do not depend on the number of workers.
+
+Workers send back their utils_instrumentation summary with each result, merged here. Their progress
+trackers are not visible to this process (e.g. to its heartbeat), a tracker over the cells is kept instead.
+
+Created by Loic Matthey on 2015-08-03.
+Copyright (c) 2015 Gatsby Unit. All rights reserved.
+"""
+
+import os
+import multiprocessing
+
+import numpy as np
+
+import progress
+import utils_instrumentation
+
+
+# Function and cells shared with the worker processes, see map_cells()
+_cells_shared = dict()
+
+
+def get_nb_processes(nb_processes=None, nb_tasks=None):
+    '''
+        Number of worker processes to use. None or <= 0 uses all CPUs, never more than the number of tasks.
+    '''
+
+    if nb_processes is None or nb_processes <= 0:
+        nb_processes = multiprocessing.cpu_count()
+    if nb_tasks is not None:
+        nb_processes = min(nb_processes, nb_tasks)
+
+    return max(nb_processes, 1)
+
+
+def _apply_cell(task):
+    '''
+        Seed and evaluate one cell. Runs in a worker process (or in this one if not parallel).
+
+        task: (cell_i, seed)
+
+        Returns (cell_i, result, instrumentation summary of the cell if in a worker process, else None)
+    '''
+
+    (cell_i, seed) = task
+
+    in_worker = os.getpid() != _cells_shared['parent_pid']
+    if in_worker:
+        # Do not send back what the parent recorded before forking
+        utils_instrumentation.reset()
+
+    np.random.seed(seed)
+
+    result = _cells_shared['fct'](*_cells_shared['cells'][cell_i])
+
+    if in_worker:
+        return (cell_i, result, utils_instrumentation.get_summary())
+    else:
+        return (cell_i, result, None)
+
+
+def map_cells(fct, cells, nb_processes=1, random_seed=None):
+    '''
+        [fct(*cell) for cell in cells], cells evaluated in parallel worker processes.
+
+        Inputs:
+            - fct: function of the cell arguments. Its results need to be picklable.
+            - cells: list of tuples of arguments
+            - nb_processes: 1 runs everything in this process, changes made by fct to objects are then kept.
+                            None or <= 0 uses all CPUs.
+            - random_seed: base seed of the cells, drawn from np.random if None.
+
+        The global random state is left as if only the base seed had been drawn.
+        Instrumentation recorded by the workers is merged into this process.
+
+        Returns the list of results, in the order of cells.
+    '''
+
+    if random_seed is None:
+        random_seed = np.random.randint(2**30)
+
+    tasks = [(cell_i, random_seed + cell_i) for cell_i in xrange(len(cells))]
+    nb_processes = get_nb_processes(nb_processes, len(tasks))
+
+    random_state = np.random.get_state()
+    _cells_shared.update(fct=fct, cells=list(cells), parent_pid=os.getpid())
+
+    cells_progress = progress.Progress(len(tasks))
+    results = []
+
+    try:
+        if nb_processes > 1:
+            pool = multiprocessing.Pool(processes=nb_processes)
+            try:
+                for result in pool.imap_unordered(_apply_cell, tasks, chunksize=1):
+                    results.append(result)
+                    cells_progress.increment()
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for task in tasks:
+                results.append(_apply_cell(task))
+                cells_progress.increment()
+    finally:
+        _cells_shared.clear()
+        np.random.set_state(random_state)
+
+    for (_, _, summary) in results:
+        if summary is not None:
+            utils_instrumentation.merge_summary(summary)
+
+    # Merge the results, in cells order
+    results = sorted(results, key=lambda res: res[0])
+
+    return [res[1] for res in results]
+
+
+def test():
+    '''
+        Check that results are the same in parallel and serial, and independent of the global random state
+    '''
+
+    offsets = np.arange(5.)
+
+    def fct(i, scale):
+        utils_instrumentation.count('cells_evaluated')
+        return dict(i=i, value=offsets[i] + scale*np.random.randn(3))
+
+    cells = [(i, 2.) for i in xrange(offsets.size)]
+
+    utils_instrumentation.reset()
+    results_serial = map_cells(fct, cells, nb_processes=1, random_seed=10)
+    results_parallel = map_cells(fct, cells, nb_processes=3, random_seed=10)
+
+    # Counted in this process and in the workers
+    assert utils_instrumentation.get_summary()['counters']['cells_evaluated'] == 2*offsets.size
+    utils_instrumentation.reset()
+
+    assert [res['i'] for res in results_parallel] == range(offsets.size)
+    for (res_serial, res_parallel) in zip(results_serial, results_parallel):
+        assert np.allclose(res_serial['value'], res_parallel['value'])
+
+    np.random.seed(1)
+    map_cells(fct, cells, random_seed=10)
+    after_map = np.random.rand()
+    np.random.seed(1)
+    assert after_map == np.random.rand()
+
+
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,334 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+utils_sharedmemory.py
+
+Share networks, covariances and datasets between processes through POSIX shared memory.
+
+Large arrays are copied once into shared memory segments (files in /dev/shm), which worker processes map read-only.
+An object is exported to a small picklable description (SharedMemory.export_object), that workers turn back
+into an equivalent object, whose large arrays are read-only views of the shared segments (import_object).
+Works for the networks, DataGeneratorRFN and StatisticsMeasurer objects, which cannot be pickled directly
+(they hold bound methods and references to each other).
+
+    with SharedMemory() as shared_memory:
+        description = shared_memory.export_object((random_network, data_gen))
+        pool.map(work, [(description, repet_i) for repet_i in xrange(10)])
+
+    def work((description, repet_i)):
+        (random_network, data_gen) = utils_sharedmemory.import_object(description)
+
+Segments are removed when the SharedMemory is released (or deleted, or at exit of the process which created them).
+Workers map each segment once, detach() forgets these mappings when the objects are not needed anymore.
+
+Created by Loic Matthey on 2015-07-29.
+Copyright (c) 2015 Gatsby Unit. All rights reserved.
+"""
+
+import os
+import types
+import atexit
+import tempfile
+import uuid
+import weakref
+
+import numpy as np
+
+
+# Arrays smaller than this (in bytes) are pickled with the description instead
+MIN_SHARED_BYTES = 2**16
+
+# Segments already mapped by this process, by path
+_attached_segments = dict()
+
+# SharedMemory objects of this process not released yet, released at exit
+_live_shared_memories = weakref.WeakSet()
+
+
+def get_shared_memory_directory():
+    '''
+        /dev/shm on Linux (POSIX shared memory). Falls back to the temporary directory elsewhere.
+    '''
+    if os.path.isdir('/dev/shm'):
+        return '/dev/shm'
+    return tempfile.gettempdir()
+
+
+def attach_array(path, dtype, shape):
+    '''
+        Read-only view of an array stored in a shared memory segment.
+
+        Each segment is mapped once per process.
+    '''
+
+    if path not in _attached_segments:
+        _attached_segments[path] = np.memmap(path, dtype=dtype, mode='r', shape=shape).view(np.ndarray)
+
+    return _attached_segments[path]
+
+
+def segment_paths(description):
+    '''
+        Paths of the shared memory segments used by an exported object description
+    '''
+
+    kind = description[0]
+
+    if kind == 'array':
+        return [description[1]]
+    elif kind == 'method':
+        return segment_paths(description[1])
+    elif kind in ('list', 'tuple'):
+        return [path for item in description[1] for path in segment_paths(item)]
+    elif kind == 'dict':
+        return [path for item in description[1].itervalues() for path in segment_paths(item)]
+    elif kind == 'object':
+        return [path for item in description[3].itervalues() for path in segment_paths(item)]
+    else:
+        return []
+
+
+def detach(description=None):
+    '''
+        Forget the segments mapped by this process: those of description (as given to import_object), or all of them.
+
+        Each mapping is closed once the arrays using it are deleted.
+    '''
+
+    if description is None:
+        _attached_segments.clear()
+    else:
+        for path in segment_paths(description):
+            _attached_segments.pop(path, None)
+
+
+def import_object(description, memo=None):
+    '''
+        Rebuild an object exported by SharedMemory.export_object.
+
+        Large arrays are read-only views on the shared segments, everything else is a copy.
+        Objects referenced several times (e.g. data_gen.random_network) are rebuilt once.
+    '''
+
+    if memo is None:
+        memo = dict()
+
+    kind = description[0]
+
+    if kind == 'value':
+        return description[1]
+    elif kind == 'array':
+        return attach_array(*description[1:])
+    elif kind == 'reference':
+        return memo[description[1]]
+    elif kind == 'method':
+        return getattr(import_object(description[1], memo), description[2])
+    elif kind == 'list':
+        return [import_object(item, memo) for item in description[1]]
+    elif kind == 'tuple':
+        return tuple([import_object(item, memo) for item in description[1]])
+    elif kind == 'dict':
+        return dict([(key, import_object(item, memo)) for (key, item) in description[1].iteritems()])
+    elif kind == 'object':
+        (object_id, object_class, object_state) = description[1:]
+
+        # Create the empty instance first, its attributes can refer to it
+        if isinstance(object_class, types.ClassType):
+            new_object = types.InstanceType(object_class)
+        else:
+            new_object = object_class.__new__(object_class)
+        memo[object_id] = new_object
+
+        for (attribute, item) in object_state.iteritems():
+            setattr(new_object, attribute, import_object(item, memo))
+
+        return new_object
+    else:
+        raise ValueError('Unknown description %s' % kind)
+
+
+class SharedMemory(object):
+    '''
+        Owner of shared memory segments.
+
+        Create it in the parent process, export objects, give their descriptions to the workers and release it at the end.
+    '''
+
+    def __init__(self, min_shared_bytes=MIN_SHARED_BYTES, directory=None):
+        self.min_shared_bytes = min_shared_bytes
+
+        if directory is None:
+            directory = get_shared_memory_directory()
+        self.directory = directory
+
+        self.prefix = 'bvwm_%d_%s' % (os.getpid(), uuid.uuid4().hex[:8])
+        self.segments = []
+        self.owner_pid = os.getpid()
+
+        _live_shared_memories.add(self)
+
+
+    def share_array(self, array):
+        '''
+            Copy an array to a new shared memory segment.
+
+            Returns its description: ('array', path, dtype, shape)
+        '''
+
+        path = os.path.join(self.directory, '%s_%d' % (self.prefix, len(self.segments)))
+        self.segments.append(path)
+
+        segment = np.memmap(path, dtype=array.dtype, mode='w+', shape=array.shape)
+        segment[...] = array
+        segment.flush()
+        del segment
+
+        return ('array', path, array.dtype.str, array.shape)
+
+
+    def export_object(self, exported, memo=None):
+        '''
+            Picklable description of an object, its large arrays being moved to shared memory.
+
+            Handles numpy arrays, lists/tuples/dicts, bound methods and instances of (old or new style) classes,
+            recursively. Other values are kept as they are, they need to be picklable.
+        '''
+
+        if memo is None:
+            memo = dict()
+
+        if isinstance(exported, np.ndarray):
+            if exported.nbytes >= self.min_shared_bytes and not exported.dtype.hasobject:
+                if id(exported) not in memo:
+                    memo[id(exported)] = (self.share_array(exported), exported)
+                return memo[id(exported)][0]
+
+            return ('value', exported)
+        elif isinstance(exported, list):
+            return ('list', [self.export_object(item, memo) for item in exported])
+        elif isinstance(exported, tuple):
+            return ('tuple', [self.export_object(item, memo) for item in exported])
+        elif isinstance(exported, dict):
+            return ('dict', dict([(key, self.export_object(item, memo)) for (key, item) in exported.iteritems()]))
+        elif isinstance(exported, types.MethodType) and exported.__self__ is not None:
+            return ('method', self.export_object(exported.__self__, memo), exported.__func__.__name__)
+        elif isinstance(exported, types.InstanceType) or (hasattr(exported, '__dict__') and not isinstance(exported, (type, types.ClassType, types.FunctionType, types.ModuleType, np.generic))):
+            if id(exported) in memo:
+                return ('reference', id(exported))
+            # Keep the object alive, so that its id stays valid while exporting
+            memo[id(exported)] = (None, exported)
+
+            object_state = dict([(attribute, self.export_object(item, memo)) for (attribute, item) in vars(exported).iteritems()])
+
+            return ('object', id(exported), exported.__class__, object_state)
+        else:
+            return ('value', exported)
+
+
+    def release(self):
+        '''
+            Remove all segments. Processes which already mapped them can still use them.
+        '''
+
+        if os.getpid() != self.owner_pid:
+            return
+
+        for path in self.segments:
+            if os.path.exists(path):
+                os.remove(path)
+        self.segments = []
+
+        _live_shared_memories.discard(self)
+
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+    def __del__(self):
+        self.release()
+
+
+def _release_all():
+    '''
+        Release the SharedMemory objects still alive at exit
+    '''
+
+    for shared_memory in list(_live_shared_memories):
+        shared_memory.release()
+
+atexit.register(_release_all)
+
+
+
+def _test_worker((description, stimulus)):
+    '''
+        Rebuild the network and dataset, check they use shared memory
+    '''
+    (random_network, data_gen) = import_object(description)
+
+    assert data_gen.random_network is random_network
+    assert not data_gen.Y.flags.writeable
+
+    result = (random_network.get_network_response(stimulus), data_gen.Y.sum())
+
+    detach(description)
+    assert not any([path in _attached_segments for path in segment_paths(description)])
+
+    return result
+
+
+def test():
+    '''
+        Share a network and its dataset with worker processes, check the results
+    '''
+    import multiprocessing
+    import cPickle as pickle
+
+    from highdimensionnetwork import HighDimensionNetwork
+    from datageneratorrfn import DataGeneratorRFN
+
+    np.random.seed(10)
+
+    random_network = HighDimensionNetwork.create_full_conjunctive(100, R=2, rcscale=2.5)
+    time_weights_parameters = dict(weighting_alpha=1.0, weighting_beta=1.0, specific_weighting=0.1, weight_prior='uniform')
+    data_gen = DataGeneratorRFN(500, 2, random_network, sigma_x=0.1, sigma_y=0.001, sigma_baseline=0.0001, time_weights_parameters=time_weights_parameters, cued_feature_time=1)
+
+    stimuli = np.random.uniform(-np.pi, np.pi, size=(4, 2))
+
+    with SharedMemory(min_shared_bytes=2**12) as shared_memory:
+        description = shared_memory.export_object((random_network, data_gen))
+
+        # Small description, the datasets are in shared memory
+        assert len(pickle.dumps(description, 2)) < data_gen.Y.nbytes/10
+
+        pool = multiprocessing.Pool(processes=2)
+        try:
+            results = pool.map(_test_worker, [(description, stimulus) for stimulus in stimuli])
+        finally:
+            pool.close()
+            pool.join()
+
+        segments = list(shared_memory.segments)
+
+    assert not any([os.path.exists(path) for path in segments])
+
+    # Not referenced anymore once deleted, segments are removed
+    shared_memory = SharedMemory(min_shared_bytes=2**12)
+    shared_memory.export_object(data_gen.Y)
+    segments = list(shared_memory.segments)
+    shared_memory_ref = weakref.ref(shared_memory)
+    del shared_memory
+    assert shared_memory_ref() is None
+    assert not any([os.path.exists(path) for path in segments])
+
+    for (stimulus, (response, Y_sum)) in zip(stimuli, results):
+        assert np.allclose(response, random_network.get_network_response(stimulus))
+        assert np.allclose(Y_sum, data_gen.Y.sum())
+
+
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+utils_surrogate.py
+
+Cheap surrogate models of a fitness function, trained on (parameters, fitness) pairs already evaluated.
+
+Used by SubmitPBS.perform_cma_es_optimization to pre-screen CMA-ES candidates (as in lq-CMA-ES, Hansen 2019):
+only the candidates the surrogate ranks best are really evaluated.
+
+Two models, with the same fit(X, y, center, scales)/predict(X) interface:
+    - QuadraticSurrogate: linear, diagonal quadratic or full quadratic least squares,
+                          the richest model the number of training points allows.
+    - GaussianProcessSurrogate: GP mean with a squared exponential kernel.
+
+Parameters are normalised by (X - center)/scales, with scales e.g. CMA-ES sigma*stds.
+Only the max_points points closest to center are used for training (local model), see select_training_points().
+
+Created by Loic Matthey on 2015-08-24.
+Copyright (c) 2015 Gatsby Unit. All rights reserved.
+"""
+
+import numpy as np
+import scipy.linalg as spla
+import scipy.stats as spst
+
+
+def select_training_points(X, y, center, scales, max_points=None):
+    '''
+        Keep the finite points, at most max_points of them, the closest to center (in normalised distance).
+
+        Returns (X, y) subsets.
+    '''
+
+    X = np.asarray(X, dtype=float)
+    y = np.asarray(y, dtype=float)
+
+    finite = np.isfinite(y) & np.all(np.isfinite(X), axis=1)
+    X = X[finite]
+    y = y[finite]
+
+    if max_points is not None and y.size > max_points:
+        distances = np.sum(((X - center)/scales)**2., axis=1)
+        closest = np.argsort(distances)[:max_points]
+        X = X[closest]
+        y = y[closest]
+
+    return X, y
+
+
+def kendall_tau(predictions, results):
+    '''
+        Rank correlation between predicted and true fitness. nan if it cannot be computed (less than 2 points, constant values).
+    '''
+
+    predictions = np.asarray(predictions, dtype=float)
+    results = np.asarray(results, dtype=float)
+
+    finite = np.isfinite(predictions) & np.isfinite(results)
+    if np.sum(finite) < 2:
+        return np.nan
+
+    return spst.kendalltau(predictions[finite], results[finite])[0]
+
+
+class QuadraticSurrogate(object):
+    '''
+        Quadratic model of the fitness, fit by least squares.
+
+        The model used depends on the number of training points n, for dimension d:
+            - full quadratic if n >= 1.1*(1 + 2d + d(d-1)/2)
+            - diagonal quadratic if n >= 1.1*(1 + 2d)
+            - linear otherwise (needs n >= d + 2)
+    '''
+
+    def __init__(self, ridge=1e-8):
+        self.ridge = ridge
+
+        self.model_type = None
+        self.center = None
+        self.scales = None
+        self.coefficients = None
+        self.nb_training_points = 0
+
+
+    @staticmethod
+    def min_training_points(dimension):
+        return dimension + 2
+
+
+    @staticmethod
+    def nb_coefficients(dimension, model_type):
+        if model_type == 'linear':
+            return 1 + dimension
+        elif model_type == 'diagonal':
+            return 1 + 2*dimension
+        else:
+            return 1 + 2*dimension + dimension*(dimension - 1)/2
+
+
+    def features(self, X):
+        '''
+            Design matrix of the model, on normalised parameters
+        '''
+
+        Z = (np.asarray(X, dtype=float) - self.center)/self.scales
+
+        features = [np.ones((Z.shape[0], 1)), Z]
+        if self.model_type in ('diagonal', 'full'):
+            features.append(Z**2.)
+        if self.model_type == 'full':
+            (rows, cols) = np.triu_indices(Z.shape[1], k=1)
+            features.append(Z[:, rows]*Z[:, cols])
+
+        return np.hstack(features)
+
+
+    def fit(self, X, y, center, scales):
+        X = np.asarray(X, dtype=float)
+        y = np.asarray(y, dtype=float)
+        dimension = X.shape[1]
+
+        if y.size < self.min_training_points(dimension):
+            raise ValueError('Not enough points for a QuadraticSurrogate: %d, need %d' % (y.size, self.min_training_points(dimension)))
+
+        self.center = np.asarray(center, dtype=float)
+        self.scales = np.asarray(scales, dtype=float)
+        self.nb_training_points = y.size
+
+        if y.size >= 1.1*self.nb_coefficients(dimension, 'full'):
+            self.model_type = 'full'
+        elif y.size >= 1.1*self.nb_coefficients(dimension, 'diagonal'):
+            self.model_type = 'diagonal'
+        else:
+            self.model_type = 'linear'
+
+        # Ridge-regularised least squares, the intercept is not penalised
+        features = self.features(X)
+        regulariser = self.ridge*np.eye(features.shape[1])
+        regulariser[0, 0] = 0.0
+        self.coefficients = np.linalg.solve(np.dot(features.T, features) + regulariser, np.dot(features.T, y))
+
+        return self
+
+
+    def predict(self, X):
+        return np.dot(self.features(X), self.coefficients)
+
+
+class GaussianProcessSurrogate(object):
+    '''
+        Mean of a Gaussian process with squared exponential kernel.
+
+        Targets are standardised, the length scale is the median distance between normalised training points.
+    '''
+
+    def __init__(self, noise=1e-6):
+        self.noise = noise
+
+        self.model_type = 'gp'
+        self.nb_training_points = 0
+        self.center = None
+        self.scales = None
+        self.Z_training = None
+        self.length_scale = None
+        self.alpha = None
+        self.y_mean = 0.0
+        self.y_std = 1.0
+
+
+    @staticmethod
+    def min_training_points(dimension):
+        return 3
+
+
+    def kernel(self, Z1, Z2):
+        distances_sq = np.sum(Z1**2., axis=1)[:, np.newaxis] + np.sum(Z2**2., axis=1)[np.newaxis, :] - 2.*np.dot(Z1, Z2.T)
+        return np.exp(-0.5*np.maximum(distances_sq, 0.0)/self.length_scale**2.)
+
+
+    def fit(self, X, y, center, scales):
+        X = np.asarray(X, dtype=float)
+        y = np.asarray(y, dtype=float)
+
+        if y.size < self.min_training_points(X.shape[1]):
+            raise ValueError('Not enough points for a GaussianProcessSurrogate: %d' % y.size)
+
+        self.center = np.asarray(center, dtype=float)
+        self.scales = np.asarray(scales, dtype=float)
+        self.nb_training_points = y.size
+        self.Z_training = (X - self.center)/self.scales
+
+        self.y_mean = np.mean(y)
+        self.y_std = np.std(y)
+        if self.y_std <= 0:
+            self.y_std = 1.0
+
+        pairwise_distances = np.sqrt(np.sum((self.Z_training[:, np.newaxis] - self.Z_training[np.newaxis])**2., axis=-1))
+        self.length_scale = np.median(pairwise_distances[np.triu_indices(y.size, k=1)])
+        if self.length_scale <= 0:
+            self.length_scale = 1.0
+
+        K = self.kernel(self.Z_training, self.Z_training) + self.noise*np.eye(y.size)
+        self.alpha = spla.cho_solve(spla.cho_factor(K, lower=True), (y - self.y_mean)/self.y_std)
+
+        return self
+
+
+    def predict(self, X):
+        Z = (np.asarray(X, dtype=float) - self.center)/self.scales
+        return self.y_mean + self.y_std*np.dot(self.kernel(Z, self.Z_training), self.alpha)
+
+
+def create_surrogate(model='quadratic'):
+    '''
+        Instantiate a surrogate: 'quadratic' or 'gp'
+    '''
+
+    if model == 'quadratic':
+        return QuadraticSurrogate()
+    elif model == 'gp':
+        return GaussianProcessSurrogate()
+    else:
+        raise ValueError('Unknown surrogate model %s' % model)
+
+
+def test():
+    '''
+        Each surrogate model should rank new points nearly perfectly on a fitness it can represent
+    '''
+
+    np.random.seed(10)
+
+    dimension = 3
+    rotation = np.linalg.qr(np.random.randn(dimension, dimension))[0]
+    optimum = np.array([0.3, -0.2, 0.5])
+    fitness = lambda X: np.sum(np.dot(X - optimum, rotation)**2.*np.array([1., 4., 10.]), axis=1)
+    fitness_separable = lambda X: np.sum((X - optimum)**2.*np.array([1., 4., 10.]), axis=1)
+    fitness_linear = lambda X: np.dot(X, np.array([1., -2., 0.5]))
+
+    center = np.zeros(dimension)
+    scales = np.ones(dimension)
+
+    X_training = np.random.randn(60, dimension)
+    X_test = np.random.randn(20, dimension)
+
+    # Farthest points are dropped, as are nans
+    y_training = fitness(X_training)
+    y_training[0] = np.nan
+    (X_local, y_local) = select_training_points(X_training, y_training, center, scales, max_points=40)
+    assert y_local.size == 40 and np.all(np.isfinite(y_local))
+    assert np.max(np.sum(X_local**2., axis=1)) <= np.sort(np.sum(X_training[1:]**2., axis=1))[39] + 1e-10
+
+    # Full quadratic: rotated ellipsoid
+    quadratic = create_surrogate('quadratic').fit(X_local, y_local, center, scales)
+    assert quadratic.model_type == 'full'
+    assert np.allclose(quadratic.predict(X_test), fitness(X_test), atol=1e-4)
+    tau_full = kendall_tau(quadratic.predict(X_test), fitness(X_test))
+
+    # Fewer points, diagonal quadratic: axis-aligned ellipsoid
+    quadratic_diag = create_surrogate('quadratic').fit(X_training[:8], fitness_separable(X_training[:8]), center, scales)
+    assert quadratic_diag.model_type == 'diagonal'
+    tau_diagonal = kendall_tau(quadratic_diag.predict(X_test), fitness_separable(X_test))
+
+    # Even fewer points, linear: hyperplane
+    quadratic_linear = create_surrogate('quadratic').fit(X_training[:5], fitness_linear(X_training[:5]), center, scales)
+    assert quadratic_linear.model_type == 'linear'
+    tau_linear = kendall_tau(quadratic_linear.predict(X_test), fitness_linear(X_test))
+
+    gp = create_surrogate('gp').fit(X_local, y_local, center, scales)
+    tau_gp = kendall_tau(gp.predict(X_test), fitness(X_test))
+
+    print "Kendall tau, full quadratic: %.2f, diagonal: %.2f, linear: %.2f, GP: %.2f" % (tau_full, tau_diagonal, tau_linear, tau_gp)
+    assert tau_full > 0.95, tau_full
+    assert tau_diagonal > 0.95, tau_diagonal
+    assert tau_linear > 0.95, tau_linear
+    assert tau_gp > 0.6, tau_gp
+
+    assert np.isnan(kendall_tau([1.], [2.]))
+
+
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+utils_vonmises.py
+
+Von Mises kernels shared by the EM mixture models and the directional statistics.
+
+Densities are computed in log-space with the exponentially scaled Bessel function i0e,
+so they stay finite for any concentration (no overflow of I0(kappa) above kappa ~700).
+All functions accept an out= buffer, to be filled in-place, and a dtype (e.g. np.float32).
+
+Created by Loic Matthey on 2015-07-23.
+Copyright (c) 2015 Gatsby Unit. All rights reserved.
+"""
+
+import numpy as np
+import scipy.special as spsp
+
+
+def _get_output(x, out=None, dtype=None):
+    '''
+        Return the buffer to write into: out if provided, else a new array of the appropriate shape/dtype.
+    '''
+    if out is None:
+        if dtype is None:
+            dtype = np.result_type(x, np.float64)
+        out = np.empty(np.shape(x), dtype=dtype)
+
+    return out
+
+
+def wrap(angles, out=None, max_angle=np.pi):
+    '''
+        Wrap angles in a -max_angle:max_angle space
+
+        Can be done in-place by using out=angles.
+    '''
+
+    if out is None:
+        return np.mod(angles + max_angle, 2.*max_angle) - max_angle
+
+    np.add(angles, max_angle, out=out)
+    np.mod(out, 2.*max_angle, out=out)
+    out -= max_angle
+
+    return out
+
+
+def log_i0(kappa):
+    '''
+        Log of the modified Bessel function I0, stable for large kappa.
+
+        log I0(kappa) = log i0e(kappa) + kappa
+    '''
+    return np.log(spsp.i0e(kappa)) + np.abs(kappa)
+
+
+def vonmises_lognorm(kappa):
+    '''
+        Scaled log-normaliser of a Von Mises: log(2 pi I0(kappa)) - kappa
+    '''
+    return np.log(2.*np.pi*spsp.i0e(kappa))
+
+
+def vonmises_logpdf_cos(cos_x, kappa, out=None, dtype=None):
+    '''
+        Von Mises log PDF, from precomputed cos(x - mu).
+
+        Useful when x - mu does not change between calls (e.g. errors in EM loops).
+        kappa can be a scalar or an array broadcastable to cos_x.
+    '''
+    out = _get_output(cos_x, out=out, dtype=dtype)
+
+    np.subtract(cos_x, 1., out=out)
+    out *= kappa
+    out -= vonmises_lognorm(kappa)
+
+    return out
+
+
+def vonmisespdf_cos(cos_x, kappa, out=None, dtype=None):
+    '''
+        Von Mises PDF, from precomputed cos(x - mu).
+    '''
+    out = vonmises_logpdf_cos(cos_x, kappa, out=out, dtype=dtype)
+    np.exp(out, out=out)
+
+    return out
+
+
+def vonmises_logpdf(x, mu, kappa, out=None, dtype=None):
+    '''
+        Von Mises log PDF
+
+        x: array of angles
+        mu: mean (scalar or broadcastable to x)
+        kappa: concentration (scalar or broadcastable to x)
+    '''
+    out = _get_output(x, out=out, dtype=dtype)
+
+    np.subtract(x, mu, out=out)
+    np.cos(out, out=out)
+
+    return vonmises_logpdf_cos(out, kappa, out=out)
+
+
+def vonmisespdf(x, mu, kappa, out=None, dtype=None):
+    '''
+        Von Mises PDF, stable for all kappa.
+    '''
+    out = vonmises_logpdf(x, mu, kappa, out=out, dtype=dtype)
+    np.exp(out, out=out)
+
+    return out
+
+
+def test():
+    '''
+        Check kernels against scipy, and stability at large kappa
+    '''
+    import scipy.stats as spst
+
+    x = np.linspace(-np.pi, np.pi, 101)
+
+    assert np.allclose(vonmisespdf(x, 0.3, 0.0), 1./(2.*np.pi))
+    for kappa in [0.1, 5.0, 300.]:
+        assert np.allclose(vonmisespdf(x, 0.3, kappa), spst.vonmises.pdf(x, kappa, loc=0.3))
+
+    # Large kappa: should be finite and close to a Normal with variance 1/kappa
+    kappa = 10000.
+    pdf = vonmisespdf(x, 0.0, kappa)
+    assert np.all(np.isfinite(pdf))
+    assert np.allclose(pdf[50], np.sqrt(kappa/(2.*np.pi)), rtol=1e-4)
+
+    # In-place and float32 paths
+    buffer_out = np.empty(x.size, dtype=np.float32)
+    vonmisespdf(x, 0.0, 5.0, out=buffer_out)
+    assert buffer_out.dtype == np.float32
+    assert np.allclose(buffer_out, spst.vonmises.pdf(x, 5.0), rtol=1e-5)
+
+    # Broadcasting kappas across columns
+    kappas = np.array([1.0, 10.0])
+    pdf_cols = vonmisespdf_cos(np.cos(x)[:, np.newaxis]*np.ones((1, 2)), kappas)
+    assert np.allclose(pdf_cols[:, 1], spst.vonmises.pdf(x, 10.0))
+
+    assert np.allclose(wrap(x + 4.*np.pi), wrap(x))
+
+
+
+if __name__ == '__main__':
+    test()